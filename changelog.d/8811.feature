@@ -0,0 +1 @@
+Speed up push rule evaluation in large rooms by compiling push rules and sharing the evaluation of identical rule sets between users.
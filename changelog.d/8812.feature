@@ -0,0 +1 @@
+Maintain per-room unread counts incrementally, rather than counting push actions each time they are requested.
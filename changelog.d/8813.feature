@@ -0,0 +1 @@
+Add options to keep push gateway connections alive, limit concurrent requests to each gateway, and batch notifications to multiple devices, along with per-gateway metrics.
@@ -0,0 +1 @@
+Fetch push actions for many HTTP pushers in a single query, limit the number of pushers processing at once, and export the age of each pusher's backlog.
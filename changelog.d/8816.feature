@@ -0,0 +1 @@
+Send batches of replication rows as a single command, and deduplicate cache invalidations received over replication.
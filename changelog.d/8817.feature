@@ -0,0 +1 @@
+Reduce the number of redis round trips during replication by pipelining publishes, and send each replication stream on its own redis channel.
@@ -0,0 +1 @@
+Catch up with replication streams using adaptively sized, prefetched pages, add catch-up progress metrics, and add a `/ready` endpoint to workers which reports whether they have caught up.
@@ -0,0 +1 @@
+Encode large JSON responses on a thread, using the faster one-shot encoder, so that they don't block the reactor.
@@ -0,0 +1 @@
+Compress client and federation API responses with gzip or deflate, negotiated with `Accept-Encoding`, and accept compressed federation request bodies.
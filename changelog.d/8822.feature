@@ -0,0 +1 @@
+Make the outbound federation connection pool configurable, and add metrics on connection reuse and TLS handshakes.
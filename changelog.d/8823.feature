@@ -0,0 +1 @@
+Parse the response to `/send_join` incrementally as it arrives, if `ijson` is installed, and limit the size of federation responses.
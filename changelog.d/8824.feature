@@ -0,0 +1 @@
+Limit the size of outbound federation transactions based on how quickly each destination accepts them, optionally gzip them, and add metrics on transaction size, response time and queue age.
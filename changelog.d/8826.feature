@@ -0,0 +1 @@
+Wake destinations needing federation catch-up after startup in prioritised batches, and add catch-up progress metrics.
@@ -0,0 +1 @@
+Record each change to a user's devices once, rather than once per remote server, when queueing device list updates for federation.
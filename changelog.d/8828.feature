@@ -0,0 +1 @@
+Claim one-time keys for many devices in a single database transaction, and combine concurrent requests for keys to the same remote server.
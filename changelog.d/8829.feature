@@ -0,0 +1 @@
+Fetch and delete to-device messages for all of a user's syncing devices together, skip devices with no new messages, and clear out messages for deleted (and optionally inactive) devices.
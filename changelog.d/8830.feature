@@ -0,0 +1 @@
+Work out the destinations for outgoing presence updates in bulk, and send each update to each server at most once. Add experimental support for sharding presence by user across multiple workers.
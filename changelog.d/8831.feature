@@ -0,0 +1 @@
+Schedule a single presence timer per user for the time their presence may next change, rather than several overlapping timers.
@@ -0,0 +1 @@
+Batch outgoing typing notifications per room, and share the typing event for a room between syncs.
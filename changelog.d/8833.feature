@@ -0,0 +1 @@
+Cache verify keys and verified signatures in memory, to avoid repeated database lookups and signature checks when verifying the same objects.
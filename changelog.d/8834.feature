@@ -0,0 +1 @@
+Backfill history ahead of clients paginating backwards in rooms with missing history.
@@ -168,7 +168,7 @@ class SynapseHomeServer(HomeServer):
 
         Args:
             name (str): named resource: one of "client", "federation", etc
-            compress (bool): whether to enable gzip compression for this
+            compress (bool): whether to enable HTTP compression for this
                 resource
 
         Returns:
@@ -178,7 +178,7 @@ class SynapseHomeServer(HomeServer):
         if name == "client":
             client_resource = ClientRestResource(self)
             if compress:
-                client_resource = gz_wrap(client_resource)
+                client_resource.enable_compression()
 
             resources.update(
                 {
@@ -220,7 +220,11 @@ class SynapseHomeServer(HomeServer):
             resources.update({"/_matrix/consent": consent_resource})
 
         if name == "federation":
-            resources.update({FEDERATION_PREFIX: TransportLayerServer(self)})
+            federation_resource = TransportLayerServer(self)
+            if compress:
+                federation_resource.enable_compression()
+
+            resources.update({FEDERATION_PREFIX: federation_resource})
 
         if name == "openid":
             resources.update(
@@ -61,6 +61,33 @@ class FederationConfig(Config):
         )
         self.federation_metrics_domains = set(federation_metrics_domains)
 
+        compress_transactions_to = (
+            config.get("federation_compress_transactions_to") or []
+        )
+        validate_config(
+            _METRICS_FOR_DOMAINS_SCHEMA,
+            compress_transactions_to,
+            ("federation_compress_transactions_to",),
+        )
+        self.federation_compress_transactions_to = set(compress_transactions_to)
+
+        connection_pool = config.get("federation_client_connection_pool") or {}
+        self.federation_client_max_idle_connections_per_host = connection_pool.get(
+            "max_idle_connections_per_host", 5
+        )
+        if (
+            not isinstance(self.federation_client_max_idle_connections_per_host, int)
+            or self.federation_client_max_idle_connections_per_host < 1
+        ):
+            raise ConfigError(
+                "federation_client_connection_pool.max_idle_connections_per_host "
+                "must be a positive integer"
+            )
+
+        self.federation_client_idle_connection_timeout_ms = self.parse_duration(
+            connection_pool.get("idle_timeout", "2m")
+        )
+
     def generate_config_section(self, config_dir_path, server_name, **kwargs):
         return """\
         ## Federation ##
@@ -107,6 +134,30 @@ class FederationConfig(Config):
         #federation_metrics_domains:
         #  - matrix.org
         #  - example.com
+
+        # Compress the bodies of the transactions we send to the following domains
+        # with gzip. This reduces bandwidth at the cost of some CPU, but must only
+        # be enabled for servers which are known to accept compressed requests.
+        #
+        # By default, transactions are not compressed.
+        #
+        #federation_compress_transactions_to:
+        #  - example.com
+
+        # Outbound federation requests are sent over persistent HTTP connections,
+        # which are kept open between requests to avoid repeating the TCP and TLS
+        # handshakes.
+        #
+        federation_client_connection_pool:
+          # The maximum number of idle connections to keep open to each
+          # destination. Busy destinations may have more connections open while
+          # requests are in flight. Defaults to 5.
+          #
+          #max_idle_connections_per_host: 10
+
+          # How long an idle connection is kept open for. Defaults to 2m.
+          #
+          #idle_timeout: 5m
         """
 
 
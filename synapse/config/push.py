@@ -24,6 +24,16 @@ class PushConfig(Config):
         push_config = config.get("push", {})
         self.push_include_content = push_config.get("include_content", True)
 
+        self.push_gateway_max_concurrent_requests = push_config.get(
+            "gateway_max_concurrent_requests", 50
+        )
+        self.push_gateway_max_idle_connections = push_config.get(
+            "gateway_max_idle_connections"
+        )
+        self.push_gateway_batch_delay_ms = push_config.get("gateway_batch_delay_ms", 0)
+
+        self.pusher_processing_lanes = push_config.get("processing_lanes", 100)
+
         pusher_instances = config.get("pusher_instances") or []
         self.pusher_shard_config = ShardedWorkerHandlingConfig(pusher_instances)
 
@@ -63,4 +73,28 @@ class PushConfig(Config):
         #
         #push:
         #  include_content: true
+        #
+        #  # The maximum number of concurrent requests to send to each push
+        #  # gateway. Defaults to 50.
+        #  #
+        #  gateway_max_concurrent_requests: 50
+        #
+        #  # The number of idle connections to keep open to each push gateway,
+        #  # so that they can be reused for later notifications. Defaults to a
+        #  # value based on the global cache factor.
+        #  #
+        #  gateway_max_idle_connections: 100
+        #
+        #  # If set, identical notifications for several of a user's devices on
+        #  # the same push gateway which are sent within this many milliseconds
+        #  # of each other are combined into a single request. Defaults to 0,
+        #  # which disables batching.
+        #  #
+        #  gateway_batch_delay_ms: 10
+        #
+        #  # The maximum number of HTTP pushers which can be fetching
+        #  # notifications from the database at once on this worker. Defaults
+        #  # to 100.
+        #  #
+        #  processing_lanes: 100
         """
@@ -248,6 +248,18 @@ class ServerConfig(Config):
         else:
             self.user_ips_max_age = None
 
+        # How long a device can go unused before messages queued for it are
+        # deleted.
+        to_device_inactive_device_max_age = config.get(
+            "to_device_inactive_device_max_age"
+        )
+        if to_device_inactive_device_max_age is not None:
+            self.to_device_inactive_device_max_age = self.parse_duration(
+                to_device_inactive_device_max_age
+            )
+        else:
+            self.to_device_inactive_device_max_age = None
+
         # Options to disable HS
         self.hs_disabled = config.get("hs_disabled", False)
         self.hs_disabled_message = config.get("hs_disabled_message", "")
@@ -446,6 +458,17 @@ class ServerConfig(Config):
             **(config.get("limit_remote_rooms") or {})
         )
 
+        # Settings for resources with `compress` enabled.
+        http_compression = config.get("http_compression") or {}
+        self.http_compression_min_length = self.parse_size(
+            http_compression.get("min_length", "1K")
+        )
+        self.http_compression_level = http_compression.get("level", 6)
+        if not isinstance(self.http_compression_level, int) or not (
+            1 <= self.http_compression_level <= 9
+        ):
+            raise ConfigError("http_compression.level must be between 1 and 9")
+
         bind_port = config.get("bind_port")
         if bind_port:
             if config.get("no_tls", False):
@@ -781,6 +804,8 @@ class ServerConfig(Config):
         #           valid resource names.
         #
         #       compress: set to true to enable HTTP compression for this resource.
+        #           Only supported by the 'client', 'consent' and 'federation'
+        #           resources. See also 'http_compression' below.
         #
         #   additional_resources: Only valid for an 'http' listener. A map of
         #        additional endpoints which should be loaded via dynamic modules.
@@ -843,6 +868,21 @@ class ServerConfig(Config):
           #  bind_addresses: ['::1', '127.0.0.1']
           #  type: manhole
 
+        # Settings for resources with 'compress' enabled in 'listeners' above.
+        #
+        # JSON responses are compressed with gzip or deflate, if the requester
+        # supports it, on a thread so as not to block other requests.
+        #
+        http_compression:
+          # Responses smaller than this are sent uncompressed. Defaults to 1K.
+          #
+          #min_length: 4K
+
+          # The compression level to use, from 1 (fastest) to 9 (smallest).
+          # Defaults to 6.
+          #
+          #level: 4
+
         # Forward extremities can build up in a room due to networking delays between
         # homeservers. Once this happens in a large room, calculation of the state of
         # that room can become quite expensive. To mitigate this, once the number of
@@ -962,6 +1002,15 @@ class ServerConfig(Config):
         #
         #user_ips_max_age: 14d
 
+        # How long a device can go without being used before any to-device
+        # messages waiting for it are deleted. Messages for devices which
+        # have been deleted are always cleared out.
+        #
+        # Defaults to `null`, meaning that messages are kept until the device
+        # collects them.
+        #
+        #to_device_inactive_device_max_age: 90d
+
         # Message retention policy at the server level.
         #
         # Room admins and mods can define a retention period for their rooms using the
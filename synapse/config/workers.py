@@ -47,12 +47,16 @@ class WriterLocations:
     Attributes:
         events: The instances that write to the event and backfill streams.
         typing: The instance that writes to the typing stream.
+        presence: The instances that write to the presence stream.
     """
 
     events = attr.ib(
         default=["master"], type=List[str], converter=_instance_to_list_converter
     )
     typing = attr.ib(default="master", type=str)
+    presence = attr.ib(
+        default=["master"], type=List[str], converter=_instance_to_list_converter
+    )
 
 
 class WorkerConfig(Config):
@@ -89,6 +93,16 @@ class WorkerConfig(Config):
 
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
 
+        # The replication streams which must have caught up before the worker
+        # reports itself as ready on its readiness endpoint. None means all streams.
+        readiness_streams = config.get("worker_readiness_streams")
+        if readiness_streams is not None and (
+            not isinstance(readiness_streams, list)
+            or not all(isinstance(s, str) for s in readiness_streams)
+        ):
+            raise ConfigError("worker_readiness_streams must be a list of strings")
+        self.worker_readiness_streams = readiness_streams
+
         # This option is really only here to support `--manhole` command line
         # argument.
         manhole = config.get("worker_manhole")
@@ -119,9 +133,9 @@ class WorkerConfig(Config):
         writers = config.get("stream_writers") or {}
         self.writers = WriterLocations(**writers)
 
-        # Check that the configured writers for events and typing also appears in
-        # `instance_map`.
-        for stream in ("events", "typing"):
+        # Check that the configured writers for events, typing and presence also
+        # appear in `instance_map`.
+        for stream in ("events", "typing", "presence"):
             instances = _instance_to_list_converter(getattr(self.writers, stream))
             for instance in instances:
                 if instance != "master" and instance not in self.instance_map:
@@ -131,6 +145,7 @@ class WorkerConfig(Config):
                     )
 
         self.events_shard_config = ShardedWorkerHandlingConfig(self.writers.events)
+        self.presence_shard_config = ShardedWorkerHandlingConfig(self.writers.presence)
 
         # Whether this worker should run background tasks or not.
         #
@@ -174,12 +189,13 @@ class WorkerConfig(Config):
         #    port: 8034
 
         # Experimental: When using workers you can define which workers should
-        # handle event persistence and typing notifications. Any worker
+        # handle event persistence, typing notifications and presence. Any worker
         # specified here must also be in the `instance_map`.
         #
         #stream_writers:
         #  events: worker1
         #  typing: worker1
+        #  presence: worker1
 
         # The worker that is used to run background tasks (e.g. cleaning up expired
         # data). If not provided this defaults to the main process.
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import logging
+import time
 
+from prometheus_client import Counter, Histogram
 from service_identity import VerificationError
 from service_identity.pyopenssl import verify_hostname, verify_ip_address
 from zope.interface import implementer
@@ -34,6 +36,16 @@ from twisted.web.iweb import IPolicyForHTTPS
 
 logger = logging.getLogger(__name__)
 
+tls_handshakes_counter = Counter(
+    "synapse_http_client_tls_handshakes",
+    "Number of TLS handshakes completed for outbound connections",
+)
+
+tls_handshake_duration_histogram = Histogram(
+    "synapse_http_client_tls_handshake_duration_seconds",
+    "Time taken to complete TLS handshakes for outbound connections",
+)
+
 
 _TLS_VERSION_MAP = {
     "1": TLSVersion.TLSv1_0,
@@ -183,6 +195,8 @@ def _context_info_cb(ssl_connection, where, ret):
     # a TLSMemoryBIOProtocol object. (This is done by SSLClientConnectionCreator)
     tls_protocol = ssl_connection.get_app_data()
     try:
+        _record_handshake_time(tls_protocol, where)
+
         # ... we further assume that SSLClientConnectionCreator has set the
         # '_synapse_tls_verifier' attribute to a ConnectionVerifier object.
         tls_protocol._synapse_tls_verifier.verify_context_info_cb(ssl_connection, where)
@@ -192,6 +206,24 @@ def _context_info_cb(ssl_connection, where, ret):
         tls_protocol.failVerification(f)
 
 
+def _record_handshake_time(tls_protocol, where):
+    """Track how long the TLS handshake on a connection takes.
+
+    Only the initial handshake is recorded: with TLSv1.3, OpenSSL may report
+    post-handshake messages as further handshakes.
+    """
+    if where & SSL.SSL_CB_HANDSHAKE_START:
+        if not hasattr(tls_protocol, "_synapse_tls_handshake_start"):
+            setattr(tls_protocol, "_synapse_tls_handshake_start", time.monotonic())
+
+    if where & SSL.SSL_CB_HANDSHAKE_DONE:
+        start = getattr(tls_protocol, "_synapse_tls_handshake_start", None)
+        if start is not None:
+            tls_handshakes_counter.inc()
+            tls_handshake_duration_histogram.observe(time.monotonic() - start)
+            setattr(tls_protocol, "_synapse_tls_handshake_start", None)
+
+
 @implementer(IOpenSSLClientConnectionCreator)
 class SSLClientConnectionCreator:
     """Creates openssl connection objects for client connections.
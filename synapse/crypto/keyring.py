@@ -14,9 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 import urllib
 from collections import defaultdict
+from typing import Tuple
 
 import attr
 from signedjson.key import (
@@ -49,6 +51,7 @@ from synapse.logging.context import (
 from synapse.storage.keys import FetchKeyResult
 from synapse.util import unwrapFirstError
 from synapse.util.async_helpers import yieldable_gather_results
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.metrics import Measure
 from synapse.util.retryutils import NotRetryingDestination
 
@@ -114,6 +117,22 @@ class Keyring:
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # The verify keys we have fetched, so that requests which can be
+        # satisfied by a key we already know about don't have to go through
+        # the key fetchers at all.
+        self._verify_key_cache = LruCache(
+            10000, "keyring_verify_keys"
+        )  # type: LruCache[Tuple[str, str], FetchKeyResult]
+
+        # The signatures we have already checked. The same signed JSON is often
+        # verified several times (e.g. the same auth events in many /send_join
+        # responses), so we remember which (object, server, key ID, signature,
+        # verify key) combinations were valid, and skip the ed25519 work next
+        # time.
+        self._verified_signature_cache = LruCache(
+            50000, "keyring_verified_signatures"
+        )  # type: LruCache[Tuple[bytes, str, str, str, str], bool]
+
     def verify_json_for_server(
         self, server_name, json_object, validity_time, request_name
     ):
@@ -180,7 +199,7 @@ class Keyring:
         """
         # a list of VerifyJsonRequests which are awaiting a key lookup
         key_lookups = []
-        handle = preserve_fn(_handle_key_deferred)
+        handle = preserve_fn(self._handle_key_deferred)
 
         def process(verify_request):
             """Process an entry in the request list
@@ -205,6 +224,13 @@ class Keyring:
                 verify_request.minimum_valid_until_ts,
             )
 
+            cached_key = self._get_cached_verify_key(verify_request)
+            if cached_key:
+                # we already have a suitable key, so there's no need for a
+                # lookup.
+                verify_request.key_ready.callback(cached_key)
+                return handle(verify_request)
+
             # add the key request to the queue, but don't start it off yet.
             key_lookups.append(verify_request)
 
@@ -222,6 +248,42 @@ class Keyring:
 
         return results
 
+    def _get_cached_verify_key(self, verify_request):
+        """Look for a key in the verify key cache which can satisfy the request
+
+        Args:
+            verify_request (VerifyJsonRequest)
+
+        Returns:
+            tuple[str, str, nacl.signing.VerifyKey]|None: a (server_name, key_id,
+                verify_key) tuple suitable for resolving `key_ready`, or None.
+        """
+        server_name = verify_request.server_name
+        for key_id in verify_request.key_ids:
+            result = self._verify_key_cache.get((server_name, key_id))
+            if (
+                result
+                and result.valid_until_ts >= verify_request.minimum_valid_until_ts
+            ):
+                return server_name, key_id, result.verify_key
+        return None
+
+    def _cache_verify_key(self, server_name, key_id, result):
+        """Add a fetched key to the verify key cache, unless we already have a
+        copy which is valid for longer.
+
+        Args:
+            server_name (str)
+            key_id (str)
+            result (FetchKeyResult)
+        """
+        existing = self._verify_key_cache.get(
+            (server_name, key_id), update_metrics=False
+        )
+        if existing and existing.valid_until_ts >= result.valid_until_ts:
+            return
+        self._verify_key_cache.set((server_name, key_id), result)
+
     async def _start_key_lookups(self, verify_requests):
         """Sets off the key fetches for each verify request
 
@@ -395,6 +457,11 @@ class Keyring:
 
         results = await fetcher.get_keys(missing_keys)
 
+        for server_name, result_keys in results.items():
+            for key_id, fetch_key_result in result_keys.items():
+                if fetch_key_result:
+                    self._cache_verify_key(server_name, key_id, fetch_key_result)
+
         completed = []
         for verify_request in remaining_requests:
             server_name = verify_request.server_name
@@ -437,6 +504,48 @@ class Keyring:
 
         remaining_requests.difference_update(completed)
 
+    async def _handle_key_deferred(self, verify_request) -> None:
+        """Waits for the key to become available, and then performs a verification
+
+        Args:
+            verify_request (VerifyJsonRequest):
+
+        Raises:
+            SynapseError if there was a problem performing the verification
+        """
+        server_name = verify_request.server_name
+        with PreserveLoggingContext():
+            _, key_id, verify_key = await verify_request.key_ready
+
+        json_object = verify_request.json_object
+
+        cache_key = _get_signature_cache_key(
+            json_object, server_name, key_id, verify_key
+        )
+        if cache_key and self._verified_signature_cache.get(cache_key):
+            return
+
+        try:
+            verify_signed_json(json_object, server_name, verify_key)
+        except SignatureVerifyException as e:
+            logger.debug(
+                "Error verifying signature for %s:%s:%s with key %s: %s",
+                server_name,
+                verify_key.alg,
+                verify_key.version,
+                encode_verify_key_base64(verify_key),
+                str(e),
+            )
+            raise SynapseError(
+                401,
+                "Invalid signature for server %s with key %s:%s: %s"
+                % (server_name, verify_key.alg, verify_key.version, str(e)),
+                Codes.UNAUTHORIZED,
+            )
+
+        if cache_key:
+            self._verified_signature_cache.set(cache_key, True)
+
 
 class KeyFetcher:
     async def get_keys(self, keys_to_fetch):
@@ -846,35 +955,35 @@ class ServerKeyFetcher(BaseV2KeyFetcher):
         return keys
 
 
-async def _handle_key_deferred(verify_request) -> None:
-    """Waits for the key to become available, and then performs a verification
+def _get_signature_cache_key(json_object, server_name, key_id, verify_key):
+    """Get the key to use for the given signature in the verified signature
+    cache.
 
     Args:
-        verify_request (VerifyJsonRequest):
-
-    Raises:
-        SynapseError if there was a problem performing the verification
+        json_object (dict): the signed JSON object
+        server_name (str): the server whose signature is being checked
+        key_id (str): the key the signature was made with
+        verify_key (nacl.signing.VerifyKey): the key the signature is being
+            checked against. This is included so that a signature which was
+            verified under a different key for the same key ID isn't trusted.
+
+    Returns:
+        tuple[bytes, str, str, str, str]|None: a tuple of the sha256 digest of
+            the signed content, the server name, key ID, signature and verify
+            key, or None if there is no such signature on the object.
     """
-    server_name = verify_request.server_name
-    with PreserveLoggingContext():
-        _, key_id, verify_key = await verify_request.key_ready
-
-    json_object = verify_request.json_object
-
-    try:
-        verify_signed_json(json_object, server_name, verify_key)
-    except SignatureVerifyException as e:
-        logger.debug(
-            "Error verifying signature for %s:%s:%s with key %s: %s",
-            server_name,
-            verify_key.alg,
-            verify_key.version,
-            encode_verify_key_base64(verify_key),
-            str(e),
-        )
-        raise SynapseError(
-            401,
-            "Invalid signature for server %s with key %s:%s: %s"
-            % (server_name, verify_key.alg, verify_key.version, str(e)),
-            Codes.UNAUTHORIZED,
-        )
+    signature = json_object.get("signatures", {}).get(server_name, {}).get(key_id)
+    if not isinstance(signature, str):
+        return None
+
+    signed_content = {
+        k: v for k, v in json_object.items() if k not in ("signatures", "unsigned")
+    }
+    digest = hashlib.sha256(encode_canonical_json(signed_content)).digest()
+    return (
+        digest,
+        server_name,
+        key_id,
+        signature,
+        encode_verify_key_base64(verify_key),
+    )
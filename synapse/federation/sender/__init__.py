@@ -16,7 +16,7 @@
 import logging
 from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Gauge
 
 from twisted.internet import defer
 
@@ -40,6 +40,7 @@ from synapse.metrics import (
     events_processed_counter,
 )
 from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.storage.databases.main.transactions import CatchUpDestination
 from synapse.types import ReadReceipt, RoomStreamToken
 from synapse.util.metrics import Measure, measure_func
 
@@ -59,11 +60,44 @@ sent_pdus_destination_dist_total = Counter(
 # that have catch-up outstanding.
 CATCH_UP_STARTUP_DELAY_SEC = 15
 
-# Time (in s) to wait in between waking up each destination, i.e. one destination
-# will be woken up every <x> seconds after Synapse's startup until we have woken
-# every destination has outstanding catch-up.
+# Time (in s) to wait in between waking up each batch of destinations, i.e. up
+# to CATCH_UP_BATCH_SIZE destinations will be woken up every <x> seconds after
+# Synapse's startup until we have woken every destination that has outstanding
+# catch-up.
 CATCH_UP_STARTUP_INTERVAL_SEC = 5
 
+# The maximum number of destinations to wake up at once after startup. Their
+# catch-up positions and first events to send are fetched in a single query.
+CATCH_UP_BATCH_SIZE = 50
+
+# The maximum number of destinations we will have catching up at the same time
+# when waking destinations after startup. Once this many are in progress, we
+# wait for some of them to finish before waking any more.
+CATCH_UP_MAX_CONCURRENT_DESTINATIONS = 200
+
+catch_up_destinations_remaining = Gauge(
+    "synapse_federation_catch_up_destinations_remaining",
+    "Number of destinations with outstanding catch-up which are waiting to be "
+    "woken up after startup",
+)
+
+catch_up_destinations_woken_counter = Counter(
+    "synapse_federation_catch_up_destinations_woken",
+    "Number of destinations with outstanding catch-up woken up after startup",
+)
+
+# The number of presence EDUs actually sent is tracked by the
+# `synapse_federation_client_sent_edus_by_type` counter.
+presence_updates_processed_counter = Counter(
+    "synapse_federation_presence_updates_processed",
+    "Number of local presence updates which have had their destinations worked out",
+)
+
+presence_updates_queued_counter = Counter(
+    "synapse_federation_presence_updates_queued",
+    "Number of presence updates queued for sending, summed across destinations",
+)
+
 
 class FederationSender:
     def __init__(self, hs: "synapse.server.HomeServer"):
@@ -95,6 +129,13 @@ class FederationSender:
             ),
         )
 
+        LaterGauge(
+            "synapse_federation_catch_up_destinations_in_progress",
+            "Number of destinations which are currently being caught up",
+            [],
+            self._count_destinations_catching_up,
+        )
+
         # Map of user_id -> UserPresenceState for all the pending presence
         # to be sent out by user_id. Entries here get processed and put in
         # pending_presence_by_dest
@@ -438,6 +479,11 @@ class FederationSender:
 
         self._processing_pending_presence = True
         try:
+            # Wait for the rest of this reactor tick, so that presence updates
+            # which arrive together (e.g. from a batch of timeouts or a burst of
+            # replication) are fanned out together.
+            await self.clock.sleep(0)
+
             while True:
                 states_map = self.pending_presence
                 self.pending_presence = {}
@@ -476,19 +522,22 @@ class FederationSender:
         """Given a list of states populate self.pending_presence_by_dest and
         poke to send a new transaction to each destination
         """
-        hosts_and_states = await get_interested_remotes(self.store, states, self.state)
+        states_by_destination = await get_interested_remotes(self.store, states)
+        presence_updates_processed_counter.inc(len(states))
 
-        for destinations, states in hosts_and_states:
-            for destination in destinations:
-                if destination == self.server_name:
-                    continue
+        for destination, dest_states in states_by_destination.items():
+            if destination == self.server_name:
+                continue
 
-                if not self._federation_shard_config.should_handle(
-                    self._instance_name, destination
-                ):
-                    continue
+            if not self._federation_shard_config.should_handle(
+                self._instance_name, destination
+            ):
+                continue
 
-                self._get_per_destination_queue(destination).send_presence(states)
+            presence_updates_queued_counter.inc(len(dest_states))
+            self._get_per_destination_queue(destination).send_presence(
+                dest_states.values()
+            )
 
     def build_and_send_edu(
         self,
@@ -585,36 +634,84 @@ class FederationSender:
         # to a worker.
         return [], 0, False
 
+    def _count_destinations_catching_up(self) -> int:
+        return sum(
+            1
+            for d in self._per_destination_queues.values()
+            if d.transmission_loop_running and d.is_catching_up()
+        )
+
     async def _wake_destinations_needing_catchup(self):
         """
         Wakes up destinations that need catch-up and are not currently being
         backed off from.
 
-        In order to reduce load spikes, adds a delay between each destination.
+        Destinations are woken in batches, prioritising those which we are not
+        backing off from at all (i.e. those that were reachable most recently),
+        followed by those with the largest backlog, so that the slowest
+        catch-ups get started first. In order to reduce load spikes, adds a
+        delay between each batch and limits the number of destinations which
+        are catching up at once.
         """
 
+        # There is only one row per destination, so we can afford to fetch them
+        # all up front and put them in order.
+        destinations = []  # type: List[CatchUpDestination]
         last_processed = None  # type: Optional[str]
-
         while True:
-            destinations_to_wake = await self.store.get_catch_up_outstanding_destinations(
+            batch = await self.store.get_catch_up_outstanding_destinations_with_backlog(
                 last_processed
             )
-
-            if not destinations_to_wake:
-                # finished waking all destinations!
-                self._catchup_after_startup_timer = None
+            if not batch:
                 break
 
-            destinations_to_wake = [
+            last_processed = batch[-1].destination
+            destinations.extend(
                 d
-                for d in destinations_to_wake
-                if self._federation_shard_config.should_handle(self._instance_name, d)
-            ]
-
-            for last_processed in destinations_to_wake:
-                logger.info(
-                    "Destination %s has outstanding catch-up, waking up.",
-                    last_processed,
+                for d in batch
+                if self._federation_shard_config.should_handle(
+                    self._instance_name, d.destination
                 )
-                self.wake_destination(last_processed)
-                await self.clock.sleep(CATCH_UP_STARTUP_INTERVAL_SEC)
+            )
+
+        destinations.sort(key=lambda d: (bool(d.retry_interval), -d.backlog))
+        catch_up_destinations_remaining.set(len(destinations))
+
+        while destinations:
+            capacity = (
+                CATCH_UP_MAX_CONCURRENT_DESTINATIONS
+                - self._count_destinations_catching_up()
+            )
+            if capacity > 0:
+                batch = destinations[: min(capacity, CATCH_UP_BATCH_SIZE)]
+                del destinations[: len(batch)]
+
+                await self._wake_catch_up_batch(batch)
+
+                catch_up_destinations_woken_counter.inc(len(batch))
+                catch_up_destinations_remaining.set(len(destinations))
+
+            await self.clock.sleep(CATCH_UP_STARTUP_INTERVAL_SEC)
+
+        # finished waking all destinations!
+        self._catchup_after_startup_timer = None
+
+    async def _wake_catch_up_batch(self, batch: List[CatchUpDestination]) -> None:
+        """Fetch the first events to catch up on for the given destinations,
+        and wake them up.
+        """
+        event_ids_by_destination = await self.store.get_catch_up_room_event_ids_for_destinations(
+            {d.destination: d.last_successful_stream_ordering for d in batch}
+        )
+
+        for d in batch:
+            logger.info(
+                "Destination %s has outstanding catch-up (%d rooms), waking up.",
+                d.destination,
+                d.backlog,
+            )
+            self._get_per_destination_queue(d.destination).prefetch_catch_up(
+                d.last_successful_stream_ordering,
+                event_ids_by_destination.get(d.destination, []),
+            )
+            self.wake_destination(d.destination)
@@ -26,6 +26,10 @@ from synapse.api.errors import (
 )
 from synapse.api.presence import UserPresenceState
 from synapse.events import EventBase
+from synapse.federation.sender.transaction_manager import (
+    estimate_pdu_size,
+    estimate_transaction_size,
+)
 from synapse.federation.units import Edu
 from synapse.handlers.presence import format_user_presence_state
 from synapse.metrics import sent_transactions_counter
@@ -36,9 +40,24 @@ from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 if TYPE_CHECKING:
     import synapse.server
 
-# This is defined in the Matrix spec and enforced by the receiver.
+# These are defined in the Matrix spec and enforced by the receiver.
+MAX_PDUS_PER_TRANSACTION = 50
 MAX_EDUS_PER_TRANSACTION = 100
 
+# Bounds on the number of bytes of PDUs we put in each transaction. Within
+# these, the budget for each destination is chosen so that a transaction should
+# take about TARGET_TRANSACTION_DURATION_SECS to be accepted, based on how
+# quickly it has accepted transactions before: slow destinations get smaller
+# transactions, so that they don't time out, and fast ones get as many PDUs as
+# the spec allows.
+MIN_TRANSACTION_BYTES = 64 * 1024
+MAX_TRANSACTION_BYTES = 10 * 1024 * 1024
+TARGET_TRANSACTION_DURATION_SECS = 5
+
+# The weight given to the most recent transaction when updating the moving
+# average of the acceptance rate of a destination.
+ACCEPTANCE_RATE_SMOOTHING_FACTOR = 0.3
+
 logger = logging.getLogger(__name__)
 
 
@@ -52,6 +71,16 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+catch_up_pdus_sent_counter = Counter(
+    "synapse_federation_catch_up_pdus_sent",
+    "Number of PDUs successfully sent to destinations while catching them up",
+)
+
+catch_up_completed_counter = Counter(
+    "synapse_federation_catch_up_completed",
+    "Number of times a destination has finished catching up",
+)
+
 
 class PerDestinationQueue:
     """
@@ -107,6 +136,11 @@ class PerDestinationQueue:
         # destination (we are the only updater so this is safe)
         self._last_successful_stream_ordering = None  # type: Optional[int]
 
+        # The last successfully-transmitted stream ordering and the first batch
+        # of event IDs to catch up on, if they were fetched for us by the
+        # catch-up scheduler before our first catch-up check.
+        self._prefetched_catch_up = None  # type: Optional[Tuple[int, List[str]]]
+
         # a list of pending PDUs
         self._pending_pdus = []  # type: List[EventBase]
 
@@ -134,6 +168,14 @@ class PerDestinationQueue:
         # stream_id of last successfully sent device list update.
         self._last_device_list_stream_id = 0
 
+        # A moving average of the rate (in bytes/sec) at which this destination
+        # has accepted our transactions, or None if we haven't sent anything
+        # yet. This is measured over the whole request, so includes the time
+        # the destination takes to process the transaction as well as the time
+        # to send it; that's what decides whether a transaction times out.
+        self._acceptance_rate = None  # type: Optional[float]
+        self._transaction_byte_budget = MAX_TRANSACTION_BYTES
+
     def __str__(self) -> str:
         return "PerDestinationQueue[%s]" % self._destination
 
@@ -147,6 +189,31 @@ class PerDestinationQueue:
             + len(self._pending_edus_keyed)
         )
 
+    def is_catching_up(self) -> bool:
+        """Whether this destination is (or may need to be) caught up before we
+        can send it new PDUs.
+        """
+        return self._catching_up
+
+    def prefetch_catch_up(
+        self, last_successful_stream_ordering: int, event_ids: List[str]
+    ) -> None:
+        """Provide the catch-up position for this destination, so that the
+        first catch-up check doesn't need to query the database.
+
+        This is ignored if we have already done the first check.
+
+        Args:
+            last_successful_stream_ordering: the stream ordering of the last
+                PDU successfully sent to this destination, per the database.
+            event_ids: the first event IDs to send to catch up, as returned by
+                `get_catch_up_room_event_ids`.
+        """
+        if self._last_successful_stream_ordering is not None:
+            return
+
+        self._prefetched_catch_up = (last_successful_stream_ordering, event_ids)
+
     def send_pdu(self, pdu: EventBase) -> None:
         """Add a PDU to the queue, and start the transmission loop if necessary
 
@@ -276,8 +343,13 @@ class PerDestinationQueue:
 
                 pending_pdus = self._pending_pdus
 
-                # We can only include at most 50 PDUs per transactions
-                pending_pdus, self._pending_pdus = pending_pdus[:50], pending_pdus[50:]
+                # We can only include at most 50 PDUs per transactions, and we
+                # also limit the total size of them.
+                pdu_count = self._count_pdus_within_budget(pending_pdus)
+                pending_pdus, self._pending_pdus = (
+                    pending_pdus[:pdu_count],
+                    pending_pdus[pdu_count:],
+                )
 
                 pending_edus.extend(self._get_rr_edus(force_flush=False))
                 pending_presence = self._pending_presence
@@ -328,10 +400,16 @@ class PerDestinationQueue:
 
                 # END CRITICAL SECTION
 
+                start = self._clock.time()
                 success = await self._transaction_manager.send_new_transaction(
                     self._destination, pending_pdus, pending_edus
                 )
                 if success:
+                    self._update_transaction_byte_budget(
+                        estimate_transaction_size(pending_pdus, pending_edus),
+                        self._clock.time() - start,
+                    )
+
                     sent_transactions_counter.inc()
                     sent_edus_counter.inc(len(pending_edus))
                     for edu in pending_edus:
@@ -438,11 +516,19 @@ class PerDestinationQueue:
     async def _catch_up_transmission_loop(self) -> None:
         first_catch_up_check = self._last_successful_stream_ordering is None
 
-        if first_catch_up_check:
+        prefetched_event_ids = None  # type: Optional[List[str]]
+        if first_catch_up_check and self._prefetched_catch_up is not None:
+            # the catch-up scheduler has already looked up where we are.
+            (
+                self._last_successful_stream_ordering,
+                prefetched_event_ids,
+            ) = self._prefetched_catch_up
+        elif first_catch_up_check:
             # first catchup so get last_successful_stream_ordering from database
             self._last_successful_stream_ordering = await self._store.get_destination_last_successful_stream_ordering(
                 self._destination
             )
+        self._prefetched_catch_up = None
 
         if self._last_successful_stream_ordering is None:
             # if it's still None, then this means we don't have the information
@@ -454,11 +540,17 @@ class PerDestinationQueue:
             self._catching_up = False
             return
 
+        sent_catch_up_pdus = False
+
         # get at most 50 catchup room/PDUs
         while True:
-            event_ids = await self._store.get_catch_up_room_event_ids(
-                self._destination, self._last_successful_stream_ordering,
-            )
+            if prefetched_event_ids is not None:
+                event_ids = prefetched_event_ids
+                prefetched_event_ids = None
+            else:
+                event_ids = await self._store.get_catch_up_room_event_ids(
+                    self._destination, self._last_successful_stream_ordering,
+                )
 
             if not event_ids:
                 # No more events to catch up on, but we can't ignore the chance
@@ -471,6 +563,8 @@ class PerDestinationQueue:
 
                 # we are done catching up!
                 self._catching_up = False
+                if sent_catch_up_pdus or not first_catch_up_check:
+                    catch_up_completed_counter.inc()
                 break
 
             if first_catch_up_check:
@@ -503,6 +597,8 @@ class PerDestinationQueue:
                 return
 
             sent_transactions_counter.inc()
+            catch_up_pdus_sent_counter.inc(len(catchup_pdus))
+            sent_catch_up_pdus = True
             final_pdu = catchup_pdus[-1]
             self._last_successful_stream_ordering = cast(
                 int, final_pdu.internal_metadata.stream_ordering
@@ -511,6 +607,53 @@ class PerDestinationQueue:
                 self._destination, self._last_successful_stream_ordering
             )
 
+    def _count_pdus_within_budget(self, pdus: List[EventBase]) -> int:
+        """Work out how many of the given PDUs to include in the next
+        transaction.
+
+        We always include at least one PDU (if there are any), even if it is
+        larger than the budget.
+        """
+        total_size = 0
+        for count, pdu in enumerate(pdus[:MAX_PDUS_PER_TRANSACTION]):
+            total_size += estimate_pdu_size(pdu)
+            if count and total_size > self._transaction_byte_budget:
+                return count
+
+        return min(len(pdus), MAX_PDUS_PER_TRANSACTION)
+
+    def _update_transaction_byte_budget(self, size: int, duration: float) -> None:
+        """Update the transaction size budget for this destination after
+        successfully sending a transaction.
+
+        Args:
+            size: the approximate size of the transaction, in bytes
+            duration: the time taken for the destination to accept it, in
+                seconds
+        """
+        # Small transactions are dominated by round-trip time rather than
+        # bandwidth or processing time, so don't tell us anything useful.
+        if size < MIN_TRANSACTION_BYTES:
+            return
+
+        rate = size / max(duration, 0.001)
+        if self._acceptance_rate is None:
+            self._acceptance_rate = rate
+        else:
+            self._acceptance_rate += ACCEPTANCE_RATE_SMOOTHING_FACTOR * (
+                rate - self._acceptance_rate
+            )
+
+        self._transaction_byte_budget = int(
+            min(
+                MAX_TRANSACTION_BYTES,
+                max(
+                    MIN_TRANSACTION_BYTES,
+                    self._acceptance_rate * TARGET_TRANSACTION_DURATION_SECS,
+                ),
+            )
+        )
+
     def _get_rr_edus(self, force_flush: bool) -> Iterable[Edu]:
         if not self._pending_rrs:
             return
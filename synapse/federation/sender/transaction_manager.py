@@ -13,9 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+import weakref
 from typing import TYPE_CHECKING, List
 
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Histogram
 
 from synapse.api.errors import HttpResponseException
 from synapse.events import EventBase
@@ -28,7 +29,7 @@ from synapse.logging.opentracing import (
     tags,
     whitelisted_homeserver,
 )
-from synapse.util import json_decoder
+from synapse.util import json_decoder, json_encoder
 from synapse.util.metrics import measure_func
 
 if TYPE_CHECKING:
@@ -42,6 +43,58 @@ last_pdu_age_metric = Gauge(
     labelnames=("server_name",),
 )
 
+# The following metrics are labelled with the destination for the domains in
+# `federation_metrics_domains`, and with "other" for everything else.
+transaction_size_histogram = Histogram(
+    "synapse_federation_client_transaction_size_bytes",
+    "Approximate size of the transactions sent to the given domain",
+    labelnames=("server_name",),
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+)
+
+transaction_response_time_histogram = Histogram(
+    "synapse_federation_client_transaction_response_time_seconds",
+    "Time taken for the given domain to respond to transactions, including its "
+    "processing time",
+    labelnames=("server_name",),
+)
+
+transaction_queue_age_histogram = Histogram(
+    "synapse_federation_client_transaction_queue_age_seconds",
+    "The age of the oldest PDU in each transaction sent to the given domain",
+    labelnames=("server_name",),
+)
+
+# Map from event to the approximate size of its PDU JSON, so that we only need
+# to encode each event once to size it, even though we send it to many
+# destinations.
+_pdu_sizes = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+def estimate_pdu_size(pdu: EventBase) -> int:
+    """Get the approximate size in bytes of a PDU as it will be sent.
+    """
+    size = _pdu_sizes.get(pdu)
+    if size is None:
+        size = len(json_encoder.encode(pdu.get_pdu_json()))
+        _pdu_sizes[pdu] = size
+    return size
+
+
+def estimate_edu_size(edu: Edu) -> int:
+    """Get the approximate size in bytes of an EDU as it will be sent.
+    """
+    return len(json_encoder.encode(edu.content)) + len(edu.edu_type)
+
+
+def estimate_transaction_size(pdus: List[EventBase], edus: List[Edu]) -> int:
+    """Get the approximate size in bytes of a transaction with the given PDUs
+    and EDUs.
+    """
+    return sum(estimate_pdu_size(p) for p in pdus) + sum(
+        estimate_edu_size(e) for e in edus
+    )
+
 
 class TransactionManager:
     """Helper class which handles building and sending transactions
@@ -145,6 +198,20 @@ class TransactionManager:
                             del p["age_ts"]
                 return data
 
+            if destination in self._federation_metrics_domains:
+                metrics_label = destination
+            else:
+                metrics_label = "other"
+
+            transaction_size_histogram.labels(metrics_label).observe(
+                estimate_transaction_size(pdus, edus)
+            )
+            if pdus:
+                transaction_queue_age_histogram.labels(metrics_label).observe(
+                    (self.clock.time_msec() - pdus[0].origin_server_ts) / 1000
+                )
+
+            start = self.clock.time()
             try:
                 response = await self._transport_layer.send_transaction(
                     transaction, json_data_cb
@@ -159,6 +226,10 @@ class TransactionManager:
                         "TX [%s] {%s} got %d response", destination, txn_id, code
                     )
                     raise e
+            finally:
+                transaction_response_time_histogram.labels(metrics_label).observe(
+                    self.clock.time() - start
+                )
 
             logger.info("TX [%s] {%s} got %d response", destination, txn_id, code)
 
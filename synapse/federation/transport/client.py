@@ -16,19 +16,35 @@
 
 import logging
 import urllib
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
+
+import attr
 
 from synapse.api.constants import Membership
 from synapse.api.errors import Codes, HttpResponseException, SynapseError
+from synapse.api.room_versions import RoomVersion
 from synapse.api.urls import (
     FEDERATION_UNSTABLE_PREFIX,
     FEDERATION_V1_PREFIX,
     FEDERATION_V2_PREFIX,
 )
+from synapse.events import EventBase
+from synapse.federation.federation_base import event_from_pdu_json
+from synapse.http.matrixfederationclient import ByteParser
 from synapse.logging.utils import log_function
+from synapse.util import json_decoder
+
+try:
+    import ijson
+except ImportError:
+    ijson = None  # type: ignore
 
 logger = logging.getLogger(__name__)
 
+# The maximum size of a response to /send_join. Responses for large rooms can
+# be hundreds of megabytes.
+MAX_RESPONSE_SIZE_SEND_JOIN = 500 * 1024 * 1024
+
 
 class TransportLayerClient:
     """Sends federation HTTP requests to other servers"""
@@ -36,6 +52,9 @@ class TransportLayerClient:
     def __init__(self, hs):
         self.server_name = hs.hostname
         self.client = hs.get_http_client()
+        self._compress_transactions_to = (
+            hs.config.federation.federation_compress_transactions_to
+        )
 
     @log_function
     def get_room_state_ids(self, destination, room_id, event_id):
@@ -120,6 +139,9 @@ class TransportLayerClient:
     async def send_transaction(self, transaction, json_data_callback=None):
         """ Sends the given Transaction to its destination
 
+        The body is compressed if the destination is listed in
+        `federation_compress_transactions_to`.
+
         Args:
             transaction (Transaction)
 
@@ -159,6 +181,7 @@ class TransportLayerClient:
             long_retries=True,
             backoff_on_404=True,  # If we get a 404 the other side has gone
             try_trailing_slash_on_400=True,
+            compress_body=(transaction.destination in self._compress_transactions_to),
         )
 
         return response
@@ -240,21 +263,33 @@ class TransportLayerClient:
         return content
 
     @log_function
-    async def send_join_v1(self, destination, room_id, event_id, content):
+    async def send_join_v1(
+        self, room_version, destination, room_id, event_id, content
+    ) -> "SendJoinResponse":
         path = _create_v1_path("/send_join/%s/%s", room_id, event_id)
 
         response = await self.client.put_json(
-            destination=destination, path=path, data=content
+            destination=destination,
+            path=path,
+            data=content,
+            parser=SendJoinParser(room_version, v1_api=True),
+            max_response_size=MAX_RESPONSE_SIZE_SEND_JOIN,
         )
 
         return response
 
     @log_function
-    async def send_join_v2(self, destination, room_id, event_id, content):
+    async def send_join_v2(
+        self, room_version, destination, room_id, event_id, content
+    ) -> "SendJoinResponse":
         path = _create_v2_path("/send_join/%s/%s", room_id, event_id)
 
         response = await self.client.put_json(
-            destination=destination, path=path, data=content
+            destination=destination,
+            path=path,
+            data=content,
+            parser=SendJoinParser(room_version, v1_api=False),
+            max_response_size=MAX_RESPONSE_SIZE_SEND_JOIN,
         )
 
         return response
@@ -1046,3 +1081,98 @@ def _create_v2_path(path, *args):
         str
     """
     return _create_path(FEDERATION_V2_PREFIX, path, *args)
+
+
+@attr.s(slots=True)
+class SendJoinResponse:
+    """The parsed response of a `/send_join` request."""
+
+    # The events in the auth chain of the state.
+    auth_events = attr.ib(type=List[EventBase])
+    # The state of the room at the join event.
+    state = attr.ib(type=List[EventBase])
+
+
+class SendJoinParser(ByteParser[SendJoinResponse]):
+    """A parser for the response to `/send_join` requests.
+
+    If ijson is installed, the `state` and `auth_chain` lists are decoded
+    incrementally as the response arrives, and each event is built as soon as
+    it has been received. This spreads the work of handling the response
+    (which can be hundreds of megabytes for a large room) across the time it
+    takes to download, rather than blocking the reactor for seconds at the
+    end. Otherwise we fall back to decoding the whole response at the end.
+
+    Args:
+        room_version: the version of the room being joined
+        v1_api: whether the request was made with the v1 API, which wraps the
+            response in `[200, {...}]`
+    """
+
+    def __init__(self, room_version: RoomVersion, v1_api: bool):
+        self._room_version = room_version
+        self._v1_api = v1_api
+        self._response = SendJoinResponse([], [])
+
+        if ijson is None:
+            self._buffer = []  # type: List[bytes]
+            return
+
+        prefix = "item." if v1_api else ""
+        self._coros = [
+            ijson.items_coro(
+                _event_list_parser(room_version, self._response.state),
+                prefix + "state.item",
+                use_float=True,
+            ),
+            ijson.items_coro(
+                _event_list_parser(room_version, self._response.auth_events),
+                prefix + "auth_chain.item",
+                use_float=True,
+            ),
+        ]
+
+    def write(self, data: bytes) -> None:
+        if ijson is None:
+            self._buffer.append(data)
+            return
+
+        for c in self._coros:
+            c.send(data)
+
+    def finish(self) -> SendJoinResponse:
+        if ijson is not None:
+            for c in self._coros:
+                c.close()
+            return self._response
+
+        content = json_decoder.decode(b"".join(self._buffer).decode("utf-8"))
+        if self._v1_api:
+            # The v1 API responds with `[200, content]`.
+            content = content[1]
+
+        self._response.state = [
+            event_from_pdu_json(p, self._room_version, outlier=True)
+            for p in content.get("state", [])
+        ]
+        self._response.auth_events = [
+            event_from_pdu_json(p, self._room_version, outlier=True)
+            for p in content.get("auth_chain", [])
+        ]
+        return self._response
+
+
+def _event_list_parser(room_version: RoomVersion, events: List[EventBase]):
+    """Returns a coroutine which builds events from the JSON objects sent to it,
+    and appends them to `events`.
+    """
+
+    def _parse():
+        while True:
+            obj = yield
+            events.append(event_from_pdu_json(obj, room_version, outlier=True))
+
+    coro = _parse()
+    # ijson expects the coroutine to have been started already.
+    next(coro)
+    return coro
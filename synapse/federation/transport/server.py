@@ -297,7 +297,9 @@ class BaseFederationServlet:
             content = None
             if request.method in [b"PUT", b"POST"]:
                 # TODO: Handle other method types? other content types?
-                content = parse_json_object_from_request(request)
+                content = parse_json_object_from_request(
+                    request, allow_compressed_body=True
+                )
 
             try:
                 origin = await authenticator.authenticate_request(request, content)
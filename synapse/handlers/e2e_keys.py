@@ -14,12 +14,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-
 import logging
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import attr
 from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Histogram
 from signedjson.key import VerifyKey, decode_verify_key_bytes
 from signedjson.sign import SignatureVerifyException, verify_signed_json
 from unpaddedbase64 import decode_base64
@@ -29,19 +29,47 @@ from twisted.internet import defer
 from synapse.api.errors import CodeMessageException, Codes, NotFoundError, SynapseError
 from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.logging.opentracing import log_kv, set_tag, tag_args, trace
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.devices import ReplicationUserDevicesResyncRestServlet
 from synapse.types import (
+    JsonDict,
     UserID,
     get_domain_from_id,
     get_verify_key_from_cross_signing_key,
 )
 from synapse.util import json_decoder, unwrapFirstError
-from synapse.util.async_helpers import Linearizer
+from synapse.util.async_helpers import Linearizer, ObservableDeferred
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.retryutils import NotRetryingDestination
 
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
 logger = logging.getLogger(__name__)
 
+# How long to wait for further requests for keys to the same remote server, so
+# that they can be sent as a single federation request.
+KEY_REQUEST_BATCH_DELAY_MS = 20
+
+e2e_keys_stage_time = Histogram(
+    "synapse_handlers_e2e_keys_stage_duration_seconds",
+    "Time taken by each stage of handling a client request for E2E keys",
+    ["operation", "stage"],
+)
+
+e2e_key_federation_request_time = Histogram(
+    "synapse_handlers_e2e_keys_federation_request_duration_seconds",
+    "Time taken by (possibly coalesced) federation requests for E2E keys",
+    ["operation"],
+)
+
+e2e_key_requests_coalesced_counter = Counter(
+    "synapse_handlers_e2e_keys_federation_requests_coalesced",
+    "Number of requests for E2E keys which were added to a pending federation"
+    " request rather than being sent separately",
+    ["operation"],
+)
+
 
 class E2eKeysHandler:
     def __init__(self, hs):
@@ -53,6 +81,23 @@ class E2eKeysHandler:
 
         self._edu_updater = SigningKeyEduUpdater(hs, self)
 
+        self._claim_batcher = _FederationKeyRequestBatcher(
+            hs,
+            "claim",
+            lambda destination, query, timeout: self.federation.claim_client_keys(
+                destination, {"one_time_keys": query}, timeout=timeout
+            ),
+            _merge_claim_query,
+        )
+        self._query_batcher = _FederationKeyRequestBatcher(
+            hs,
+            "query",
+            lambda destination, query, timeout: self.federation.query_client_keys(
+                destination, {"device_keys": query}, timeout=timeout
+            ),
+            _merge_device_query,
+        )
+
         federation_registry = hs.get_federation_registry()
 
         self._is_master = hs.config.worker_app is None
@@ -121,6 +166,7 @@ class E2eKeysHandler:
         set_tag("remote_key_query", remote_queries)
 
         # First get local devices.
+        start = self.clock.time()
         failures = {}
         results = {}
         if local_query:
@@ -133,6 +179,7 @@ class E2eKeysHandler:
         cross_signing_keys = await self.get_cross_signing_keys_from_cache(
             device_keys_query, from_user_id
         )
+        e2e_keys_stage_time.labels("query", "local").observe(self.clock.time() - start)
 
         # Now attempt to get any remote devices from our local cache.
         remote_queries_not_in_cache = {}
@@ -243,12 +290,17 @@ class E2eKeysHandler:
                 destination_query.pop(user_id)
 
             try:
-                remote_result = await self.federation.query_client_keys(
-                    destination, {"device_keys": destination_query}, timeout=timeout
+                # the result may include devices which other callers asked for,
+                # if the request was combined with theirs.
+                remote_result = await self._query_batcher.request(
+                    destination, destination_query, timeout
                 )
 
                 for user_id, keys in remote_result["device_keys"].items():
                     if user_id in destination_query:
+                        device_ids = destination_query[user_id]
+                        if device_ids:
+                            keys = {d: k for d, k in keys.items() if d in device_ids}
                         results[user_id] = keys
 
                 if "master_keys" in remote_result:
@@ -267,6 +319,7 @@ class E2eKeysHandler:
                 set_tag("error", True)
                 set_tag("reason", failure)
 
+        start = self.clock.time()
         await make_deferred_yieldable(
             defer.gatherResults(
                 [
@@ -276,6 +329,10 @@ class E2eKeysHandler:
                 consumeErrors=True,
             ).addErrback(unwrapFirstError)
         )
+        if remote_queries_not_in_cache:
+            e2e_keys_stage_time.labels("query", "remote").observe(
+                self.clock.time() - start
+            )
 
         ret = {"device_keys": results, "failures": failures}
 
@@ -413,7 +470,9 @@ class E2eKeysHandler:
         set_tag("local_key_query", local_query)
         set_tag("remote_key_query", remote_queries)
 
+        start = self.clock.time()
         results = await self.store.claim_e2e_one_time_keys(local_query)
+        e2e_keys_stage_time.labels("claim", "local").observe(self.clock.time() - start)
 
         json_result = {}
         failures = {}
@@ -429,12 +488,16 @@ class E2eKeysHandler:
             set_tag("destination", destination)
             device_keys = remote_queries[destination]
             try:
-                remote_result = await self.federation.claim_client_keys(
-                    destination, {"one_time_keys": device_keys}, timeout=timeout
+                # the result may include keys claimed by other callers, if the
+                # request was combined with theirs.
+                remote_result = await self._claim_batcher.request(
+                    destination, device_keys, timeout
                 )
                 for user_id, keys in remote_result["one_time_keys"].items():
                     if user_id in device_keys:
-                        json_result[user_id] = keys
+                        json_result[user_id] = {
+                            d: k for d, k in keys.items() if d in device_keys[user_id]
+                        }
 
             except Exception as e:
                 failure = _exception_to_failure(e)
@@ -442,6 +505,7 @@ class E2eKeysHandler:
                 set_tag("error", True)
                 set_tag("reason", failure)
 
+        start = self.clock.time()
         await make_deferred_yieldable(
             defer.gatherResults(
                 [
@@ -451,6 +515,10 @@ class E2eKeysHandler:
                 consumeErrors=True,
             )
         )
+        if remote_queries:
+            e2e_keys_stage_time.labels("claim", "remote").observe(
+                self.clock.time() - start
+            )
 
         logger.info(
             "Claimed one-time-keys: %s",
@@ -1326,3 +1394,135 @@ class SigningKeyEduUpdater:
                 device_ids = device_ids + new_device_ids
 
             await device_handler.notify_device_update(user_id, device_ids)
+
+
+class _PendingKeyRequest:
+    """A request for keys to a remote server which is waiting to be sent, to
+    which further queries may be added until it is flushed.
+    """
+
+    __slots__ = ["query", "timeout", "deferred"]
+
+    def __init__(self):
+        self.query = {}  # type: Dict[str, Any]
+        self.timeout = None  # type: Optional[int]
+        self.deferred = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+
+
+class _FederationKeyRequestBatcher:
+    """Coalesces requests for keys to the same remote server which are made
+    within `KEY_REQUEST_BATCH_DELAY_MS` of each other into a single federation
+    request.
+
+    Callers are given the whole response to the combined request, and are
+    responsible for picking out the parts which answer their own query.
+
+    Args:
+        hs
+        operation: the name of the operation, for metrics and logging.
+        send_request: called with the destination, the combined query and the
+            timeout to make the federation request.
+        merge_query: called to add a caller's query to a pending one. Should
+            update the pending query in place and return True, or return False
+            without modifying it if the two cannot be combined.
+    """
+
+    def __init__(
+        self,
+        hs: "HomeServer",
+        operation: str,
+        send_request: Callable[
+            [str, Dict[str, Any], Optional[int]], Awaitable[JsonDict]
+        ],
+        merge_query: Callable[[Dict[str, Any], Dict[str, Any]], bool],
+    ):
+        self._clock = hs.get_clock()
+        self._operation = operation
+        self._send_request = send_request
+        self._merge_query = merge_query
+
+        # requests waiting to be sent, by destination
+        self._pending = {}  # type: Dict[str, List[_PendingKeyRequest]]
+
+    async def request(
+        self, destination: str, query: Dict[str, Any], timeout: Optional[int]
+    ) -> JsonDict:
+        pending_requests = self._pending.setdefault(destination, [])
+        for pending in pending_requests:
+            if self._merge_query(pending.query, query):
+                e2e_key_requests_coalesced_counter.labels(self._operation).inc()
+                break
+        else:
+            pending = _PendingKeyRequest()
+            self._merge_query(pending.query, query)
+            pending_requests.append(pending)
+            self._clock.call_later(
+                KEY_REQUEST_BATCH_DELAY_MS / 1000,
+                self._flush_pending,
+                destination,
+                pending,
+            )
+
+        # use the most generous of the callers' timeouts
+        if timeout is not None:
+            pending.timeout = max(pending.timeout or 0, timeout)
+
+        return await make_deferred_yieldable(pending.deferred.observe())
+
+    def _flush_pending(self, destination: str, pending: _PendingKeyRequest) -> None:
+        pending_requests = self._pending[destination]
+        pending_requests.remove(pending)
+        if not pending_requests:
+            del self._pending[destination]
+
+        async def _send_pending():
+            start = self._clock.time()
+            try:
+                result = await self._send_request(
+                    destination, pending.query, pending.timeout
+                )
+            except Exception as e:
+                pending.deferred.errback(e)
+            else:
+                pending.deferred.callback(result)
+            finally:
+                e2e_key_federation_request_time.labels(self._operation).observe(
+                    self._clock.time() - start
+                )
+
+        run_as_background_process("e2e_keys_%s" % (self._operation,), _send_pending)
+
+
+def _merge_claim_query(
+    pending: Dict[str, Dict[str, str]], query: Dict[str, Dict[str, str]]
+) -> bool:
+    """Add a query of the form `{user_id: {device_id: algorithm}}` to a pending
+    claim.
+
+    Two callers claiming keys for the same device each need a key of their own,
+    so such queries are never combined.
+    """
+    for user_id, devices in query.items():
+        pending_devices = pending.get(user_id)
+        if pending_devices and any(d in pending_devices for d in devices):
+            return False
+
+    for user_id, devices in query.items():
+        pending.setdefault(user_id, {}).update(devices)
+    return True
+
+
+def _merge_device_query(
+    pending: Dict[str, List[str]], query: Dict[str, List[str]]
+) -> bool:
+    """Add a query of the form `{user_id: [device_id]}` to a pending device key
+    query, where an empty list of devices means all of the user's devices.
+    """
+    for user_id, device_ids in query.items():
+        if user_id not in pending:
+            pending[user_id] = list(device_ids)
+        elif not pending[user_id] or not device_ids:
+            pending[user_id] = []
+        else:
+            pending[user_id].extend(d for d in device_ids if d not in pending[user_id])
+    return True
@@ -16,17 +16,21 @@
 import logging
 from typing import TYPE_CHECKING, Any, Dict, Optional, Set
 
+from prometheus_client import Counter
+
+from twisted.internet import defer
 from twisted.python.failure import Failure
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
 from synapse.api.filtering import Filter
-from synapse.logging.context import run_in_background
+from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
 from synapse.streams.config import PaginationConfig
 from synapse.types import Requester
-from synapse.util.async_helpers import ReadWriteLock
+from synapse.util.async_helpers import ObservableDeferred, ReadWriteLock
+from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.stringutils import random_string
 from synapse.visibility import filter_events_for_client
 
@@ -36,6 +40,27 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Once a client paginating backwards gets within this many pages of a backward
+# extremity, we start backfilling the next page of history in the background.
+BACKFILL_PREFETCH_PAGES = 4
+
+# The maximum number of rooms which we will prefetch history for at once.
+MAX_CONCURRENT_BACKFILL_PREFETCHES = 5
+
+backfill_prefetch_counter = Counter(
+    "synapse_handlers_pagination_backfill_prefetches",
+    "Number of speculative backfills run ahead of clients paginating",
+    ["outcome"],
+)
+
+backfill_prefetch_hits_counter = Counter(
+    "synapse_handlers_pagination_backfill_prefetch_hits",
+    "Outcome of pagination requests in rooms which we have prefetched history "
+    "for: 'hit' if no further backfill was needed, 'wait' if the request had "
+    "to wait for a prefetch to finish, and 'miss' if it still had to backfill",
+    ["outcome"],
+)
+
 
 class PurgeStatus:
     """Object tracking the status of a purge request
@@ -82,6 +107,17 @@ class PaginationHandler:
         self._server_name = hs.hostname
 
         self.pagination_lock = ReadWriteLock()
+
+        # map from room ID to the in-flight backfill prefetch for that room.
+        self._backfill_prefetches = {}  # type: Dict[str, ObservableDeferred]
+        # rooms with a completed prefetch which no request has used yet. Only
+        # used for metrics, so we don't mind forgetting about rooms.
+        self._backfill_prefetched_rooms = ExpiringCache(
+            cache_name="backfill_prefetched_rooms",
+            clock=self.clock,
+            max_len=1000,
+            expiry_ms=30 * 60 * 1000,
+        )
         self._purges_in_progress_by_room = set()  # type: Set[str]
         # map from purge id to PurgeStatus
         self._purges_by_id = {}  # type: Dict[str, PurgeStatus]
@@ -313,6 +349,76 @@ class PaginationHandler:
 
             await self.storage.purge_events.purge_room(room_id)
 
+    def _maybe_prefetch_backfill(
+        self, room_id: str, current_depth: int, limit: int
+    ) -> None:
+        """Start backfilling the next page of history for the room in the
+        background, if the client is getting close to a backward extremity.
+
+        This means that the client's next few requests can hopefully be served
+        from the database, rather than each waiting for a backfill.
+
+        Args:
+            room_id
+            current_depth: The depth the client is paginating from.
+            limit: The number of events the client is requesting per page.
+        """
+        if room_id in self._backfill_prefetches:
+            return
+
+        if len(self._backfill_prefetches) >= MAX_CONCURRENT_BACKFILL_PREFETCHES:
+            backfill_prefetch_counter.labels("skipped").inc()
+            return
+
+        run_as_background_process(
+            "backfill_prefetch", self._prefetch_backfill, room_id, current_depth, limit
+        )
+
+    async def _prefetch_backfill(
+        self, room_id: str, current_depth: int, limit: int
+    ) -> None:
+        """Backfill from the deepest backward extremity of the room, if it is
+        within `BACKFILL_PREFETCH_PAGES` pages of `current_depth`.
+        """
+        extremities = await self.store.get_oldest_events_with_depth_in_room(room_id)
+        if not extremities:
+            return
+
+        max_depth = max(extremities.values())
+        if current_depth - BACKFILL_PREFETCH_PAGES * limit > max_depth:
+            return
+
+        # check again, since we awaited above.
+        if room_id in self._backfill_prefetches:
+            return
+
+        if len(self._backfill_prefetches) >= MAX_CONCURRENT_BACKFILL_PREFETCHES:
+            backfill_prefetch_counter.labels("skipped").inc()
+            return
+
+        prefetch = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+        self._backfill_prefetches[room_id] = prefetch
+
+        try:
+            with await self.pagination_lock.read(room_id):
+                # Asking for history from the deepest extremity makes
+                # `maybe_backfill` fetch the page beyond it.
+                backfilled = await self.hs.get_federation_handler().maybe_backfill(
+                    room_id, max_depth, limit=limit
+                )
+
+            if backfilled:
+                backfill_prefetch_counter.labels("backfilled").inc()
+                self._backfill_prefetched_rooms[room_id] = True
+            else:
+                backfill_prefetch_counter.labels("nothing").inc()
+        except Exception:
+            backfill_prefetch_counter.labels("failed").inc()
+            logger.exception("Error prefetching history for %s", room_id)
+        finally:
+            self._backfill_prefetches.pop(room_id, None)
+            prefetch.callback(None)
+
     async def get_messages(
         self,
         requester: Requester,
@@ -346,6 +452,16 @@ class PaginationHandler:
 
         room_token = from_token.room_key
 
+        if pagin_config.direction == "b":
+            # If we're already fetching history for this room, wait for that
+            # to finish rather than racing it. We must do this before taking
+            # the lock, as the prefetch takes it too.
+            prefetch = self._backfill_prefetches.get(room_id)
+            if prefetch:
+                backfill_prefetch_hits_counter.labels("wait").inc()
+                await make_deferred_yieldable(prefetch.observe())
+                self._backfill_prefetched_rooms.pop(room_id, None)
+
         with await self.pagination_lock.read(room_id):
             (
                 membership,
@@ -383,10 +499,15 @@ class PaginationHandler:
                             "room_key", leave_token
                         )
 
-                await self.hs.get_federation_handler().maybe_backfill(
+                backfilled = await self.hs.get_federation_handler().maybe_backfill(
                     room_id, curr_topo, limit=pagin_config.limit,
                 )
 
+                if self._backfill_prefetched_rooms.pop(room_id, None):
+                    backfill_prefetch_hits_counter.labels(
+                        "miss" if backfilled else "hit"
+                    ).inc()
+
             to_room_key = None
             if pagin_config.to_token:
                 to_room_key = pagin_config.to_token.room_key
@@ -402,6 +523,11 @@ class PaginationHandler:
 
             next_token = from_token.copy_and_replace("room_key", next_key)
 
+        if pagin_config.direction == "b":
+            # We check whether to prefetch once we've released the lock, so
+            # that we don't hold up purges while we look up the extremities.
+            self._maybe_prefetch_backfill(room_id, curr_topo, pagin_config.limit)
+
         if events:
             if event_filter:
                 events = event_filter.filter(events)
@@ -25,7 +25,7 @@ The methods that define policy are:
 import abc
 import logging
 from contextlib import contextmanager
-from typing import TYPE_CHECKING, Dict, Iterable, List, Set, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
 
 from prometheus_client import Counter
 from typing_extensions import ContextManager
@@ -38,13 +38,19 @@ from synapse.logging.context import run_in_background
 from synapse.logging.utils import log_function
 from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
-from synapse.state import StateHandler
+from synapse.replication.http.federation import ReplicationFederationSendEduRestServlet
+from synapse.replication.http.presence import (
+    ReplicationBumpPresenceActiveTime,
+    ReplicationPresenceSendToRemotes,
+    ReplicationPresenceSetState,
+)
+from synapse.replication.tcp.commands import ClearUserSyncsCommand
 from synapse.storage.databases.main import DataStore
 from synapse.types import Collection, JsonDict, UserID, get_domain_from_id
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches.descriptors import cached
 from synapse.util.metrics import Measure
-from synapse.util.wheel_timer import WheelTimer
+from synapse.util.wheel_timer import KeyedWheelTimer
 
 if TYPE_CHECKING:
     from synapse.server import HomeServer
@@ -94,6 +100,10 @@ FEDERATION_PING_INTERVAL = 25 * 60 * 1000
 # are dead.
 EXTERNAL_PROCESS_EXPIRY = 5 * 60 * 1000
 
+# How long to wait before telling the presence writer that a user has stopped
+# syncing, in case they come straight back.
+UPDATE_SYNCING_USERS_MS = 10 * 1000
+
 assert LAST_ACTIVE_GRANULARITY < IDLE_TIMER
 
 
@@ -101,12 +111,40 @@ class BasePresenceHandler(abc.ABC):
     """Parts of the PresenceHandler that are shared between workers and master"""
 
     def __init__(self, hs: "HomeServer"):
+        self.hs = hs
         self.clock = hs.get_clock()
         self.store = hs.get_datastore()
+        self.notifier = hs.get_notifier()
+        self.instance_id = hs.get_instance_id()
+        self._instance_name = hs.get_instance_name()
+        self._presence_enabled = hs.config.use_presence
+        self._presence_shard_config = hs.config.worker.presence_shard_config
 
         active_presence = self.store.take_presence_startup_info()
         self.user_to_current_state = {state.user_id: state for state in active_presence}
 
+        self._bump_active_client = ReplicationBumpPresenceActiveTime.make_client(hs)
+        self._set_state_client = ReplicationPresenceSetState.make_client(hs)
+        self._send_edu_client = ReplicationFederationSendEduRestServlet.make_client(hs)
+
+        # The number of ongoing syncs on this process for users whose presence
+        # is handled by another process, by user id. Empty if
+        # _presence_enabled is false.
+        self._user_to_num_forwarded_syncs = {}  # type: Dict[str, int]
+
+        # user_id -> last_sync_ms. Lists the users that have stopped syncing
+        # but we haven't notified their presence writer of that yet
+        self.users_going_offline = {}  # type: Dict[str, int]
+
+        self._send_stop_syncing_loop = self.clock.looping_call(
+            self.send_stop_syncing, UPDATE_SYNCING_USERS_MS
+        )
+
+    def _is_mine_to_handle(self, user_id: str) -> bool:
+        """Whether this process is the presence writer for the given user.
+        """
+        return self._presence_shard_config.get_instance(user_id) == self._instance_name
+
     @abc.abstractmethod
     async def user_syncing(
         self, user_id: str, affect_presence: bool
@@ -125,7 +163,6 @@ class BasePresenceHandler(abc.ABC):
                 client that is being used by a user.
         """
 
-    @abc.abstractmethod
     def get_currently_syncing_users_for_replication(self) -> Iterable[str]:
         """Get an iterable of syncing users on this worker, to send to the presence handler
 
@@ -136,6 +173,140 @@ class BasePresenceHandler(abc.ABC):
         Returns:
             An iterable of user_id strings.
         """
+        return [
+            user_id
+            for user_id, count in self._user_to_num_forwarded_syncs.items()
+            if count > 0
+        ]
+
+    def send_user_sync(self, user_id, is_syncing, last_sync_ms):
+        if self._presence_enabled:
+            self.hs.get_tcp_replication().send_user_sync(
+                self.instance_id, user_id, is_syncing, last_sync_ms
+            )
+
+    def send_clear_user_syncs(self):
+        """Tell the presence writers that none of the users we told them about
+        are syncing on this process any more.
+        """
+        if self._presence_enabled:
+            self.hs.get_tcp_replication().send_command(
+                ClearUserSyncsCommand(self.instance_id)
+            )
+
+    def mark_as_coming_online(self, user_id):
+        """A user has started syncing. Send a UserSync to their presence writer,
+        unless they had recently stopped syncing.
+
+        Args:
+            user_id (str)
+        """
+        going_offline = self.users_going_offline.pop(user_id, None)
+        if not going_offline:
+            # Safe to skip because we haven't yet told the writer they were offline
+            self.send_user_sync(user_id, True, self.clock.time_msec())
+
+    def mark_as_going_offline(self, user_id):
+        """A user has stopped syncing. We wait before notifying their presence
+        writer as its likely they'll come back soon. This allows us to avoid
+        sending a stopped syncing immediately followed by a started syncing
+        notification to the writer
+
+        Args:
+            user_id (str)
+        """
+        self.users_going_offline[user_id] = self.clock.time_msec()
+
+    def send_stop_syncing(self):
+        """Check if there are any users who have stopped syncing a while ago
+        and haven't come back yet. If there are poke their presence writer
+        about them.
+        """
+        now = self.clock.time_msec()
+        for user_id, last_sync_ms in list(self.users_going_offline.items()):
+            if now - last_sync_ms > UPDATE_SYNCING_USERS_MS:
+                self.users_going_offline.pop(user_id, None)
+                self.send_user_sync(user_id, False, last_sync_ms)
+
+    def _forwarded_user_syncing(self, user_id: str) -> ContextManager[None]:
+        """Record that a user whose presence is handled by another process is
+        syncing against this one, telling their presence writer over
+        replication.
+        """
+        curr_sync = self._user_to_num_forwarded_syncs.get(user_id, 0)
+        self._user_to_num_forwarded_syncs[user_id] = curr_sync + 1
+
+        # If we went from no in flight sync to some, notify replication
+        if self._user_to_num_forwarded_syncs[user_id] == 1:
+            self.mark_as_coming_online(user_id)
+
+        def _end():
+            # We check that the user_id is in _user_to_num_forwarded_syncs
+            # because it may have been cleared if we are shutting down.
+            if user_id in self._user_to_num_forwarded_syncs:
+                self._user_to_num_forwarded_syncs[user_id] -= 1
+
+                # If we went from one in flight sync to non, notify replication
+                if self._user_to_num_forwarded_syncs[user_id] == 0:
+                    self.mark_as_going_offline(user_id)
+
+        @contextmanager
+        def _user_syncing():
+            try:
+                yield
+            finally:
+                _end()
+
+        return _user_syncing()
+
+    async def _forward_set_state(
+        self, user_id: str, state: JsonDict, ignore_status_msg: bool
+    ) -> None:
+        """Proxy a presence update to the writer handling the user."""
+        await self._set_state_client(
+            instance_name=self._presence_shard_config.get_instance(user_id),
+            user_id=user_id,
+            state=state,
+            ignore_status_msg=ignore_status_msg,
+        )
+
+    async def _forward_bump_presence_active_time(self, user_id: str) -> None:
+        """Proxy an activity bump to the writer handling the user."""
+        await self._bump_active_client(
+            instance_name=self._presence_shard_config.get_instance(user_id),
+            user_id=user_id,
+        )
+
+    async def _forward_incoming_presence(
+        self, origin: str, pushes: List[JsonDict]
+    ) -> None:
+        """Forward the pushes of a `m.presence` EDU to the presence writers
+        handling the users they are about.
+        """
+        pushes_by_instance = {}  # type: Dict[str, List[JsonDict]]
+        for push in pushes:
+            user_id = push.get("user_id", None)
+            if not isinstance(user_id, str):
+                logger.info(
+                    "Got presence update from %r with no 'user_id': %r", origin, push
+                )
+                continue
+
+            instance_name = self._presence_shard_config.get_instance(user_id)
+            pushes_by_instance.setdefault(instance_name, []).append(push)
+
+        for instance_name, instance_pushes in pushes_by_instance.items():
+            try:
+                await self._send_edu_client(
+                    instance_name=instance_name,
+                    edu_type="m.presence",
+                    origin=origin,
+                    content={"push": instance_pushes},
+                )
+            except Exception:
+                logger.exception(
+                    "Failed to forward presence from %r to %s", origin, instance_name
+                )
 
     async def get_state(self, target_user: UserID) -> UserPresenceState:
         results = await self.get_states([target_user.to_string()])
@@ -196,18 +367,170 @@ class BasePresenceHandler(abc.ABC):
         with the app.
         """
 
+    async def is_visible(self, observed_user, observer_user):
+        """Returns whether a user can see another user's presence.
+        """
+        observer_room_ids = await self.store.get_rooms_for_user(
+            observer_user.to_string()
+        )
+        observed_room_ids = await self.store.get_rooms_for_user(
+            observed_user.to_string()
+        )
+
+        if observer_room_ids & observed_room_ids:
+            return True
+
+        return False
+
+    async def notify_from_replication(self, states, stream_id):
+        parties = await get_interested_parties(self.store, states)
+        room_ids_to_states, users_to_states = parties
+
+        self.notifier.on_new_event(
+            "presence_key",
+            stream_id,
+            rooms=room_ids_to_states.keys(),
+            users=users_to_states.keys(),
+        )
+
+    async def process_replication_rows(self, token, rows):
+        """Process presence stream rows received over replication from a
+        presence writer.
+        """
+        states = [
+            UserPresenceState(
+                row.user_id,
+                row.state,
+                row.last_active_ts,
+                row.last_federation_update_ts,
+                row.last_user_sync_ts,
+                row.status_msg,
+                row.currently_active,
+            )
+            for row in rows
+        ]
+        if not states:
+            return
+
+        for state in states:
+            self.user_to_current_state[state.user_id] = state
+
+        stream_id = token
+        await self.notify_from_replication(states, stream_id)
+
+
+class _NullContextManager(ContextManager[None]):
+    """A context manager which does nothing."""
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class WorkerPresenceHandler(BasePresenceHandler):
+    """Presence handler for processes which are not presence writers.
+
+    Updates are proxied to the writer handling each user, and the in-memory
+    state is kept up to date from the presence replication stream.
+    """
+
+    def __init__(self, hs: "HomeServer"):
+        super().__init__(hs)
+
+        # Incoming presence EDUs may be routed here (e.g. on the main process
+        # when it isn't a presence writer), so pass them on to the writers.
+        if self._presence_enabled:
+            hs.get_federation_registry().register_edu_handler(
+                "m.presence", self.incoming_presence
+            )
+
+        hs.get_reactor().addSystemEventTrigger(
+            "before",
+            "shutdown",
+            run_as_background_process,
+            "generic_presence.on_shutdown",
+            self._on_shutdown,
+        )
+
+    def _on_shutdown(self):
+        self.send_clear_user_syncs()
+
+    async def user_syncing(
+        self, user_id: str, affect_presence: bool
+    ) -> ContextManager[None]:
+        """Record that a user is syncing.
+
+        Called by the sync and events servlets to record that a user has connected to
+        this worker and is waiting for some events.
+        """
+        if not affect_presence or not self._presence_enabled:
+            return _NullContextManager()
+
+        return self._forwarded_user_syncing(user_id)
+
+    async def incoming_presence(self, origin, content):
+        """Called when we receive a `m.presence` EDU from a remote server.
+        """
+        await self._forward_incoming_presence(origin, content.get("push", []))
+
+    async def set_state(self, target_user, state, ignore_status_msg=False):
+        """Set the presence state of the user.
+        """
+        presence = state["presence"]
+
+        valid_presence = (
+            PresenceState.ONLINE,
+            PresenceState.UNAVAILABLE,
+            PresenceState.OFFLINE,
+        )
+        if presence not in valid_presence:
+            raise SynapseError(400, "Invalid presence state")
+
+        user_id = target_user.to_string()
+
+        # If presence is disabled, no-op
+        if not self._presence_enabled:
+            return
+
+        # Proxy request to the presence writer
+        await self._forward_set_state(user_id, state, ignore_status_msg)
+
+    async def bump_presence_active_time(self, user):
+        """We've seen the user do something that indicates they're interacting
+        with the app.
+        """
+        # If presence is disabled, no-op
+        if not self._presence_enabled:
+            return
+
+        # Proxy request to the presence writer
+        await self._forward_bump_presence_active_time(user.to_string())
+
 
 class PresenceHandler(BasePresenceHandler):
+    """Presence handler for presence writers.
+
+    When there are multiple presence writers users are sharded between them by
+    user ID; each writer only runs the state machine for the users it handles,
+    and proxies updates for other users to their writer.
+    """
+
     def __init__(self, hs: "HomeServer"):
         super().__init__(hs)
-        self.hs = hs
         self.is_mine_id = hs.is_mine_id
         self.server_name = hs.hostname
-        self.wheel_timer = WheelTimer()
-        self.notifier = hs.get_notifier()
-        self.federation = hs.get_federation_sender()
+        self.wheel_timer = KeyedWheelTimer()
         self.state = hs.get_state_handler()
-        self._presence_enabled = hs.config.use_presence
+
+        # Only the main process can send federation traffic, so presence
+        # writers on workers hand their updates to it.
+        if hs.config.worker_app is None:
+            self.federation = hs.get_federation_sender()
+            self._send_to_remotes_client = None
+        else:
+            self.federation = None
+            self._send_to_remotes_client = ReplicationPresenceSendToRemotes.make_client(
+                hs
+            )
 
         federation_registry = hs.get_federation_registry()
 
@@ -220,28 +543,13 @@ class PresenceHandler(BasePresenceHandler):
             lambda: len(self.user_to_current_state),
         )
 
+        # Each user only has a single timer, for the earliest time at which
+        # their presence might need to change. It is rescheduled whenever their
+        # presence is updated or the timer fires.
         now = self.clock.time_msec()
         for state in self.user_to_current_state.values():
-            self.wheel_timer.insert(
-                now=now, obj=state.user_id, then=state.last_active_ts + IDLE_TIMER
-            )
-            self.wheel_timer.insert(
-                now=now,
-                obj=state.user_id,
-                then=state.last_user_sync_ts + SYNC_ONLINE_TIMEOUT,
-            )
-            if self.is_mine_id(state.user_id):
-                self.wheel_timer.insert(
-                    now=now,
-                    obj=state.user_id,
-                    then=state.last_federation_update_ts + FEDERATION_PING_INTERVAL,
-                )
-            else:
-                self.wheel_timer.insert(
-                    now=now,
-                    obj=state.user_id,
-                    then=state.last_federation_update_ts + FEDERATION_TIMEOUT,
-                )
+            if self._is_mine_to_handle(state.user_id):
+                self._schedule_timeout(now, state, is_syncing=False)
 
         # Set of users who have presence in the `user_to_current_state` that
         # have not yet been persisted
@@ -336,6 +644,11 @@ class PresenceHandler(BasePresenceHandler):
             )
         logger.info("Finished _on_shutdown")
 
+        # Tell the other presence writers that the users we were proxying
+        # syncs for have stopped syncing here.
+        if len(self._presence_shard_config.instances) > 1:
+            self.send_clear_user_syncs()
+
     async def _persist_unpersisted_changes(self):
         """We periodically persist the unpersisted changes, as otherwise they
         may stack up and slow down shutdown times.
@@ -390,6 +703,9 @@ class PresenceHandler(BasePresenceHandler):
                 )
 
                 self.user_to_current_state[user_id] = new_state
+                self._schedule_timeout(
+                    now, new_state, is_syncing=self._is_syncing(user_id)
+                )
 
                 if should_notify:
                     to_notify[user_id] = new_state
@@ -467,8 +783,39 @@ class PresenceHandler(BasePresenceHandler):
             now=now,
         )
 
+        # Users whose presence has changed get a new timer from
+        # `_update_states`; everyone else we checked needs their next timer
+        # scheduled here, as it will have been dropped when the earlier one
+        # fired.
+        changed_user_ids = {state.user_id for state in changes}
+        for state in states:
+            if state.user_id not in changed_user_ids:
+                self._schedule_timeout(
+                    now, state, is_syncing=state.user_id in syncing_user_ids
+                )
+
         return await self._update_states(changes)
 
+    def _schedule_timeout(
+        self, now: int, state: UserPresenceState, is_syncing: bool
+    ) -> None:
+        """Set the user's timer for the next time their presence may need to
+        time out, if any.
+        """
+        then = get_next_timeout(state, self.is_mine_id(state.user_id), is_syncing)
+        if then is not None:
+            self.wheel_timer.insert(now=now, obj=state.user_id, then=then)
+
+    def _is_syncing(self, user_id: str) -> bool:
+        """Whether the user has a sync ongoing on this or any other process.
+        """
+        if self.user_to_num_current_syncs.get(user_id):
+            return True
+        return any(
+            user_id in user_ids
+            for user_ids in self.external_process_to_current_syncs.values()
+        )
+
     async def bump_presence_active_time(self, user):
         """We've seen the user do something that indicates they're interacting
         with the app.
@@ -479,6 +826,10 @@ class PresenceHandler(BasePresenceHandler):
 
         user_id = user.to_string()
 
+        if not self._is_mine_to_handle(user_id):
+            await self._forward_bump_presence_active_time(user_id)
+            return
+
         bump_active_time_counter.inc()
 
         prev_state = await self.current_state_for_user(user_id)
@@ -510,6 +861,11 @@ class PresenceHandler(BasePresenceHandler):
         if not self.hs.config.use_presence:
             affect_presence = False
 
+        if affect_presence and not self._is_mine_to_handle(user_id):
+            # Another writer handles this user's presence, so just tell it
+            # that they're syncing here.
+            return self._forwarded_user_syncing(user_id)
+
         if affect_presence:
             curr_sync = self.user_to_num_current_syncs.get(user_id, 0)
             self.user_to_num_current_syncs[user_id] = curr_sync + 1
@@ -561,10 +917,6 @@ class PresenceHandler(BasePresenceHandler):
 
         return _user_syncing()
 
-    def get_currently_syncing_users_for_replication(self) -> Iterable[str]:
-        # since we are the process handling presence, there is nothing to do here.
-        return []
-
     async def update_external_syncs_row(
         self, process_id, user_id, is_syncing, sync_time_msec
     ):
@@ -578,6 +930,11 @@ class PresenceHandler(BasePresenceHandler):
             is_syncing (bool): Whether or not the user is now syncing
             sync_time_msec(int): Time in ms when the user was last syncing
         """
+        if not self._is_mine_to_handle(user_id):
+            # USER_SYNC commands go to all presence writers; only the writer
+            # handling the user cares.
+            return
+
         with (await self.external_sync_linearizer.queue(process_id)):
             prev_state = await self.current_state_for_user(user_id)
 
@@ -658,6 +1015,12 @@ class PresenceHandler(BasePresenceHandler):
 
         self._push_to_remotes(states)
 
+    async def process_replication_rows(self, token, rows):
+        # We're the source of truth for the users we handle, so only take
+        # updates for users handled by other writers.
+        rows = [row for row in rows if not self._is_mine_to_handle(row.user_id)]
+        await super().process_replication_rows(token, rows)
+
     async def notify_for_states(self, state, stream_id):
         parties = await get_interested_parties(self.store, [state])
         room_ids_to_states, users_to_states = parties
@@ -675,7 +1038,34 @@ class PresenceHandler(BasePresenceHandler):
         Args:
             states (list(UserPresenceState))
         """
-        self.federation.send_presence(states)
+        if self.federation:
+            self.federation.send_presence(states)
+        else:
+            run_as_background_process(
+                "presence.send_to_remotes",
+                self._send_to_remotes_client,
+                states=states,
+                destinations=None,
+            )
+
+    def _push_to_destinations(self, states, destinations):
+        """Sends state updates to the given remote servers.
+
+        Args:
+            states (list(UserPresenceState))
+            destinations (Collection[str])
+        """
+        if self.federation:
+            self.federation.send_presence_to_destinations(
+                states=states, destinations=destinations
+            )
+        else:
+            run_as_background_process(
+                "presence.send_to_destinations",
+                self._send_to_remotes_client,
+                states=states,
+                destinations=list(destinations),
+            )
 
     async def incoming_presence(self, origin, content):
         """Called when we receive a `m.presence` EDU from a remote server.
@@ -685,6 +1075,7 @@ class PresenceHandler(BasePresenceHandler):
 
         now = self.clock.time_msec()
         updates = []
+        forward = []
         for push in content.get("push", []):
             # A "push" contains a list of presence that we are probably interested
             # in.
@@ -703,6 +1094,10 @@ class PresenceHandler(BasePresenceHandler):
                 )
                 continue
 
+            if not self._is_mine_to_handle(user_id):
+                forward.append(push)
+                continue
+
             presence_state = push.get("presence", None)
             if not presence_state:
                 logger.info(
@@ -728,6 +1123,9 @@ class PresenceHandler(BasePresenceHandler):
             federation_presence_counter.inc(len(updates))
             await self._update_states(updates)
 
+        if forward:
+            await self._forward_incoming_presence(origin, forward)
+
     async def set_state(self, target_user, state, ignore_status_msg=False):
         """Set the presence state of the user.
         """
@@ -744,6 +1142,10 @@ class PresenceHandler(BasePresenceHandler):
 
         user_id = target_user.to_string()
 
+        if not self._is_mine_to_handle(user_id):
+            await self._forward_set_state(user_id, state, ignore_status_msg)
+            return
+
         prev_state = await self.current_state_for_user(user_id)
 
         new_fields = {"state": presence}
@@ -757,21 +1159,6 @@ class PresenceHandler(BasePresenceHandler):
 
         await self._update_states([prev_state.copy_and_replace(**new_fields)])
 
-    async def is_visible(self, observed_user, observer_user):
-        """Returns whether a user can see another user's presence.
-        """
-        observer_room_ids = await self.store.get_rooms_for_user(
-            observer_user.to_string()
-        )
-        observed_room_ids = await self.store.get_rooms_for_user(
-            observed_user.to_string()
-        )
-
-        if observer_room_ids & observed_room_ids:
-            return True
-
-        return False
-
     async def get_all_presence_updates(
         self, instance_name: str, last_id: int, current_id: int, limit: int
     ) -> Tuple[List[Tuple[int, list]], int, bool]:
@@ -788,8 +1175,7 @@ class PresenceHandler(BasePresenceHandler):
         - currently_active(int)
 
         Args:
-            instance_name: The writer we want to fetch updates from. Unused
-                here since there is only ever one writer.
+            instance_name: The writer we want to fetch updates from.
             last_id: The token to fetch updates from. Exclusive.
             current_id: The token to fetch updates up to. Inclusive.
             limit: The requested limit for the number of rows to return. The
@@ -900,6 +1286,10 @@ class PresenceHandler(BasePresenceHandler):
         """
 
         if self.is_mine_id(user_id):
+            if not self._is_mine_to_handle(user_id):
+                # Their presence writer will send it out.
+                return
+
             # If this is a local user then we need to send their presence
             # out to hosts in the room (who don't already have it)
 
@@ -912,9 +1302,7 @@ class PresenceHandler(BasePresenceHandler):
             # Filter out ourselves.
             hosts = {host for host in hosts if host != self.server_name}
 
-            self.federation.send_presence_to_destinations(
-                states=[state], destinations=hosts
-            )
+            self._push_to_destinations(states=[state], destinations=hosts)
         else:
             # A remote user has joined the room, so we need to:
             #   1. Check if this is a new server in the room
@@ -927,8 +1315,12 @@ class PresenceHandler(BasePresenceHandler):
             # TODO: Check that this is actually a new server joining the
             # room.
 
+            # Each presence writer sends the presence of the local users it
+            # handles.
             users = await self.state.get_current_users_in_room(room_id)
-            user_ids = list(filter(self.is_mine_id, users))
+            user_ids = [
+                u for u in users if self.is_mine_id(u) and self._is_mine_to_handle(u)
+            ]
 
             states_d = await self.current_state_for_users(user_ids)
 
@@ -947,7 +1339,7 @@ class PresenceHandler(BasePresenceHandler):
             ]
 
             if states:
-                self.federation.send_presence_to_destinations(
+                self._push_to_destinations(
                     states=states, destinations=[get_domain_from_id(user_id)]
                 )
 
@@ -1216,6 +1608,40 @@ def handle_timeout(state, is_mine, syncing_user_ids, now):
     return state if changed else None
 
 
+def get_next_timeout(
+    state: UserPresenceState, is_mine: bool, is_syncing: bool
+) -> Optional[int]:
+    """Get the earliest time at which `handle_timeout` might change the
+    given presence state.
+
+    Args:
+        state
+        is_mine: Whether the user is ours
+        is_syncing: Whether the user has any ongoing syncs.
+
+    Returns:
+        The time in ms, or None if the state will never time out.
+    """
+    if state.state == PresenceState.OFFLINE:
+        return None
+
+    if not is_mine:
+        return state.last_federation_update_ts + FEDERATION_TIMEOUT
+
+    timeouts = [state.last_federation_update_ts + FEDERATION_PING_INTERVAL]
+
+    if state.state == PresenceState.ONLINE:
+        timeouts.append(state.last_active_ts + IDLE_TIMER)
+        if state.currently_active:
+            timeouts.append(state.last_active_ts + LAST_ACTIVE_GRANULARITY)
+
+    if not is_syncing:
+        sync_or_active = max(state.last_user_sync_ts, state.last_active_ts)
+        timeouts.append(sync_or_active + SYNC_ONLINE_TIMEOUT)
+
+    return min(timeouts)
+
+
 def handle_update(prev_state, new_state, is_mine, wheel_timer, now):
     """Given a presence update:
         1. Add any appropriate timers.
@@ -1303,10 +1729,13 @@ async def get_interested_parties(
     """
     room_ids_to_states = {}  # type: Dict[str, List[UserPresenceState]]
     users_to_states = {}  # type: Dict[str, List[UserPresenceState]]
+
+    rooms_by_user = await store.get_rooms_for_users_with_stream_ordering(
+        [state.user_id for state in states]
+    )
     for state in states:
-        room_ids = await store.get_rooms_for_user(state.user_id)
-        for room_id in room_ids:
-            room_ids_to_states.setdefault(room_id, []).append(state)
+        for room in rooms_by_user.get(state.user_id, ()):
+            room_ids_to_states.setdefault(room.room_id, []).append(state)
 
         # Always notify self
         users_to_states.setdefault(state.user_id, []).append(state)
@@ -1315,8 +1744,8 @@ async def get_interested_parties(
 
 
 async def get_interested_remotes(
-    store: DataStore, states: List[UserPresenceState], state_handler: StateHandler
-) -> List[Tuple[Collection[str], List[UserPresenceState]]]:
+    store: DataStore, states: List[UserPresenceState]
+) -> Dict[str, Dict[str, UserPresenceState]]:
     """Given a list of presence states figure out which remote servers
     should be sent which.
 
@@ -1325,26 +1754,30 @@ async def get_interested_remotes(
     Args:
         store
         states
-        state_handler
 
     Returns:
-        A list of 2-tuples of destinations and states, where for
-        each tuple the list of UserPresenceState should be sent to each
-        destination
+        A map from destination to the states to send to it, keyed by user ID.
+        Each state appears at most once per destination, however many rooms
+        the destination shares with the user.
     """
-    hosts_and_states = []  # type: List[Tuple[Collection[str], List[UserPresenceState]]]
-
     # First we look up the rooms each user is in (as well as any explicit
     # subscriptions), then for each distinct room we look up the remote
     # hosts in those rooms.
     room_ids_to_states, users_to_states = await get_interested_parties(store, states)
 
-    for room_id, states in room_ids_to_states.items():
-        hosts = await state_handler.get_current_hosts_in_room(room_id)
-        hosts_and_states.append((hosts, states))
+    hosts_by_room = await store.get_current_hosts_in_rooms(list(room_ids_to_states))
+
+    states_by_destination = {}  # type: Dict[str, Dict[str, UserPresenceState]]
+    for room_id, room_states in room_ids_to_states.items():
+        for host in hosts_by_room.get(room_id, ()):
+            dest_states = states_by_destination.setdefault(host, {})
+            for state in room_states:
+                dest_states[state.user_id] = state
 
-    for user_id, states in users_to_states.items():
+    for user_id, user_states in users_to_states.items():
         host = get_domain_from_id(user_id)
-        hosts_and_states.append(([host], states))
+        dest_states = states_by_destination.setdefault(host, {})
+        for state in user_states:
+            dest_states[state.user_id] = state
 
-    return hosts_and_states
+    return states_by_destination
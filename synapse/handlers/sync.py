@@ -20,10 +20,13 @@ from typing import TYPE_CHECKING, Any, Dict, FrozenSet, List, Optional, Set, Tup
 import attr
 from prometheus_client import Counter
 
+from twisted.internet import defer
+
 from synapse.api.constants import AccountDataTypes, EventTypes, Membership
 from synapse.api.filtering import FilterCollection
 from synapse.events import EventBase
-from synapse.logging.context import current_context
+from synapse.logging.context import current_context, make_deferred_yieldable
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.push.clientformat import format_push_rules_for_user
 from synapse.storage.roommember import MemberSummary
 from synapse.storage.state import StateFilter
@@ -37,7 +40,7 @@ from synapse.types import (
     StreamToken,
     UserID,
 )
-from synapse.util.async_helpers import concurrently_execute
+from synapse.util.async_helpers import ObservableDeferred, concurrently_execute
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
@@ -235,6 +238,19 @@ class SyncResult:
         )
 
 
+class _PendingToDeviceFetch:
+    """A fetch of to-device messages for some of a user's devices, which is
+    waiting for an earlier fetch for the user to finish.
+    """
+
+    __slots__ = ["stream_ids", "deferred"]
+
+    def __init__(self):
+        # map from device ID to the (since, now) to-device stream positions
+        self.stream_ids = {}  # type: Dict[str, Tuple[int, int]]
+        self.deferred = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+
+
 class SyncHandler:
     def __init__(self, hs: "HomeServer"):
         self.hs_config = hs.config
@@ -259,6 +275,11 @@ class SyncHandler:
             expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
         )
 
+        # Users with a fetch of to-device messages in flight, and the fetches
+        # for their other devices which are waiting for it to finish.
+        self._to_device_fetches_in_flight = set()  # type: Set[str]
+        self._pending_to_device_fetches = {}  # type: Dict[str, _PendingToDeviceFetch]
+
     async def wait_for_sync_for_user(
         self,
         requester: Requester,
@@ -1209,16 +1230,8 @@ class SyncHandler:
         if since_stream_id != int(now_token.to_device_key):
             # We only delete messages when a new message comes in, but that's
             # fine so long as we delete them at some point.
-
-            deleted = await self.store.delete_messages_for_device(
-                user_id, device_id, since_stream_id
-            )
-            logger.debug(
-                "Deleted %d to-device messages up to %d", deleted, since_stream_id
-            )
-
-            messages, stream_id = await self.store.get_new_messages_for_device(
-                user_id, device_id, since_stream_id, now_token.to_device_key
+            messages, stream_id = await self._get_to_device_messages(
+                user_id, device_id, since_stream_id, int(now_token.to_device_key)
             )
 
             logger.debug(
@@ -1235,6 +1248,78 @@ class SyncHandler:
         else:
             sync_result_builder.to_device = []
 
+    async def _get_to_device_messages(
+        self, user_id: str, device_id: str, since_stream_id: int, now_stream_id: int
+    ) -> Tuple[List[JsonDict], int]:
+        """Delete the to-device messages which the device has received, and
+        fetch its new ones.
+
+        Messages are often sent to all of a user's devices at once, which then
+        all sync at about the same time. So while a fetch for one of the
+        user's devices is in flight, fetches for their other devices are
+        queued up and then done together.
+
+        Returns:
+            The messages, and where in the to-device stream they got to.
+        """
+        stream_ids = {device_id: (since_stream_id, now_stream_id)}
+
+        if user_id not in self._to_device_fetches_in_flight:
+            self._to_device_fetches_in_flight.add(user_id)
+            try:
+                results = await self._fetch_to_device_messages(user_id, stream_ids)
+            finally:
+                self._start_pending_to_device_fetch(user_id)
+            return results[device_id]
+
+        pending = self._pending_to_device_fetches.get(user_id)
+        if pending is None:
+            pending = _PendingToDeviceFetch()
+            self._pending_to_device_fetches[user_id] = pending
+        elif device_id in pending.stream_ids:
+            # This device already has a fetch queued (e.g. from a request
+            # which the client has since retried), so just do ours separately.
+            results = await self._fetch_to_device_messages(user_id, stream_ids)
+            return results[device_id]
+
+        pending.stream_ids.update(stream_ids)
+        results = await make_deferred_yieldable(pending.deferred.observe())
+        return results[device_id]
+
+    def _start_pending_to_device_fetch(self, user_id: str) -> None:
+        """Start the queued fetch of to-device messages for the user, if any.
+        """
+        pending = self._pending_to_device_fetches.pop(user_id, None)
+        if pending is None:
+            self._to_device_fetches_in_flight.discard(user_id)
+            return
+
+        async def _fetch():
+            try:
+                results = await self._fetch_to_device_messages(
+                    user_id, pending.stream_ids
+                )
+            except Exception as e:
+                pending.deferred.errback(e)
+            else:
+                pending.deferred.callback(results)
+            finally:
+                self._start_pending_to_device_fetch(user_id)
+
+        run_as_background_process("fetch_to_device_messages", _fetch)
+
+    async def _fetch_to_device_messages(
+        self, user_id: str, stream_ids: Dict[str, Tuple[int, int]]
+    ) -> Dict[str, Tuple[List[JsonDict], int]]:
+        deleted = await self.store.delete_messages_for_devices(
+            user_id, {device_id: since for device_id, (since, _) in stream_ids.items()}
+        )
+        logger.debug(
+            "Deleted %d to-device messages for %d devices", deleted, len(stream_ids)
+        )
+
+        return await self.store.get_new_messages_for_devices(user_id, stream_ids)
+
     async def _generate_sync_entry_for_account_data(
         self, sync_result_builder: "SyncResultBuilder"
     ) -> Dict[str, Dict[str, JsonDict]]:
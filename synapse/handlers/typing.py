@@ -15,7 +15,9 @@
 import logging
 import random
 from collections import namedtuple
-from typing import TYPE_CHECKING, List, Set, Tuple
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple
+
+from prometheus_client import Counter
 
 from synapse.api.errors import AuthError, ShadowBanError, SynapseError
 from synapse.appservice import ApplicationService
@@ -43,6 +45,22 @@ FEDERATION_TIMEOUT = 60 * 1000
 # How often to resend typing across federation.
 FEDERATION_PING_INTERVAL = 40 * 1000
 
+# How long to collect typing changes in a room for before sending them out
+# over federation, so that changes which are superseded within the window are
+# never sent.
+FEDERATION_BATCH_DELAY = 100
+
+typing_edus_sent_counter = Counter(
+    "synapse_handlers_typing_federation_edus_sent",
+    "Number of typing EDUs queued for sending to remote servers",
+)
+
+typing_edus_saved_counter = Counter(
+    "synapse_handlers_typing_federation_edus_saved",
+    "Number of typing EDUs which were not sent to remote servers because the "
+    "update was superseded within the batching window",
+)
+
 
 class FollowerTypingHandler:
     """A typing handler on a different process than the writer that is updated
@@ -73,6 +91,14 @@ class FollowerTypingHandler:
         self.wheel_timer = WheelTimer(bucket_size=5000)
         self._latest_room_serial = 0
 
+        # map room IDs to the `m.typing` event for the room, along with the
+        # serial it was built at, so that it can be shared between syncs.
+        self._room_typing_events = {}  # type: Dict[str, Tuple[int, JsonDict]]
+
+        # map room IDs to the (user_id, typing) updates for local users
+        # waiting to be sent over federation.
+        self._pending_remote_updates = {}  # type: Dict[str, List[Tuple[str, bool]]]
+
         self.clock.looping_call(self._handle_timeouts, 5000)
 
     def _reset(self):
@@ -85,6 +111,7 @@ class FollowerTypingHandler:
 
         self._member_last_federation_poke = {}
         self.wheel_timer = WheelTimer(bucket_size=5000)
+        self._room_typing_events = {}
 
     def _handle_timeouts(self):
         logger.debug("Checking for typing timeouts")
@@ -106,9 +133,7 @@ class FollowerTypingHandler:
         if self.federation and self.is_mine_id(member.user_id):
             last_fed_poke = self._member_last_federation_poke.get(member, None)
             if not last_fed_poke or last_fed_poke + FEDERATION_PING_INTERVAL <= now:
-                run_as_background_process(
-                    "typing._push_remote", self._push_remote, member=member, typing=True
-                )
+                self._push_remote(member=member, typing=True)
 
         # Add a paranoia timer to ensure that we always have a timer for
         # each person typing.
@@ -117,32 +142,85 @@ class FollowerTypingHandler:
     def is_typing(self, member):
         return member.user_id in self._room_typing.get(member.room_id, [])
 
-    async def _push_remote(self, member, typing):
+    def get_typing_event(self, room_id: str) -> JsonDict:
+        """Get the `m.typing` event for the given room.
+
+        The event is cached until the room's typing serial changes, so callers
+        must not modify it.
+        """
+        serial = self._room_serials[room_id]
+        cached = self._room_typing_events.get(room_id)
+        if cached and cached[0] == serial:
+            return cached[1]
+
+        event = {
+            "type": "m.typing",
+            "room_id": room_id,
+            "content": {"user_ids": list(self._room_typing[room_id])},
+        }
+        self._room_typing_events[room_id] = (serial, event)
+        return event
+
+    def _push_remote(self, member, typing):
+        """Queue a typing update for a local user to be sent to the other
+        servers in the room.
+
+        Updates are collected per room for `FEDERATION_BATCH_DELAY` ms, and
+        only the latest update for each user is sent.
+        """
         if not self.federation:
             return
 
+        pending = self._pending_remote_updates.get(member.room_id)
+        if pending is None:
+            pending = self._pending_remote_updates[member.room_id] = []
+            self.clock.call_later(
+                FEDERATION_BATCH_DELAY / 1000,
+                run_as_background_process,
+                "typing._push_remote",
+                self._send_pending_remote_updates,
+                member.room_id,
+            )
+
+        pending.append((member.user_id, typing))
+
+    async def _send_pending_remote_updates(self, room_id: str):
+        updates = self._pending_remote_updates.pop(room_id, [])
+
+        # Only the latest update for each user is worth sending.
+        latest = dict(updates)
+
         try:
-            users = await self.store.get_users_in_room(member.room_id)
-            self._member_last_federation_poke[member] = self.clock.time_msec()
+            hosts = await self.store.get_current_hosts_in_room(room_id)
 
             now = self.clock.time_msec()
-            self.wheel_timer.insert(
-                now=now, obj=member, then=now + FEDERATION_PING_INTERVAL
-            )
+            for user_id in latest:
+                member = RoomMember(room_id, user_id)
+                self._member_last_federation_poke[member] = now
+                self.wheel_timer.insert(
+                    now=now, obj=member, then=now + FEDERATION_PING_INTERVAL
+                )
 
-            for domain in {get_domain_from_id(u) for u in users}:
-                if domain != self.server_name:
-                    logger.debug("sending typing update to %s", domain)
+            destinations = [domain for domain in hosts if domain != self.server_name]
+
+            for domain in destinations:
+                logger.debug("sending typing updates to %s", domain)
+                for user_id, typing in latest.items():
                     self.federation.build_and_send_edu(
                         destination=domain,
                         edu_type="m.typing",
                         content={
-                            "room_id": member.room_id,
-                            "user_id": member.user_id,
+                            "room_id": room_id,
+                            "user_id": user_id,
                             "typing": typing,
                         },
-                        key=member,
+                        key=RoomMember(room_id, user_id),
                     )
+
+            typing_edus_sent_counter.inc(len(destinations) * len(latest))
+            typing_edus_saved_counter.inc(
+                len(destinations) * (len(updates) - len(latest))
+            )
         except Exception:
             logger.exception("Error pushing typing notif to remotes")
 
@@ -168,15 +246,11 @@ class FollowerTypingHandler:
             self._room_typing[row.room_id] = row.user_ids
 
             if self.federation:
-                run_as_background_process(
-                    "_send_changes_in_typing_to_remotes",
-                    self._send_changes_in_typing_to_remotes,
-                    row.room_id,
-                    prev_typing,
-                    now_typing,
+                self._send_changes_in_typing_to_remotes(
+                    row.room_id, prev_typing, now_typing
                 )
 
-    async def _send_changes_in_typing_to_remotes(
+    def _send_changes_in_typing_to_remotes(
         self, room_id: str, prev_typing: Set[str], now_typing: Set[str]
     ):
         """Process a change in typing of a room from replication, sending EDUs
@@ -188,11 +262,11 @@ class FollowerTypingHandler:
 
         for user_id in now_typing - prev_typing:
             if self.is_mine_id(user_id):
-                await self._push_remote(RoomMember(room_id, user_id), True)
+                self._push_remote(RoomMember(room_id, user_id), True)
 
         for user_id in prev_typing - now_typing:
             if self.is_mine_id(user_id):
-                await self._push_remote(RoomMember(room_id, user_id), False)
+                self._push_remote(RoomMember(room_id, user_id), False)
 
     def get_current_token(self):
         return self._latest_room_serial
@@ -309,9 +383,7 @@ class TypingWriterHandler(FollowerTypingHandler):
     def _push_update(self, member, typing):
         if self.hs.is_mine_id(member.user_id):
             # Only send updates for changes to our own users.
-            run_as_background_process(
-                "typing._push_remote", self._push_remote, member, typing
-            )
+            self._push_remote(member, typing)
 
         self._push_update_local(member=member, typing=typing)
 
@@ -428,12 +500,7 @@ class TypingNotificationEventSource:
         self.get_typing_handler = hs.get_typing_handler
 
     def _make_event_for(self, room_id):
-        typing = self.get_typing_handler()._room_typing[room_id]
-        return {
-            "type": "m.typing",
-            "room_id": room_id,
-            "content": {"user_ids": list(typing)},
-        }
+        return self.get_typing_handler().get_typing_event(room_id)
 
     async def get_new_events_as(
         self, from_key: int, service: ApplicationService
@@ -232,6 +232,7 @@ class SimpleHttpClient:
         ip_blacklist=None,
         http_proxy=None,
         https_proxy=None,
+        max_persistent_per_host=None,
     ):
         """
         Args:
@@ -243,6 +244,9 @@ class SimpleHttpClient:
                request if it were otherwise caught in a blacklist.
             http_proxy (bytes): proxy server to use for http connections. host[:port]
             https_proxy (bytes): proxy server to use for https connections. host[:port]
+            max_persistent_per_host (int|None): The number of idle connections
+                to keep open to each host. Defaults to a value based on the
+                cache factor.
         """
         self.hs = hs
 
@@ -285,10 +289,11 @@ class SimpleHttpClient:
         # tends to do so in batches, so we need to allow the pool to keep
         # lots of idle connections around.
         pool = HTTPConnectionPool(self.reactor)
-        # XXX: The justification for using the cache factor here is that larger instances
-        # will need both more cache and more connections.
-        # Still, this should probably be a separate dial
-        pool.maxPersistentPerHost = max((100 * hs.config.caches.global_factor, 5))
+        if max_persistent_per_host is None:
+            # XXX: The justification for using the cache factor here is that larger
+            # instances will need both more cache and more connections.
+            max_persistent_per_host = max((100 * hs.config.caches.global_factor, 5))
+        pool.maxPersistentPerHost = max_persistent_per_host
         pool.cachedConnectionTimeout = 2 * 60
 
         self.agent = ProxyAgent(
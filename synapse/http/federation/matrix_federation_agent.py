@@ -17,6 +17,7 @@ import urllib.parse
 from typing import List, Optional
 
 from netaddr import AddrFormatError, IPAddress
+from prometheus_client import Counter, Histogram
 from zope.interface import implementer
 
 from twisted.internet import defer
@@ -34,10 +35,80 @@ from synapse.crypto.context_factory import FederationPolicyForHTTPS
 from synapse.http.federation.srv_resolver import Server, SrvResolver
 from synapse.http.federation.well_known_resolver import WellKnownResolver
 from synapse.logging.context import make_deferred_yieldable, run_in_background
+from synapse.metrics import LaterGauge
 from synapse.util import Clock
 
 logger = logging.getLogger(__name__)
 
+connection_requests_counter = Counter(
+    "synapse_http_matrixfederationclient_connection_requests",
+    "Number of connections requested from the outbound federation connection "
+    "pool, by whether an idle connection was reused or a new one was opened",
+    ["outcome"],
+)
+
+connect_failures_counter = Counter(
+    "synapse_http_matrixfederationclient_connect_failures",
+    "Number of failed attempts to open a new outbound federation connection",
+)
+
+connect_duration_histogram = Histogram(
+    "synapse_http_matrixfederationclient_connect_duration_seconds",
+    "Time taken to resolve and connect to a remote server when opening a new "
+    "outbound federation connection",
+)
+
+
+class FederationConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which records how often connections are reused.
+
+    Each new connection costs at least a TCP and a TLS handshake, so a low
+    ratio of reused to new connections suggests that the pool is too small (or
+    the idle timeout too short) for the number of concurrent requests we are
+    making.
+    """
+
+    def __init__(self, reactor, max_persistent_per_host: int, idle_timeout: float):
+        super().__init__(reactor)
+        self.retryAutomatically = False
+        self.maxPersistentPerHost = max_persistent_per_host
+        self.cachedConnectionTimeout = idle_timeout
+
+        # Set by `_newConnection` so that `getConnection` can tell whether an
+        # idle connection was reused.
+        self._opened_new_connection = False
+
+        LaterGauge(
+            "synapse_http_matrixfederationclient_idle_connections",
+            "Number of idle connections in the outbound federation connection pool",
+            [],
+            lambda: sum(len(conns) for conns in self._connections.values()),
+        )
+
+    def getConnection(self, key, endpoint):
+        self._opened_new_connection = False
+        d = super().getConnection(key, endpoint)
+
+        outcome = "new" if self._opened_new_connection else "reused"
+        connection_requests_counter.labels(outcome).inc()
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._opened_new_connection = True
+        start = self._reactor.seconds()
+
+        def _on_connected(protocol):
+            connect_duration_histogram.observe(self._reactor.seconds() - start)
+            return protocol
+
+        def _on_failure(f):
+            connect_failures_counter.inc()
+            return f
+
+        d = super()._newConnection(key, endpoint)
+        d.addCallbacks(_on_connected, _on_failure)
+        return d
+
 
 @implementer(IAgent)
 class MatrixFederationAgent:
@@ -56,6 +127,12 @@ class MatrixFederationAgent:
         user_agent:
             The user agent header to use for federation requests.
 
+        max_persistent_per_host:
+            The maximum number of idle connections to keep open to each server.
+
+        idle_connection_timeout:
+            The number of seconds to keep idle connections open for.
+
         _srv_resolver:
             SrvResolver implementation to use for looking up SRV records. None
             to use a default implementation.
@@ -70,15 +147,16 @@ class MatrixFederationAgent:
         reactor: IReactorCore,
         tls_client_options_factory: Optional[FederationPolicyForHTTPS],
         user_agent: bytes,
+        max_persistent_per_host: int = 5,
+        idle_connection_timeout: float = 2 * 60,
         _srv_resolver: Optional[SrvResolver] = None,
         _well_known_resolver: Optional[WellKnownResolver] = None,
     ):
         self._reactor = reactor
         self._clock = Clock(reactor)
-        self._pool = HTTPConnectionPool(reactor)
-        self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        self._pool = FederationConnectionPool(
+            reactor, max_persistent_per_host, idle_connection_timeout
+        )
 
         self._agent = Agent.usingEndpointFactory(
             self._reactor,
@@ -13,13 +13,26 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import abc
 import cgi
+import gzip
 import logging
 import random
 import sys
 import urllib.parse
 from io import BytesIO
-from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import attr
 import treq
@@ -49,7 +62,7 @@ from synapse.api.errors import (
 from synapse.http import QuieterFileBodyProducer
 from synapse.http.client import BlacklistingAgentWrapper, IPBlacklistingResolver
 from synapse.http.federation.matrix_federation_agent import MatrixFederationAgent
-from synapse.logging.context import make_deferred_yieldable
+from synapse.logging.context import defer_to_thread, make_deferred_yieldable
 from synapse.logging.opentracing import (
     inject_active_span_byte_dict,
     set_tag,
@@ -75,6 +88,14 @@ MAX_LONG_RETRIES = 10
 MAX_SHORT_RETRIES = 3
 MAXINT = sys.maxsize
 
+# The default limit on the size of the body of a response to a federation
+# request.
+MAX_RESPONSE_SIZE = 100 * 1024 * 1024
+
+# Request bodies larger than this are compressed on a thread rather than on the
+# reactor.
+COMPRESS_IN_THREAD_THRESHOLD = 64 * 1024
+
 
 _next_id = 1
 
@@ -82,6 +103,50 @@ _next_id = 1
 QueryArgs = Dict[str, Union[str, List[str]]]
 
 
+T = TypeVar("T")
+
+
+class ByteParser(Generic[T], metaclass=abc.ABCMeta):
+    """Parses the body of a response as it is received.
+
+    `write` is called with each chunk of the body as it arrives, and then
+    `finish` once the body is complete.
+    """
+
+    @abc.abstractmethod
+    def write(self, data: bytes) -> None:
+        """Consume the next chunk of the body.
+
+        Raises:
+            Exception if the body is invalid.
+        """
+
+    @abc.abstractmethod
+    def finish(self) -> T:
+        """Called once the whole body has been received.
+
+        Returns:
+            The parsed body.
+
+        Raises:
+            Exception if the body is invalid or incomplete.
+        """
+
+
+class JsonParser(ByteParser[Union[JsonDict, list]]):
+    """A parser which buffers the body and then decodes it as JSON.
+    """
+
+    def __init__(self):
+        self._buffer = BytesIO()
+
+    def write(self, data: bytes) -> None:
+        self._buffer.write(data)
+
+    def finish(self) -> Union[JsonDict, list]:
+        return json_decoder.decode(self._buffer.getvalue().decode("utf-8"))
+
+
 @attr.s(slots=True, frozen=True)
 class MatrixFederationRequest:
     method = attr.ib(type=str)
@@ -104,6 +169,10 @@ class MatrixFederationRequest:
     """A callback to generate the JSON.
     """
 
+    compress_body = attr.ib(default=False, type=bool)
+    """Whether to gzip the body.
+    """
+
     query = attr.ib(default=None, type=Optional[dict])
     """Query arguments.
     """
@@ -142,13 +211,15 @@ class MatrixFederationRequest:
         return self.json
 
 
-async def _handle_json_response(
+async def _handle_response(
     reactor: IReactorTime,
     timeout_sec: float,
     request: MatrixFederationRequest,
     response: IResponse,
     start_ms: int,
-) -> JsonDict:
+    parser: ByteParser[T],
+    max_response_size: Optional[int] = None,
+) -> T:
     """
     Reads the JSON body of a response, with a timeout
 
@@ -158,16 +229,20 @@ async def _handle_json_response(
         request: the request that triggered the response
         response: response to the request
         start_ms: Timestamp when request was made
+        parser: the parser which will be fed the body of the response
+        max_response_size: the maximum size of the body to read.
+            MAX_RESPONSE_SIZE by default.
 
     Returns:
-        The parsed JSON response
+        The result of the parser
     """
+    if max_response_size is None:
+        max_response_size = MAX_RESPONSE_SIZE
+
     try:
         check_content_type_is_json(response.headers)
 
-        # Use the custom JSON decoder (partially re-implements treq.json_content).
-        d = treq.text_content(response, encoding="utf-8")
-        d.addCallback(json_decoder.decode)
+        d = _read_body_with_parser(response, parser, max_response_size)
         d = timeout_deferred(d, timeout=timeout_sec, reactor=reactor)
 
         body = await make_deferred_yieldable(d)
@@ -243,8 +318,14 @@ class MatrixFederationHttpClient:
             user_agent = "%s %s" % (user_agent, hs.config.user_agent_suffix)
         user_agent = user_agent.encode("ascii")
 
+        pool_size = hs.config.federation_client_max_idle_connections_per_host
+        idle_timeout = hs.config.federation_client_idle_connection_timeout_ms / 1000
         self.agent = MatrixFederationAgent(
-            self.reactor, tls_client_options_factory, user_agent
+            self.reactor,
+            tls_client_options_factory,
+            user_agent,
+            max_persistent_per_host=pool_size,
+            idle_connection_timeout=idle_timeout,
         )
 
         # Use a BlacklistingAgentWrapper to prevent circumventing the IP
@@ -259,6 +340,7 @@ class MatrixFederationHttpClient:
         self._store = hs.get_datastore()
         self.version_string_bytes = hs.version_string.encode("ascii")
         self.default_timeout = 60
+        self._compression_level = hs.config.http_compression_level
 
         def schedule(x):
             self.reactor.callLater(_EPSILON, x)
@@ -427,15 +509,39 @@ class MatrixFederationHttpClient:
                 (b"", b"", path_bytes, None, query_bytes, b"")
             )
 
+            # Compressing the body is relatively expensive, so we only do it
+            # once rather than on every retry. (This means that retries send
+            # the body as it was when we first tried.)
+            compressed_body = None  # type: Optional[Tuple[JsonDict, bytes]]
+            if request.compress_body:
+                json = request.get_json()
+                if json:
+                    data = encode_canonical_json(json)
+                    if len(data) > COMPRESS_IN_THREAD_THRESHOLD:
+                        data = await defer_to_thread(
+                            self.reactor, gzip.compress, data, self._compression_level
+                        )
+                    else:
+                        data = gzip.compress(
+                            data, compresslevel=self._compression_level
+                        )
+                    compressed_body = (json, data)
+
             while True:
                 try:
-                    json = request.get_json()
+                    if compressed_body:
+                        json, data = compressed_body
+                    else:
+                        json = request.get_json()
                     if json:
                         headers_dict[b"Content-Type"] = [b"application/json"]
                         auth_headers = self.build_auth_headers(
                             destination_bytes, method_bytes, url_to_sign_bytes, json
                         )
-                        data = encode_canonical_json(json)
+                        if compressed_body:
+                            headers_dict[b"Content-Encoding"] = [b"gzip"]
+                        else:
+                            data = encode_canonical_json(json)
                         producer = QuieterFileBodyProducer(
                             BytesIO(data), cooperator=self._cooperator
                         )  # type: Optional[IBodyProducer]
@@ -649,7 +755,10 @@ class MatrixFederationHttpClient:
         ignore_backoff: bool = False,
         backoff_on_404: bool = False,
         try_trailing_slash_on_400: bool = False,
-    ) -> Union[JsonDict, list]:
+        parser: Optional[ByteParser] = None,
+        max_response_size: Optional[int] = None,
+        compress_body: bool = False,
+    ) -> Any:
         """ Sends the specified json data using PUT
 
         Args:
@@ -682,10 +791,17 @@ class MatrixFederationHttpClient:
                 of the request. Workaround for #3622 in Synapse <= v0.99.3. This
                 will be attempted before backing off if backing off has been
                 enabled.
+            parser: The parser to use to decode the response. Defaults to
+                parsing as JSON.
+            max_response_size: The maximum size to read from the response.
+                MAX_RESPONSE_SIZE by default.
+            compress_body: Whether to gzip the request body. The remote server
+                must support compressed request bodies.
 
         Returns:
             Succeeds when we get a 2xx HTTP response. The
-            result will be the decoded JSON body.
+            result will be the decoded JSON body, or the result of `parser`
+            if one was given.
 
         Raises:
             HttpResponseException: If we get an HTTP response code >= 300
@@ -704,6 +820,7 @@ class MatrixFederationHttpClient:
             query=args,
             json_callback=json_data_callback,
             json=data,
+            compress_body=compress_body,
         )
 
         start_ms = self.clock.time_msec()
@@ -722,8 +839,17 @@ class MatrixFederationHttpClient:
         else:
             _sec_timeout = self.default_timeout
 
-        body = await _handle_json_response(
-            self.reactor, _sec_timeout, request, response, start_ms
+        if parser is None:
+            parser = JsonParser()
+
+        body = await _handle_response(
+            self.reactor,
+            _sec_timeout,
+            request,
+            response,
+            start_ms,
+            parser=parser,
+            max_response_size=max_response_size,
         )
 
         return body
@@ -796,8 +922,8 @@ class MatrixFederationHttpClient:
         else:
             _sec_timeout = self.default_timeout
 
-        body = await _handle_json_response(
-            self.reactor, _sec_timeout, request, response, start_ms,
+        body = await _handle_response(
+            self.reactor, _sec_timeout, request, response, start_ms, JsonParser()
         )
         return body
 
@@ -869,8 +995,8 @@ class MatrixFederationHttpClient:
         else:
             _sec_timeout = self.default_timeout
 
-        body = await _handle_json_response(
-            self.reactor, _sec_timeout, request, response, start_ms
+        body = await _handle_response(
+            self.reactor, _sec_timeout, request, response, start_ms, JsonParser()
         )
 
         return body
@@ -937,8 +1063,8 @@ class MatrixFederationHttpClient:
         else:
             _sec_timeout = self.default_timeout
 
-        body = await _handle_json_response(
-            self.reactor, _sec_timeout, request, response, start_ms
+        body = await _handle_response(
+            self.reactor, _sec_timeout, request, response, start_ms, JsonParser()
         )
         return body
 
@@ -1048,6 +1174,75 @@ def _readBodyToFile(
     return d
 
 
+class _ReadBodyWithParserProtocol(protocol.Protocol):
+    def __init__(self, parser: ByteParser, deferred: defer.Deferred, max_size: int):
+        self.parser = parser
+        self.deferred = deferred
+        self.length = 0
+        self.max_size = max_size
+
+    def dataReceived(self, data: bytes) -> None:
+        # If the deferred has already been called then we've either failed or
+        # been cancelled, so we ignore the rest of the body.
+        if self.deferred.called:
+            return
+
+        self.length += len(data)
+        if self.length > self.max_size:
+            self._fail(
+                SynapseError(
+                    502,
+                    "Response is too large > %r bytes" % (self.max_size,),
+                    Codes.TOO_LARGE,
+                )
+            )
+            return
+
+        try:
+            self.parser.write(data)
+        except Exception as e:
+            self._fail(e)
+
+    def _fail(self, e: Exception) -> None:
+        self.deferred.errback(e)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason: Failure) -> None:
+        # We've already failed (or been cancelled).
+        if self.deferred.called:
+            return
+
+        if not reason.check(ResponseDone):
+            self.deferred.errback(reason)
+            return
+
+        try:
+            result = self.parser.finish()
+        except Exception as e:
+            self.deferred.errback(e)
+        else:
+            self.deferred.callback(result)
+
+
+def _read_body_with_parser(
+    response: IResponse, parser: ByteParser[T], max_size: int
+) -> defer.Deferred:
+    """Feed the body of the response to the given parser, failing if the body
+    is larger than `max_size`.
+
+    Returns:
+        A Deferred which resolves to the result of the parser.
+    """
+
+    def _cancel(d: defer.Deferred) -> None:
+        read_protocol.transport.loseConnection()
+
+    d = defer.Deferred(_cancel)
+    read_protocol = _ReadBodyWithParserProtocol(parser, d, max_size)
+    response.deliverBody(read_protocol)
+    return d
+
+
 def _flatten_response_never_received(e):
     if hasattr(e, "reasons"):
         reasons = ", ".join(
@@ -16,16 +16,23 @@
 
 import abc
 import collections
+import gzip
 import html
 import logging
 import types
 import urllib
+import zlib
 from http import HTTPStatus
 from io import BytesIO
-from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import jinja2
-from canonicaljson import iterencode_canonical_json, iterencode_pretty_printed_json
+from canonicaljson import (
+    encode_canonical_json,
+    iterencode_canonical_json,
+    iterencode_pretty_printed_json,
+)
+from prometheus_client import Counter, Histogram
 from zope.interface import implementer
 
 from twisted.internet import defer, interfaces
@@ -43,13 +50,36 @@ from synapse.api.errors import (
     UnrecognizedRequestError,
 )
 from synapse.http.site import SynapseRequest
-from synapse.logging.context import preserve_fn
+from synapse.logging.context import defer_to_threadpool, preserve_fn, run_in_background
 from synapse.logging.opentracing import trace_servlet
 from synapse.util import json_encoder
 from synapse.util.caches import intern_dict
 
 logger = logging.getLogger(__name__)
 
+json_encode_time = Histogram(
+    "synapse_http_server_response_json_encode_seconds",
+    "Time taken to encode JSON responses",
+    ["servlet"],
+)
+
+response_compression_saved_bytes = Counter(
+    "synapse_http_server_response_compression_saved_bytes",
+    "Number of bytes saved by compressing responses",
+    ["servlet", "encoding"],
+)
+
+# Responses which encode to at least this many bytes are considered large, and
+# are encoded on a thread so as not to block the reactor.
+_LARGE_RESPONSE_THRESHOLD = 64 * 1024
+
+# We can't know how large a response is until it has been encoded, so instead
+# we keep an estimate per servlet: the size of the servlet's last response, or
+# the previous estimate multiplied by this factor if that is larger. A servlet
+# which returns a large response will therefore have its responses encoded on a
+# thread until it has returned a few small ones.
+_RESPONSE_SIZE_DECAY = 0.5
+
 HTML_ERROR_TEMPLATE = """<!DOCTYPE html>
 <html lang=en>
   <head>
@@ -314,6 +344,15 @@ class JsonResource(DirectServeJsonResource):
     The JsonResource is primarily intended for returning JSON, but callbacks
     may send something other than JSON, they may do so by using the methods
     on the request object and instead returning None.
+
+    Responses are encoded in one go with the C JSON encoder. Responses from
+    servlets which are expected to return more than `_LARGE_RESPONSE_THRESHOLD`
+    bytes (see `_RESPONSE_SIZE_DECAY`) are encoded on the homeserver's response
+    encoding threadpool, so that encoding e.g. large `/sync` responses doesn't
+    block the reactor.
+
+    If `enable_compression` has been called, responses are also compressed
+    (on a thread) when the requester supports it.
     """
 
     isLeaf = True
@@ -330,6 +369,20 @@ class JsonResource(DirectServeJsonResource):
         self.path_regexs = {}
         self.hs = hs
 
+        # The estimated size of the next response from each servlet.
+        self._response_size_estimates = {}  # type: Dict[str, float]
+
+        # The compression level to use for responses, or None if compression
+        # is disabled.
+        self._compression_level = None  # type: Optional[int]
+        self._compression_min_length = hs.config.http_compression_min_length
+
+    def enable_compression(self) -> None:
+        """Compress responses of at least `http_compression.min_length` bytes,
+        if the requester supports it.
+        """
+        self._compression_level = self.hs.config.http_compression_level
+
     def register_paths(self, method, path_patterns, callback, servlet_classname):
         """
         Registers a request handler against a regular expression. Later request URLs are
@@ -408,6 +461,143 @@ class JsonResource(DirectServeJsonResource):
 
         return callback_return
 
+    def _send_response(
+        self, request: SynapseRequest, code: int, response_object: Any,
+    ):
+        """Implements _AsyncResource._send_response
+        """
+        if _request_user_agent_is_curl(request):
+            # Pretty printed responses are only for debugging, so we don't
+            # bother optimising them.
+            super()._send_response(request, code, response_object)
+            return
+
+        if self.canonical_json:
+            encode = encode_canonical_json
+        else:
+            encode = _encode_json_bytes_in_one_go
+
+        content_encoding = None
+        if self._compression_level is not None:
+            request.setHeader(b"Vary", b"Accept-Encoding")
+            content_encoding = _get_accepted_content_encoding(request)
+
+        servlet_name = request.request_metrics.name
+        estimate = self._response_size_estimates.get(servlet_name, 0)
+        if estimate >= _LARGE_RESPONSE_THRESHOLD:
+            run_in_background(
+                self._async_send_response_from_thread,
+                request,
+                code,
+                response_object,
+                encode,
+                content_encoding,
+            )
+            return
+
+        json_bytes = _encode_json_timed(encode, response_object, servlet_name)
+        self._update_response_size_estimate(servlet_name, len(json_bytes))
+
+        if content_encoding and len(json_bytes) >= self._compression_min_length:
+            run_in_background(
+                self._async_send_response_from_thread,
+                request,
+                code,
+                json_bytes,
+                None,
+                content_encoding,
+            )
+            return
+
+        respond_with_json_bytes(request, code, json_bytes, send_cors=True)
+
+    async def _async_send_response_from_thread(
+        self,
+        request: SynapseRequest,
+        code: int,
+        response: Any,
+        encode: Optional[Callable[[Any], bytes]],
+        content_encoding: Optional[str],
+    ):
+        """Encode and/or compress the response on a thread and then send it.
+
+        Args:
+            request
+            code
+            response: the object to respond with, or the encoded JSON bytes if
+                `encode` is None.
+            encode: the function to encode `response` with, if necessary.
+            content_encoding: the encoding to compress the response with, if
+                any.
+        """
+        servlet_name = request.request_metrics.name
+        try:
+            body, content_encoding, length = await defer_to_threadpool(
+                self.hs.get_reactor(),
+                self.hs.get_response_encoding_threadpool(),
+                self._encode_response_body,
+                servlet_name,
+                response,
+                encode,
+                content_encoding,
+            )
+        except Exception:
+            self._send_error_response(failure.Failure(), request)
+            return
+
+        if encode is not None:
+            self._update_response_size_estimate(servlet_name, length)
+
+        if content_encoding:
+            request.setHeader(b"Content-Encoding", content_encoding.encode("ascii"))
+
+        respond_with_json_bytes(request, code, body, send_cors=True)
+
+    def _update_response_size_estimate(self, servlet_name: str, length: int):
+        """Record that the given servlet has returned a response which encoded
+        to `length` bytes.
+        """
+        estimate = self._response_size_estimates.get(servlet_name, 0)
+        self._response_size_estimates[servlet_name] = max(
+            length, estimate * _RESPONSE_SIZE_DECAY
+        )
+
+    def _encode_response_body(
+        self,
+        servlet_name: str,
+        response: Any,
+        encode: Optional[Callable[[Any], bytes]],
+        content_encoding: Optional[str],
+    ) -> Tuple[bytes, Optional[str], int]:
+        """Encode and compress a response. Called on a thread.
+
+        Returns:
+            The response body, the content encoding it was compressed with (if
+            any), and the length of the body before compression.
+        """
+        if encode is not None:
+            body = _encode_json_timed(encode, response, servlet_name)
+        else:
+            body = response
+
+        if (
+            not content_encoding
+            or self._compression_level is None
+            or len(body) < self._compression_min_length
+        ):
+            return body, None, len(body)
+
+        if content_encoding == "gzip":
+            compressed = gzip.compress(body, compresslevel=self._compression_level)
+        else:
+            compressed = zlib.compress(body, self._compression_level)
+
+        response_compression_saved_bytes.labels(servlet_name, content_encoding).inc(
+            len(body) - len(compressed)
+        )
+
+        return compressed, content_encoding, len(body)
+
 
 class DirectServeHtmlResource(_AsyncResource):
     """A resource that will call `self._async_on_<METHOD>` on new requests,
@@ -582,6 +772,56 @@ def _encode_json_bytes(json_object: Any) -> Iterator[bytes]:
         yield chunk.encode("utf-8")
 
 
+def _get_accepted_content_encoding(request: Request) -> Optional[str]:
+    """Pick the content encoding to compress a response with, based on the
+    request's Accept-Encoding header.
+
+    Returns:
+        "gzip", "deflate", or None if the requester doesn't accept either.
+    """
+    qvalues = {}  # type: Dict[bytes, float]
+    for header in request.requestHeaders.getRawHeaders(b"Accept-Encoding", []):
+        for item in header.split(b","):
+            coding, _, params = item.partition(b";")
+            q = 1.0
+            for param in params.split(b";"):
+                name, _, value = param.partition(b"=")
+                if name.strip() == b"q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            qvalues[coding.strip().lower()] = q
+
+    default_q = qvalues.get(b"*", 0.0)
+    best = None  # type: Optional[str]
+    best_q = 0.0
+    for coding in ("gzip", "deflate"):
+        q = qvalues.get(coding.encode("ascii"), default_q)
+        if q > best_q:
+            best, best_q = coding, q
+
+    return best
+
+
+def _encode_json_bytes_in_one_go(json_object: Any) -> bytes:
+    """
+    Encode an object into JSON bytes, using the C encoder.
+    """
+    return json_encoder.encode(json_object).encode("utf-8")
+
+
+def _encode_json_timed(
+    encode: Callable[[Any], bytes], json_object: Any, servlet_name: str
+) -> bytes:
+    """
+    Encode an object into JSON bytes with the given function, recording how long
+    it took against the servlet. May be called from a thread.
+    """
+    with json_encode_time.labels(servlet_name).time():
+        return encode(json_object)
+
+
 def respond_with_json(
     request: Request,
     code: int,
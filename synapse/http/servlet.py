@@ -16,12 +16,16 @@
 """ This module contains base REST classes for constructing REST servlets. """
 
 import logging
+import zlib
 
 from synapse.api.errors import Codes, SynapseError
 from synapse.util import json_decoder
 
 logger = logging.getLogger(__name__)
 
+# The maximum size of a compressed request body once decompressed.
+MAX_DECOMPRESSED_BODY_SIZE = 50 * 1024 * 1024
+
 
 def parse_integer(request, name, default=None, required=False):
     """Parse an integer parameter from the request string
@@ -191,13 +195,18 @@ def parse_string_from_args(
             return default
 
 
-def parse_json_value_from_request(request, allow_empty_body=False):
+def parse_json_value_from_request(
+    request, allow_empty_body=False, allow_compressed_body=False
+):
     """Parse a JSON value from the body of a twisted HTTP request.
 
     Args:
         request: the twisted HTTP request.
         allow_empty_body (bool): if True, an empty body will be accepted and
             turned into None
+        allow_compressed_body (bool): if True, a body compressed with gzip or
+            deflate (as given by the Content-Encoding header) will be
+            decompressed.
 
     Returns:
         The JSON value.
@@ -210,6 +219,9 @@ def parse_json_value_from_request(request, allow_empty_body=False):
     except Exception:
         raise SynapseError(400, "Error reading JSON content.")
 
+    if allow_compressed_body:
+        content_bytes = _decompress_request_body(request, content_bytes)
+
     if not content_bytes and allow_empty_body:
         return None
 
@@ -222,19 +234,62 @@ def parse_json_value_from_request(request, allow_empty_body=False):
     return content
 
 
-def parse_json_object_from_request(request, allow_empty_body=False):
+def _decompress_request_body(request, content_bytes: bytes) -> bytes:
+    """Decompress the body of a request according to its Content-Encoding.
+
+    Raises:
+        SynapseError if the encoding isn't supported, or the body is invalid or
+            too large once decompressed.
+    """
+    encodings = request.requestHeaders.getRawHeaders(b"Content-Encoding")
+    if not encodings:
+        return content_bytes
+
+    encoding = encodings[-1].strip().lower()
+    if encoding == b"identity":
+        return content_bytes
+
+    if encoding not in (b"gzip", b"x-gzip", b"deflate"):
+        raise SynapseError(415, "Unsupported Content-Encoding")
+
+    # Adding 32 to wbits makes zlib detect whether there is a gzip or zlib
+    # header.
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    try:
+        content_bytes = decompressor.decompress(
+            content_bytes, MAX_DECOMPRESSED_BODY_SIZE
+        )
+    except zlib.error:
+        raise SynapseError(400, "Invalid compressed content")
+
+    if decompressor.unconsumed_tail:
+        raise SynapseError(413, "Request body too large", errcode=Codes.TOO_LARGE)
+
+    return content_bytes
+
+
+def parse_json_object_from_request(
+    request, allow_empty_body=False, allow_compressed_body=False
+):
     """Parse a JSON object from the body of a twisted HTTP request.
 
     Args:
         request: the twisted HTTP request.
         allow_empty_body (bool): if True, an empty body will be accepted and
             turned into an empty dict.
+        allow_compressed_body (bool): if True, a body compressed with gzip or
+            deflate (as given by the Content-Encoding header) will be
+            decompressed.
 
     Raises:
         SynapseError if the request body couldn't be decoded as JSON or
             if it wasn't a JSON object.
     """
-    content = parse_json_value_from_request(request, allow_empty_body=allow_empty_body)
+    content = parse_json_value_from_request(
+        request,
+        allow_empty_body=allow_empty_body,
+        allow_compressed_body=allow_compressed_body,
+    )
 
     if allow_empty_body and content is None:
         return {}
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import logging
+from typing import Dict, List, Optional, Tuple, Union
 
 import attr
 from prometheus_client import Counter
@@ -24,12 +25,13 @@ from synapse.event_auth import get_user_power_level
 from synapse.events import EventBase
 from synapse.events.snapshot import EventContext
 from synapse.state import POWER_KEY
+from synapse.util import json_encoder
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import register_cache
 from synapse.util.caches.descriptors import lru_cache
 from synapse.util.caches.lrucache import LruCache
 
-from .push_rule_evaluator import PushRuleEvaluatorForEvent
+from .push_rule_evaluator import PushRuleEvaluatorForEvent, condition_depends_on_user
 
 logger = logging.getLogger(__name__)
 
@@ -194,12 +196,12 @@ class BulkPushRuleEvaluator:
             sender_power_level,
         ) = await self._get_power_levels_and_sender_level(event, context)
 
-        evaluator = PushRuleEvaluatorForEvent(
-            event, len(room_members), sender_power_level, power_levels
+        evaluator = _CompiledRulesEvaluator(
+            PushRuleEvaluatorForEvent(
+                event, len(room_members), sender_power_level, power_levels
+            )
         )
 
-        condition_cache = {}
-
         for uid, rules in rules_by_user.items():
             if event.sender == uid:
                 continue
@@ -227,19 +229,10 @@ class BulkPushRuleEvaluator:
                 # current user, it'll be added to the dict later.
                 actions_by_user[uid] = []
 
-            for rule in rules:
-                if "enabled" in rule and not rule["enabled"]:
-                    continue
-
-                matches = _condition_checker(
-                    evaluator, rule["conditions"], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule["actions"] if x != "dont_notify"]
-                    if actions and "notify" in actions:
-                        # Push rules say we should notify the user of this event
-                        actions_by_user[uid] = actions
-                    break
+            actions = evaluator.actions_for_user(rules, uid, display_name)
+            if actions is not None:
+                # Push rules say we should notify the user of this event
+                actions_by_user[uid] = actions
 
         # Mark in the DB staging area the push actions for users who should be
         # notified for this event. (This will then get handled when we persist
@@ -269,6 +262,162 @@ def _condition_checker(evaluator, conditions, uid, display_name, cache):
     return True
 
 
+@attr.s(slots=True, frozen=True)
+class _CompiledPushRule:
+    # The conditions whose outcome only depends on the event.
+    event_conditions = attr.ib(type=Tuple[dict, ...])
+    # The conditions whose outcome depends on the user ID or display name of the
+    # user the rules are being evaluated for.
+    user_conditions = attr.ib(type=Tuple[dict, ...])
+    # The actions to use if the rule matches, or None if the user shouldn't be
+    # notified.
+    actions = attr.ib(type=Optional[List[Union[str, Dict]]])
+
+
+@attr.s(slots=True, frozen=True, eq=False)
+class _CompiledPushRules:
+    """A user's list of push rules, with disabled rules removed and the
+    conditions of each rule split up by whether they depend on the user.
+
+    Users with identical push rules (typically those that only use the base
+    rules) share the same instance, so that the parts of the rules which only
+    depend on the event only need to be evaluated once per event. Hashes by
+    identity.
+    """
+
+    rules = attr.ib(type=Tuple[_CompiledPushRule, ...])
+
+
+def _compile_push_rules(rules: List[dict]) -> _CompiledPushRules:
+    compiled_rules = []
+    for rule in rules:
+        if "enabled" in rule and not rule["enabled"]:
+            continue
+
+        actions = [x for x in rule["actions"] if x != "dont_notify"]
+        if not actions or "notify" not in actions:
+            actions = None
+
+        compiled_rules.append(
+            _CompiledPushRule(
+                event_conditions=tuple(
+                    c for c in rule["conditions"] if not condition_depends_on_user(c)
+                ),
+                user_conditions=tuple(
+                    c for c in rule["conditions"] if condition_depends_on_user(c)
+                ),
+                actions=actions,
+            )
+        )
+
+    return _CompiledPushRules(tuple(compiled_rules))
+
+
+# Maps the id of a list of push rules (as returned by the push rule caches) to a
+# tuple of that list and its compiled rules. We keep a reference to the list so
+# that its id can't be reused while it is in the cache.
+_compiled_rules_by_list = LruCache(
+    100000, "push_rules_compiled_by_list"
+)  # type: LruCache[int, Tuple[List[dict], _CompiledPushRules]]
+
+# Maps the canonical JSON of a list of push rules to its compiled rules, so that
+# users with identical rules share the compiled rules.
+_compiled_rules_by_content = LruCache(
+    10000, "push_rules_compiled_by_content"
+)  # type: LruCache[str, _CompiledPushRules]
+
+
+def _get_compiled_push_rules(rules: List[dict]) -> _CompiledPushRules:
+    entry = _compiled_rules_by_list.get(id(rules))
+    if entry is not None and entry[0] is rules:
+        return entry[1]
+
+    key = json_encoder.encode(_canonicalise_rules(rules))
+    compiled = _compiled_rules_by_content.get(key)
+    if compiled is None:
+        compiled = _compile_push_rules(rules)
+        _compiled_rules_by_content[key] = compiled
+
+    _compiled_rules_by_list[id(rules)] = (rules, compiled)
+    return compiled
+
+
+def _canonicalise_rules(rules: List[dict]) -> list:
+    # Only the fields which affect evaluation matter. Conditions and actions
+    # are sorted by key so that identical rules loaded from different places
+    # compare equal.
+    return [
+        (
+            rule.get("enabled", True),
+            [sorted(c.items()) for c in rule["conditions"]],
+            [sorted(a.items()) if isinstance(a, dict) else a for a in rule["actions"]],
+        )
+        for rule in rules
+    ]
+
+
+class _CompiledRulesEvaluator:
+    """Evaluates users' push rules against a single event.
+
+    The conditions which only depend on the event are evaluated once for each
+    distinct set of push rules, leaving just the user-specific conditions
+    (e.g. mentions of the user's name) to be checked for each user.
+    """
+
+    def __init__(self, evaluator: PushRuleEvaluatorForEvent):
+        self._evaluator = evaluator
+
+        # Maps condition `_id` to the outcome of the condition for this event.
+        self._condition_cache = {}  # type: Dict[str, bool]
+
+        # Maps compiled rules to the list of candidate rules for this event: the
+        # rules whose event conditions matched, up to and including the first
+        # rule which has no user conditions.
+        self._candidates = {}  # type: Dict[_CompiledPushRules, List[_CompiledPushRule]]
+
+    def actions_for_user(
+        self, rules: List[dict], user_id: str, display_name: Optional[str]
+    ) -> Optional[List[Union[str, Dict]]]:
+        """Returns the actions to notify the user with, or None if the user
+        shouldn't be notified.
+        """
+        compiled = _get_compiled_push_rules(rules)
+
+        candidates = self._candidates.get(compiled)
+        if candidates is None:
+            candidates = self._get_candidates(compiled)
+            self._candidates[compiled] = candidates
+
+        for rule in candidates:
+            if rule.user_conditions and not _condition_checker(
+                self._evaluator, rule.user_conditions, user_id, display_name, {}
+            ):
+                continue
+
+            return rule.actions
+
+        return None
+
+    def _get_candidates(self, compiled: _CompiledPushRules) -> List[_CompiledPushRule]:
+        candidates = []
+        for rule in compiled.rules:
+            if not _condition_checker(
+                self._evaluator,
+                rule.event_conditions,
+                None,
+                None,
+                self._condition_cache,
+            ):
+                continue
+
+            candidates.append(rule)
+            if not rule.user_conditions:
+                # This rule always matches, so no later rule can apply.
+                break
+
+        return candidates
+
+
 class RulesForRoom:
     """Caches push rules for users in a room.
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import urllib.parse
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from twisted.internet import defer
+
+from synapse.logging.context import make_deferred_yieldable
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util import json_encoder
+from synapse.util.async_helpers import Linearizer, ObservableDeferred
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+logger = logging.getLogger(__name__)
+
+push_gateway_request_time = Histogram(
+    "synapse_push_gateway_request_duration_seconds",
+    "Time taken for a push gateway to respond to a notification request",
+    ["gateway"],
+)
+
+push_gateway_requests_counter = Counter(
+    "synapse_push_gateway_requests",
+    "Number of requests made to each push gateway",
+    ["gateway", "outcome"],
+)
+
+push_gateway_devices_counter = Counter(
+    "synapse_push_gateway_devices",
+    "Number of devices notified via each push gateway",
+    ["gateway"],
+)
+
+
+class _PendingNotification:
+    """A notification which is waiting to be sent, to which further devices
+    may be added until it is flushed.
+    """
+
+    __slots__ = ["body", "devices", "deferred"]
+
+    def __init__(self, body: Dict[str, Any]):
+        self.body = body
+        self.devices = []  # type: List[Dict[str, Any]]
+        self.deferred = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+
+
+class PushGatewayClient:
+    """Sends notifications to push gateways on behalf of HTTP pushers.
+
+    Requests go through a dedicated HTTP client, so that connections to each
+    gateway are kept alive and shared by all the pushers using that gateway,
+    and the number of concurrent requests to each gateway is limited so that
+    we don't open more connections than the pool is prepared to keep around.
+
+    If `push.gateway_batch_delay_ms` is set, identical notifications to the
+    same gateway (i.e. the same event for the same user, delivered to several
+    of their devices) which are sent within the window are merged into a
+    single request carrying all the devices. The push gateway API only allows
+    a single notification per request, so this is the only kind of batching
+    we can do.
+    """
+
+    def __init__(self, hs: "HomeServer"):
+        self._clock = hs.get_clock()
+        self._http_client = hs.get_push_http_client()
+
+        self._batch_delay_ms = hs.config.push_gateway_batch_delay_ms
+
+        # Limits the number of in-flight requests to each gateway host.
+        self._limiter = Linearizer(
+            name="push_gateway",
+            max_count=hs.config.push_gateway_max_concurrent_requests,
+            clock=self._clock,
+        )
+
+        # Notifications waiting to be sent, keyed by the URL and the JSON
+        # encoding of the notification minus its list of devices.
+        self._pending = {}  # type: Dict[Tuple[str, str], _PendingNotification]
+
+    async def send_notification(self, url: str, body: Dict[str, Any]) -> List[str]:
+        """Send a notification to a push gateway.
+
+        Args:
+            url: the URL of the push gateway's notify endpoint.
+            body: the request body, of the form `{"notification": {...}}`.
+
+        Returns:
+            The pushkeys, out of the devices in `body`, which the gateway
+            rejected.
+
+        Raises:
+            Exception if the request failed.
+        """
+        if not self._batch_delay_ms:
+            return await self._send(url, body)
+
+        notification = dict(body["notification"])
+        devices = notification.pop("devices", [])
+
+        key = (url, json_encoder.encode(notification))
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = _PendingNotification(notification)
+            self._pending[key] = pending
+            self._clock.call_later(
+                self._batch_delay_ms / 1000, self._flush_pending, key
+            )
+
+        pending.devices.extend(devices)
+
+        rejected = await make_deferred_yieldable(pending.deferred.observe())
+
+        # only report the rejected pushkeys which belong to this caller.
+        our_pushkeys = {device.get("pushkey") for device in devices}
+        return [pushkey for pushkey in rejected if pushkey in our_pushkeys]
+
+    def _flush_pending(self, key: Tuple[str, str]) -> None:
+        pending = self._pending.pop(key)
+
+        async def _send_pending():
+            try:
+                body = {"notification": dict(pending.body, devices=pending.devices)}
+                rejected = await self._send(key[0], body)
+            except Exception as e:
+                pending.deferred.errback(e)
+            else:
+                pending.deferred.callback(rejected)
+
+        run_as_background_process("push_gateway_send", _send_pending)
+
+    async def _send(self, url: str, body: Dict[str, Any]) -> List[str]:
+        gateway = urllib.parse.urlparse(url).netloc
+
+        with (await self._limiter.queue(gateway)):
+            start = self._clock.time()
+            try:
+                resp = await self._http_client.post_json_get_json(url, body)
+            except Exception:
+                push_gateway_requests_counter.labels(gateway, "failure").inc()
+                raise
+            finally:
+                push_gateway_request_time.labels(gateway).observe(
+                    self._clock.time() - start
+                )
+
+        push_gateway_requests_counter.labels(gateway, "success").inc()
+        push_gateway_devices_counter.labels(gateway).inc(
+            len(body["notification"].get("devices", []))
+        )
+
+        return resp.get("rejected", [])
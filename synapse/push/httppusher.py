@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+from typing import List, Optional, Tuple
 
 from prometheus_client import Counter
 
@@ -57,6 +58,9 @@ class HttpPusher:
     # This one's in ms because we compare it against the clock
     GIVE_UP_AFTER_MS = 24 * 60 * 60 * 1000
 
+    # The maximum number of push actions to fetch from the database at once
+    FETCH_LIMIT = 20
+
     def __init__(self, hs, pusherdict):
         self.hs = hs
         self.store = self.hs.get_datastore()
@@ -75,6 +79,21 @@ class HttpPusher:
         self.failing_since = pusherdict["failing_since"]
         self.timed_call = None
         self._is_processing = False
+        self._pusher_pool = hs.get_pusherpool()
+
+        # When we were first told about notifications which haven't been sent
+        # yet, in ms. Used to report how far behind the pusher is.
+        self.pending_since = None  # type: Optional[int]
+
+        # Push actions fetched by the pusher pool for a range of stream
+        # orderings, as a tuple of (exclusive lower bound, inclusive upper
+        # bound, push actions), which we can use rather than querying the
+        # database ourselves if we're caught up to the start of the range.
+        self._prefetched_actions = None  # type: Optional[Tuple[int, int, List[dict]]]
+
+        # The stream ordering up to which we know we have processed all push
+        # actions, if any.
+        self.processed_up_to = None  # type: Optional[int]
 
         # This is the highest stream ordering we know it's safe to process.
         # When new events arrive, we'll be given a window of new events: we
@@ -99,7 +118,7 @@ class HttpPusher:
         if "url" not in self.data:
             raise PusherConfigException("'url' required in data for HTTP pusher")
         self.url = self.data["url"]
-        self.http_client = hs.get_proxied_http_client()
+        self.gateway_client = hs.get_push_gateway_client()
         self.data_minus_url = {}
         self.data_minus_url.update(self.data)
         del self.data_minus_url["url"]
@@ -115,7 +134,19 @@ class HttpPusher:
         if should_check_for_notifs:
             self._start_processing()
 
-    def on_new_notifications(self, max_token: RoomStreamToken):
+    def on_new_notifications(
+        self,
+        max_token: RoomStreamToken,
+        prefetched_actions: Optional[Tuple[int, int, List[dict]]] = None,
+    ):
+        """Called when there may be new notifications for this pusher.
+
+        Args:
+            max_token: the token up to which there may be new notifications.
+            prefetched_actions: optionally, the unread push actions for this
+                pusher's user in the range `(prev_stream_ordering,
+                max_stream_ordering]`, as fetched by the pusher pool.
+        """
         # We just use the minimum stream ordering and ignore the vector clock
         # component. This is safe to do as long as we *always* ignore the vector
         # clock components.
@@ -124,6 +155,11 @@ class HttpPusher:
         self.max_stream_ordering = max(
             max_stream_ordering, self.max_stream_ordering or 0
         )
+        self._prefetched_actions = prefetched_actions
+
+        if self.pending_since is None:
+            self.pending_since = self.clock.time_msec()
+
         self._start_processing()
 
     def on_new_receipts(self, min_stream_id, max_stream_id):
@@ -140,6 +176,7 @@ class HttpPusher:
         await self._send_badge(badge)
 
     def on_timer(self):
+        self.timed_call = None
         self._start_processing()
 
     def on_stop(self):
@@ -172,6 +209,10 @@ class HttpPusher:
                     logger.exception("Exception processing notifs")
                 if self.max_stream_ordering == starting_max_ordering:
                     break
+
+            if self.timed_call is None:
+                # We're not backing off, so we've sent everything we know of.
+                self.pending_since = None
         finally:
             self._is_processing = False
 
@@ -182,10 +223,36 @@ class HttpPusher:
         run once per pusher.
         """
 
-        fn = self.store.get_unread_push_actions_for_user_in_range_for_http
-        unprocessed = await fn(
-            self.user_id, self.last_stream_ordering, self.max_stream_ordering
-        )
+        max_stream_ordering = self.max_stream_ordering
+        prefetched = self._prefetched_actions
+        self._prefetched_actions = None
+
+        if (
+            prefetched is not None
+            and self.processed_up_to is not None
+            and prefetched[0] <= self.processed_up_to
+            and prefetched[1] == max_stream_ordering
+        ):
+            # The pusher pool has already fetched everything we need.
+            unprocessed = [
+                push_action
+                for push_action in prefetched[2]
+                if push_action["stream_ordering"] > self.last_stream_ordering
+            ]
+            fetched_all = True
+        else:
+            # Limit how many pushers are querying for push actions at once. We
+            # don't hold a lane while talking to the push gateway, so that slow
+            # gateways can't hold up everyone else's pushes.
+            with (await self._pusher_pool.processing_lanes.queue(None)):
+                fn = self.store.get_unread_push_actions_for_user_in_range_for_http
+                unprocessed = await fn(
+                    self.user_id,
+                    self.last_stream_ordering,
+                    max_stream_ordering,
+                    limit=self.FETCH_LIMIT,
+                )
+            fetched_all = len(unprocessed) < self.FETCH_LIMIT
 
         logger.info(
             "Processing %i unprocessed push actions for %s starting at "
@@ -277,6 +344,9 @@ class HttpPusher:
                         self.backoff_delay * 2, self.MAX_BACKOFF_SEC
                     )
                     break
+        else:
+            if fetched_all and max_stream_ordering is not None:
+                self.processed_up_to = max_stream_ordering
 
     async def _process_one(self, push_action):
         if "notify" not in push_action["actions"]:
@@ -382,7 +452,7 @@ class HttpPusher:
         if not notification_dict:
             return []
         try:
-            resp = await self.http_client.post_json_get_json(
+            rejected = await self.gateway_client.send_notification(
                 self.url, notification_dict
             )
         except Exception as e:
@@ -394,9 +464,6 @@ class HttpPusher:
                 e,
             )
             return False
-        rejected = []
-        if "rejected" in resp:
-            rejected = resp["rejected"]
         return rejected
 
     async def _send_badge(self, badge):
@@ -422,7 +489,7 @@ class HttpPusher:
             }
         }
         try:
-            await self.http_client.post_json_get_json(self.url, d)
+            await self.gateway_client.send_notification(self.url, d)
             http_badges_processed_counter.inc()
         except Exception as e:
             logger.warning(
@@ -104,6 +104,20 @@ def tweaks_for_actions(actions: List[Union[str, Dict]]) -> Dict[str, Any]:
     return tweaks
 
 
+def condition_depends_on_user(condition: dict) -> bool:
+    """Returns whether the outcome of the condition depends on which user the
+    push rules are being evaluated for (i.e. on their user ID or display name),
+    rather than just on the event.
+    """
+    if condition["kind"] == "contains_display_name":
+        return True
+
+    if condition["kind"] == "event_match" and not condition.get("pattern"):
+        return condition.get("pattern_type") in ("user_id", "user_localpart")
+
+    return False
+
+
 class PushRuleEvaluatorForEvent:
     def __init__(
         self,
@@ -15,10 +15,11 @@
 # limitations under the License.
 
 import logging
-from typing import TYPE_CHECKING, Dict, Union
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
 
 from prometheus_client import Gauge
 
+from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import (
     run_as_background_process,
     wrap_as_background_process,
@@ -28,7 +29,7 @@ from synapse.push.emailpusher import EmailPusher
 from synapse.push.httppusher import HttpPusher
 from synapse.push.pusher import PusherFactory
 from synapse.types import RoomStreamToken
-from synapse.util.async_helpers import concurrently_execute
+from synapse.util.async_helpers import Linearizer, concurrently_execute
 
 if TYPE_CHECKING:
     from synapse.server import HomeServer
@@ -79,6 +80,37 @@ class PusherPool:
         # map from user id to app_id:pushkey to pusher
         self.pushers = {}  # type: Dict[str, Dict[str, Union[HttpPusher, EmailPusher]]]
 
+        # Limits the number of HTTP pushers which can be fetching push actions
+        # at once, so that waking up lots of pushers doesn't swamp the
+        # database.
+        self.processing_lanes = Linearizer(
+            name="pusher_processing_lanes",
+            max_count=hs.config.pusher_processing_lanes,
+            clock=self.clock,
+        )
+
+        LaterGauge(
+            "synapse_pushers_backlog_age_seconds",
+            "Age of the oldest unsent notification for HTTP pushers, by app_id",
+            ["kind", "app_id"],
+            self._get_backlog_ages,
+        )
+
+    def _get_backlog_ages(self) -> Dict[Tuple[str, str], float]:
+        now = self.clock.time_msec()
+        ages = {}  # type: Dict[Tuple[str, str], float]
+        for pushers in self.pushers.values():
+            for p in pushers.values():
+                if not isinstance(p, HttpPusher):
+                    continue
+
+                key = ("http", p.app_id)
+                age = 0.0
+                if p.pending_since is not None:
+                    age = (now - p.pending_since) / 1000
+                ages[key] = max(age, ages.get(key, 0.0))
+        return ages
+
     def start(self):
         """Starts the pushers off in a background process.
         """
@@ -223,7 +255,11 @@ class PusherPool:
                 prev_stream_id, max_stream_id
             )
 
+            users_to_notify = []
             for u in users_affected:
+                if u not in self.pushers:
+                    continue
+
                 # Don't push if the user account has expired
                 if self._account_validity.enabled:
                     expired = await self.store.is_account_expired(
@@ -232,8 +268,39 @@ class PusherPool:
                     if expired:
                         continue
 
-                if u in self.pushers:
-                    for p in self.pushers[u].values():
+                users_to_notify.append(u)
+
+            # Fetch the push actions for the new events for all the HTTP pushers
+            # which have caught up in one go, rather than having each pusher
+            # query for its own.
+            users_to_prefetch = {
+                u
+                for u in users_to_notify
+                if any(
+                    isinstance(p, HttpPusher)
+                    and p.processed_up_to is not None
+                    and p.processed_up_to >= prev_stream_id
+                    for p in self.pushers[u].values()
+                )
+            }
+            push_actions_by_user = {}  # type: Dict[str, List[dict]]
+            if users_to_prefetch:
+                push_actions_by_user = await self.store.get_unread_push_actions_for_users_in_range_for_http(
+                    users_to_prefetch, prev_stream_id, max_stream_id
+                )
+
+            for u in users_to_notify:
+                for p in self.pushers.get(u, {}).values():
+                    if isinstance(p, HttpPusher):
+                        prefetched = None
+                        if u in users_to_prefetch:
+                            prefetched = (
+                                prev_stream_id,
+                                max_stream_id,
+                                push_actions_by_user.get(u, []),
+                            )
+                        p.on_new_notifications(max_token, prefetched)
+                    else:
                         p.on_new_notifications(max_token)
 
         except Exception:
@@ -353,9 +420,14 @@ class PusherPool:
         user_id = pusherdict["user_name"]
         last_stream_ordering = pusherdict["last_stream_ordering"]
         if last_stream_ordering:
+            max_stream_ordering = self.store.get_room_max_stream_ordering()
             have_notifs = await self.store.get_if_maybe_push_in_range_for_user(
                 user_id, last_stream_ordering
             )
+            if not have_notifs and isinstance(p, HttpPusher):
+                # Push actions are persisted along with their events, so there
+                # is nothing for the pusher to do up to the current position.
+                p.processed_up_to = max_stream_ordering
         else:
             # We always want to default to starting up the pusher rather than
             # risk missing push.
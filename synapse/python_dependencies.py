@@ -109,6 +109,10 @@ CONDITIONAL_REQUIREMENTS = {
     # hiredis is not a *strict* dependency, but it makes things much faster.
     # (if it is not installed, we fall back to slow code.)
     "redis": ["txredisapi>=1.4.7", "hiredis"],
+    # ijson is used to parse large federation responses incrementally. (If it
+    # is not installed, we fall back to parsing the whole response at once.)
+    # We need `use_float`, which was added in ijson 3.1.
+    "ijson": ["ijson>=3.1"],
 }
 
 ALL_OPTIONAL_REQUIREMENTS = set()  # type: Set[str]
@@ -16,6 +16,7 @@
 import logging
 from typing import TYPE_CHECKING
 
+from synapse.api.presence import UserPresenceState
 from synapse.http.servlet import parse_json_object_from_request
 from synapse.replication.http._base import ReplicationEndpoint
 from synapse.types import UserID
@@ -111,6 +112,72 @@ class ReplicationPresenceSetState(ReplicationEndpoint):
         )
 
 
+class ReplicationPresenceSendToRemotes(ReplicationEndpoint):
+    """Send presence updates written by a presence writer worker out over
+    federation.
+
+    Only the main process can queue up federation traffic, so presence writers
+    running on workers forward their updates to it.
+
+    The POST looks like:
+
+        POST /_synapse/replication/presence_send_to_remotes/<txn_id>
+
+        {
+            "states": [ ... ],
+            "destinations": [ ... ],
+        }
+
+        200 OK
+
+        {}
+
+    `destinations` is null if the updates should be sent to all servers that
+    share a room with the users.
+    """
+
+    NAME = "presence_send_to_remotes"
+    PATH_ARGS = ()
+    METHOD = "POST"
+
+    def __init__(self, hs: "HomeServer"):
+        super().__init__(hs)
+
+        self._federation_sender = hs.get_federation_sender()
+
+    @staticmethod
+    async def _serialize_payload(states, destinations):
+        """
+        Args:
+            states (list[UserPresenceState])
+            destinations (list[str]|None)
+        """
+        return {
+            "states": [state.as_dict() for state in states],
+            "destinations": destinations,
+        }
+
+    async def _handle_request(self, request):
+        content = parse_json_object_from_request(request)
+
+        states = [UserPresenceState.from_dict(d) for d in content["states"]]
+        destinations = content["destinations"]
+
+        if destinations is None:
+            self._federation_sender.send_presence(states)
+        else:
+            self._federation_sender.send_presence_to_destinations(
+                states=states, destinations=destinations
+            )
+
+        return 200, {}
+
+
 def register_servlets(hs, http_server):
     ReplicationBumpPresenceActiveTime(hs).register(http_server)
     ReplicationPresenceSetState(hs).register(http_server)
+
+    # Only the main process can send federation traffic on behalf of presence
+    # writers.
+    if hs.config.worker.worker_app is None:
+        ReplicationPresenceSendToRemotes(hs).register(http_server)
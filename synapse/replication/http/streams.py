@@ -28,7 +28,7 @@ class ReplicationGetStreamUpdates(ReplicationEndpoint):
 
     The API looks like:
 
-        GET /_synapse/replication/get_repl_stream_updates/<stream name>?from_token=0&to_token=10
+        GET /_synapse/replication/get_repl_stream_updates/<stream name>?from_token=0&to_token=10&limit=100
 
         200 OK
 
@@ -39,7 +39,8 @@ class ReplicationGetStreamUpdates(ReplicationEndpoint):
         }
 
     If there are more rows than can sensibly be returned in one lump, `limited` will be
-    set to true, and the caller should call again with a new `from_token`.
+    set to true, and the caller should call again with a new `from_token`. The
+    optional `limit` is a hint for the number of rows to return.
 
     """
 
@@ -54,8 +55,8 @@ class ReplicationGetStreamUpdates(ReplicationEndpoint):
         self.streams = hs.get_replication_streams()
 
     @staticmethod
-    async def _serialize_payload(stream_name, from_token, upto_token):
-        return {"from_token": from_token, "upto_token": upto_token}
+    async def _serialize_payload(stream_name, from_token, upto_token, limit):
+        return {"from_token": from_token, "upto_token": upto_token, "limit": limit}
 
     async def _handle_request(self, request, stream_name):
         stream = self.streams.get(stream_name)
@@ -64,10 +65,16 @@ class ReplicationGetStreamUpdates(ReplicationEndpoint):
 
         from_token = parse_integer(request, "from_token", required=True)
         upto_token = parse_integer(request, "upto_token", required=True)
-
-        updates, upto_token, limited = await stream.get_updates_since(
-            self._instance_name, from_token, upto_token
-        )
+        limit = parse_integer(request, "limit")
+
+        if limit is None:
+            updates, upto_token, limited = await stream.get_updates_since(
+                self._instance_name, from_token, upto_token
+            )
+        else:
+            updates, upto_token, limited = await stream.get_updates_since(
+                self._instance_name, from_token, upto_token, limit
+            )
 
         return (
             200,
@@ -32,6 +32,10 @@ class SlavedDeviceInboxStore(DeviceInboxWorkerStore, BaseSlavedStore):
             "DeviceInboxStreamChangeCache",
             self._device_inbox_id_gen.get_current_token(),
         )
+        self._device_inbox_per_device_stream_cache = StreamChangeCache(
+            "DeviceInboxPerDeviceStreamChangeCache",
+            self._device_inbox_id_gen.get_current_token(),
+        )
         self._device_federation_outbox_stream_cache = StreamChangeCache(
             "DeviceFederationOutboxStreamChangeCache",
             self._device_inbox_id_gen.get_current_token(),
@@ -52,6 +56,9 @@ class SlavedDeviceInboxStore(DeviceInboxWorkerStore, BaseSlavedStore):
                     self._device_inbox_stream_cache.entity_has_changed(
                         row.entity, token
                     )
+                    self._device_inbox_per_device_stream_cache.entity_has_changed(
+                        (row.entity, row.device_id), token
+                    )
                 else:
                     self._device_federation_outbox_stream_cache.entity_has_changed(
                         row.entity, token
@@ -34,7 +34,8 @@ class SlavedDeviceStore(EndToEndKeyWorkerStore, DeviceWorkerStore, BaseSlavedSto
             "stream_id",
             extra_tables=[
                 ("user_signature_stream", "stream_id"),
-                ("device_lists_outbound_pokes", "stream_id"),
+                ("device_lists_outbound_changes", "stream_id"),
+                ("device_lists_outbound_positions", "stream_id"),
             ],
         )
         device_list_max = self._device_list_id_gen.get_current_token()
@@ -19,7 +19,7 @@ allowed to be sent by which side.
 """
 import abc
 import logging
-from typing import Tuple, Type
+from typing import Optional, Tuple, Type
 
 from synapse.util import json_decoder, json_encoder
 
@@ -37,6 +37,9 @@ class Command(metaclass=abc.ABCMeta):
 
     NAME = None  # type: str
 
+    # The cached result of `encode`.
+    _encoded = None  # type: Optional[bytes]
+
     @classmethod
     @abc.abstractmethod
     def from_line(cls, line):
@@ -50,6 +53,22 @@ class Command(metaclass=abc.ABCMeta):
         prefix.
         """
 
+    def encode(self) -> bytes:
+        """Serialises the full command line for the wire, including the command
+        prefix.
+
+        The result is cached, since the same command is generally sent to every
+        connection: commands must not be modified once they have been sent.
+        """
+        if self._encoded is None:
+            string = "%s %s" % (self.NAME, self.to_line())
+            if "\n" in string:
+                raise Exception("Unexpected newline in command: %r", string)
+
+            self._encoded = string.encode("utf-8")
+
+        return self._encoded
+
     def get_logcontext_id(self):
         """Get a suitable string for the logcontext when processing this command"""
 
@@ -140,6 +159,55 @@ class RdataCommand(Command):
         return "RDATA-" + self.stream_name
 
 
+class RdataBatchCommand(Command):
+    """Sent by server when a subscribed stream has several updates.
+
+    Format::
+
+        RDATA_BATCH <stream_name> <instance_name> <token> <rows_json>
+
+    This is equivalent to sending an RDATA for each of the rows in the
+    `<rows_json>` array, all with the given `<token>`. As with RDATA, the
+    `<token>` may be "batch", in which case the client should continue batching
+    rows until it sees an RDATA or RDATA_BATCH with a numeric stream ID.
+
+    An example::
+
+        RDATA_BATCH caches master 73 [["get_user_by_id", ["@foo:example.com"], 1605000000000], ...]
+    """
+
+    NAME = "RDATA_BATCH"
+
+    def __init__(self, stream_name, instance_name, token, rows):
+        self.stream_name = stream_name
+        self.instance_name = instance_name
+        self.token = token
+        self.rows = rows
+
+    @classmethod
+    def from_line(cls, line):
+        stream_name, instance_name, token, rows_json = line.split(" ", 3)
+        return cls(
+            stream_name,
+            instance_name,
+            None if token == "batch" else int(token),
+            json_decoder.decode(rows_json),
+        )
+
+    def to_line(self):
+        return " ".join(
+            (
+                self.stream_name,
+                self.instance_name,
+                str(self.token) if self.token is not None else "batch",
+                json_encoder.encode(self.rows),
+            )
+        )
+
+    def get_logcontext_id(self):
+        return "RDATA-" + self.stream_name
+
+
 class PositionCommand(Command):
     """Sent by an instance to tell others the stream position without needing to
     send an RDATA.
@@ -410,6 +478,7 @@ class RemoteServerUpCommand(_SimpleCommand):
 _COMMANDS = (
     ServerCommand,
     RdataCommand,
+    RdataBatchCommand,
     PositionCommand,
     ErrorCommand,
     PingCommand,
@@ -430,6 +499,7 @@ COMMAND_MAP = {cmd.NAME: cmd for cmd in _COMMANDS}
 VALID_SERVER_COMMANDS = (
     ServerCommand.NAME,
     RdataCommand.NAME,
+    RdataBatchCommand.NAME,
     PositionCommand.NAME,
     ErrorCommand.NAME,
     PingCommand.NAME,
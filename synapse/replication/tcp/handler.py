@@ -28,11 +28,12 @@ from typing import (
     Union,
 )
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 from typing_extensions import Deque
 
 from twisted.internet.protocol import ReconnectingClientFactory
 
+from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.tcp.client import DirectTcpReplicationClientFactory
@@ -41,6 +42,7 @@ from synapse.replication.tcp.commands import (
     Command,
     FederationAckCommand,
     PositionCommand,
+    RdataBatchCommand,
     RdataCommand,
     RemoteServerUpCommand,
     RemovePusherCommand,
@@ -48,16 +50,30 @@ from synapse.replication.tcp.commands import (
     UserIpCommand,
     UserSyncCommand,
 )
-from synapse.replication.tcp.protocol import AbstractConnection
+from synapse.replication.tcp.protocol import (
+    AbstractConnection,
+    BaseReplicationStreamProtocol,
+)
 from synapse.replication.tcp.streams import (
     STREAMS_MAP,
     BackfillStream,
     CachesStream,
+    DeviceListsStream,
     EventsStream,
     FederationStream,
+    PresenceStream,
+    PushersStream,
+    ReceiptsStream,
     Stream,
+    ToDeviceStream,
     TypingStream,
 )
+from synapse.replication.tcp.streams._base import (
+    _STREAM_UPDATE_MAX_ROW_COUNT,
+    _STREAM_UPDATE_TARGET_ROW_COUNT,
+    StreamUpdateResult,
+    Token,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -66,12 +82,63 @@ logger = logging.getLogger(__name__)
 inbound_rdata_count = Counter(
     "synapse_replication_tcp_protocol_inbound_rdata_count", "", ["stream_name"]
 )
+# number of RDATA_BATCH commands received for each stream
+inbound_rdata_batch_count = Counter(
+    "synapse_replication_tcp_protocol_inbound_rdata_batch_count", "", ["stream_name"]
+)
 user_sync_counter = Counter("synapse_replication_tcp_resource_user_sync", "")
 federation_ack_counter = Counter("synapse_replication_tcp_resource_federation_ack", "")
 remove_pusher_counter = Counter("synapse_replication_tcp_resource_remove_pusher", "")
 
 user_ip_cache_counter = Counter("synapse_replication_tcp_resource_user_ip_cache", "")
 
+# number of rows fetched while catching up with each stream after a POSITION
+catchup_rows_counter = Counter(
+    "synapse_replication_tcp_catchup_rows",
+    "Number of rows fetched while catching up with a stream",
+    ["stream_name"],
+)
+catchup_duration = Histogram(
+    "synapse_replication_tcp_catchup_duration_seconds",
+    "Time taken to catch up with a stream after a POSITION",
+    ["stream_name"],
+)
+
+# How long we aim for each page of updates fetched while catching up to take.
+# The page size is adjusted after each page to try and hit this.
+_CATCHUP_PAGE_TARGET_SECONDS = 0.5
+
+
+# The streams that each type of dedicated worker needs updates for, in addition
+# to the cache invalidation stream and any streams it writes to. Other workers
+# may serve any client endpoint (including /sync) and so need every stream.
+_STREAMS_BY_WORKER_APP = {
+    "synapse.app.appservice": (
+        EventsStream.NAME,
+        BackfillStream.NAME,
+        # Ephemeral events are sent to application services.
+        TypingStream.NAME,
+        ReceiptsStream.NAME,
+        PresenceStream.NAME,
+    ),
+    "synapse.app.federation_sender": (
+        EventsStream.NAME,
+        BackfillStream.NAME,
+        FederationStream.NAME,
+        ReceiptsStream.NAME,
+        DeviceListsStream.NAME,
+        ToDeviceStream.NAME,
+    ),
+    "synapse.app.media_repository": (),
+    "synapse.app.pusher": (
+        EventsStream.NAME,
+        BackfillStream.NAME,
+        ReceiptsStream.NAME,
+        PushersStream.NAME,
+    ),
+    "synapse.app.user_dir": (EventsStream.NAME, BackfillStream.NAME),
+}  # type: Dict[str, Tuple[str, ...]]
+
 
 # the type of the entries in _command_queues_by_stream
 _StreamCommandQueue = Deque[
@@ -123,6 +190,14 @@ class ReplicationCommandHandler:
 
                 continue
 
+            if isinstance(stream, PresenceStream):
+                # Only add PresenceStream as a source on the instances in
+                # charge of presence.
+                if hs.get_instance_name() in hs.config.worker.writers.presence:
+                    self._streams_to_replicate.append(stream)
+
+                continue
+
             # Only add any other streams if we're on master.
             if hs.config.worker_app is not None:
                 continue
@@ -134,6 +209,27 @@ class ReplicationCommandHandler:
 
             self._streams_to_replicate.append(stream)
 
+        # The streams which this instance processes updates for. When using
+        # redis we only subscribe to the channels for these streams.
+        self._streams_to_subscribe = set()  # type: Set[str]
+        if hs.config.worker_app in _STREAMS_BY_WORKER_APP:
+            self._streams_to_subscribe.update(
+                _STREAMS_BY_WORKER_APP[hs.config.worker_app]
+            )
+        else:
+            self._streams_to_subscribe.update(self._streams)
+
+        # Everyone needs to invalidate their caches, and writers need to track
+        # the positions of the other writers to the streams they write to.
+        self._streams_to_subscribe.add(CachesStream.NAME)
+        self._streams_to_subscribe.update(
+            stream.NAME for stream in self._streams_to_replicate
+        )
+
+        if hs.config.worker_app is None or not hs.config.send_federation:
+            # Only federation sender workers consume the federation stream.
+            self._streams_to_subscribe.discard(FederationStream.NAME)
+
         # Map of stream name to batched updates. See RdataCommand for info on
         # how batching works.
         self._pending_batches = {}  # type: Dict[str, List[Any]]
@@ -168,6 +264,31 @@ class ReplicationCommandHandler:
         # from that connection.
         self._streams_by_connection = {}  # type: Dict[AbstractConnection, Set[str]]
 
+        # For each stream, the number of POSITION commands which have been
+        # received but not yet processed, i.e. whether we are catching up.
+        self._pending_positions = {}  # type: Dict[str, int]
+
+        # For each stream which is currently catching up, the position we have
+        # caught up to and the position we are catching up to.
+        self._catchup_progress = {}  # type: Dict[str, Tuple[Token, Token]]
+
+        LaterGauge(
+            "synapse_replication_tcp_catchup_remaining",
+            "Number of stream positions left to fetch for streams which are "
+            "catching up",
+            ["stream_name"],
+            lambda: {
+                (stream_name,): target - current
+                for stream_name, (current, target) in self._catchup_progress.items()
+            },
+        )
+
+        # The streams which must have caught up for `is_ready` to return True,
+        # or None for all streams.
+        self._readiness_streams = None  # type: Optional[Set[str]]
+        if hs.config.worker.worker_readiness_streams is not None:
+            self._readiness_streams = set(hs.config.worker.worker_readiness_streams)
+
         LaterGauge(
             "synapse_replication_tcp_command_queue",
             "Number of inbound RDATA/POSITION commands queued for processing",
@@ -179,6 +300,9 @@ class ReplicationCommandHandler:
         )
 
         self._is_master = hs.config.worker_app is None
+        self._is_presence_writer = (
+            hs.get_instance_name() in hs.config.worker.writers.presence
+        )
 
         self._federation_sender = None
         if self._is_master and not hs.config.send_federation:
@@ -189,7 +313,9 @@ class ReplicationCommandHandler:
             self._server_notices_sender = hs.get_server_notices_sender()
 
     def _add_command_to_stream_queue(
-        self, conn: AbstractConnection, cmd: Union[RdataCommand, PositionCommand]
+        self,
+        conn: AbstractConnection,
+        cmd: Union[RdataCommand, RdataBatchCommand, PositionCommand],
     ) -> None:
         """Queue the given received command for processing
 
@@ -204,6 +330,11 @@ class ReplicationCommandHandler:
 
         queue.append((cmd, conn))
 
+        if isinstance(cmd, PositionCommand):
+            self._pending_positions[stream_name] = (
+                self._pending_positions.get(stream_name, 0) + 1
+            )
+
         # if we're already processing this stream, there's nothing more to do:
         # the new entry on the queue will get picked up in due course
         if stream_name in self._processing_streams:
@@ -230,18 +361,21 @@ class ReplicationCommandHandler:
                     await self._process_command(cmd, conn, stream_name)
                 except Exception:
                     logger.exception("Failed to handle command %s", cmd)
+                finally:
+                    if isinstance(cmd, PositionCommand):
+                        self._pending_positions[stream_name] -= 1
         finally:
             self._processing_streams.discard(stream_name)
 
     async def _process_command(
         self,
-        cmd: Union[PositionCommand, RdataCommand],
+        cmd: Union[PositionCommand, RdataCommand, RdataBatchCommand],
         conn: AbstractConnection,
         stream_name: str,
     ) -> None:
         if isinstance(cmd, PositionCommand):
             await self._process_position(stream_name, conn, cmd)
-        elif isinstance(cmd, RdataCommand):
+        elif isinstance(cmd, (RdataCommand, RdataBatchCommand)):
             await self._process_rdata(stream_name, conn, cmd)
         else:
             # This shouldn't be possible
@@ -303,6 +437,33 @@ class ReplicationCommandHandler:
         """
         return self._streams_to_replicate
 
+    def get_streams_to_subscribe(self) -> Set[str]:
+        """Get the names of the streams that this instance needs updates for.
+        """
+        return self._streams_to_subscribe
+
+    def is_ready(self) -> bool:
+        """Whether this instance has caught up with the replication streams,
+        and so is ready to serve traffic.
+
+        Only the streams listed in the `worker_readiness_streams` config option
+        are considered, if it is set.
+        """
+        if not self._connections:
+            return False
+
+        for stream_name, pending in self._pending_positions.items():
+            if not pending:
+                continue
+
+            if (
+                self._readiness_streams is None
+                or stream_name in self._readiness_streams
+            ):
+                return False
+
+        return True
+
     def on_REPLICATE(self, conn: AbstractConnection, cmd: ReplicateCommand):
         self.send_positions_to_connection(conn)
 
@@ -330,7 +491,7 @@ class ReplicationCommandHandler:
     ) -> Optional[Awaitable[None]]:
         user_sync_counter.inc()
 
-        if self._is_master:
+        if self._is_presence_writer:
             return self._presence_handler.update_external_syncs_row(
                 cmd.instance_id, cmd.user_id, cmd.is_syncing, cmd.last_sync_ms
             )
@@ -340,7 +501,7 @@ class ReplicationCommandHandler:
     def on_CLEAR_USER_SYNC(
         self, conn: AbstractConnection, cmd: ClearUserSyncsCommand
     ) -> Optional[Awaitable[None]]:
-        if self._is_master:
+        if self._is_presence_writer:
             return self._presence_handler.update_external_syncs_clear(cmd.instance_id)
         else:
             return None
@@ -407,18 +568,39 @@ class ReplicationCommandHandler:
 
         self._add_command_to_stream_queue(conn, cmd)
 
+    def on_RDATA_BATCH(self, conn: AbstractConnection, cmd: RdataBatchCommand):
+        if cmd.instance_name == self._instance_name:
+            # Ignore RDATA that are just our own echoes
+            return
+
+        stream_name = cmd.stream_name
+        inbound_rdata_count.labels(stream_name).inc(len(cmd.rows))
+        inbound_rdata_batch_count.labels(stream_name).inc()
+
+        # See on_RDATA for why we queue the command.
+        self._add_command_to_stream_queue(conn, cmd)
+
     async def _process_rdata(
-        self, stream_name: str, conn: AbstractConnection, cmd: RdataCommand
+        self,
+        stream_name: str,
+        conn: AbstractConnection,
+        cmd: Union[RdataCommand, RdataBatchCommand],
     ) -> None:
-        """Process an RDATA command
+        """Process an RDATA or RDATA_BATCH command
 
         Called after the command has been popped off the queue of inbound commands
         """
+        if isinstance(cmd, RdataBatchCommand):
+            raw_rows = cmd.rows
+        else:
+            raw_rows = [cmd.row]
+
         try:
-            row = STREAMS_MAP[stream_name].parse_row(cmd.row)
+            parse_row = STREAMS_MAP[stream_name].parse_row
+            new_rows = [parse_row(raw_row) for raw_row in raw_rows]
         except Exception as e:
             raise Exception(
-                "Failed to parse RDATA: %r %r" % (stream_name, cmd.row)
+                "Failed to parse %s: %r %r" % (cmd.NAME, stream_name, raw_rows)
             ) from e
 
         # make sure that we've processed a POSITION for this stream *on this
@@ -439,12 +621,12 @@ class ReplicationCommandHandler:
             # I.e. this is part of a batch of updates for this stream (in
             # which case batch until we get an update for the stream with a non
             # None token).
-            self._pending_batches.setdefault(stream_name, []).append(row)
+            self._pending_batches.setdefault(stream_name, []).extend(new_rows)
             return
 
         # Check if this is the last of a batch of updates
         rows = self._pending_batches.pop(stream_name, [])
-        rows.append(row)
+        rows.extend(new_rows)
 
         stream = self._streams[stream_name]
 
@@ -515,29 +697,10 @@ class ReplicationCommandHandler:
         # If the position token matches our current token then we're up to
         # date and there's nothing to do. Otherwise, fetch all updates
         # between then and now.
-        missing_updates = cmd.prev_token != current_token
-        while missing_updates:
-            logger.info(
-                "Fetching replication rows for '%s' between %i and %i",
-                stream_name,
-                current_token,
-                cmd.new_token,
-            )
-            (updates, current_token, missing_updates) = await stream.get_updates_since(
-                cmd.instance_name, current_token, cmd.new_token
-            )
-
-            # TODO: add some tests for this
-
-            # Some streams return multiple rows with the same stream IDs,
-            # which need to be processed in batches.
-
-            for token, rows in _batch_updates(updates):
-                await self.on_rdata(
-                    stream_name,
-                    cmd.instance_name,
-                    token,
-                    [stream.parse_row(row) for row in rows],
+        if cmd.prev_token != current_token:
+            with catchup_duration.labels(stream_name).time():
+                await self._catch_up_stream(
+                    stream, cmd.instance_name, current_token, cmd.new_token
                 )
 
         logger.info("Caught up with stream '%s' to %i", stream_name, cmd.new_token)
@@ -549,6 +712,95 @@ class ReplicationCommandHandler:
 
         self._streams_by_connection.setdefault(conn, set()).add(stream_name)
 
+    async def _catch_up_stream(
+        self, stream: Stream, instance_name: str, from_token: Token, upto_token: Token
+    ) -> None:
+        """Fetch and process all the updates to the stream between the two
+        tokens.
+
+        The updates are fetched a page at a time, with the page size adjusted
+        according to how long each page takes to fetch. The next page is
+        fetched while the current one is being processed.
+        """
+        stream_name = stream.NAME
+        limit = _STREAM_UPDATE_TARGET_ROW_COUNT
+
+        self._catchup_progress[stream_name] = (from_token, upto_token)
+
+        fetch = run_in_background(
+            self._fetch_catchup_page,
+            stream,
+            instance_name,
+            from_token,
+            upto_token,
+            limit,
+        )
+        try:
+            while fetch is not None:
+                (
+                    (updates, current_token, limited),
+                    duration,
+                ) = await make_deferred_yieldable(fetch)
+                fetch = None
+
+                limit = _get_next_catchup_page_size(limit, duration)
+
+                if limited:
+                    fetch = run_in_background(
+                        self._fetch_catchup_page,
+                        stream,
+                        instance_name,
+                        current_token,
+                        upto_token,
+                        limit,
+                    )
+
+                # Some streams return multiple rows with the same stream IDs,
+                # which need to be processed in batches.
+                for token, rows in _batch_updates(updates):
+                    await self.on_rdata(
+                        stream_name,
+                        instance_name,
+                        token,
+                        [stream.parse_row(row) for row in rows],
+                    )
+
+                catchup_rows_counter.labels(stream_name).inc(len(updates))
+                self._catchup_progress[stream_name] = (current_token, upto_token)
+        finally:
+            if fetch is not None:
+                # We failed to process a page: make sure that the error from the
+                # prefetch, if any, doesn't get logged as unhandled.
+                fetch.addErrback(lambda _: None)
+
+            self._catchup_progress.pop(stream_name, None)
+
+    async def _fetch_catchup_page(
+        self,
+        stream: Stream,
+        instance_name: str,
+        from_token: Token,
+        upto_token: Token,
+        limit: int,
+    ) -> Tuple[StreamUpdateResult, float]:
+        """Fetch a page of updates for the stream.
+
+        Returns:
+            The result of `get_updates_since`, and how long it took in seconds.
+        """
+        logger.info(
+            "Fetching up to %i replication rows for '%s' between %i and %i",
+            limit,
+            stream.NAME,
+            from_token,
+            upto_token,
+        )
+        start = self._clock.time()
+        result = await stream.get_updates_since(
+            instance_name, from_token, upto_token, limit
+        )
+        return result, self._clock.time() - start
+
     def on_REMOTE_SERVER_UP(self, conn: AbstractConnection, cmd: RemoteServerUpCommand):
         """"Called when get a new REMOTE_SERVER_UP command."""
         self._replication_data_handler.on_remote_server_up(cmd.data)
@@ -695,6 +947,46 @@ class ReplicationCommandHandler:
         """
         self.send_command(RdataCommand(stream_name, self._instance_name, token, data))
 
+    def stream_updates(self, stream_name: str, token: int, rows: List[Any]):
+        """Called when a batch of updates with the same token is available to
+        stream to clients.
+
+        Single rows are sent as an RDATA; larger batches as one or more
+        RDATA_BATCH commands, each of which fits within the maximum line length.
+        """
+        for cmd in self._build_rdata_batches(stream_name, token, rows):
+            self.send_command(cmd)
+
+    def _build_rdata_batches(
+        self, stream_name: str, token: Optional[int], rows: List[Any]
+    ) -> List[Command]:
+        """Split the given rows into RDATA_BATCH commands which fit within the
+        maximum line length. All but the last command get a "batch" token.
+        """
+        if len(rows) == 1:
+            return [RdataCommand(stream_name, self._instance_name, token, rows[0])]
+
+        cmd = RdataBatchCommand(stream_name, self._instance_name, token, rows)
+        if len(cmd.encode()) <= BaseReplicationStreamProtocol.MAX_LENGTH:
+            return [cmd]
+
+        mid = len(rows) // 2
+        return self._build_rdata_batches(
+            stream_name, None, rows[:mid]
+        ) + self._build_rdata_batches(stream_name, token, rows[mid:])
+
+
+def _get_next_catchup_page_size(limit: int, duration: float) -> int:
+    """Work out how many rows to ask for in the next page of updates while
+    catching up with a stream, given that the last page of `limit` rows took
+    `duration` seconds to fetch.
+    """
+    if duration < _CATCHUP_PAGE_TARGET_SECONDS / 2:
+        return min(limit * 2, _STREAM_UPDATE_MAX_ROW_COUNT)
+    elif duration > _CATCHUP_PAGE_TARGET_SECONDS:
+        return max(limit // 2, _STREAM_UPDATE_TARGET_ROW_COUNT)
+    return limit
+
 
 UpdateToken = TypeVar("UpdateToken")
 UpdateRow = TypeVar("UpdateRow")
@@ -72,6 +72,9 @@ from synapse.replication.tcp.commands import (
     ErrorCommand,
     NameCommand,
     PingCommand,
+    PositionCommand,
+    RdataBatchCommand,
+    RdataCommand,
     ReplicateCommand,
     ServerCommand,
     parse_command_from_line,
@@ -101,6 +104,18 @@ tcp_outbound_commands_counter = Counter(
     ["command", "name"],
 )
 
+tcp_inbound_stream_bytes_counter = Counter(
+    "synapse_replication_tcp_protocol_inbound_stream_bytes",
+    "Number of bytes of RDATA and POSITION commands received, by stream",
+    ["stream_name"],
+)
+
+tcp_outbound_stream_bytes_counter = Counter(
+    "synapse_replication_tcp_protocol_outbound_stream_bytes",
+    "Number of bytes of RDATA and POSITION commands sent, by stream",
+    ["stream_name"],
+)
+
 # A list of all connected protocols. This allows us to send metrics about the
 # connections.
 connected_connections = []
@@ -250,6 +265,8 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
         self.last_received_command = self.clock.time_msec()
 
         tcp_inbound_commands_counter.labels(cmd.NAME, self.name).inc()
+        if isinstance(cmd, (RdataCommand, RdataBatchCommand, PositionCommand)):
+            tcp_inbound_stream_bytes_counter.labels(cmd.stream_name).inc(len(line))
 
         self.handle_command(cmd)
 
@@ -325,11 +342,11 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
         tcp_outbound_commands_counter.labels(cmd.NAME, self.name).inc()
 
-        string = "%s %s" % (cmd.NAME, cmd.to_line())
-        if "\n" in string:
-            raise Exception("Unexpected newline in command: %r", string)
-
-        encoded_string = string.encode("utf-8")
+        encoded_string = cmd.encode()
+        if isinstance(cmd, (RdataCommand, RdataBatchCommand, PositionCommand)):
+            tcp_outbound_stream_bytes_counter.labels(cmd.stream_name).inc(
+                len(encoded_string)
+            )
 
         if len(encoded_string) > self.MAX_LENGTH:
             raise Exception(
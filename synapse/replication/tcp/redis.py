@@ -15,9 +15,12 @@
 
 import logging
 from inspect import isawaitable
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import txredisapi
+from prometheus_client import Counter
+
+from twisted.internet import defer
 
 from synapse.logging.context import PreserveLoggingContext, make_deferred_yieldable
 from synapse.metrics.background_process_metrics import (
@@ -26,14 +29,21 @@ from synapse.metrics.background_process_metrics import (
 )
 from synapse.replication.tcp.commands import (
     Command,
+    PositionCommand,
+    RdataBatchCommand,
+    RdataCommand,
     ReplicateCommand,
     parse_command_from_line,
 )
 from synapse.replication.tcp.protocol import (
     AbstractConnection,
     tcp_inbound_commands_counter,
+    tcp_inbound_stream_bytes_counter,
     tcp_outbound_commands_counter,
+    tcp_outbound_stream_bytes_counter,
 )
+from synapse.types import Collection
+from synapse.util import Clock
 
 if TYPE_CHECKING:
     from synapse.replication.tcp.handler import ReplicationCommandHandler
@@ -41,6 +51,12 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+redis_published_messages_counter = Counter(
+    "synapse_replication_redis_published_messages",
+    "Number of messages published to redis, each of which may contain several "
+    "commands",
+)
+
 
 class RedisSubscriber(txredisapi.SubscriberProtocol, AbstractConnection):
     """Connection to redis subscribed to replication stream.
@@ -58,21 +74,39 @@ class RedisSubscriber(txredisapi.SubscriberProtocol, AbstractConnection):
     constructor, so instead we expect the defined attributes below to be set
     immediately after initialisation.
 
+    Commands for a replication stream (RDATA, RDATA_BATCH and POSITION) are sent
+    on a separate redis channel per replication stream, so that instances only
+    receive updates for the streams they are interested in. All other commands
+    are sent on the `stream_name` channel.
+
+    Outgoing commands are buffered until the end of the current reactor tick,
+    and consecutive commands for the same channel are then published as a
+    single newline-separated message.
+
     Attributes:
         handler: The command handler to handle incoming commands.
         stream_name: The *redis* stream name to subscribe to and publish from
             (not anything to do with Synapse replication streams).
+        subscribed_streams: The names of the replication streams to subscribe
+            to.
         outbound_redis_connection: The connection to redis to use to send
             commands.
+        clock: Used to schedule sending buffered commands.
     """
 
     handler = None  # type: ReplicationCommandHandler
     stream_name = None  # type: str
+    subscribed_streams = ()  # type: Collection[str]
     outbound_redis_connection = None  # type: txredisapi.RedisProtocol
+    clock = None  # type: Clock
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Encoded outgoing commands waiting to be published, along with the
+        # channel to publish them on.
+        self._pending_commands = []  # type: List[Tuple[str, bytes]]
+
         # a logcontext which we use for processing incoming commands. We declare it as a
         # background process so that the CPU stats get reported to prometheus.
         self._logging_context = BackgroundProcessLoggingContext(
@@ -88,25 +122,33 @@ class RedisSubscriber(txredisapi.SubscriberProtocol, AbstractConnection):
         # it's important to make sure that we only send the REPLICATE command once we
         # have successfully subscribed to the stream - otherwise we might miss the
         # POSITION response sent back by the other end.
-        logger.info("Sending redis SUBSCRIBE for %s", self.stream_name)
-        await make_deferred_yieldable(self.subscribe(self.stream_name))
+        channels = [self.stream_name] + [
+            get_channel_for_stream(self.stream_name, name)
+            for name in sorted(self.subscribed_streams)
+        ]
+        logger.info("Sending redis SUBSCRIBE for %s", channels)
+        await make_deferred_yieldable(self.subscribe(channels))
         logger.info(
             "Successfully subscribed to redis stream, sending REPLICATE command"
         )
         self.handler.new_connection(self)
-        await self._async_send_command(ReplicateCommand())
-        logger.info("REPLICATE successfully sent")
+        self.send_command(ReplicateCommand())
 
         # We send out our positions when there is a new connection in case the
         # other side missed updates. We do this for Redis connections as the
         # otherside won't know we've connected and so won't issue a REPLICATE.
+        #
+        # Outgoing commands are buffered in order, so these will be published
+        # after the REPLICATE.
         self.handler.send_positions_to_connection(self)
 
     def messageReceived(self, pattern: str, channel: str, message: str):
         """Received a message from redis.
         """
         with PreserveLoggingContext(self._logging_context):
-            self._parse_and_dispatch_message(message)
+            # A message may contain several commands, one per line.
+            for line in message.split("\n"):
+                self._parse_and_dispatch_message(line)
 
     def _parse_and_dispatch_message(self, message: str):
         if message.strip() == "":
@@ -124,6 +166,8 @@ class RedisSubscriber(txredisapi.SubscriberProtocol, AbstractConnection):
         # We use "redis" as the name here as we don't have 1:1 connections to
         # remote instances.
         tcp_inbound_commands_counter.labels(cmd.NAME, "redis").inc()
+        if isinstance(cmd, (RdataCommand, RdataBatchCommand, PositionCommand)):
+            tcp_inbound_stream_bytes_counter.labels(cmd.stream_name).inc(len(message))
 
         self.handle_command(cmd)
 
@@ -166,27 +210,71 @@ class RedisSubscriber(txredisapi.SubscriberProtocol, AbstractConnection):
         Args:
             cmd (Command)
         """
-        run_as_background_process(
-            "send-cmd", self._async_send_command, cmd, bg_start_span=False
-        )
-
-    async def _async_send_command(self, cmd: Command):
-        """Encode a replication command and send it over our outbound connection"""
-        string = "%s %s" % (cmd.NAME, cmd.to_line())
-        if "\n" in string:
-            raise Exception("Unexpected newline in command: %r", string)
-
-        encoded_string = string.encode("utf-8")
+        encoded_string = cmd.encode()
 
         # We use "redis" as the name here as we don't have 1:1 connections to
         # remote instances.
         tcp_outbound_commands_counter.labels(cmd.NAME, "redis").inc()
 
+        if isinstance(cmd, (RdataCommand, RdataBatchCommand, PositionCommand)):
+            tcp_outbound_stream_bytes_counter.labels(cmd.stream_name).inc(
+                len(encoded_string)
+            )
+            channel = get_channel_for_stream(self.stream_name, cmd.stream_name)
+        else:
+            channel = self.stream_name
+
+        if not self._pending_commands:
+            self.clock.call_later(0, self._send_pending_commands)
+
+        self._pending_commands.append((channel, encoded_string))
+
+    def _send_pending_commands(self):
+        """Publish all the buffered commands, combining consecutive commands
+        for the same channel into a single message.
+        """
+        pending = self._pending_commands
+        self._pending_commands = []
+
+        messages = []  # type: List[Tuple[str, List[bytes]]]
+        for channel, encoded_string in pending:
+            if messages and messages[-1][0] == channel:
+                messages[-1][1].append(encoded_string)
+            else:
+                messages.append((channel, [encoded_string]))
+
+        redis_published_messages_counter.inc(len(messages))
+
+        run_as_background_process(
+            "send-cmd", self._async_send_messages, messages, bg_start_span=False
+        )
+
+    async def _async_send_messages(self, messages: List[Tuple[str, List[bytes]]]):
+        """Publish the given messages over our outbound connection.
+
+        The PUBLISH commands are all written to the connection before we wait
+        for any of the replies, and redis processes them in order.
+        """
         await make_deferred_yieldable(
-            self.outbound_redis_connection.publish(self.stream_name, encoded_string)
+            defer.gatherResults(
+                [
+                    self.outbound_redis_connection.publish(
+                        channel, b"\n".join(encoded_strings)
+                    )
+                    for channel, encoded_strings in messages
+                ],
+                consumeErrors=True,
+            )
         )
 
 
+def get_channel_for_stream(channel_prefix: str, stream_name: str) -> str:
+    """Get the redis channel used for the commands of the given replication
+    stream.
+    """
+    return "%s/%s" % (channel_prefix, stream_name)
+
+
 class RedisDirectTcpReplicationClientFactory(txredisapi.SubscriberFactory):
     """This is a reconnecting factory that connects to redis and immediately
     subscribes to a stream.
@@ -214,6 +302,7 @@ class RedisDirectTcpReplicationClientFactory(txredisapi.SubscriberFactory):
 
         self.handler = hs.get_tcp_replication()
         self.stream_name = hs.hostname
+        self.clock = hs.get_clock()
 
         self.outbound_redis_connection = outbound_redis_connection
 
@@ -227,6 +316,8 @@ class RedisDirectTcpReplicationClientFactory(txredisapi.SubscriberFactory):
         p.handler = self.handler
         p.outbound_redis_connection = self.outbound_redis_connection
         p.stream_name = self.stream_name
+        p.subscribed_streams = self.handler.get_streams_to_subscribe()
+        p.clock = self.clock
         p.password = self.password
 
         return p
@@ -215,16 +215,16 @@ class ReplicationStreamer:
                             continue
 
                         # Some streams return multiple rows with the same stream IDs,
-                        # we need to make sure they get sent out in batches. We do
-                        # this by setting the current token to all but the last of
-                        # a series of updates with the same token to have a None
-                        # token. See RdataCommand for more details.
-                        batched_updates = _batch_updates(updates)
+                        # we need to make sure they get sent out in batches. See
+                        # RdataCommand and RdataBatchCommand for more details.
+                        batched_updates = _batch_updates(
+                            updates, stream.BATCH_ACROSS_TOKENS
+                        )
 
-                        for token, row in batched_updates:
+                        for token, rows in batched_updates:
                             try:
-                                self.command_handler.stream_update(
-                                    stream.NAME, token, row
+                                self.command_handler.stream_updates(
+                                    stream.NAME, token, rows
                                 )
                             except Exception:
                                 logger.exception("Failed to replicate")
@@ -235,28 +235,32 @@ class ReplicationStreamer:
             self.is_looping = False
 
 
-def _batch_updates(updates):
-    """Takes a list of updates of form [(token, row)] and sets the token to
-    None for all rows where the next row has the same token. This is used to
-    implement batching.
+def _batch_updates(updates, across_tokens=False):
+    """Takes a list of updates of form [(token, row)] and groups together the
+    rows of consecutive updates with the same token.
 
     For example:
 
-        [(1, _), (1, _), (2, _), (3, _), (3, _)]
+        [(1, a), (1, b), (2, c), (3, d), (3, e)]
 
     becomes:
 
-        [(None, _), (1, _), (2, _), (None, _), (3, _)]
+        [(1, [a, b]), (2, [c]), (3, [d, e])]
+
+    If `across_tokens` is set then all the rows are grouped under the last
+    token, i.e. the example becomes [(3, [a, b, c, d, e])].
     """
     if not updates:
         return []
 
-    new_updates = []
-    for i, update in enumerate(updates[:-1]):
-        if update[0] == updates[i + 1][0]:
-            new_updates.append((None, update[1]))
+    if across_tokens:
+        return [(updates[-1][0], [row for _, row in updates])]
+
+    batches = []
+    for token, row in updates:
+        if batches and batches[-1][0] == token:
+            batches[-1][1].append(row)
         else:
-            new_updates.append(update)
+            batches.append((token, [row]))
 
-    new_updates.append(updates[-1])
-    return new_updates
+    return batches
@@ -40,6 +40,10 @@ logger = logging.getLogger(__name__)
 # the number of rows to request from an update_function.
 _STREAM_UPDATE_TARGET_ROW_COUNT = 100
 
+# the maximum number of rows which may be requested from an update_function in
+# one go, e.g. by a worker catching up with a stream.
+_STREAM_UPDATE_MAX_ROW_COUNT = 10000
+
 
 # Some type aliases to make things a bit easier.
 
@@ -90,6 +94,11 @@ class Stream:
     # The type of the row. Used by the default impl of parse_row.
     ROW_TYPE = None  # type: Any
 
+    # Whether updates with different tokens can be sent to other instances as
+    # a single batch under the last token, i.e. nothing which processes the
+    # rows depends on the tokens of the individual rows.
+    BATCH_ACROSS_TOKENS = False
+
     @classmethod
     def parse_row(cls, row: StreamRow):
         """Parse a row received over replication
@@ -165,11 +174,22 @@ class Stream:
         return updates, current_token, limited
 
     async def get_updates_since(
-        self, instance_name: str, from_token: Token, upto_token: Token
+        self,
+        instance_name: str,
+        from_token: Token,
+        upto_token: Token,
+        target_row_count: int = _STREAM_UPDATE_TARGET_ROW_COUNT,
     ) -> StreamUpdateResult:
         """Like get_updates except allows specifying from when we should
         stream updates
 
+        Args:
+            instance_name: the writer of the stream
+            from_token: the token to fetch updates after
+            upto_token: the token to fetch updates up to
+            target_row_count: the approximate number of rows to return. This is
+                capped at `_STREAM_UPDATE_MAX_ROW_COUNT`.
+
         Returns:
             A triplet `(updates, new_last_token, limited)`, where `updates` is
             a list of `(token, row)` entries, `new_last_token` is the new
@@ -182,8 +202,10 @@ class Stream:
         if from_token == upto_token:
             return [], upto_token, False
 
+        target_row_count = min(target_row_count, _STREAM_UPDATE_MAX_ROW_COUNT)
+
         updates, upto_token, limited = await self.update_function(
-            instance_name, from_token, upto_token, _STREAM_UPDATE_TARGET_ROW_COUNT,
+            instance_name, from_token, upto_token, target_row_count,
         )
         return updates, upto_token, limited
 
@@ -213,6 +235,7 @@ def make_http_update_function(hs, stream_name: str) -> UpdateFunction:
             stream_name=stream_name,
             from_token=from_token,
             upto_token=upto_token,
+            limit=limit,
         )
         return result["updates"], result["upto_token"], result["limited"]
 
@@ -273,17 +296,17 @@ class PresenceStream(Stream):
     def __init__(self, hs):
         store = hs.get_datastore()
 
-        if hs.config.worker_app is None:
-            # on the master, query the presence handler
+        if hs.get_instance_name() in hs.config.worker.writers.presence:
+            # on a presence writer, query the presence handler
             presence_handler = hs.get_presence_handler()
             update_function = presence_handler.get_all_presence_updates
         else:
-            # Query master process
+            # Query the presence writer process
             update_function = make_http_update_function(hs, self.NAME)
 
         super().__init__(
             hs.get_instance_name(),
-            current_token_without_instance(store.get_current_presence_token),
+            store._presence_id_gen.get_current_token_for_writer,
             update_function,
         )
 
@@ -405,6 +428,7 @@ class CachesStream(Stream):
 
     NAME = "caches"
     ROW_TYPE = CachesStreamRow
+    BATCH_ACROSS_TOKENS = True
 
     def __init__(self, hs):
         store = hs.get_datastore()
@@ -466,7 +490,13 @@ class ToDeviceStream(Stream):
     """New to_device messages for a client
     """
 
-    ToDeviceStreamRow = namedtuple("ToDeviceStreamRow", ("entity",))  # str
+    ToDeviceStreamRow = namedtuple(
+        "ToDeviceStreamRow",
+        (
+            "entity",  # str: a local user ID or a remote server name
+            "device_id",  # Optional[str]: the local user's device, if any
+        ),
+    )
 
     NAME = "to_device"
     ROW_TYPE = ToDeviceStreamRow
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Callable
+
 from twisted.web.resource import Resource
 
 
@@ -29,3 +31,29 @@ class HealthResource(Resource):
     def render_GET(self, request):
         request.setHeader(b"Content-Type", b"text/plain")
         return b"OK"
+
+
+class ReadinessResource(Resource):
+    """A resource that returns a 200 with a body of `OK` if `is_ready` returns
+    True, and a 503 otherwise, e.g. while a worker is catching up with
+    replication.
+
+    Unlike `HealthResource` this is not suitable as a liveness check, as a
+    process that is not ready may still be making progress.
+
+    Note: `SynapseRequest._should_log_request` ensures that requests to
+    `/ready` do not get logged at INFO.
+    """
+
+    isLeaf = 1
+
+    def __init__(self, is_ready: Callable[[], bool]):
+        super().__init__()
+        self._is_ready = is_ready
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain")
+        if not self._is_ready():
+            request.setResponseCode(503)
+            return b"Not ready"
+        return b"OK"
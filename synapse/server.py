@@ -30,6 +30,7 @@ from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, TypeVar,
 import twisted.internet.base
 import twisted.internet.tcp
 from twisted.mail.smtp import sendmail
+from twisted.python.threadpool import ThreadPool
 from twisted.web.iweb import IPolicyForHTTPS
 
 from synapse.api.auth import Auth
@@ -75,7 +76,11 @@ from synapse.handlers.initial_sync import InitialSyncHandler
 from synapse.handlers.message import EventCreationHandler, MessageHandler
 from synapse.handlers.pagination import PaginationHandler
 from synapse.handlers.password_policy import PasswordPolicyHandler
-from synapse.handlers.presence import PresenceHandler
+from synapse.handlers.presence import (
+    BasePresenceHandler,
+    PresenceHandler,
+    WorkerPresenceHandler,
+)
 from synapse.handlers.profile import ProfileHandler
 from synapse.handlers.read_marker import ReadMarkerHandler
 from synapse.handlers.receipts import ReceiptsHandler
@@ -100,6 +105,7 @@ from synapse.http.matrixfederationclient import MatrixFederationHttpClient
 from synapse.module_api import ModuleApi
 from synapse.notifier import Notifier
 from synapse.push.action_generator import ActionGenerator
+from synapse.push.gateway import PushGatewayClient
 from synapse.push.pusherpool import PusherPool
 from synapse.replication.tcp.client import ReplicationDataHandler
 from synapse.replication.tcp.handler import ReplicationCommandHandler
@@ -126,6 +132,10 @@ from synapse.util.stringutils import random_string
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of threads used to encode large HTTP responses. Encoding
+# mostly holds the GIL, so there is little to gain from more.
+RESPONSE_ENCODING_THREADS = 4
+
 if TYPE_CHECKING:
     from synapse.handlers.oidc_handler import OidcHandler
     from synapse.handlers.saml_handler import SamlHandler
@@ -361,6 +371,19 @@ class HomeServer(metaclass=abc.ABCMeta):
             https_proxy=os.getenvb(b"HTTPS_PROXY"),
         )
 
+    @cache_in_self
+    def get_push_http_client(self) -> SimpleHttpClient:
+        return SimpleHttpClient(
+            self,
+            http_proxy=os.getenvb(b"http_proxy"),
+            https_proxy=os.getenvb(b"HTTPS_PROXY"),
+            max_persistent_per_host=self.config.push_gateway_max_idle_connections,
+        )
+
+    @cache_in_self
+    def get_push_gateway_client(self) -> PushGatewayClient:
+        return PushGatewayClient(self)
+
     @cache_in_self
     def get_room_creation_handler(self) -> RoomCreationHandler:
         return RoomCreationHandler(self)
@@ -382,8 +405,11 @@ class HomeServer(metaclass=abc.ABCMeta):
         return StateResolutionHandler(self)
 
     @cache_in_self
-    def get_presence_handler(self) -> PresenceHandler:
-        return PresenceHandler(self)
+    def get_presence_handler(self) -> BasePresenceHandler:
+        if self.get_instance_name() in self.config.worker.writers.presence:
+            return PresenceHandler(self)
+        else:
+            return WorkerPresenceHandler(self)
 
     @cache_in_self
     def get_typing_handler(self):
@@ -693,6 +719,20 @@ class HomeServer(metaclass=abc.ABCMeta):
     def get_module_api(self) -> ModuleApi:
         return ModuleApi(self, self.get_auth_handler())
 
+    @cache_in_self
+    def get_response_encoding_threadpool(self) -> ThreadPool:
+        """The threadpool used to encode and compress large HTTP responses.
+
+        This is kept separate from the reactor's threadpool, which is also used
+        for DNS lookups, so that those don't queue behind large responses.
+        """
+        threadpool = ThreadPool(
+            maxthreads=RESPONSE_ENCODING_THREADS, name="response_encoding"
+        )
+        threadpool.start()
+        self.get_reactor().addSystemEventTrigger("during", "shutdown", threadpool.stop)
+        return threadpool
+
     async def remove_pusher(self, app_id: str, push_key: str, user_id: str):
         return await self.get_pusherpool().remove_pusher(app_id, push_key, user_id)
 
@@ -232,8 +232,13 @@ class StateHandler:
         return await self.store.get_joined_users_from_state(room_id, entry)
 
     async def get_current_hosts_in_room(self, room_id: str) -> Set[str]:
-        event_ids = await self.store.get_latest_event_ids_in_room(room_id)
-        return await self.get_hosts_in_room_at_events(room_id, event_ids)
+        """Get the hosts currently in the room.
+
+        This is answered from the current state of the room, which is cached
+        and invalidated as membership changes, rather than by resolving the
+        state at the forward extremities each time.
+        """
+        return await self.store.get_current_hosts_in_room(room_id)
 
     async def get_hosts_in_room_at_events(
         self, room_id: str, event_ids: List[str]
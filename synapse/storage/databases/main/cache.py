@@ -16,7 +16,9 @@
 
 import itertools
 import logging
-from typing import Any, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from prometheus_client import Counter
 
 from synapse.api.constants import EventTypes
 from synapse.replication.tcp.streams import BackfillStream, CachesStream
@@ -37,6 +39,15 @@ logger = logging.getLogger(__name__)
 # based on the current state when notifying workers over replication.
 CURRENT_STATE_CACHE_NAME = "cs_cache_fake"
 
+# Counts cache invalidation rows received over replication, and the number of
+# invalidations we actually applied after removing duplicates.
+cache_invalidation_rows_counter = Counter(
+    "synapse_replication_cache_invalidation_rows", "", ["cache_name"]
+)
+cache_invalidations_applied_counter = Counter(
+    "synapse_replication_cache_invalidations_applied", "", ["cache_name"]
+)
+
 
 class CacheInvalidationWorkerStore(SQLBaseStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
@@ -116,21 +127,56 @@ class CacheInvalidationWorkerStore(SQLBaseStore):
             if self._cache_id_gen:
                 self._cache_id_gen.advance(instance_name, token)
 
-            for row in rows:
-                if row.cache_func == CURRENT_STATE_CACHE_NAME:
-                    if row.keys is None:
-                        raise Exception(
-                            "Can't send an 'invalidate all' for current state cache"
-                        )
-
-                    room_id = row.keys[0]
-                    members_changed = set(row.keys[1:])
-                    self._invalidate_state_caches(room_id, members_changed)
-                else:
-                    self._attempt_to_invalidate_cache(row.cache_func, row.keys)
+            self._process_cache_rows(rows)
 
         super().process_replication_rows(stream_name, instance_name, token, rows)
 
+    def _process_cache_rows(self, rows: List[CachesStream.CachesStreamRow]) -> None:
+        """Apply the invalidations in a batch of rows from the caches stream.
+
+        Since the whole batch is applied at once, repeated invalidations of the
+        same cache entry (e.g. from a room purge or a large state change) are
+        only applied once, and current state invalidations for the same room
+        are merged.
+        """
+        # map from room ID to the members which changed
+        current_state_changes = {}  # type: Dict[str, Set[str]]
+
+        seen = set()  # type: Set[Tuple[str, Optional[tuple]]]
+        invalidations = []  # type: List[Tuple[str, Optional[list]]]
+
+        for row in rows:
+            cache_invalidation_rows_counter.labels(row.cache_func).inc()
+
+            if row.cache_func == CURRENT_STATE_CACHE_NAME:
+                if row.keys is None:
+                    raise Exception(
+                        "Can't send an 'invalidate all' for current state cache"
+                    )
+
+                room_id = row.keys[0]
+                current_state_changes.setdefault(room_id, set()).update(row.keys[1:])
+                continue
+
+            try:
+                key = (row.cache_func, None if row.keys is None else tuple(row.keys))
+                if key in seen:
+                    continue
+                seen.add(key)
+            except TypeError:
+                # The keys aren't hashable, so we can't deduplicate them.
+                pass
+
+            invalidations.append((row.cache_func, row.keys))
+
+        for room_id, members_changed in current_state_changes.items():
+            cache_invalidations_applied_counter.labels(CURRENT_STATE_CACHE_NAME).inc()
+            self._invalidate_state_caches(room_id, members_changed)
+
+        for cache_func, keys in invalidations:
+            cache_invalidations_applied_counter.labels(cache_func).inc()
+            self._attempt_to_invalidate_cache(cache_func, keys)
+
     def _process_event_stream_row(self, token, row):
         data = row.data
 
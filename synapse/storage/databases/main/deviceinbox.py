@@ -14,18 +14,33 @@
 # limitations under the License.
 
 import logging
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Set, Tuple
 
 from synapse.logging.opentracing import log_kv, set_tag, trace
+from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore, db_to_json, make_in_list_sql_clause
 from synapse.storage.database import DatabasePool
 from synapse.util import json_encoder
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.iterutils import batch_iter
 
 logger = logging.getLogger(__name__)
 
 
 class DeviceInboxWorkerStore(SQLBaseStore):
+    def __init__(self, database: DatabasePool, db_conn, hs):
+        super().__init__(database, db_conn, hs)
+
+        self._inactive_device_max_age = hs.config.to_device_inactive_device_max_age
+
+        # How far through the device_inbox table the pruner has got. This is
+        # only kept in memory: after a restart we just start from the
+        # beginning again.
+        self._device_inbox_prune_position = 0
+
+        if hs.config.run_background_tasks:
+            self._clock.looping_call(self._prune_device_inbox, 10 * 60 * 1000)
+
     def get_to_device_stream_token(self):
         return self._device_inbox_id_gen.get_current_token()
 
@@ -49,13 +64,45 @@ class DeviceInboxWorkerStore(SQLBaseStore):
         Returns:
             A list of messages for the device and where in the stream the messages got to.
         """
-        has_changed = self._device_inbox_stream_cache.has_entity_changed(
-            user_id, last_stream_id
+        results = await self.get_new_messages_for_devices(
+            user_id, {device_id: (last_stream_id, current_stream_id)}, limit
         )
-        if not has_changed:
-            return ([], current_stream_id)
+        return results[device_id]
+
+    async def get_new_messages_for_devices(
+        self,
+        user_id: str,
+        stream_ids_by_device: Dict[str, Tuple[int, int]],
+        limit: int = 100,
+    ) -> Dict[str, Tuple[List[dict], int]]:
+        """Get new messages for several of a user's devices at once.
 
-        def get_new_messages_for_device_txn(txn):
+        Args:
+            user_id: The recipient user_id.
+            stream_ids_by_device: Map from the recipient device_id to a tuple
+                of the last stream ID checked and the current position of the
+                to device message stream for that device.
+            limit: The maximum number of messages to retrieve for each device.
+
+        Returns:
+            A map from device_id to a tuple of the list of messages for the
+            device and where in the stream the messages got to.
+        """
+        results = {}  # type: Dict[str, Tuple[List[dict], int]]
+        to_fetch = {}  # type: Dict[str, Tuple[int, int]]
+        for (
+            device_id,
+            (last_stream_id, current_stream_id),
+        ) in stream_ids_by_device.items():
+            if self._has_device_inbox_changed(user_id, device_id, last_stream_id):
+                to_fetch[device_id] = (last_stream_id, current_stream_id)
+            else:
+                results[device_id] = ([], current_stream_id)
+
+        if not to_fetch:
+            return results
+
+        def get_new_messages_for_devices_txn(txn):
             sql = (
                 "SELECT stream_id, message_json FROM device_inbox"
                 " WHERE user_id = ? AND device_id = ?"
@@ -63,19 +110,37 @@ class DeviceInboxWorkerStore(SQLBaseStore):
                 " ORDER BY stream_id ASC"
                 " LIMIT ?"
             )
-            txn.execute(
-                sql, (user_id, device_id, last_stream_id, current_stream_id, limit)
-            )
-            messages = []
-            for row in txn:
-                stream_pos = row[0]
-                messages.append(db_to_json(row[1]))
-            if len(messages) < limit:
-                stream_pos = current_stream_id
-            return messages, stream_pos
+            for device_id, (last_stream_id, current_stream_id) in to_fetch.items():
+                txn.execute(
+                    sql, (user_id, device_id, last_stream_id, current_stream_id, limit)
+                )
+                messages = []
+                for row in txn:
+                    stream_pos = row[0]
+                    messages.append(db_to_json(row[1]))
+                if len(messages) < limit:
+                    stream_pos = current_stream_id
+                results[device_id] = (messages, stream_pos)
 
-        return await self.db_pool.runInteraction(
-            "get_new_messages_for_device", get_new_messages_for_device_txn
+        await self.db_pool.runInteraction(
+            "get_new_messages_for_devices", get_new_messages_for_devices_txn
+        )
+        return results
+
+    def _has_device_inbox_changed(
+        self, user_id: str, device_id: str, stream_id: int
+    ) -> bool:
+        """Whether there may be messages for the device after the given stream
+        ID, according to the stream change caches.
+        """
+        if not self._device_inbox_stream_cache.has_entity_changed(user_id, stream_id):
+            return False
+
+        # The per-device cache only knows about changes since the process
+        # started, but lets us skip devices which aren't the recipients of the
+        # user's messages.
+        return self._device_inbox_per_device_stream_cache.has_entity_changed(
+            (user_id, device_id), stream_id
         )
 
     @trace
@@ -91,49 +156,153 @@ class DeviceInboxWorkerStore(SQLBaseStore):
         Returns:
             The number of messages deleted.
         """
-        # If we have cached the last stream id we've deleted up to, we can
-        # check if there is likely to be anything that needs deleting
-        last_deleted_stream_id = self._last_device_delete_cache.get(
-            (user_id, device_id), None
+        return await self.delete_messages_for_devices(
+            user_id, {device_id: up_to_stream_id}
         )
 
-        set_tag("last_deleted_stream_id", last_deleted_stream_id)
+    @trace
+    async def delete_messages_for_devices(
+        self, user_id: str, up_to_stream_ids: Dict[str, int]
+    ) -> int:
+        """Delete the messages which several of a user's devices have received.
+
+        Args:
+            user_id: The recipient user_id.
+            up_to_stream_ids: Map from the recipient device_id to where to
+                delete messages up to.
 
-        if last_deleted_stream_id:
-            has_changed = self._device_inbox_stream_cache.has_entity_changed(
-                user_id, last_deleted_stream_id
+        Returns:
+            The number of messages deleted.
+        """
+        to_delete = []
+        for device_id, up_to_stream_id in up_to_stream_ids.items():
+            # If we have cached the last stream id we've deleted up to, we can
+            # check if there is likely to be anything that needs deleting
+            last_deleted_stream_id = self._last_device_delete_cache.get(
+                (user_id, device_id), None
             )
-            if not has_changed:
-                log_kv({"message": "No changes in cache since last check"})
-                return 0
+            if last_deleted_stream_id and not self._has_device_inbox_changed(
+                user_id, device_id, last_deleted_stream_id
+            ):
+                continue
+
+            to_delete.append((device_id, up_to_stream_id))
 
-        def delete_messages_for_device_txn(txn):
+        set_tag("devices_to_delete", len(to_delete))
+
+        if not to_delete:
+            log_kv({"message": "No changes in cache since last check"})
+            return 0
+
+        def delete_messages_for_devices_txn(txn):
             sql = (
                 "DELETE FROM device_inbox"
                 " WHERE user_id = ? AND device_id = ?"
                 " AND stream_id <= ?"
             )
-            txn.execute(sql, (user_id, device_id, up_to_stream_id))
-            return txn.rowcount
+            count = 0
+            for device_id, up_to_stream_id in to_delete:
+                txn.execute(sql, (user_id, device_id, up_to_stream_id))
+                count += txn.rowcount
+            return count
 
         count = await self.db_pool.runInteraction(
-            "delete_messages_for_device", delete_messages_for_device_txn
+            "delete_messages_for_devices", delete_messages_for_devices_txn
         )
 
         log_kv(
-            {"message": "deleted {} messages for device".format(count), "count": count}
+            {"message": "deleted {} messages for devices".format(count), "count": count}
         )
 
-        # Update the cache, ensuring that we only ever increase the value
-        last_deleted_stream_id = self._last_device_delete_cache.get(
-            (user_id, device_id), 0
-        )
-        self._last_device_delete_cache[(user_id, device_id)] = max(
-            last_deleted_stream_id, up_to_stream_id
-        )
+        for device_id, up_to_stream_id in to_delete:
+            # Update the cache, ensuring that we only ever increase the value
+            last_deleted_stream_id = self._last_device_delete_cache.get(
+                (user_id, device_id), 0
+            )
+            self._last_device_delete_cache[(user_id, device_id)] = max(
+                last_deleted_stream_id, up_to_stream_id
+            )
 
         return count
 
+    @wrap_as_background_process("prune_device_inbox")
+    async def _prune_device_inbox(self) -> None:
+        """Delete any messages queued for devices which have been deleted, or
+        (if `to_device_inactive_device_max_age` is set) which have not been
+        used for a long time.
+
+        Each run works through the next part of the device_inbox table, in
+        stream order, and wraps around once it reaches the end.
+        """
+        for _ in range(10):
+            more = await self._prune_device_inbox_batch(1000)
+            if not more:
+                break
+
+    async def _prune_device_inbox_batch(self, batch_size: int) -> bool:
+        """Prune the next `batch_size` rows of the device_inbox table.
+
+        Returns:
+            Whether there are more rows to look at before wrapping around.
+        """
+        if self._inactive_device_max_age:
+            inactive_before = self._clock.time_msec() - self._inactive_device_max_age
+        else:
+            inactive_before = None
+
+        def _prune_device_inbox_batch_txn(txn):
+            txn.execute(
+                "SELECT stream_id, user_id, device_id FROM device_inbox"
+                " WHERE stream_id > ? ORDER BY stream_id ASC LIMIT ?",
+                (self._device_inbox_prune_position, batch_size),
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return 0, None
+
+            recipients = {(user_id, device_id) for _, user_id, device_id in rows}
+            last_seen_by_device = {}
+            for batch in batch_iter(recipients, 100):
+                clause = " OR ".join(["(user_id = ? AND device_id = ?)"] * len(batch))
+                txn.execute(
+                    "SELECT user_id, device_id, last_seen FROM devices WHERE " + clause,
+                    [arg for recipient in batch for arg in recipient],
+                )
+                for user_id, device_id, last_seen in txn:
+                    last_seen_by_device[(user_id, device_id)] = last_seen
+
+            to_prune = []
+            for recipient in recipients:
+                if recipient not in last_seen_by_device:
+                    # the device has been deleted
+                    to_prune.append(recipient)
+                    continue
+
+                last_seen = last_seen_by_device[recipient]
+                if (
+                    inactive_before is not None
+                    and last_seen is not None
+                    and last_seen < inactive_before
+                ):
+                    to_prune.append(recipient)
+
+            txn.executemany(
+                "DELETE FROM device_inbox WHERE user_id = ? AND device_id = ?",
+                to_prune,
+            )
+
+            next_position = rows[-1][0] if len(rows) == batch_size else None
+            return len(to_prune), next_position
+
+        pruned, next_position = await self.db_pool.runInteraction(
+            "prune_device_inbox", _prune_device_inbox_batch_txn
+        )
+        if pruned:
+            logger.info("Pruned to-device messages for %d devices", pruned)
+
+        self._device_inbox_prune_position = next_position or 0
+        return next_position is not None
+
     @trace
     async def get_new_device_msgs_for_remote(
         self, destination, last_stream_id, current_stream_id, limit
@@ -246,16 +415,16 @@ class DeviceInboxWorkerStore(SQLBaseStore):
             # we return.
             upper_pos = min(current_id, last_id + limit)
             sql = (
-                "SELECT max(stream_id), user_id"
+                "SELECT max(stream_id), user_id, device_id"
                 " FROM device_inbox"
                 " WHERE ? < stream_id AND stream_id <= ?"
-                " GROUP BY user_id"
+                " GROUP BY user_id, device_id"
             )
             txn.execute(sql, (last_id, upper_pos))
             updates = [(row[0], row[1:]) for row in txn]
 
             sql = (
-                "SELECT max(stream_id), destination"
+                "SELECT max(stream_id), destination, NULL"
                 " FROM device_federation_outbox"
                 " WHERE ? < stream_id AND stream_id <= ?"
                 " GROUP BY destination"
@@ -344,7 +513,7 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
 
         def add_messages_txn(txn, now_ms, stream_id):
             # Add the local messages directly to the local inbox.
-            self._add_messages_to_local_device_inbox_txn(
+            recipients = self._add_messages_to_local_device_inbox_txn(
                 txn, stream_id, local_messages_by_user_then_device
             )
 
@@ -362,13 +531,16 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
                 rows.append((destination, stream_id, now_ms, edu_json))
             txn.executemany(sql, rows)
 
+            return recipients
+
         async with self._device_inbox_id_gen.get_next() as stream_id:
             now_ms = self.clock.time_msec()
-            await self.db_pool.runInteraction(
+            recipients = await self.db_pool.runInteraction(
                 "add_messages_to_device_inbox", add_messages_txn, now_ms, stream_id
             )
-            for user_id in local_messages_by_user_then_device.keys():
-                self._device_inbox_stream_cache.entity_has_changed(user_id, stream_id)
+            self._device_inbox_has_changed(
+                local_messages_by_user_then_device, recipients, stream_id
+            )
             for destination in remote_messages_by_destination.keys():
                 self._device_federation_outbox_stream_cache.entity_has_changed(
                     destination, stream_id
@@ -391,7 +563,7 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
                 allow_none=True,
             )
             if already_inserted is not None:
-                return
+                return set()
 
             # Add an entry for this message_id so that we know we've processed
             # it.
@@ -407,26 +579,55 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
 
             # Add the messages to the approriate local device inboxes so that
             # they'll be sent to the devices when they next sync.
-            self._add_messages_to_local_device_inbox_txn(
+            return self._add_messages_to_local_device_inbox_txn(
                 txn, stream_id, local_messages_by_user_then_device
             )
 
         async with self._device_inbox_id_gen.get_next() as stream_id:
             now_ms = self.clock.time_msec()
-            await self.db_pool.runInteraction(
+            recipients = await self.db_pool.runInteraction(
                 "add_messages_from_remote_to_device_inbox",
                 add_messages_txn,
                 now_ms,
                 stream_id,
             )
-            for user_id in local_messages_by_user_then_device.keys():
-                self._device_inbox_stream_cache.entity_has_changed(user_id, stream_id)
+            self._device_inbox_has_changed(
+                local_messages_by_user_then_device, recipients, stream_id
+            )
 
         return stream_id
 
+    def _device_inbox_has_changed(
+        self,
+        user_ids: Iterable[str],
+        recipients: Iterable[Tuple[str, str]],
+        stream_id: int,
+    ) -> None:
+        """Update the stream change caches after adding messages to local
+        device inboxes.
+
+        Args:
+            user_ids: the users whose devices were sent messages.
+            recipients: the (user_id, device_id) pairs which messages were
+                actually stored for.
+            stream_id: the stream ID of the messages.
+        """
+        for user_id in user_ids:
+            self._device_inbox_stream_cache.entity_has_changed(user_id, stream_id)
+        for recipient in recipients:
+            self._device_inbox_per_device_stream_cache.entity_has_changed(
+                recipient, stream_id
+            )
+
     def _add_messages_to_local_device_inbox_txn(
         self, txn, stream_id, messages_by_user_then_device
-    ):
+    ) -> Set[Tuple[str, str]]:
+        """Add the messages to the inboxes of those of the given devices which
+        exist.
+
+        Returns:
+            The (user_id, device_id) pairs which messages were stored for.
+        """
         local_by_user_then_device = {}
         for user_id, messages_by_device in messages_by_user_then_device.items():
             messages_json_for_user = {}
@@ -464,7 +665,7 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
                 local_by_user_then_device[user_id] = messages_json_for_user
 
         if not local_by_user_then_device:
-            return
+            return set()
 
         sql = (
             "INSERT INTO device_inbox"
@@ -477,3 +678,5 @@ class DeviceInboxStore(DeviceInboxWorkerStore, DeviceInboxBackgroundUpdateStore)
                 rows.append((user_id, device_id, stream_id, message_json))
 
         txn.executemany(sql, rows)
+
+        return {(user_id, device_id) for user_id, device_id, _, _ in rows}
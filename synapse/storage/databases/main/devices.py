@@ -15,9 +15,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import abc
+import hashlib
 import logging
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
+from prometheus_client import Histogram
+
 from synapse.api.errors import Codes, StoreError
 from synapse.logging.opentracing import (
     get_active_span_text_map,
@@ -27,11 +30,7 @@ from synapse.logging.opentracing import (
 )
 from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore, db_to_json, make_in_list_sql_clause
-from synapse.storage.database import (
-    DatabasePool,
-    LoggingTransaction,
-    make_tuple_comparison_clause,
-)
+from synapse.storage.database import DatabasePool, LoggingTransaction
 from synapse.types import Collection, JsonDict, get_verify_key_from_cross_signing_key
 from synapse.util import json_decoder, json_encoder
 from synapse.util.caches.descriptors import cached, cachedList
@@ -47,6 +46,13 @@ DROP_DEVICE_LIST_STREAMS_NON_UNIQUE_INDEXES = (
 
 BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES = "remove_dup_outbound_pokes"
 
+device_list_outbound_rows_written = Histogram(
+    "synapse_storage_device_list_outbound_rows_written",
+    "Number of rows written to record a change to a user's devices for "
+    "sending over federation",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, "+Inf"),
+)
+
 
 class DeviceWorkerStore(SQLBaseStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
@@ -234,16 +240,52 @@ class DeviceWorkerStore(SQLBaseStore):
         Returns:
             List: List of device updates
         """
-        # get the list of device updates that need to be sent
+        # we never need to send anything from before the last update we
+        # successfully sent.
+        from_stream_id = max(
+            from_stream_id,
+            self._get_device_list_outbound_position_txn(txn, destination),
+        )
+
+        # get the list of device updates that need to be sent, skipping those
+        # which have been collapsed into a later update by
+        # `_prune_old_outbound_device_pokes`.
         sql = """
-            SELECT user_id, device_id, stream_id, opentracing_context FROM device_lists_outbound_pokes
-            WHERE destination = ? AND ? < stream_id AND stream_id <= ?
-            ORDER BY stream_id
+            SELECT c.user_id, c.device_id, c.stream_id, c.opentracing_context
+            FROM device_lists_outbound_host_sets AS h
+            INNER JOIN device_lists_outbound_changes AS c USING (host_set)
+            LEFT JOIN device_lists_outbound_collapsed AS col
+                ON col.destination = h.destination AND col.user_id = c.user_id
+            WHERE h.destination = ? AND ? < c.stream_id AND c.stream_id <= ?
+                AND (col.stream_id IS NULL OR col.stream_id <= c.stream_id)
+            ORDER BY c.stream_id
             LIMIT ?
         """
         txn.execute(sql, (destination, from_stream_id, now_stream_id, limit))
 
-        return list(txn)
+        # the changes are shared between destinations, so we only pass on the
+        # opentracing context to the ones we're allowed to.
+        if whitelisted_homeserver(destination):
+            return list(txn)
+        return [
+            (user_id, device_id, stream_id, "{}")
+            for user_id, device_id, stream_id, _ in txn
+        ]
+
+    def _get_device_list_outbound_position_txn(
+        self, txn: LoggingTransaction, destination: str
+    ) -> int:
+        """Get the stream_id up to which device list updates have been
+        successfully sent to the destination.
+        """
+        position = self.db_pool.simple_select_one_onecol_txn(
+            txn,
+            table="device_lists_outbound_positions",
+            keyvalues={"destination": destination},
+            retcol="stream_id",
+            allow_none=True,
+        )
+        return position or 0
 
     async def _get_device_update_edus_by_remote(
         self,
@@ -346,15 +388,22 @@ class DeviceWorkerStore(SQLBaseStore):
     def _mark_as_sent_devices_by_remote_txn(
         self, txn: LoggingTransaction, destination: str, stream_id: int
     ) -> None:
+        previous_position = self._get_device_list_outbound_position_txn(
+            txn, destination
+        )
+        if stream_id <= previous_position:
+            return
+
         # We update the device_lists_outbound_last_success with the successfully
         # poked users.
         sql = """
-            SELECT user_id, coalesce(max(o.stream_id), 0)
-            FROM device_lists_outbound_pokes as o
-            WHERE destination = ? AND o.stream_id <= ?
-            GROUP BY user_id
+            SELECT c.user_id, MAX(c.stream_id)
+            FROM device_lists_outbound_host_sets AS h
+            INNER JOIN device_lists_outbound_changes AS c USING (host_set)
+            WHERE h.destination = ? AND ? < c.stream_id AND c.stream_id <= ?
+            GROUP BY c.user_id
         """
-        txn.execute(sql, (destination, stream_id))
+        txn.execute(sql, (destination, previous_position, stream_id))
         rows = txn.fetchall()
 
         self.db_pool.simple_upsert_many_txn(
@@ -366,12 +415,22 @@ class DeviceWorkerStore(SQLBaseStore):
             value_values=((stream_id,) for _, stream_id in rows),
         )
 
-        # Delete all sent outbound pokes
-        sql = """
-            DELETE FROM device_lists_outbound_pokes
+        # Move the destination's high-water mark on, rather than deleting the
+        # changes, since they are shared with other destinations.
+        self.db_pool.simple_upsert_txn(
+            txn,
+            table="device_lists_outbound_positions",
+            keyvalues={"destination": destination},
+            values={"stream_id": stream_id},
+        )
+
+        txn.execute(
+            """
+            DELETE FROM device_lists_outbound_collapsed
             WHERE destination = ? AND stream_id <= ?
-        """
-        txn.execute(sql, (destination, stream_id))
+            """,
+            (destination, stream_id),
+        )
 
     async def add_user_signature_change_to_streams(
         self, from_user_id: str, user_ids: List[str]
@@ -594,20 +653,50 @@ class DeviceWorkerStore(SQLBaseStore):
                 SELECT stream_id, entity FROM (
                     SELECT stream_id, user_id AS entity FROM device_lists_stream
                     UNION ALL
-                    SELECT stream_id, destination AS entity FROM device_lists_outbound_pokes
+                    SELECT stream_id, host_set AS entity
+                        FROM device_lists_outbound_changes
                 ) AS e
                 WHERE ? < stream_id AND stream_id <= ?
+                ORDER BY stream_id
                 LIMIT ?
             """
 
             txn.execute(sql, (last_id, current_id, limit))
-            updates = [(row[0], row[1:]) for row in txn]
+            rows = txn.fetchall()
             limited = False
             upto_token = current_id
-            if len(updates) >= limit:
-                upto_token = updates[-1][0]
+            if len(rows) >= limit:
+                upto_token = rows[-1][0]
                 limited = True
 
+            # Outbound changes are recorded against a set of destinations,
+            # which we expand into a row per destination. (We apply the limit
+            # before doing so, so that a change is never split between
+            # batches.)
+            host_sets = {entity for _, entity in rows if not entity.startswith("@")}
+            destinations_by_host_set = {}  # type: Dict[str, List[str]]
+            for row in self.db_pool.simple_select_many_txn(
+                txn,
+                table="device_lists_outbound_host_sets",
+                column="host_set",
+                iterable=host_sets,
+                keyvalues={},
+                retcols=("host_set", "destination"),
+            ):
+                destinations_by_host_set.setdefault(row["host_set"], []).append(
+                    row["destination"]
+                )
+
+            updates = []  # type: List[Tuple[int, tuple]]
+            for stream_id, entity in rows:
+                if entity.startswith("@"):
+                    updates.append((stream_id, (entity,)))
+                else:
+                    updates.extend(
+                        (stream_id, (destination,))
+                        for destination in destinations_by_host_set.get(entity, ())
+                    )
+
             return updates, upto_token, limited
 
         return await self.db_pool.runInteraction(
@@ -785,89 +874,153 @@ class DeviceWorkerStore(SQLBaseStore):
     async def _prune_old_outbound_device_pokes(
         self, prune_age: int = 24 * 60 * 60 * 1000
     ) -> None:
-        """Delete old entries out of the device_lists_outbound_pokes to ensure
-        that we don't fill up due to dead servers.
+        """Collapse old pending device list updates for unreachable destinations,
+        and delete changes that are no longer needed.
 
         Normally, we try to send device updates as a delta since a previous known point:
         this is done by setting the prev_id in the m.device_list_update EDU. However,
-        for that to work, we have to have a complete record of each change to
+        for that to work, we have to send a complete record of each change to
         each device, which can add up to quite a lot of data.
 
         An alternative mechanism is that, if the remote server sees that it has missed
         an entry in the stream_id sequence for a given user, it will request a full
         list of that user's devices. Hence, we can reduce the amount of data we have to
-        store (and transmit in some future transaction), by clearing almost everything
-        for a given destination out of the database, and having the remote server
-        resync.
-
-        All we need to do is make sure we keep at least one row for each
-        (user, destination) pair, to remind us to send a m.device_list_update EDU for
-        that user when the destination comes back. It doesn't matter which device
-        we keep.
+        transmit in some future transaction, by only sending a single update for
+        each user to a destination that has been unreachable for a while, and having
+        the remote server resync.
+
+        The changes themselves are shared between destinations, so rather than
+        deleting a destination's pending updates, we record in
+        `device_lists_outbound_collapsed` that only the most recent one should be
+        sent. Changes are deleted once every destination they are for has
+        received them, or once they are old and every destination which has not
+        received them will receive a later change to the same device.
+
+        Sets of destinations are deleted once no change refers to them and they
+        have not been used for `prune_age`.
         """
-        yesterday = self._clock.time_msec() - prune_age
+        cutoff = self._clock.time_msec() - prune_age
 
         def _prune_txn(txn):
-            # look for (user, destination) pairs which have an update older than
-            # the cutoff.
-            #
-            # For each pair, we also need to know the most recent stream_id, and
-            # an arbitrary device_id at that stream_id.
+            # look for (user, destination) pairs which have more than one
+            # pending update, the oldest of which is older than the cutoff.
             select_sql = """
-            SELECT
-                dlop1.destination,
-                dlop1.user_id,
-                MAX(dlop1.stream_id) AS stream_id,
-                (SELECT MIN(dlop2.device_id) AS device_id FROM
-                    device_lists_outbound_pokes dlop2
-                    WHERE dlop2.destination = dlop1.destination AND
-                      dlop2.user_id=dlop1.user_id AND
-                      dlop2.stream_id=MAX(dlop1.stream_id)
-                )
-            FROM device_lists_outbound_pokes dlop1
-                GROUP BY destination, user_id
-                HAVING min(ts) < ? AND count(*) > 1
+                SELECT h.destination, c.user_id, MAX(c.stream_id)
+                FROM device_lists_outbound_host_sets AS h
+                INNER JOIN device_lists_outbound_changes AS c USING (host_set)
+                LEFT JOIN device_lists_outbound_positions AS p
+                    ON p.destination = h.destination
+                LEFT JOIN device_lists_outbound_collapsed AS col
+                    ON col.destination = h.destination AND col.user_id = c.user_id
+                WHERE COALESCE(p.stream_id, 0) < c.stream_id
+                    AND (col.stream_id IS NULL OR col.stream_id <= c.stream_id)
+                GROUP BY h.destination, c.user_id
+                HAVING MIN(c.ts) < ? AND COUNT(*) > 1
             """
 
-            txn.execute(select_sql, (yesterday,))
+            txn.execute(select_sql, (cutoff,))
             rows = txn.fetchall()
 
-            if not rows:
-                return
+            if rows:
+                logger.info(
+                    "Collapsing old outbound device list updates for %i users/destinations: %s",
+                    len(rows),
+                    shortstr((row[0], row[1]) for row in rows),
+                )
 
-            logger.info(
-                "Pruning old outbound device list updates for %i users/destinations: %s",
-                len(rows),
-                shortstr((row[0], row[1]) for row in rows),
-            )
+                # we only send the update with the highest stream_id for each user.
+                self.db_pool.simple_upsert_many_txn(
+                    txn,
+                    table="device_lists_outbound_collapsed",
+                    key_names=("destination", "user_id"),
+                    key_values=[(row[0], row[1]) for row in rows],
+                    value_names=("stream_id",),
+                    value_values=[(row[2],) for row in rows],
+                )
 
-            # we want to keep the update with the highest stream_id for each user.
-            #
-            # there might be more than one update (with different device_ids) with the
-            # same stream_id, so we also delete all but one rows with the max stream id.
-            delete_sql = """
-                DELETE FROM device_lists_outbound_pokes
-                WHERE destination = ? AND user_id = ? AND (
-                    stream_id < ? OR
-                    (stream_id = ? AND device_id != ?)
+                # Since we're skipping unsent deltas, we need to remove the entry
+                # of last successful sent so that the prev_ids are correctly set.
+                sql = """
+                    DELETE FROM device_lists_outbound_last_success
+                    WHERE destination = ? AND user_id = ?
+                """
+                txn.executemany(sql, ((row[0], row[1]) for row in rows))
+
+            # delete changes which have been sent to all of their destinations...
+            txn.execute(
+                """
+                DELETE FROM device_lists_outbound_changes
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM device_lists_outbound_host_sets AS h
+                    LEFT JOIN device_lists_outbound_positions AS p
+                        ON p.destination = h.destination
+                    WHERE h.host_set = device_lists_outbound_changes.host_set
+                        AND COALESCE(p.stream_id, 0)
+                            < device_lists_outbound_changes.stream_id
                 )
-            """
-            count = 0
-            for (destination, user_id, stream_id, device_id) in rows:
-                txn.execute(
-                    delete_sql, (destination, user_id, stream_id, stream_id, device_id)
+                """
+            )
+            count = txn.rowcount
+
+            # ... and old changes which have been superseded by a later change to
+            # the same device, which is for every destination that hasn't yet
+            # received the old one.
+            txn.execute(
+                """
+                DELETE FROM device_lists_outbound_changes
+                WHERE ts < ? AND EXISTS (
+                    SELECT 1 FROM device_lists_outbound_changes AS later
+                    WHERE later.user_id = device_lists_outbound_changes.user_id
+                        AND later.device_id = device_lists_outbound_changes.device_id
+                        AND later.stream_id > device_lists_outbound_changes.stream_id
+                        AND NOT EXISTS (
+                            SELECT 1 FROM device_lists_outbound_host_sets AS h
+                            LEFT JOIN device_lists_outbound_positions AS p
+                                ON p.destination = h.destination
+                            WHERE h.host_set = device_lists_outbound_changes.host_set
+                                AND COALESCE(p.stream_id, 0)
+                                    < device_lists_outbound_changes.stream_id
+                                AND NOT EXISTS (
+                                    SELECT 1 FROM device_lists_outbound_host_sets AS lh
+                                    WHERE lh.host_set = later.host_set
+                                        AND lh.destination = h.destination
+                                )
+                        )
                 )
-                count += txn.rowcount
-
-            # Since we've deleted unsent deltas, we need to remove the entry
-            # of last successful sent so that the prev_ids are correctly set.
-            sql = """
-                DELETE FROM device_lists_outbound_last_success
-                WHERE destination = ? AND user_id = ?
-            """
-            txn.executemany(sql, ((row[0], row[1]) for row in rows))
+                """,
+                (cutoff,),
+            )
+            count += txn.rowcount
+
+            logger.info("Pruned %d device list outbound changes", count)
+
+            # Finally, delete any sets of destinations which are no longer in
+            # use. A new change for a set updates its usage row, so if one races
+            # with us then one of the transactions will conflict and be retried.
+            txn.execute(
+                """
+                SELECT DISTINCT h.host_set FROM device_lists_outbound_host_sets AS h
+                LEFT JOIN device_lists_outbound_host_set_usage AS u USING (host_set)
+                WHERE COALESCE(u.last_used_ts, 0) < ? AND NOT EXISTS (
+                    SELECT 1 FROM device_lists_outbound_changes AS c
+                    WHERE c.host_set = h.host_set
+                )
+                """,
+                (cutoff,),
+            )
+            unused_host_sets = [row[0] for row in txn]
 
-            logger.info("Pruned %d device list outbound pokes", count)
+            for table in (
+                "device_lists_outbound_host_sets",
+                "device_lists_outbound_host_set_usage",
+            ):
+                self.db_pool.simple_delete_many_txn(
+                    txn,
+                    table=table,
+                    column="host_set",
+                    iterable=unused_host_sets,
+                    keyvalues={},
+                )
 
         await self.db_pool.runInteraction(
             "_prune_old_outbound_device_pokes", _prune_txn,
@@ -909,9 +1062,10 @@ class DeviceBackgroundUpdateStore(SQLBaseStore):
             self._drop_device_list_streams_non_unique_indexes,
         )
 
-        # clear out duplicate device list outbound pokes
-        self.db_pool.updates.register_background_update_handler(
-            BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES, self._remove_duplicate_outbound_pokes,
+        # cleared out duplicate device list outbound pokes. The table it operated
+        # on has since been replaced by device_lists_outbound_changes.
+        self.db_pool.updates.register_noop_background_update(
+            BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES
         )
 
         # a pair of background updates that were added during the 1.14 release cycle,
@@ -936,68 +1090,6 @@ class DeviceBackgroundUpdateStore(SQLBaseStore):
         )
         return 1
 
-    async def _remove_duplicate_outbound_pokes(self, progress, batch_size):
-        # for some reason, we have accumulated duplicate entries in
-        # device_lists_outbound_pokes, which makes prune_outbound_device_list_pokes less
-        # efficient.
-        #
-        # For each duplicate, we delete all the existing rows and put one back.
-
-        KEY_COLS = ["stream_id", "destination", "user_id", "device_id"]
-        last_row = progress.get(
-            "last_row",
-            {"stream_id": 0, "destination": "", "user_id": "", "device_id": ""},
-        )
-
-        def _txn(txn):
-            clause, args = make_tuple_comparison_clause(
-                self.db_pool.engine, [(x, last_row[x]) for x in KEY_COLS]
-            )
-            sql = """
-                SELECT stream_id, destination, user_id, device_id, MAX(ts) AS ts
-                FROM device_lists_outbound_pokes
-                WHERE %s
-                GROUP BY %s
-                HAVING count(*) > 1
-                ORDER BY %s
-                LIMIT ?
-                """ % (
-                clause,  # WHERE
-                ",".join(KEY_COLS),  # GROUP BY
-                ",".join(KEY_COLS),  # ORDER BY
-            )
-            txn.execute(sql, args + [batch_size])
-            rows = self.db_pool.cursor_to_dict(txn)
-
-            row = None
-            for row in rows:
-                self.db_pool.simple_delete_txn(
-                    txn, "device_lists_outbound_pokes", {x: row[x] for x in KEY_COLS},
-                )
-
-                row["sent"] = False
-                self.db_pool.simple_insert_txn(
-                    txn, "device_lists_outbound_pokes", row,
-                )
-
-            if row:
-                self.db_pool.updates._background_update_progress_txn(
-                    txn, BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES, {"last_row": row},
-                )
-
-            return len(rows)
-
-        rows = await self.db_pool.runInteraction(
-            BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES, _txn
-        )
-
-        if not rows:
-            await self.db_pool.updates._end_background_update(
-                BG_UPDATE_REMOVE_DUP_OUTBOUND_POKES
-            )
-
-        return rows
-
 
 class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
@@ -1282,7 +1374,7 @@ class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
 
         context = get_active_span_text_map()
         async with self._device_list_id_gen.get_next_mult(
-            len(hosts) * len(device_ids)
+            len(device_ids)
         ) as stream_ids:
             await self.db_pool.runInteraction(
                 "add_device_outbound_poke_to_stream",
@@ -1344,25 +1436,67 @@ class DeviceStore(DeviceWorkerStore, DeviceBackgroundUpdateStore):
                 stream_ids[-1],
             )
 
+        # The destinations are recorded as a set which is shared between
+        # changes, so that we only write a row per destination when the set of
+        # servers a user shares rooms with changes, rather than for every change.
+        host_set = _get_host_set_key(hosts)
         now = self._clock.time_msec()
-        next_stream_id = iter(stream_ids)
+        rows_written = len(device_ids)
+
+        txn.execute(
+            "SELECT 1 FROM device_lists_outbound_host_set_usage WHERE host_set = ?",
+            (host_set,),
+        )
+        if not txn.fetchone():
+            self.db_pool.simple_upsert_many_txn(
+                txn,
+                table="device_lists_outbound_host_sets",
+                key_names=("host_set", "destination"),
+                key_values=[(host_set, host) for host in hosts],
+                value_names=(),
+                value_values=(),
+            )
+            rows_written += len(hosts)
+
+        # Mark the set as in use. This also makes the transaction conflict with
+        # `_prune_old_outbound_device_pokes` if it is deleting the set.
+        self.db_pool.simple_upsert_txn(
+            txn,
+            table="device_lists_outbound_host_set_usage",
+            keyvalues={"host_set": host_set},
+            values={"last_used_ts": now},
+        )
+
+        # Any earlier change to these devices which is for the same set of
+        # destinations is superseded by this one.
+        txn.executemany(
+            """
+            DELETE FROM device_lists_outbound_changes
+            WHERE user_id = ? AND device_id = ? AND host_set = ?
+            """,
+            [(user_id, device_id, host_set) for device_id in device_ids],
+        )
 
         self.db_pool.simple_insert_many_txn(
             txn,
-            table="device_lists_outbound_pokes",
+            table="device_lists_outbound_changes",
             values=[
                 {
-                    "destination": destination,
-                    "stream_id": next(next_stream_id),
+                    "stream_id": stream_id,
                     "user_id": user_id,
                     "device_id": device_id,
-                    "sent": False,
+                    "host_set": host_set,
                     "ts": now,
-                    "opentracing_context": json_encoder.encode(context)
-                    if whitelisted_homeserver(destination)
-                    else "{}",
+                    "opentracing_context": json_encoder.encode(context),
                 }
-                for destination in hosts
-                for device_id in device_ids
+                for stream_id, device_id in zip(stream_ids, device_ids)
             ],
         )
+
+        device_list_outbound_rows_written.observe(rows_written)
+
+
+def _get_host_set_key(hosts: Iterable[str]) -> str:
+    """Get the key for a set of destinations in device_lists_outbound_host_sets.
+    """
+    return hashlib.sha256("\n".join(sorted(set(hosts))).encode("utf-8")).hexdigest()
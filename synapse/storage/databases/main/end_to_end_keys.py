@@ -24,9 +24,14 @@ from twisted.enterprise.adbapi import Connection
 
 from synapse.logging.opentracing import log_kv, set_tag, trace
 from synapse.storage._base import SQLBaseStore, db_to_json
-from synapse.storage.database import DatabasePool, make_in_list_sql_clause
+from synapse.storage.database import (
+    DatabasePool,
+    LoggingTransaction,
+    make_in_list_sql_clause,
+)
+from synapse.storage.engines import PostgresEngine
 from synapse.storage.types import Cursor
-from synapse.types import JsonDict
+from synapse.types import Collection, JsonDict
 from synapse.util import json_encoder
 from synapse.util.caches.descriptors import cached, cachedList
 from synapse.util.iterutils import batch_iter
@@ -756,80 +761,60 @@ class EndToEndKeyStore(EndToEndKeyWorkerStore, SQLBaseStore):
     ) -> Dict[str, Dict[str, Dict[str, bytes]]]:
         """Take a list of one time keys out of the database.
 
+        If no one-time key is available for a given device and algorithm, the
+        device's fallback key for the algorithm (if any) is returned instead,
+        and marked as used.
+
         Args:
             query_list: An iterable of tuples of (user ID, device ID, algorithm).
 
         Returns:
             A map of user ID -> a map device ID -> a map of key ID -> JSON bytes.
         """
+        query_list = list(query_list)
 
         @trace
         def _claim_e2e_one_time_keys(txn):
-            sql = (
-                "SELECT key_id, key_json FROM e2e_one_time_keys_json"
-                " WHERE user_id = ? AND device_id = ? AND algorithm = ?"
-                " LIMIT 1"
-            )
-            fallback_sql = (
-                "SELECT key_id, key_json, used FROM e2e_fallback_keys_json"
-                " WHERE user_id = ? AND device_id = ? AND algorithm = ?"
-                " LIMIT 1"
-            )
-            result = {}
-            delete = []
-            used_fallbacks = []
-            for user_id, device_id, algorithm in query_list:
-                user_result = result.setdefault(user_id, {})
-                device_result = user_result.setdefault(device_id, {})
-                txn.execute(sql, (user_id, device_id, algorithm))
-                otk_row = txn.fetchone()
-                if otk_row is not None:
-                    key_id, key_json = otk_row
-                    device_result[algorithm + ":" + key_id] = key_json
-                    delete.append((user_id, device_id, algorithm, key_id))
-                else:
-                    # no one-time key available, so see if there's a fallback
-                    # key
-                    txn.execute(fallback_sql, (user_id, device_id, algorithm))
-                    fallback_row = txn.fetchone()
-                    if fallback_row is not None:
-                        key_id, key_json, used = fallback_row
-                        device_result[algorithm + ":" + key_id] = key_json
-                        if not used:
-                            used_fallbacks.append(
-                                (user_id, device_id, algorithm, key_id)
-                            )
-
-            # drop any one-time keys that were claimed
-            sql = (
-                "DELETE FROM e2e_one_time_keys_json"
-                " WHERE user_id = ? AND device_id = ? AND algorithm = ?"
-                " AND key_id = ?"
+            result = {}  # type: Dict[str, Dict[str, Dict[str, bytes]]]
+            for user_id, device_id, _ in query_list:
+                result.setdefault(user_id, {}).setdefault(device_id, {})
+
+            # the (user_id, device_id) pairs whose caches need invalidating
+            claimed_otks = set()
+            used_fallbacks = set()
+
+            for batch in batch_iter(query_list, 100):
+                otk_rows = self._claim_e2e_one_time_keys_batch_txn(txn, batch)
+
+                # any devices which have run out of one-time keys get their
+                # fallback key instead.
+                claimed = {tuple(row[:3]) for row in otk_rows}
+                missing = [query for query in batch if query not in claimed]
+                fallback_rows = self._claim_e2e_fallback_keys_batch_txn(txn, missing)
+
+                for user_id, device_id, algorithm, key_id, key_json in otk_rows:
+                    result[user_id][device_id][algorithm + ":" + key_id] = key_json
+                    claimed_otks.add((user_id, device_id))
+
+                for row in fallback_rows:
+                    user_id, device_id, algorithm, key_id, key_json, used = row
+                    result[user_id][device_id][algorithm + ":" + key_id] = key_json
+                    if not used:
+                        used_fallbacks.add((user_id, device_id))
+
+            log_kv(
+                {
+                    "message": "Claimed one-time keys",
+                    "one_time_keys": len(claimed_otks),
+                    "fallback_keys": len(used_fallbacks),
+                }
             )
-            for user_id, device_id, algorithm, key_id in delete:
-                log_kv(
-                    {
-                        "message": "Executing claim e2e_one_time_keys transaction on database."
-                    }
-                )
-                txn.execute(sql, (user_id, device_id, algorithm, key_id))
-                log_kv({"message": "finished executing and invalidating cache"})
+
+            for user_id, device_id in claimed_otks:
                 self._invalidate_cache_and_stream(
                     txn, self.count_e2e_one_time_keys, (user_id, device_id)
                 )
-            # mark fallback keys as used
-            for user_id, device_id, algorithm, key_id in used_fallbacks:
-                self.db_pool.simple_update_txn(
-                    txn,
-                    "e2e_fallback_keys_json",
-                    {
-                        "user_id": user_id,
-                        "device_id": device_id,
-                        "algorithm": algorithm,
-                        "key_id": key_id,
-                    },
-                    {"used": True},
-                )
+            for user_id, device_id in used_fallbacks:
                 self._invalidate_cache_and_stream(
                     txn, self.get_e2e_unused_fallback_key_types, (user_id, device_id)
                 )
@@ -840,6 +825,88 @@ class EndToEndKeyStore(EndToEndKeyWorkerStore, SQLBaseStore):
             "claim_e2e_one_time_keys", _claim_e2e_one_time_keys
         )
 
+    def _claim_e2e_one_time_keys_batch_txn(
+        self, txn: LoggingTransaction, batch: Collection[Tuple[str, str, str]]
+    ) -> List[Tuple[str, str, str, str, bytes]]:
+        """Claim a one-time key for each of the given (user ID, device ID,
+        algorithm) tuples, deleting the claimed keys from the database.
+
+        Returns:
+            A list of (user ID, device ID, algorithm, key ID, key JSON) tuples,
+            for the devices which had a key of the requested algorithm.
+        """
+        clause = " OR ".join(
+            ["(user_id = ? AND device_id = ? AND algorithm = ?)"] * len(batch)
+        )
+        args = [arg for query in batch for arg in query]
+
+        # pick the lowest key ID for each tuple, which is what the old
+        # per-tuple `LIMIT 1` queries would have returned.
+        if isinstance(self.database_engine, PostgresEngine):
+            sql = (
+                "SELECT DISTINCT ON (user_id, device_id, algorithm)"
+                " user_id, device_id, algorithm, key_id, key_json"
+                " FROM e2e_one_time_keys_json WHERE %s"
+                " ORDER BY user_id, device_id, algorithm, key_id"
+            ) % (clause,)
+        else:
+            # SQLite takes the bare columns from the row which matched MIN().
+            sql = (
+                "SELECT user_id, device_id, algorithm, MIN(key_id), key_json"
+                " FROM e2e_one_time_keys_json WHERE %s"
+                " GROUP BY user_id, device_id, algorithm"
+            ) % (clause,)
+
+        txn.execute(sql, args)
+        rows = txn.fetchall()
+        if not rows:
+            return []
+
+        sql = "DELETE FROM e2e_one_time_keys_json WHERE " + " OR ".join(
+            ["(user_id = ? AND device_id = ? AND algorithm = ? AND key_id = ?)"]
+            * len(rows)
+        )
+        txn.execute(sql, [arg for row in rows for arg in row[:4]])
+
+        return rows
+
+    def _claim_e2e_fallback_keys_batch_txn(
+        self, txn: LoggingTransaction, batch: Collection[Tuple[str, str, str]]
+    ) -> List[Tuple[str, str, str, str, bytes, bool]]:
+        """Get the fallback keys for the given (user ID, device ID, algorithm)
+        tuples, and mark any which have not been used yet as used.
+
+        Returns:
+            A list of (user ID, device ID, algorithm, key ID, key JSON, used)
+            tuples, where `used` is whether the key had been used before this
+            claim.
+        """
+        if not batch:
+            return []
+
+        clause = " OR ".join(
+            ["(user_id = ? AND device_id = ? AND algorithm = ?)"] * len(batch)
+        )
+        txn.execute(
+            "SELECT user_id, device_id, algorithm, key_id, key_json, used"
+            " FROM e2e_fallback_keys_json WHERE " + clause,
+            [arg for query in batch for arg in query],
+        )
+        rows = [
+            (user_id, device_id, algorithm, key_id, key_json, bool(used))
+            for user_id, device_id, algorithm, key_id, key_json, used in txn
+        ]
+
+        newly_used = [row[:4] for row in rows if not row[5]]
+        if newly_used:
+            sql = "UPDATE e2e_fallback_keys_json SET used = ? WHERE " + " OR ".join(
+                ["(user_id = ? AND device_id = ? AND algorithm = ? AND key_id = ?)"]
+                * len(newly_used)
+            )
+            txn.execute(sql, [True] + [arg for key in newly_used for arg in key])
+
+        return rows
+
     async def delete_e2e_keys_by_device(self, user_id: str, device_id: str) -> None:
         def delete_e2e_keys_by_device_txn(txn):
             log_kv(
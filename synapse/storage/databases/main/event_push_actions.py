@@ -17,15 +17,31 @@ import logging
 from typing import Dict, List, Optional, Tuple, Union
 
 import attr
+from prometheus_client import Counter
 
+from synapse.api.constants import Membership
 from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore, db_to_json
-from synapse.storage.database import DatabasePool, LoggingTransaction
+from synapse.storage.database import (
+    DatabasePool,
+    LoggingTransaction,
+    make_in_list_sql_clause,
+    make_tuple_comparison_clause,
+)
+from synapse.storage.engines import PostgresEngine
+from synapse.types import Collection
 from synapse.util import json_encoder
 from synapse.util.caches.descriptors import cached
+from synapse.util.iterutils import batch_iter
 
 logger = logging.getLogger(__name__)
 
+# The number of per-room unread counts written by the reconciliation job, labelled
+# by whether the counts had drifted or hadn't been calculated yet.
+push_counts_reconciled_counter = Counter(
+    "synapse_storage_event_push_counts_reconciled", "", ["reason"]
+)
+
 
 DEFAULT_NOTIF_ACTION = ["notify", {"set_tweak": "highlight", "value": False}]
 DEFAULT_HIGHLIGHT_ACTION = [
@@ -89,6 +105,19 @@ class EventPushActionsWorkerStore(SQLBaseStore):
                 self._rotate_notifs, 30 * 60 * 1000
             )
 
+        # The number of rows of event_push_counts to check each time the
+        # reconciliation job runs, and the (user_id, room_id) to continue from.
+        self._push_counts_reconcile_batch_size = 1000
+        self._push_counts_reconcile_position = None  # type: Optional[Tuple[str, str]]
+
+        # The number of uncalculated rows to fill in per transaction, and the
+        # maximum number of transactions per run of the job.
+        self._push_counts_calculate_batch_size = 1000
+        self._push_counts_calculate_max_batches = 10
+        if hs.config.run_background_tasks:
+            self._clock.looping_call(self._reconcile_push_counts, 10 * 60 * 1000)
+            self._clock.looping_call(self._calculate_push_counts, 60 * 1000)
+
     @cached(num_args=3, tree=True, max_entries=5000)
     async def get_unread_event_push_actions_by_room_for_user(
         self, room_id: str, user_id: str, last_read_event_id: Optional[str],
@@ -122,6 +151,26 @@ class EventPushActionsWorkerStore(SQLBaseStore):
     def _get_unread_counts_by_receipt_txn(
         self, txn, room_id, user_id, last_read_event_id,
     ):
+        # Use the incrementally maintained counts if we have them.
+        row = self.db_pool.simple_select_one_txn(
+            txn,
+            table="event_push_counts",
+            keyvalues={"room_id": room_id, "user_id": user_id},
+            retcols=(
+                "notif_count",
+                "highlight_count",
+                "unread_count",
+                "stream_ordering",
+            ),
+            allow_none=True,
+        )
+        if row and row["stream_ordering"] is not None:
+            return {
+                "notify_count": row["notif_count"],
+                "unread_count": row["unread_count"],
+                "highlight_count": row["highlight_count"],
+            }
+
         stream_ordering = None
 
         if last_read_event_id is not None:
@@ -191,6 +240,349 @@ class EventPushActionsWorkerStore(SQLBaseStore):
             "highlight_count": highlight_count,
         }
 
+    def _get_last_read_stream_ordering_txn(
+        self, txn: LoggingTransaction, room_id: str, user_id: str
+    ) -> Optional[int]:
+        """Get the stream ordering that the user's unread counts in the room are
+        relative to: that of their latest read receipt, or of their membership
+        event if they don't have one.
+
+        Returns:
+            The stream ordering, or None if the user isn't in the room.
+        """
+        txn.execute(
+            """
+                SELECT MAX(stream_ordering) FROM events
+                INNER JOIN receipts_linearized AS r USING (event_id, room_id)
+                WHERE r.room_id = ? AND r.receipt_type = 'm.read' AND r.user_id = ?
+            """,
+            (room_id, user_id),
+        )
+        row = txn.fetchone()
+        if row and row[0] is not None:
+            return row[0]
+
+        txn.execute(
+            """
+                SELECT stream_ordering FROM local_current_membership
+                INNER JOIN events USING (event_id, room_id)
+                WHERE room_id = ? AND user_id = ?
+            """,
+            (room_id, user_id),
+        )
+        row = txn.fetchone()
+        return row[0] if row else None
+
+    def _lock_push_counts_txn(
+        self, txn: LoggingTransaction, room_id: str, user_id: str
+    ) -> None:
+        """Lock the user's row of event_push_counts in the room, creating it if
+        necessary, before recalculating their counts.
+
+        Otherwise an event whose push actions we don't count, but which
+        increments the row before we write the recalculated counts, would have
+        its increment overwritten.
+        """
+        if not isinstance(self.database_engine, PostgresEngine):
+            # SQLite only allows one writer at a time, so there is no race.
+            return
+
+        # The new row's counts haven't been calculated, which is fine as the
+        # caller is about to overwrite them.
+        txn.execute(
+            """
+                INSERT INTO event_push_counts
+                    (user_id, room_id, notif_count, highlight_count, unread_count)
+                VALUES (?, ?, 0, 0, 0)
+                ON CONFLICT (user_id, room_id) DO NOTHING
+            """,
+            (user_id, room_id),
+        )
+        txn.execute(
+            """
+                SELECT 1 FROM event_push_counts
+                WHERE user_id = ? AND room_id = ?
+                FOR UPDATE
+            """,
+            (user_id, room_id),
+        )
+
+    def _set_push_counts_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        user_id: str,
+        stream_ordering: int,
+        counts: Dict[str, int],
+    ) -> None:
+        """Store the unread counts for the user in the room, relative to the
+        given stream ordering.
+        """
+        self.db_pool.simple_upsert_txn(
+            txn,
+            table="event_push_counts",
+            keyvalues={"room_id": room_id, "user_id": user_id},
+            values={
+                "notif_count": counts["notify_count"],
+                "highlight_count": counts["highlight_count"],
+                "unread_count": counts["unread_count"],
+                "stream_ordering": stream_ordering,
+            },
+            # event_push_counts has a unique constraint on (user_id, room_id)
+            lock=False,
+        )
+
+    def _add_to_push_counts_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        stream_ordering: int,
+        rows: List[Tuple[str, int, int, int]],
+    ) -> None:
+        """Increment the unread counts of users for a newly persisted event.
+
+        If there isn't an entry for a user yet, one is created which is marked
+        as needing to be calculated in full by the reconciliation job.
+
+        Args:
+            txn
+            room_id
+            stream_ordering: The stream ordering of the event.
+            rows: Tuples of (user_id, notif, highlight, unread) from the push
+                actions of the event.
+        """
+        if not rows:
+            return
+
+        # Update the rows in a consistent order, so that we don't deadlock
+        # with other transactions locking them.
+        rows = sorted(rows)
+
+        if self.database_engine.can_native_upsert:
+            sql = """
+                INSERT INTO event_push_counts
+                    (user_id, room_id, notif_count, highlight_count, unread_count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, room_id) DO UPDATE SET
+                    notif_count = event_push_counts.notif_count
+                        + EXCLUDED.notif_count,
+                    highlight_count = event_push_counts.highlight_count
+                        + EXCLUDED.highlight_count,
+                    unread_count = event_push_counts.unread_count
+                        + EXCLUDED.unread_count
+                WHERE event_push_counts.stream_ordering IS NULL
+                    OR event_push_counts.stream_ordering < ?
+            """
+            txn.executemany(
+                sql,
+                (
+                    (
+                        user_id,
+                        room_id,
+                        notif or 0,
+                        highlight or 0,
+                        unread or 0,
+                        stream_ordering,
+                    )
+                    for user_id, notif, highlight, unread in rows
+                ),
+            )
+            return
+
+        # Without native upserts we update the existing rows and then insert the
+        # missing ones. This is safe as we only lack native upserts on old
+        # versions of SQLite, which only allow one writer at a time.
+        for user_id, notif, highlight, unread in rows:
+            txn.execute(
+                """
+                    SELECT stream_ordering FROM event_push_counts
+                    WHERE user_id = ? AND room_id = ?
+                """,
+                (user_id, room_id),
+            )
+            existing = txn.fetchone()
+            if existing is None:
+                self.db_pool.simple_insert_txn(
+                    txn,
+                    table="event_push_counts",
+                    values={
+                        "user_id": user_id,
+                        "room_id": room_id,
+                        "notif_count": notif or 0,
+                        "highlight_count": highlight or 0,
+                        "unread_count": unread or 0,
+                        "stream_ordering": None,
+                    },
+                )
+            elif existing[0] is None or existing[0] < stream_ordering:
+                txn.execute(
+                    """
+                        UPDATE event_push_counts SET
+                            notif_count = notif_count + ?,
+                            highlight_count = highlight_count + ?,
+                            unread_count = unread_count + ?
+                        WHERE user_id = ? AND room_id = ?
+                    """,
+                    (notif or 0, highlight or 0, unread or 0, user_id, room_id),
+                )
+
+    @wrap_as_background_process("reconcile_push_counts")
+    async def _reconcile_push_counts(self) -> None:
+        """Check a batch of the incrementally maintained unread counts against
+        the push actions, correcting any that have drifted and filling in any
+        which haven't been calculated yet.
+        """
+        await self.db_pool.runInteraction(
+            "_reconcile_push_counts", self._reconcile_push_counts_txn
+        )
+
+    @wrap_as_background_process("calculate_push_counts")
+    async def _calculate_push_counts(self) -> None:
+        """Fill in the counts for rows of event_push_counts which were created
+        by a push action before the counts had been calculated in full.
+        """
+        for _ in range(self._push_counts_calculate_max_batches):
+            done = await self.db_pool.runInteraction(
+                "_calculate_push_counts", self._calculate_push_counts_txn
+            )
+            if done < self._push_counts_calculate_batch_size:
+                break
+
+    def _calculate_push_counts_txn(self, txn: LoggingTransaction) -> int:
+        """Returns the number of rows which were looked at."""
+        txn.execute(
+            """
+                SELECT user_id, room_id FROM event_push_counts
+                WHERE stream_ordering IS NULL
+                LIMIT ?
+            """,
+            (self._push_counts_calculate_batch_size,),
+        )
+        rows = txn.fetchall()
+
+        for user_id, room_id in rows:
+            if self._calculate_push_counts_for_user_txn(txn, room_id, user_id):
+                push_counts_reconciled_counter.labels("uncalculated").inc()
+
+        return len(rows)
+
+    def _calculate_push_counts_for_user_txn(
+        self, txn: LoggingTransaction, room_id: str, user_id: str
+    ) -> bool:
+        """Calculate the user's counts in the room in full, relative to their
+        read receipt, and store them.
+
+        Returns:
+            True if the counts were stored, False if the user is no longer in
+            the room (in which case any existing row is deleted).
+        """
+        self._lock_push_counts_txn(txn, room_id, user_id)
+
+        stream_ordering = self._get_last_read_stream_ordering_txn(txn, room_id, user_id)
+        if stream_ordering is None:
+            self.db_pool.simple_delete_txn(
+                txn,
+                table="event_push_counts",
+                keyvalues={"user_id": user_id, "room_id": room_id},
+            )
+            return False
+
+        counts = self._get_unread_counts_by_pos_txn(
+            txn, room_id, user_id, stream_ordering
+        )
+        self._set_push_counts_txn(txn, room_id, user_id, stream_ordering, counts)
+
+        # Workers will pick up the new counts when the next event in the
+        # room invalidates their caches.
+        txn.call_after(
+            self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
+            (room_id, user_id),
+        )
+        return True
+
+    def _reconcile_push_counts_txn(self, txn: LoggingTransaction) -> int:
+        """Returns the number of rows which were updated."""
+        position = self._push_counts_reconcile_position
+        if position is None:
+            clause, args = "1 = 1", []  # type: Tuple[str, list]
+        else:
+            clause, args = make_tuple_comparison_clause(
+                self.database_engine,
+                [("user_id", position[0]), ("room_id", position[1])],
+            )
+
+        txn.execute(
+            """
+                SELECT user_id, room_id, notif_count, highlight_count,
+                    unread_count, stream_ordering
+                FROM event_push_counts
+                WHERE %s
+                ORDER BY user_id, room_id
+                LIMIT ?
+            """
+            % (clause,),
+            args + [self._push_counts_reconcile_batch_size],
+        )
+        rows = txn.fetchall()
+
+        if len(rows) < self._push_counts_reconcile_batch_size:
+            # Start from the beginning again next time.
+            self._push_counts_reconcile_position = None
+        else:
+            self._push_counts_reconcile_position = (rows[-1][0], rows[-1][1])
+
+        corrected = 0
+        for user_id, room_id, notif, highlight, unread, stream_ordering in rows:
+            if stream_ordering is None:
+                # The counts haven't been calculated in full yet.
+                if self._calculate_push_counts_for_user_txn(txn, room_id, user_id):
+                    push_counts_reconciled_counter.labels("uncalculated").inc()
+                    corrected += 1
+                continue
+
+            counts = self._get_unread_counts_by_pos_txn(
+                txn, room_id, user_id, stream_ordering
+            )
+            if (notif, highlight, unread) == (
+                counts["notify_count"],
+                counts["highlight_count"],
+                counts["unread_count"],
+            ):
+                continue
+
+            # The counts may only differ because an event has been persisted
+            # since we read the row, so check again with the row locked.
+            self._lock_push_counts_txn(txn, room_id, user_id)
+            row = self.db_pool.simple_select_one_txn(
+                txn,
+                table="event_push_counts",
+                keyvalues={"room_id": room_id, "user_id": user_id},
+                retcols=("notif_count", "highlight_count", "unread_count"),
+            )
+            counts = self._get_unread_counts_by_pos_txn(
+                txn, room_id, user_id, stream_ordering
+            )
+            if (row["notif_count"], row["highlight_count"], row["unread_count"]) == (
+                counts["notify_count"],
+                counts["highlight_count"],
+                counts["unread_count"],
+            ):
+                continue
+
+            self._set_push_counts_txn(txn, room_id, user_id, stream_ordering, counts)
+
+            txn.call_after(
+                self.get_unread_event_push_actions_by_room_for_user.invalidate_many,
+                (room_id, user_id),
+            )
+            push_counts_reconciled_counter.labels("drift").inc()
+            corrected += 1
+
+        if corrected:
+            logger.info("Reconciled %d unread counts", corrected)
+
+        return corrected
+
     async def get_push_action_users_in_range(
         self, min_stream_ordering, max_stream_ordering
     ):
@@ -310,6 +702,101 @@ class EventPushActionsWorkerStore(SQLBaseStore):
         # one of the subqueries may have hit the limit.
         return notifs[:limit]
 
+    async def get_unread_push_actions_for_users_in_range_for_http(
+        self,
+        user_ids: Collection[str],
+        min_stream_ordering: int,
+        max_stream_ordering: int,
+    ) -> Dict[str, List[dict]]:
+        """Get all the unread push actions for the given users within the
+        given stream ordering range. This is the batched equivalent of
+        `get_unread_push_actions_for_user_in_range_for_http`, and is used to
+        fetch the push actions for new events for many pushers at once.
+
+        Unlike the single user version there is no limit on the number of push
+        actions returned, so the range should be kept small.
+
+        Args:
+            user_ids: The users to fetch push actions for.
+            min_stream_ordering: The exclusive lower bound on the
+                stream ordering of event push actions to fetch.
+            max_stream_ordering: The inclusive upper bound on the
+                stream ordering of event push actions to fetch.
+        Returns:
+            A map from user ID to a list of dicts with the keys "event_id",
+            "room_id", "stream_ordering", "actions", ordered by ascending
+            stream_ordering. Users without any push actions are omitted.
+        """
+
+        def get_push_actions_for_users_txn(txn):
+            results = {}  # type: Dict[str, List[dict]]
+            for chunk in batch_iter(user_ids, 100):
+                receipt_clause, receipt_args = make_in_list_sql_clause(
+                    self.database_engine, "r.user_id", chunk
+                )
+                user_clause, user_args = make_in_list_sql_clause(
+                    self.database_engine, "ep.user_id", chunk
+                )
+
+                # As with the single user version, we ignore push actions for
+                # events before the user's read receipt in the room, if they
+                # have one.
+                sql = """
+                    SELECT ep.user_id, ep.event_id, ep.room_id, ep.stream_ordering,
+                        ep.actions, ep.highlight
+                    FROM event_push_actions AS ep
+                    LEFT JOIN (
+                        SELECT r.user_id, r.room_id,
+                            MAX(e.stream_ordering) AS stream_ordering
+                        FROM receipts_linearized AS r
+                        INNER JOIN events AS e USING (room_id, event_id)
+                        WHERE r.receipt_type = 'm.read' AND %s
+                        GROUP BY r.user_id, r.room_id
+                    ) AS rl ON rl.user_id = ep.user_id AND rl.room_id = ep.room_id
+                    WHERE %s
+                        AND ep.stream_ordering > ?
+                        AND ep.stream_ordering <= ?
+                        AND ep.notif = 1
+                        AND (
+                            rl.stream_ordering IS NULL
+                            OR ep.stream_ordering > rl.stream_ordering
+                        )
+                    ORDER BY ep.stream_ordering ASC
+                """ % (
+                    receipt_clause,
+                    user_clause,
+                )
+                txn.execute(
+                    sql,
+                    receipt_args
+                    + user_args
+                    + [min_stream_ordering, max_stream_ordering],
+                )
+
+                for (
+                    user_id,
+                    event_id,
+                    room_id,
+                    stream_ordering,
+                    actions,
+                    highlight,
+                ) in txn:
+                    results.setdefault(user_id, []).append(
+                        {
+                            "event_id": event_id,
+                            "room_id": room_id,
+                            "stream_ordering": stream_ordering,
+                            "actions": _deserialize_action(actions, highlight),
+                        }
+                    )
+
+            return results
+
+        return await self.db_pool.runInteraction(
+            "get_unread_push_actions_for_users_in_range_for_http",
+            get_push_actions_for_users_txn,
+        )
+
     async def get_unread_push_actions_for_user_in_range_for_email(
         self,
         user_id: str,
@@ -857,6 +1344,66 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
             where_clause="highlight=1",
         )
 
+        self.db_pool.updates.register_background_update_handler(
+            "event_push_counts_populate", self._populate_event_push_counts
+        )
+
+    async def _populate_event_push_counts(self, progress, batch_size):
+        """Background update to calculate the unread counts of every local
+        user in every room they are joined to, so that they don't all have to
+        be calculated on demand.
+        """
+        last_user_id = progress.get("last_user_id", "")
+        last_room_id = progress.get("last_room_id", "")
+
+        def _populate_event_push_counts_txn(txn):
+            clause, args = make_tuple_comparison_clause(
+                self.database_engine,
+                [("user_id", last_user_id), ("room_id", last_room_id)],
+            )
+            txn.execute(
+                """
+                    SELECT user_id, room_id FROM local_current_membership
+                    WHERE membership = ? AND %s
+                    ORDER BY user_id, room_id
+                    LIMIT ?
+                """
+                % (clause,),
+                [Membership.JOIN] + args + [batch_size],
+            )
+            rows = txn.fetchall()
+
+            for user_id, room_id in rows:
+                stream_ordering = self.db_pool.simple_select_one_onecol_txn(
+                    txn,
+                    table="event_push_counts",
+                    keyvalues={"user_id": user_id, "room_id": room_id},
+                    retcol="stream_ordering",
+                    allow_none=True,
+                )
+                if stream_ordering is None:
+                    self._calculate_push_counts_for_user_txn(txn, room_id, user_id)
+
+            if rows:
+                self.db_pool.updates._background_update_progress_txn(
+                    txn,
+                    "event_push_counts_populate",
+                    {"last_user_id": rows[-1][0], "last_room_id": rows[-1][1]},
+                )
+
+            return len(rows)
+
+        count = await self.db_pool.runInteraction(
+            "_populate_event_push_counts", _populate_event_push_counts_txn
+        )
+
+        if count < batch_size:
+            await self.db_pool.updates._end_background_update(
+                "event_push_counts_populate"
+            )
+
+        return count
+
     async def get_push_actions_for_user(
         self, user_id, before=None, limit=50, only_highlight=False
     ):
@@ -950,6 +1497,15 @@ class EventPushActionsStore(EventPushActionsWorkerStore):
             (room_id, user_id, stream_ordering),
         )
 
+        # Now recalculate the counts relative to the new read receipt. Remote
+        # users never have push actions, so there is nothing to count.
+        if self.hs.is_mine_id(user_id):
+            self._lock_push_counts_txn(txn, room_id, user_id)
+            counts = self._get_unread_counts_by_pos_txn(
+                txn, room_id, user_id, stream_ordering
+            )
+            self._set_push_counts_txn(txn, room_id, user_id, stream_ordering, counts)
+
 
 def _action_has_highlight(actions):
     for action in actions:
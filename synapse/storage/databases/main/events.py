@@ -1364,19 +1364,26 @@ class PersistEventsStore:
             )
 
         for event, _ in events_and_contexts:
-            user_ids = self.db_pool.simple_select_onecol_txn(
-                txn,
-                table="event_push_actions_staging",
-                keyvalues={"event_id": event.event_id},
-                retcol="user_id",
+            txn.execute(
+                """
+                SELECT user_id, notif, highlight, unread
+                FROM event_push_actions_staging
+                WHERE event_id = ?
+                """,
+                (event.event_id,),
             )
+            rows = txn.fetchall()
 
-            for uid in user_ids:
+            for uid, _, _, _ in rows:
                 txn.call_after(
                     self.store.get_unread_event_push_actions_by_room_for_user.invalidate_many,
                     (event.room_id, uid),
                 )
 
+            self.store._add_to_push_counts_txn(
+                txn, event.room_id, event.internal_metadata.stream_ordering, rows
+            )
+
         # Now we delete the staging area for *all* events that were being
         # persisted.
         txn.executemany(
@@ -1390,6 +1397,30 @@ class PersistEventsStore:
             self.store.get_unread_event_push_actions_by_room_for_user.invalidate_many,
             (room_id,),
         )
+
+        # Take the push actions off the unread counts of the affected users.
+        txn.execute(
+            """
+            SELECT user_id, notif, highlight, unread, stream_ordering
+            FROM event_push_actions WHERE room_id = ? AND event_id = ?
+            """,
+            (room_id, event_id),
+        )
+        txn.executemany(
+            """
+            UPDATE event_push_counts SET
+                notif_count = notif_count - ?,
+                highlight_count = highlight_count - ?,
+                unread_count = unread_count - ?
+            WHERE user_id = ? AND room_id = ?
+                AND (stream_ordering IS NULL OR stream_ordering < ?)
+            """,
+            [
+                (notif or 0, highlight or 0, unread or 0, user_id, room_id, so)
+                for user_id, notif, highlight, unread, so in txn.fetchall()
+            ],
+        )
+
         txn.execute(
             "DELETE FROM event_push_actions WHERE room_id = ? AND event_id = ?",
             (room_id, event_id),
@@ -234,6 +234,13 @@ class PurgeEventsStore(StateGroupWorkerStore, SQLBaseStore):
                 (room_id,),
             )
 
+        # The unread counts in the room may now be wrong, so mark them as needing
+        # to be recalculated.
+        txn.execute(
+            "UPDATE event_push_counts SET stream_ordering = NULL WHERE room_id = ?",
+            (room_id,),
+        )
+
         # Mark all state and own events as outliers
         logger.info("[purge] marking remaining events as outliers")
         txn.execute(
@@ -342,6 +349,7 @@ class PurgeEventsStore(StateGroupWorkerStore, SQLBaseStore):
             "event_forward_extremities",
             "event_json",
             "event_push_actions",
+            "event_push_counts",
             "event_search",
             "events",
             "group_rooms",
@@ -16,6 +16,8 @@
 import logging
 from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, List, Optional, Set
 
+from prometheus_client import Counter
+
 from synapse.api.constants import EventTypes, Membership
 from synapse.events import EventBase
 from synapse.events.snapshot import EventContext
@@ -38,6 +40,7 @@ from synapse.types import Collection, PersistedEventPosition, get_domain_from_id
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import intern_string
 from synapse.util.caches.descriptors import _CacheContext, cached, cachedList
+from synapse.util.iterutils import batch_iter
 from synapse.util.metrics import Measure
 
 if TYPE_CHECKING:
@@ -49,6 +52,14 @@ logger = logging.getLogger(__name__)
 _MEMBERSHIP_PROFILE_UPDATE_NAME = "room_membership_profile_update"
 _CURRENT_STATE_MEMBERSHIP_UPDATE_NAME = "current_state_events_membership"
 
+# How `_JoinedHostsCache` answered each request: "hit" if it already held the
+# requested state group, "delta" if it could be updated from the membership
+# changes since the group it held, and "recompute" if it had to be rebuilt from
+# the full state.
+joined_hosts_cache_counter = Counter(
+    "synapse_storage_joined_hosts_cache", "", ["outcome"]
+)
+
 
 class RoomMemberWorkerStore(EventsWorkerStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
@@ -150,6 +161,65 @@ class RoomMemberWorkerStore(EventsWorkerStore):
             "get_users_in_room", self.get_users_in_room_txn, room_id
         )
 
+    @cached(max_entries=100000, iterable=True)
+    async def get_current_hosts_in_room(self, room_id: str) -> FrozenSet[str]:
+        """Get the servers which currently have users joined to the room,
+        according to the current state of the room.
+
+        This is invalidated alongside `get_users_in_room`.
+        """
+        users = await self.get_users_in_room(room_id)
+        return frozenset(intern_string(get_domain_from_id(u)) for u in users)
+
+    @cachedList(
+        cached_method_name="get_current_hosts_in_room", list_name="room_ids",
+    )
+    async def get_current_hosts_in_rooms(
+        self, room_ids: Collection[str]
+    ) -> Dict[str, FrozenSet[str]]:
+        """Bulk version of `get_current_hosts_in_room`.
+
+        Returns:
+            Map from room ID to the servers currently joined to the room.
+        """
+
+        def _get_current_hosts_in_rooms_txn(txn):
+            if self._current_state_events_membership_up_to_date:
+                sql = """
+                    SELECT room_id, state_key FROM current_state_events
+                    WHERE type = 'm.room.member' AND membership = ? AND %s
+                """
+            else:
+                sql = """
+                    SELECT c.room_id, state_key FROM room_memberships as m
+                    INNER JOIN current_state_events as c
+                    ON m.event_id = c.event_id
+                    AND m.room_id = c.room_id
+                    AND m.user_id = c.state_key
+                    WHERE c.type = 'm.room.member' AND m.membership = ? AND %s
+                """
+
+            hosts = {
+                room_id: set() for room_id in room_ids
+            }  # type: Dict[str, Set[str]]
+            for batch in batch_iter(room_ids, 100):
+                clause, args = make_in_list_sql_clause(
+                    self.database_engine,
+                    "room_id"
+                    if self._current_state_events_membership_up_to_date
+                    else "c.room_id",
+                    batch,
+                )
+                txn.execute(sql % (clause,), [Membership.JOIN] + list(args))
+                for room_id, user_id in txn:
+                    hosts[room_id].add(intern_string(get_domain_from_id(user_id)))
+
+            return {room_id: frozenset(h) for room_id, h in hosts.items()}
+
+        return await self.db_pool.runInteraction(
+            "get_current_hosts_in_rooms", _get_current_hosts_in_rooms_txn
+        )
+
     def get_users_in_room_txn(self, txn, room_id: str) -> List[str]:
         # If we can assume current_state_events.membership is up to date
         # then we can avoid a join, which is a Very Good Thing given how
@@ -408,6 +478,65 @@ class RoomMemberWorkerStore(EventsWorkerStore):
             for room_id, instance, stream_id in txn
         )
 
+    @cachedList(
+        cached_method_name="get_rooms_for_user_with_stream_ordering",
+        list_name="user_ids",
+    )
+    async def get_rooms_for_users_with_stream_ordering(
+        self, user_ids: Collection[str]
+    ) -> Dict[str, FrozenSet[GetRoomsForUserWithStreamOrdering]]:
+        """Bulk version of `get_rooms_for_user_with_stream_ordering`.
+
+        Returns:
+            Map from user ID to the rooms they are joined to, along with the
+            stream ordering of the most recent join for each room.
+        """
+
+        def _get_rooms_for_users_with_stream_ordering_txn(txn):
+            if self._current_state_events_membership_up_to_date:
+                sql = """
+                    SELECT c.state_key, room_id, e.instance_name, e.stream_ordering
+                    FROM current_state_events AS c
+                    INNER JOIN events AS e USING (room_id, event_id)
+                    WHERE
+                        c.type = 'm.room.member'
+                        AND c.membership = ?
+                        AND %s
+                """
+            else:
+                sql = """
+                    SELECT c.state_key, room_id, e.instance_name, e.stream_ordering
+                    FROM current_state_events AS c
+                    INNER JOIN room_memberships AS m USING (room_id, event_id)
+                    INNER JOIN events AS e USING (room_id, event_id)
+                    WHERE
+                        c.type = 'm.room.member'
+                        AND m.membership = ?
+                        AND %s
+                """
+
+            rooms = {
+                user_id: set() for user_id in user_ids
+            }  # type: Dict[str, Set[GetRoomsForUserWithStreamOrdering]]
+            for batch in batch_iter(user_ids, 100):
+                clause, args = make_in_list_sql_clause(
+                    self.database_engine, "c.state_key", batch
+                )
+                txn.execute(sql % (clause,), [Membership.JOIN] + list(args))
+                for user_id, room_id, instance, stream_id in txn:
+                    rooms[user_id].add(
+                        GetRoomsForUserWithStreamOrdering(
+                            room_id, PersistedEventPosition(instance, stream_id)
+                        )
+                    )
+
+            return {user_id: frozenset(r) for user_id, r in rooms.items()}
+
+        return await self.db_pool.runInteraction(
+            "get_rooms_for_users_with_stream_ordering",
+            _get_rooms_for_users_with_stream_ordering_txn,
+        )
+
     async def get_users_server_still_shares_room_with(
         self, user_ids: Collection[str]
     ) -> Set[str]:
@@ -1006,7 +1135,11 @@ class _JoinedHostsCache:
         self.store = store
         self.room_id = room_id
 
-        self.hosts_to_joined_users = {}
+        self.hosts_to_joined_users = {}  # type: Dict[str, Set[str]]
+
+        # the result for `state_group`, so that we don't have to rebuild the
+        # frozenset on every hit.
+        self._destinations = frozenset()  # type: FrozenSet[str]
 
         self.state_group = object()
 
@@ -1024,29 +1157,18 @@ class _JoinedHostsCache:
             The destinations as a set.
         """
         if state_entry.state_group == self.state_group:
-            return frozenset(self.hosts_to_joined_users)
+            joined_hosts_cache_counter.labels("hit").inc()
+            return self._destinations
 
         with (await self.linearizer.queue(())):
             if state_entry.state_group == self.state_group:
-                pass
-            elif state_entry.prev_group == self.state_group:
-                for (typ, state_key), event_id in state_entry.delta_ids.items():
-                    if typ != EventTypes.Member:
-                        continue
-
-                    host = intern_string(get_domain_from_id(state_key))
-                    user_id = state_key
-                    known_joins = self.hosts_to_joined_users.setdefault(host, set())
-
-                    event = await self.store.get_event(event_id)
-                    if event.membership == Membership.JOIN:
-                        known_joins.add(user_id)
-                    else:
-                        known_joins.discard(user_id)
-
-                        if not known_joins:
-                            self.hosts_to_joined_users.pop(host, None)
+                joined_hosts_cache_counter.labels("hit").inc()
+            elif state_entry.prev_group == self.state_group and (
+                await self._apply_delta(state_entry.delta_ids)
+            ):
+                joined_hosts_cache_counter.labels("delta").inc()
             else:
+                joined_hosts_cache_counter.labels("recompute").inc()
                 joined_users = await self.store.get_joined_users_from_state(
                     self.room_id, state_entry
                 )
@@ -1060,8 +1182,46 @@ class _JoinedHostsCache:
                 self.state_group = state_entry.state_group
             else:
                 self.state_group = object()
+            self._destinations = frozenset(self.hosts_to_joined_users)
             self._len = sum(len(v) for v in self.hosts_to_joined_users.values())
-        return frozenset(self.hosts_to_joined_users)
+        return self._destinations
+
+    async def _apply_delta(self, delta_ids) -> bool:
+        """Update `hosts_to_joined_users` with the membership changes in a
+        state delta.
+
+        Returns:
+            False if some of the membership events could not be found, in
+            which case nothing was changed and the caller should recompute the
+            hosts from scratch.
+        """
+        member_event_ids = {
+            state_key: event_id
+            for (typ, state_key), event_id in delta_ids.items()
+            if typ == EventTypes.Member
+        }
+        if not member_event_ids:
+            return True
+
+        # fetch all the membership events in one go rather than one at a time,
+        # since busy rooms can have many membership changes between groups.
+        events = await self.store.get_events(member_event_ids.values())
+        if len(events) != len(set(member_event_ids.values())):
+            return False
+
+        for user_id, event_id in member_event_ids.items():
+            host = intern_string(get_domain_from_id(user_id))
+            known_joins = self.hosts_to_joined_users.setdefault(host, set())
+
+            if events[event_id].membership == Membership.JOIN:
+                known_joins.add(user_id)
+            else:
+                known_joins.discard(user_id)
+
+                if not known_joins:
+                    self.hosts_to_joined_users.pop(host, None)
+
+        return True
 
     def __len__(self):
         return self._len
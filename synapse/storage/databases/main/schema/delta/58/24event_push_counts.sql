@@ -0,0 +1,37 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Tracks the notification, highlight and unread counts for each user in each
+-- room, so that they don't need to be calculated from event_push_actions and
+-- event_push_summary each time they are requested.
+--
+-- The counts are incremented as push actions are persisted, and recalculated
+-- when the user's read receipt moves.
+--
+-- stream_ordering is the position of the user's read receipt (or their join
+-- event, if they have no receipt) that the counts are relative to. A value of
+-- NULL means that the counts have not yet been calculated in full, and so are
+-- not to be trusted.
+CREATE TABLE IF NOT EXISTS event_push_counts (
+    user_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    notif_count BIGINT NOT NULL,
+    highlight_count BIGINT NOT NULL,
+    unread_count BIGINT NOT NULL,
+    stream_ordering BIGINT
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS event_push_counts_user_room
+    ON event_push_counts(user_id, room_id);
@@ -0,0 +1,81 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Replaces device_lists_outbound_pokes, which had a row for every destination
+-- that needed to be told about each change to a local user's devices.
+--
+-- Instead, we record each change once, along with the set of destinations
+-- which need to be told about it. Sets of destinations are shared between
+-- changes: the key of a set is a hash of the destinations in it.
+CREATE TABLE IF NOT EXISTS device_lists_outbound_changes (
+    stream_id BIGINT NOT NULL,
+    user_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    host_set TEXT NOT NULL,
+    ts BIGINT NOT NULL,
+    opentracing_context TEXT
+);
+
+CREATE INDEX IF NOT EXISTS device_lists_outbound_changes_host_set_idx
+    ON device_lists_outbound_changes(host_set, stream_id);
+CREATE INDEX IF NOT EXISTS device_lists_outbound_changes_user_idx
+    ON device_lists_outbound_changes(user_id, device_id);
+CREATE INDEX IF NOT EXISTS device_lists_outbound_changes_stream_idx
+    ON device_lists_outbound_changes(stream_id);
+
+CREATE TABLE IF NOT EXISTS device_lists_outbound_host_sets (
+    host_set TEXT NOT NULL,
+    destination TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS device_lists_outbound_host_sets_idx
+    ON device_lists_outbound_host_sets(destination, host_set);
+CREATE INDEX IF NOT EXISTS device_lists_outbound_host_sets_host_set_idx
+    ON device_lists_outbound_host_sets(host_set);
+
+-- The stream_id up to which we have successfully sent device list updates to
+-- each destination.
+CREATE TABLE IF NOT EXISTS device_lists_outbound_positions (
+    destination TEXT NOT NULL PRIMARY KEY,
+    stream_id BIGINT NOT NULL
+);
+
+-- (destination, user) pairs for which the pending updates have been collapsed
+-- into just the one with the given stream_id, because the destination has been
+-- unreachable for a while.
+CREATE TABLE IF NOT EXISTS device_lists_outbound_collapsed (
+    destination TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    stream_id BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS device_lists_outbound_collapsed_idx
+    ON device_lists_outbound_collapsed(destination, user_id);
+
+-- Carry over any pokes which have not yet been sent, each in a set on its own.
+INSERT INTO device_lists_outbound_host_sets (host_set, destination)
+    SELECT DISTINCT 'legacy:' || destination, destination
+    FROM device_lists_outbound_pokes;
+
+INSERT INTO device_lists_outbound_changes
+    (stream_id, user_id, device_id, host_set, ts, opentracing_context)
+    SELECT stream_id, user_id, device_id, 'legacy:' || destination, ts,
+        opentracing_context
+    FROM device_lists_outbound_pokes;
+
+DROP TABLE device_lists_outbound_pokes;
+
+-- this operated on device_lists_outbound_pokes, so is no longer needed.
+DELETE FROM background_updates WHERE update_name = 'remove_dup_outbound_pokes';
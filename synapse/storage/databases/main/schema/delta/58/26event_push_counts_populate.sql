@@ -0,0 +1,22 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Used to find the rows of event_push_counts which still need calculating.
+CREATE INDEX IF NOT EXISTS event_push_counts_uncalculated
+    ON event_push_counts(user_id, room_id) WHERE stream_ordering IS NULL;
+
+-- Calculate the counts for all existing local room members.
+INSERT INTO background_updates (update_name, progress_json) VALUES
+  ('event_push_counts_populate', '{}');
@@ -0,0 +1,27 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- When each set of destinations in device_lists_outbound_host_sets was last
+-- used for a change, so that sets are only deleted once they have been unused
+-- for a while. A row is written whenever a set is used, so that deleting a set
+-- conflicts with concurrently adding a change which uses it.
+CREATE TABLE IF NOT EXISTS device_lists_outbound_host_set_usage (
+    host_set TEXT NOT NULL PRIMARY KEY,
+    last_used_ts BIGINT NOT NULL
+);
+
+INSERT INTO device_lists_outbound_host_set_usage (host_set, last_used_ts)
+    SELECT host_set, MAX(ts) FROM device_lists_outbound_changes
+    GROUP BY host_set;
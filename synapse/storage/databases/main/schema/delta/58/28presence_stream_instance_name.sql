@@ -0,0 +1,21 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The presence writer which wrote each row, so that presence can be sharded
+-- across multiple writers.
+ALTER TABLE presence_stream ADD COLUMN instance_name TEXT;
+
+-- Existing rows were all written by the main process.
+UPDATE presence_stream SET instance_name = 'master';
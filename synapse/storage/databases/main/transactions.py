@@ -15,7 +15,7 @@
 
 import logging
 from collections import namedtuple
-from typing import Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from canonicaljson import encode_canonical_json
 
@@ -40,6 +40,14 @@ _UpdateTransactionRow = namedtuple(
     "_TransactionRow", ("response_code", "response_json")
 )
 
+# A destination with outstanding catch-up, as returned by
+# `get_catch_up_outstanding_destinations_with_backlog`. `backlog` is the number
+# of rooms with events which have not yet been sent to the destination.
+CatchUpDestination = namedtuple(
+    "CatchUpDestination",
+    ("destination", "last_successful_stream_ordering", "backlog", "retry_interval"),
+)
+
 SENTINEL = object()
 
 
@@ -434,6 +442,64 @@ class TransactionStore(TransactionWorkerStore):
         event_ids = [row[0] for row in txn]
         return event_ids
 
+    async def get_catch_up_room_event_ids_for_destinations(
+        self, positions: Dict[str, int]
+    ) -> Dict[str, List[str]]:
+        """
+        Batched version of `get_catch_up_room_event_ids`: for each destination,
+        returns at most 50 event IDs of the oldest events that have not yet been
+        sent to it.
+
+        Args:
+            positions: map from destination to the stream_ordering of the
+                most-recently successfully-transmitted event to it.
+
+        Returns:
+            map from destination to its list of event_ids, in stream order.
+                Destinations with nothing to catch up on are omitted.
+        """
+        return await self.db_pool.runInteraction(
+            "get_catch_up_room_event_ids_for_destinations",
+            self._get_catch_up_room_event_ids_for_destinations_txn,
+            positions,
+        )
+
+    @staticmethod
+    def _get_catch_up_room_event_ids_for_destinations_txn(
+        txn: LoggingTransaction, positions: Dict[str, int]
+    ) -> Dict[str, List[str]]:
+        # We want the first 50 events for each destination, so we glue together
+        # one limited subquery per destination, rather than doing a round trip
+        # to the database for each of them.
+        subquery = """
+            SELECT * FROM (
+                SELECT destination, stream_ordering, event_id FROM destination_rooms
+                 JOIN events USING (stream_ordering)
+                WHERE destination = ?
+                  AND stream_ordering > ?
+                ORDER BY stream_ordering
+                LIMIT 50
+            ) AS d%d
+        """
+
+        results = {}  # type: Dict[str, List[Tuple[int, str]]]
+
+        items = list(positions.items())
+        for i in range(0, len(items), 100):
+            batch = items[i : i + 100]
+
+            sql = " UNION ALL ".join(subquery % (n,) for n in range(len(batch)))
+            args = [arg for item in batch for arg in item]
+            txn.execute(sql, args)
+
+            for destination, stream_ordering, event_id in txn:
+                results.setdefault(destination, []).append((stream_ordering, event_id))
+
+        return {
+            destination: [event_id for _, event_id in sorted(rows)]
+            for destination, rows in results.items()
+        }
+
     async def get_catch_up_outstanding_destinations(
         self, after_destination: Optional[str]
     ) -> List[str]:
@@ -490,3 +556,58 @@ class TransactionStore(TransactionWorkerStore):
 
         destinations = [row[0] for row in txn]
         return destinations
+
+    async def get_catch_up_outstanding_destinations_with_backlog(
+        self, after_destination: Optional[str], limit: int = 1000
+    ) -> List[CatchUpDestination]:
+        """
+        Gets destinations which have outstanding PDUs to be caught up, and are
+        not being backed off from, along with how far behind they are.
+
+        Args:
+            after_destination:
+                If provided, all destinations must be lexicographically greater
+                than this one.
+            limit: the maximum number of destinations to return.
+
+        Returns:
+            The lexicographically first destinations with outstanding catch-up
+                which are lexicographically greater than after_destination (if
+                provided).
+        """
+        time = self.hs.get_clock().time_msec()
+
+        return await self.db_pool.runInteraction(
+            "get_catch_up_outstanding_destinations_with_backlog",
+            self._get_catch_up_outstanding_destinations_with_backlog_txn,
+            time,
+            after_destination,
+            limit,
+        )
+
+    @staticmethod
+    def _get_catch_up_outstanding_destinations_with_backlog_txn(
+        txn: LoggingTransaction,
+        now_time_ms: int,
+        after_destination: Optional[str],
+        limit: int,
+    ) -> List[CatchUpDestination]:
+        q = """
+            SELECT d.destination, d.last_successful_stream_ordering, COUNT(*),
+                d.retry_interval
+            FROM destinations AS d
+            INNER JOIN destination_rooms AS dr USING (destination)
+            WHERE dr.stream_ordering > d.last_successful_stream_ordering
+                AND d.destination > ?
+                AND (
+                    d.retry_last_ts IS NULL OR
+                    d.retry_last_ts + d.retry_interval < ?
+                )
+            GROUP BY d.destination, d.last_successful_stream_ordering,
+                d.retry_interval
+            ORDER BY d.destination
+            LIMIT ?
+        """
+        txn.execute(q, (after_destination or "", now_time_ms, limit))
+
+        return [CatchUpDestination(*row) for row in txn]
@@ -17,9 +17,11 @@ import logging
 import threading
 from collections import deque
 from contextlib import contextmanager
-from typing import Dict, List, Optional, Set, Union
+from typing import Dict, Iterable, List, Optional, Union
 
 import attr
+from prometheus_client import Gauge
+from sortedcontainers import SortedSet
 from typing_extensions import Deque
 
 from synapse.metrics.background_process_metrics import run_as_background_process
@@ -29,6 +31,23 @@ from synapse.storage.util.sequence import PostgresSequenceGenerator
 
 logger = logging.getLogger(__name__)
 
+# The number of stream positions between the furthest position any writer has
+# reached and the position up to which everything has been persisted, for each
+# stream using a `MultiWriterIdGenerator`.
+unpersisted_positions_gauge = Gauge(
+    "synapse_storage_id_generator_unpersisted_positions",
+    "Gap between the max writer position and the persisted upto position",
+    ["stream_name"],
+)
+
+# The number of IDs which have been allocated by this instance but not yet
+# finished, for each stream using a `MultiWriterIdGenerator`.
+in_flight_ids_gauge = Gauge(
+    "synapse_storage_id_generator_in_flight_ids",
+    "Number of allocated stream IDs which have not finished being persisted",
+    ["stream_name"],
+)
+
 
 class IdGenerator:
     def __init__(self, db_conn, table, column):
@@ -220,7 +239,11 @@ class MultiWriterIdGenerator:
         self._writers = writers
         self._return_factor = 1 if positive else -1
 
-        # We lock as some functions may be called from DB threads.
+        # We lock when updating our state, as `get_next_txn` may be called from
+        # DB threads. The lock is held briefly, and only once per batch of IDs.
+        #
+        # Methods which only read a single attribute don't take the lock, as
+        # that is atomic and they are called frequently.
         self._lock = threading.Lock()
 
         # Note: If we are a negative stream then we still store all the IDs as
@@ -228,13 +251,13 @@ class MultiWriterIdGenerator:
         # return them.
         self._current_positions = {}  # type: Dict[str, int]
 
-        # Set of local IDs that we're still processing. The current position
-        # should be less than the minimum of this set (if not empty).
-        self._unfinished_ids = set()  # type: Set[int]
+        # Sorted set of local IDs that we're still processing. The current
+        # position should be less than the minimum of this set (if not empty).
+        self._unfinished_ids = SortedSet()  # type: SortedSet[int]
 
-        # Set of local IDs that we've processed that are larger than the current
-        # position, due to there being smaller unpersisted IDs.
-        self._finished_ids = set()  # type: Set[int]
+        # Sorted set of local IDs that we've processed that are larger than the
+        # current position, due to there being smaller unpersisted IDs.
+        self._finished_ids = SortedSet()  # type: SortedSet[int]
 
         # We track the max position where we know everything before has been
         # persisted. This is done by a) looking at the min across all instances
@@ -342,13 +365,16 @@ class MultiWriterIdGenerator:
 
             self._persisted_upto_position = min_stream_id
 
-            with self._lock:
-                for (instance, stream_id,) in cur:
-                    stream_id = self._return_factor * stream_id
-                    self._add_persisted_position(stream_id)
+            persisted_ids = []
+            for (instance, stream_id,) in cur:
+                stream_id = self._return_factor * stream_id
+                persisted_ids.append(stream_id)
 
-                    if instance == self._instance_name:
-                        self._current_positions[instance] = stream_id
+                if instance == self._instance_name:
+                    self._current_positions[instance] = stream_id
+
+            with self._lock:
+                self._add_persisted_positions(persisted_ids)
 
         cur.close()
 
@@ -386,11 +412,10 @@ class MultiWriterIdGenerator:
 
         next_id = self._load_next_id_txn(txn)
 
-        with self._lock:
-            self._unfinished_ids.add(next_id)
+        self._add_unfinished_ids([next_id])
 
-        txn.call_after(self._mark_id_as_finished, next_id)
-        txn.call_on_exception(self._mark_id_as_finished, next_id)
+        txn.call_after(self._mark_ids_as_finished, [next_id])
+        txn.call_on_exception(self._mark_ids_as_finished, [next_id])
 
         # Update the `stream_positions` table with newly updated stream
         # ID (unless self._writers is not set in which case we don't
@@ -409,38 +434,40 @@ class MultiWriterIdGenerator:
 
         return self._return_factor * next_id
 
-    def _mark_id_as_finished(self, next_id: int):
-        """The ID has finished being processed so we should advance the
+    def _add_unfinished_ids(self, stream_ids: List[int]):
+        """Record that we've allocated the given IDs and have started
+        processing them.
+        """
+
+        with self._lock:
+            self._unfinished_ids.update(stream_ids)
+            in_flight_ids_gauge.labels(self._stream_name).set(len(self._unfinished_ids))
+
+    def _mark_ids_as_finished(self, stream_ids: List[int]):
+        """The IDs have finished being processed so we should advance the
         current position if possible.
         """
 
         with self._lock:
-            self._unfinished_ids.discard(next_id)
-            self._finished_ids.add(next_id)
+            self._unfinished_ids.difference_update(stream_ids)
+            self._finished_ids.update(stream_ids)
 
             new_cur = None  # type: Optional[int]
 
             if self._unfinished_ids:
                 # If there are unfinished IDs then the new position will be the
                 # largest finished ID less than the minimum unfinished ID.
-
-                finished = set()
-
-                min_unfinshed = min(self._unfinished_ids)
-                for s in self._finished_ids:
-                    if s < min_unfinshed:
-                        if new_cur is None or new_cur < s:
-                            new_cur = s
-                    else:
-                        finished.add(s)
-
-                # We clear these out since they're now all less than the new
-                # position.
-                self._finished_ids = finished
-            else:
+                idx = self._finished_ids.bisect_left(self._unfinished_ids[0])
+                if idx:
+                    new_cur = self._finished_ids[idx - 1]
+
+                    # We clear these out since they're now all less than the
+                    # new position.
+                    del self._finished_ids[:idx]
+            elif self._finished_ids:
                 # There are no unfinished IDs so the new position is simply the
                 # largest finished one.
-                new_cur = max(self._finished_ids)
+                new_cur = self._finished_ids[-1]
 
                 # We clear these out since they're now all less than the new
                 # position.
@@ -450,7 +477,9 @@ class MultiWriterIdGenerator:
                 curr = self._current_positions.get(self._instance_name, 0)
                 self._current_positions[self._instance_name] = max(curr, new_cur)
 
-            self._add_persisted_position(next_id)
+            self._add_persisted_positions(stream_ids)
+
+            in_flight_ids_gauge.labels(self._stream_name).set(len(self._unfinished_ids))
 
     def get_current_token(self) -> int:
         """Returns the maximum stream id such that all stream ids less than or
@@ -469,10 +498,9 @@ class MultiWriterIdGenerator:
         # For new writers we assume their initial position to be the current
         # persisted up to position. This stops Synapse from doing a full table
         # scan when a new writer announces itself over replication.
-        with self._lock:
-            return self._return_factor * self._current_positions.get(
-                instance_name, self._persisted_upto_position
-            )
+        return self._return_factor * self._current_positions.get(
+            instance_name, self._persisted_upto_position
+        )
 
     def get_positions(self) -> Dict[str, int]:
         """Get a copy of the current positon map.
@@ -499,7 +527,7 @@ class MultiWriterIdGenerator:
                 new_id, self._current_positions.get(instance_name, 0)
             )
 
-            self._add_persisted_position(new_id)
+            self._add_persisted_positions([new_id])
 
     def get_persisted_upto_position(self) -> int:
         """Get the max position where all previous positions have been
@@ -510,11 +538,10 @@ class MultiWriterIdGenerator:
         lag if one writer doesn't write very often.
         """
 
-        with self._lock:
-            return self._return_factor * self._persisted_upto_position
+        return self._return_factor * self._persisted_upto_position
 
-    def _add_persisted_position(self, new_id: int):
-        """Record that we have persisted a position.
+    def _add_persisted_positions(self, new_ids: Iterable[int]):
+        """Record that we have persisted some positions.
 
         This is used to keep the `_current_positions` up to date.
         """
@@ -522,7 +549,14 @@ class MultiWriterIdGenerator:
         # We require that the lock is locked by caller
         assert self._lock.locked()
 
-        heapq.heappush(self._known_persisted_positions, new_id)
+        max_new_id = None  # type: Optional[int]
+        for new_id in new_ids:
+            heapq.heappush(self._known_persisted_positions, new_id)
+            if max_new_id is None or new_id > max_new_id:
+                max_new_id = new_id
+
+        if max_new_id is None:
+            return
 
         # If we're a writer and we don't have any active writes we update our
         # current position to the latest position seen. This allows the instance
@@ -531,7 +565,7 @@ class MultiWriterIdGenerator:
         our_current_position = self._current_positions.get(self._instance_name)
         if our_current_position and not self._unfinished_ids:
             self._current_positions[self._instance_name] = max(
-                our_current_position, new_id
+                our_current_position, max_new_id
             )
 
         # We move the current min position up if the minimum current positions
@@ -559,6 +593,11 @@ class MultiWriterIdGenerator:
                 # do.
                 break
 
+        max_curr = max(self._current_positions.values(), default=0)
+        unpersisted_positions_gauge.labels(self._stream_name).set(
+            max(max_curr - self._persisted_upto_position, 0)
+        )
+
     def _update_stream_positions_table_txn(self, txn: Cursor):
         """Update the `stream_positions` table with newly persisted position.
         """
@@ -618,8 +657,7 @@ class _MultiWriterCtxManager:
             db_autocommit=True,
         )
 
-        with self.id_gen._lock:
-            self.id_gen._unfinished_ids.update(self.stream_ids)
+        self.id_gen._add_unfinished_ids(self.stream_ids)
 
         if self.multiple_ids is None:
             return self.stream_ids[0] * self.id_gen._return_factor
@@ -627,8 +665,7 @@ class _MultiWriterCtxManager:
             return [i * self.id_gen._return_factor for i in self.stream_ids]
 
     async def __aexit__(self, exc_type, exc, tb):
-        for i in self.stream_ids:
-            self.id_gen._mark_id_as_finished(i)
+        self.id_gen._mark_ids_as_finished(self.stream_ids)
 
         if exc_type is not None:
             return False
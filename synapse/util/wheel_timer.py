@@ -90,3 +90,43 @@ class WheelTimer:
 
     def __len__(self):
         return sum(len(entry.queue) for entry in self.entries)
+
+
+class KeyedWheelTimer(WheelTimer):
+    """A WheelTimer which holds at most one live timer per object.
+
+    Inserting an object which is already due to be returned before the new
+    time is a no-op, and inserting it with an earlier time supersedes the
+    existing timer. Objects must therefore be hashable.
+
+    Unlike WheelTimer, each object is only returned by `fetch` once per
+    expired timer, and not at all for timers which have been superseded.
+    """
+
+    def __init__(self, bucket_size=5000):
+        super().__init__(bucket_size)
+
+        # map from object to the time its live timer expires.
+        self._deadlines = {}
+
+    def insert(self, now, obj, then):
+        deadline = self._deadlines.get(obj)
+        if deadline is not None and deadline <= then:
+            return
+
+        # Any existing entry for the object is left in its bucket, and ignored
+        # by `fetch` since it no longer matches the deadline.
+        self._deadlines[obj] = then
+        super().insert(now, obj, then)
+
+    def fetch(self, now):
+        ret = []
+        for obj in super().fetch(now):
+            deadline = self._deadlines.get(obj)
+            if deadline is not None and deadline < now:
+                del self._deadlines[obj]
+                ret.append(obj)
+        return ret
+
+    def __len__(self):
+        return len(self._deadlines)
@@ -1,4 +1,4 @@
-from . import logging, lrucache, lrucache_evict
+from . import logging, lrucache, lrucache_evict, presence_timeouts, push_rules
 
 SUITES = [
     (logging, 1000),
@@ -6,4 +6,8 @@ SUITES = [
     (logging, None),
     (lrucache, None),
     (lrucache_evict, None),
+    (presence_timeouts, 100000),
+    (presence_timeouts, 1000000),
+    (push_rules, 1000),
+    (push_rules, 20000),
 ]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.api.constants import PresenceState
+from synapse.api.presence import UserPresenceState
+from synapse.handlers.presence import get_next_timeout, handle_timeouts
+from synapse.util.wheel_timer import KeyedWheelTimer
+
+
+async def main(reactor, loops):
+    """
+    Benchmark the presence timeout pass with `loops` online local users, whose
+    timers are spread over the next five minutes.
+
+    We time a full five minutes' worth of ticks (one every five seconds, as
+    the presence handler does), including rescheduling the users whose presence
+    did not change.
+    """
+    now = 1000000
+    tick = 5000
+
+    states = {}
+    timer = KeyedWheelTimer()
+    for i in range(loops):
+        user_id = "@user%d:test" % (i,)
+        last_active = now - (i % 60) * tick
+        state = UserPresenceState.default(user_id).copy_and_replace(
+            state=PresenceState.ONLINE,
+            last_active_ts=last_active,
+            last_user_sync_ts=last_active,
+            last_federation_update_ts=now,
+        )
+        states[user_id] = state
+
+        # Every other user has an ongoing sync, so won't time out.
+        timer.insert(now, user_id, get_next_timeout(state, True, i % 2 == 0))
+
+    syncing_user_ids = {user_id for i, user_id in enumerate(states) if i % 2 == 0}
+
+    def is_mine(user_id):
+        return True
+
+    start = perf_counter()
+
+    for t in range(now, now + 60 * tick, tick):
+        checked = [states[user_id] for user_id in timer.fetch(t)]
+        changes = handle_timeouts(
+            checked, is_mine_fn=is_mine, syncing_user_ids=syncing_user_ids, now=t
+        )
+        for state in changes:
+            states[state.user_id] = state
+
+        changed = {state.user_id for state in changes}
+        for state in checked:
+            if state.user_id in changed:
+                state = states[state.user_id]
+            then = get_next_timeout(state, True, state.user_id in syncing_user_ids)
+            if then is not None:
+                timer.insert(t, state.user_id, then)
+
+    end = perf_counter() - start
+
+    return end
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.api.room_versions import RoomVersions
+from synapse.events import FrozenEvent
+from synapse.push.baserules import list_with_base_rules
+from synapse.push.bulk_push_rule_evaluator import _CompiledRulesEvaluator
+from synapse.push.push_rule_evaluator import PushRuleEvaluatorForEvent
+
+
+async def main(reactor, loops):
+    """
+    Benchmark evaluating the push rules for a message in a room with `loops`
+    members, all of whom only have the default push rules.
+
+    The rules are evaluated for one event before timing starts, so that we
+    measure the steady state where the compiled rules are already cached.
+    """
+    event = FrozenEvent(
+        {
+            "event_id": "$event_id",
+            "type": "m.room.message",
+            "sender": "@sender:test",
+            "room_id": "!room:test",
+            "content": {"msgtype": "m.text", "body": "hello world"},
+        },
+        RoomVersions.V1,
+    )
+
+    # Each user gets their own copy of the rules, as they would from the push
+    # rule caches.
+    rules_by_user = {
+        "@user%d:test" % (i,): list_with_base_rules([]) for i in range(loops)
+    }
+
+    def evaluate():
+        evaluator = _CompiledRulesEvaluator(
+            PushRuleEvaluatorForEvent(event, loops, 0, {})
+        )
+        for user_id, rules in rules_by_user.items():
+            evaluator.actions_for_user(rules, user_id, "User")
+
+    evaluate()
+
+    start = perf_counter()
+
+    evaluate()
+
+    end = perf_counter() - start
+
+    return end
@@ -14,7 +14,7 @@
 # limitations under the License.
 import time
 
-from mock import Mock
+from mock import Mock, patch
 
 import canonicaljson
 import signedjson.key
@@ -310,6 +310,122 @@ class KeyringTestCase(unittest.HomeserverTestCase):
         mock_fetcher1.get_keys.assert_called_once()
         mock_fetcher2.get_keys.assert_called_once()
 
+    def test_verify_json_uses_cached_keys(self):
+        """Keys we have already fetched should be reused, as long as they are
+        valid for long enough.
+        """
+        key1 = signedjson.key.generate_signing_key(1)
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(
+            return_value=make_awaitable(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    }
+                }
+            )
+        )
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server1", key1)
+
+        self.get_success(_verify_json_for_server(kr, "server1", json1, 500, "test1"))
+        mock_fetcher.get_keys.assert_called_once()
+
+        # a second request which the key is valid for shouldn't need a fetch
+        mock_fetcher.get_keys.reset_mock()
+        self.get_success(_verify_json_for_server(kr, "server1", json1, 1000, "test2"))
+        mock_fetcher.get_keys.assert_not_called()
+
+        # but one which needs the key to be valid for longer should.
+        mock_fetcher.get_keys.return_value = make_awaitable({})
+        self.get_failure(
+            _verify_json_for_server(kr, "server1", json1, 1500, "test3"), SynapseError,
+        )
+        mock_fetcher.get_keys.assert_called_once()
+
+    def test_verified_signatures_cached(self):
+        """Verifying the same object twice should only check the signature
+        once, but changing the object should be noticed.
+        """
+        key1 = signedjson.key.generate_signing_key(1)
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(
+            return_value=make_awaitable(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    }
+                }
+            )
+        )
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        json1 = {"foo": "bar"}
+        signedjson.sign.sign_json(json1, "server1", key1)
+
+        with patch.object(
+            keyring, "verify_signed_json", wraps=keyring.verify_signed_json
+        ) as mock_verify:
+            self.get_success(_verify_json_for_server(kr, "server1", json1, 0, "t1"))
+            self.assertEqual(mock_verify.call_count, 1)
+
+            # a copy of the object with different unsigned data is still the
+            # same signed content.
+            json2 = dict(json1, unsigned={"age": 10})
+            self.get_success(_verify_json_for_server(kr, "server1", json2, 0, "t2"))
+            self.assertEqual(mock_verify.call_count, 1)
+
+            # changing the content means the signature must be checked again,
+            # and fail.
+            json3 = dict(json1, foo="baz")
+            self.get_failure(
+                _verify_json_for_server(kr, "server1", json3, 0, "t3"), SynapseError
+            )
+            self.assertEqual(mock_verify.call_count, 2)
+
+    def test_verified_signatures_cached_per_key(self):
+        """A signature which was verified under one key should be checked again
+        if the key ID is later bound to a different key.
+        """
+        key1 = signedjson.key.generate_signing_key(1)
+        key2 = signedjson.key.generate_signing_key(1)
+
+        mock_fetcher = keyring.KeyFetcher()
+        mock_fetcher.get_keys = Mock(
+            return_value=make_awaitable(
+                {
+                    "server1": {
+                        get_key_id(key1): FetchKeyResult(get_verify_key(key1), 1200)
+                    }
+                }
+            )
+        )
+        kr = keyring.Keyring(self.hs, key_fetchers=(mock_fetcher,))
+
+        json1 = {"foo": "bar"}
+        signedjson.sign.sign_json(json1, "server1", key1)
+
+        with patch.object(
+            keyring, "verify_signed_json", wraps=keyring.verify_signed_json
+        ) as mock_verify:
+            self.get_success(_verify_json_for_server(kr, "server1", json1, 0, "t1"))
+            self.assertEqual(mock_verify.call_count, 1)
+
+            # the same key ID now refers to a different key, which didn't make
+            # the signature.
+            kr._verify_key_cache.set(
+                ("server1", get_key_id(key2)),
+                FetchKeyResult(get_verify_key(key2), 2400),
+            )
+            self.get_failure(
+                _verify_json_for_server(kr, "server1", json1, 0, "t2"), SynapseError
+            )
+            self.assertEqual(mock_verify.call_count, 2)
+
 
 @logcontext_clean
 class ServerKeyFetcherTestCase(unittest.HomeserverTestCase):
@@ -420,3 +420,66 @@ class FederationCatchUpTestCases(FederatingHomeserverTestCase):
         self.assertNotIn("zzzerver", woken)
         # - all destinations are woken exactly once; they appear once in woken.
         self.assertCountEqual(woken, server_names[:-1])
+
+    @override_config({"send_federation": True})
+    def test_wake_destinations_in_batches(self):
+        """
+        Tests that _wake_destinations_needing_catchup prioritises destinations
+        with larger backlogs, and hands them their catch-up position.
+        """
+        store = self.hs.get_datastore()
+
+        self.register_user("u1", "you the one")
+        u1_token = self.login("u1", "you the one")
+        room_1 = self.helper.create_room_as("u1", tok=u1_token)
+        room_2 = self.helper.create_room_as("u1", tok=u1_token)
+
+        event_id_1 = self.helper.send(room_1, "wombats!", tok=u1_token)["event_id"]
+        event_id_2 = self.helper.send(room_2, "rabbits!", tok=u1_token)["event_id"]
+        event_1 = self.get_success(store.get_event(event_id_1))
+        event_2 = self.get_success(store.get_event(event_id_2))
+
+        # host2 has missed events in both rooms, whereas host3 is only in one.
+        for destination, room_id, event in (
+            ("host3", room_1, event_1),
+            ("host2", room_1, event_1),
+            ("host2", room_2, event_2),
+        ):
+            self.get_success(
+                store.store_destination_rooms_entries(
+                    [destination], room_id, event.internal_metadata.stream_ordering
+                )
+            )
+        for destination in ("host2", "host3"):
+            self.get_success(
+                store.set_destination_last_successful_stream_ordering(destination, 0)
+            )
+
+        outstanding = self.get_success(
+            store.get_catch_up_outstanding_destinations_with_backlog(None)
+        )
+        self.assertEqual(
+            [(d.destination, d.backlog) for d in outstanding],
+            [("host2", 2), ("host3", 1)],
+        )
+
+        event_ids = self.get_success(
+            store.get_catch_up_room_event_ids_for_destinations({"host2": 0, "host3": 0})
+        )
+        self.assertEqual(
+            event_ids, {"host2": [event_id_1, event_id_2], "host3": [event_id_1]}
+        )
+
+        # now check that the destinations are woken, biggest backlog first.
+        woken = []
+        sender = self.hs.get_federation_sender()
+        sender.wake_destination = woken.append
+        sender._catchup_after_startup_timer.cancel()
+
+        self.get_success(sender._wake_destinations_needing_catchup(), by=5.0)
+
+        self.assertEqual(woken, ["host2", "host3"])
+        self.assertEqual(
+            sender._per_destination_queues["host2"]._prefetched_catch_up,
+            (0, [event_id_1, event_id_2]),
+        )
@@ -14,7 +14,7 @@
 # limitations under the License.
 from typing import Optional
 
-from mock import Mock
+from mock import Mock, patch
 
 from signedjson import key, sign
 from signedjson.types import BaseKey, SigningKey
@@ -22,6 +22,7 @@ from signedjson.types import BaseKey, SigningKey
 from twisted.internet import defer
 
 from synapse.api.constants import RoomEncryptionAlgorithms
+from synapse.federation.sender import per_destination_queue
 from synapse.rest import admin
 from synapse.rest.client.v1 import login
 from synapse.types import JsonDict, ReadReceipt
@@ -156,6 +157,45 @@ class FederationSenderReceiptsTestCases(HomeserverTestCase):
         )
 
 
+class PerDestinationQueueBudgetTestCase(HomeserverTestCase):
+    @override_config({"send_federation": True})
+    def test_transaction_byte_budget(self):
+        queue = self.hs.get_federation_sender()._get_per_destination_queue("host2")
+        pdus = [Mock(size=100 * 1024) for _ in range(60)]
+
+        with patch.object(
+            per_destination_queue, "estimate_pdu_size", lambda pdu: pdu.size
+        ):
+            # with no information about the destination, we're only limited
+            # by the maximum number of PDUs per transaction.
+            self.assertEqual(queue._count_pdus_within_budget(pdus), 50)
+            self.assertEqual(queue._count_pdus_within_budget(pdus[:3]), 3)
+            self.assertEqual(queue._count_pdus_within_budget([]), 0)
+
+            # sending 1MB took 10 seconds, so we should aim for 500KB
+            # transactions.
+            queue._update_transaction_byte_budget(1024 * 1024, 10)
+            self.assertEqual(queue._transaction_byte_budget, 512 * 1024)
+            self.assertEqual(queue._count_pdus_within_budget(pdus), 5)
+
+            # small transactions don't tell us anything about throughput.
+            queue._update_transaction_byte_budget(1024, 10)
+            self.assertEqual(queue._transaction_byte_budget, 512 * 1024)
+
+            # a single large PDU is still sent, even if it is over budget.
+            self.assertEqual(
+                queue._count_pdus_within_budget([Mock(size=1024 * 1024)]), 1
+            )
+
+            # the budget never drops below the minimum.
+            for _ in range(20):
+                queue._update_transaction_byte_budget(1024 * 1024, 1000)
+            self.assertEqual(
+                queue._transaction_byte_budget,
+                per_destination_queue.MIN_TRANSACTION_BYTES,
+            )
+
+
 class FederationSenderDevicesTestCases(HomeserverTestCase):
     servlets = [
         admin.register_servlets,
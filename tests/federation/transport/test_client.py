@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from mock import patch
+
+from synapse.api.room_versions import RoomVersions
+from synapse.federation.transport import client
+from synapse.federation.transport.client import SendJoinParser
+
+from tests import unittest
+
+
+def _make_pdu(event_id, event_type, state_key=""):
+    return {
+        "event_id": event_id,
+        "room_id": "!room:test",
+        "sender": "@user:test",
+        "type": event_type,
+        "state_key": state_key,
+        "depth": 1,
+        "content": {"float": 1.5},
+    }
+
+
+class SendJoinParserTestCase(unittest.TestCase):
+    def _parse(self, response, v1_api):
+        parser = SendJoinParser(RoomVersions.V1, v1_api=v1_api)
+
+        body = json.dumps(response).encode("utf-8")
+
+        # feed the response in in small chunks, to check that events which are
+        # split across chunks are handled.
+        for i in range(0, len(body), 10):
+            parser.write(body[i : i + 10])
+
+        return parser.finish()
+
+    def _test_parse(self, v1_api):
+        content = {
+            "origin": "test",
+            "state": [
+                _make_pdu("$create", "m.room.create"),
+                _make_pdu("$member", "m.room.member", "@user:test"),
+            ],
+            "auth_chain": [_make_pdu("$create", "m.room.create")],
+        }
+
+        response = self._parse([200, content] if v1_api else content, v1_api)
+
+        self.assertEqual([e.event_id for e in response.state], ["$create", "$member"])
+        self.assertEqual([e.event_id for e in response.auth_events], ["$create"])
+        for event in response.state + response.auth_events:
+            self.assertTrue(event.internal_metadata.is_outlier())
+            self.assertEqual(event.content, {"float": 1.5})
+
+    def test_parse_v1(self):
+        self._test_parse(v1_api=True)
+
+    def test_parse_v2(self):
+        self._test_parse(v1_api=False)
+
+    def test_parse_without_ijson(self):
+        with patch.object(client, "ijson", None):
+            self._test_parse(v1_api=True)
+            self._test_parse(v1_api=False)
+
+    def test_invalid_event(self):
+        content = {"state": [{"type": "m.room.create"}], "auth_chain": []}
+
+        with self.assertRaises(Exception):
+            self._parse(content, v1_api=False)
+
+    def test_truncated_response(self):
+        body = json.dumps({"state": [_make_pdu("$create", "m.room.create")]})
+
+        parser = SendJoinParser(RoomVersions.V1, v1_api=False)
+        parser.write(body[:-5].encode("utf-8"))
+        with self.assertRaises(Exception):
+            parser.finish()
@@ -26,6 +26,7 @@ from synapse.api import errors
 from synapse.api.constants import RoomEncryptionAlgorithms
 
 from tests import unittest, utils
+from tests.test_utils import make_awaitable
 
 
 class E2eKeysHandlerTestCase(unittest.TestCase):
@@ -256,6 +257,79 @@ class E2eKeysHandlerTestCase(unittest.TestCase):
             {"failures": {}, "one_time_keys": {local_user: {device_id: fallback_key}}},
         )
 
+    @defer.inlineCallbacks
+    def test_claim_one_time_keys_for_many_devices(self):
+        """Claims for several devices at once should each get the right key, or
+        a fallback key where there are no one-time keys left."""
+        local_user = "@boris:" + self.hs.hostname
+
+        for device_id in ("d1", "d2"):
+            yield defer.ensureDeferred(
+                self.handler.upload_keys_for_user(
+                    local_user,
+                    device_id,
+                    {
+                        "one_time_keys": {
+                            "alg1:%s_k1" % (device_id,): "key1",
+                            "alg1:%s_k2" % (device_id,): "key2",
+                        }
+                    },
+                )
+            )
+        yield defer.ensureDeferred(
+            self.handler.upload_keys_for_user(
+                local_user,
+                "d3",
+                {"org.matrix.msc2732.fallback_keys": {"alg1:d3_fb": "fallback"}},
+            )
+        )
+
+        query = {
+            "one_time_keys": {
+                local_user: {"d1": "alg1", "d2": "alg1", "d3": "alg1", "d4": "alg1"}
+            }
+        }
+        res = yield defer.ensureDeferred(
+            self.handler.claim_one_time_keys(query, timeout=None)
+        )
+        self.assertEqual(
+            res,
+            {
+                "failures": {},
+                "one_time_keys": {
+                    local_user: {
+                        "d1": {"alg1:d1_k1": "key1"},
+                        "d2": {"alg1:d2_k1": "key1"},
+                        "d3": {"alg1:d3_fb": "fallback"},
+                    }
+                },
+            },
+        )
+
+        # the claimed keys should have been removed, and the fallback key
+        # marked as used.
+        for device_id in ("d1", "d2"):
+            res = yield defer.ensureDeferred(
+                self.store.count_e2e_one_time_keys(local_user, device_id)
+            )
+            self.assertEqual(res, {"alg1": 1})
+        res = yield defer.ensureDeferred(
+            self.store.get_e2e_unused_fallback_key_types(local_user, "d3")
+        )
+        self.assertEqual(res, [])
+
+        res = yield defer.ensureDeferred(
+            self.handler.claim_one_time_keys(query, timeout=None)
+        )
+        self.assertEqual(
+            res["one_time_keys"][local_user],
+            {
+                "d1": {"alg1:d1_k2": "key2"},
+                "d2": {"alg1:d2_k2": "key2"},
+                "d3": {"alg1:d3_fb": "fallback"},
+            },
+        )
+
     @defer.inlineCallbacks
     def test_replace_master_key(self):
         """uploading a new signing key should make the old signing key unavailable"""
@@ -660,3 +734,99 @@ class E2eKeysHandlerTestCase(unittest.TestCase):
             ],
             other_master_key["signatures"][local_user]["ed25519:" + usersigning_pubkey],
         )
+
+
+class E2eKeysHandlerRemoteTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(federation_client=mock.Mock())
+
+    def prepare(self, reactor, clock, hs):
+        self.handler = hs.get_e2e_keys_handler()
+        self.federation_client = hs.get_federation_client()
+
+    def test_claim_remote_keys_coalesced(self):
+        """Concurrent claims for keys on the same server should be sent as a
+        single request, unless they are for the same device."""
+        remote_user = "@alice:remote"
+
+        def claim_client_keys(destination, content, timeout):
+            return make_awaitable(
+                {
+                    "one_time_keys": {
+                        remote_user: {
+                            device_id: {"alg1:" + device_id: "key"}
+                            for device_id in content["one_time_keys"][remote_user]
+                        }
+                    }
+                }
+            )
+
+        self.federation_client.claim_client_keys.side_effect = claim_client_keys
+
+        d = defer.gatherResults(
+            [
+                defer.ensureDeferred(
+                    self.handler.claim_one_time_keys(
+                        {"one_time_keys": {remote_user: {device_id: "alg1"}}},
+                        timeout=None,
+                    )
+                )
+                for device_id in ("d1", "d2", "d1")
+            ]
+        )
+        results = self.get_success(d, by=0.01)
+
+        # each caller should only see the key for the device it asked for
+        self.assertEqual(
+            [r["one_time_keys"] for r in results],
+            [
+                {remote_user: {"d1": {"alg1:d1": "key"}}},
+                {remote_user: {"d2": {"alg1:d2": "key"}}},
+                {remote_user: {"d1": {"alg1:d1": "key"}}},
+            ],
+        )
+
+        # the first two requests are combined, but the third needs a key of
+        # its own.
+        self.assertEqual(
+            [c[0][1] for c in self.federation_client.claim_client_keys.call_args_list],
+            [
+                {"one_time_keys": {remote_user: {"d1": "alg1", "d2": "alg1"}}},
+                {"one_time_keys": {remote_user: {"d1": "alg1"}}},
+            ],
+        )
+
+    def test_query_remote_devices_coalesced(self):
+        """Concurrent queries for device keys on the same server should be sent
+        as a single request."""
+        remote_user = "@alice:remote"
+        devices = {"d1": {"keys": "k1"}, "d2": {"keys": "k2"}}
+
+        self.federation_client.query_client_keys.return_value = make_awaitable(
+            {"device_keys": {remote_user: devices}}
+        )
+
+        d = defer.gatherResults(
+            [
+                defer.ensureDeferred(
+                    self.handler.query_devices(
+                        {"device_keys": {remote_user: device_ids}},
+                        timeout=10000,
+                        from_user_id="@bob:test",
+                    )
+                )
+                for device_ids in (["d1"], ["d2"])
+            ]
+        )
+        results = self.get_success(d, by=0.01)
+
+        self.assertEqual(
+            [r["device_keys"] for r in results],
+            [
+                {remote_user: {"d1": devices["d1"]}},
+                {remote_user: {"d2": devices["d2"]}},
+            ],
+        )
+        self.federation_client.query_client_keys.assert_called_once_with(
+            "remote", {"device_keys": {remote_user: ["d1", "d2"]}}, timeout=10000
+        )
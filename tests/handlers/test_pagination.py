@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.logging.context import make_deferred_yieldable
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
+from synapse.streams.config import PaginationConfig
+from synapse.types import create_requester
+
+from tests import unittest
+from tests.test_utils import make_awaitable
+
+
+class BackfillPrefetchTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        self.federation_handler = Mock()
+        self.federation_handler.maybe_backfill = Mock(
+            return_value=make_awaitable(False)
+        )
+        return self.setup_test_homeserver(federation_handler=self.federation_handler)
+
+    def prepare(self, reactor, clock, hs):
+        self.handler = hs.get_pagination_handler()
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.requester = create_requester(self.user_id)
+
+        self.current_depth = self.get_success(
+            self.store.get_current_topological_token(
+                self.room_id, self.store.get_room_max_stream_ordering()
+            )
+        )
+
+    def _get_messages(self):
+        return self.handler.get_messages(
+            self.requester,
+            self.room_id,
+            PaginationConfig(from_token=None, to_token=None, direction="b", limit=10),
+        )
+
+    def _mock_extremity(self, depth):
+        self.store.get_oldest_events_with_depth_in_room = Mock(
+            return_value=make_awaitable({"$extremity": depth})
+        )
+
+    def test_no_prefetch_far_from_extremity(self):
+        self._mock_extremity(self.current_depth - 100)
+
+        self.get_success(self._get_messages())
+
+        self.federation_handler.maybe_backfill.assert_called_once_with(
+            self.room_id, self.current_depth, limit=10
+        )
+
+    def test_prefetch_check_outside_lock(self):
+        """We shouldn't look up the extremities while holding the pagination
+        lock for the room.
+        """
+        lock_held = []
+
+        async def get_oldest_events_with_depth_in_room(room_id):
+            readers = self.handler.pagination_lock.key_to_current_readers
+            lock_held.append(bool(readers.get(room_id)))
+            return {"$extremity": self.current_depth - 100}
+
+        self.store.get_oldest_events_with_depth_in_room = (
+            get_oldest_events_with_depth_in_room
+        )
+
+        self.get_success(self._get_messages())
+
+        self.assertEqual(lock_held, [False])
+
+    def test_prefetch_near_extremity(self):
+        """Paginating close to an extremity should backfill from the extremity
+        in the background, and a request made while the prefetch is running
+        should wait for it.
+        """
+        extremity_depth = self.current_depth - 30
+        self._mock_extremity(extremity_depth)
+
+        prefetch_deferred = defer.Deferred()
+
+        async def maybe_backfill(room_id, current_depth, limit):
+            if current_depth == extremity_depth:
+                await make_deferred_yieldable(prefetch_deferred)
+                return True
+            return False
+
+        self.federation_handler.maybe_backfill.side_effect = maybe_backfill
+
+        self.get_success(self._get_messages())
+
+        self.federation_handler.maybe_backfill.assert_called_with(
+            self.room_id, extremity_depth, limit=10
+        )
+        self.assertEqual(self.federation_handler.maybe_backfill.call_count, 2)
+
+        # a second request should wait for the prefetch to complete, rather
+        # than starting a backfill of its own.
+        d = defer.ensureDeferred(self._get_messages())
+        self.pump()
+        self.assertFalse(d.called)
+        self.assertEqual(self.federation_handler.maybe_backfill.call_count, 2)
+
+        prefetch_deferred.callback(None)
+        self.get_success(d)
+
+        # the second request then triggers the next prefetch.
+        self.assertEqual(self.federation_handler.maybe_backfill.call_count, 4)
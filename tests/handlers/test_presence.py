@@ -29,6 +29,10 @@ from synapse.handlers.presence import (
     IDLE_TIMER,
     LAST_ACTIVE_GRANULARITY,
     SYNC_ONLINE_TIMEOUT,
+    PresenceHandler,
+    WorkerPresenceHandler,
+    get_interested_remotes,
+    get_next_timeout,
     handle_timeout,
     handle_update,
 )
@@ -36,6 +40,7 @@ from synapse.rest.client.v1 import room
 from synapse.types import UserID, get_domain_from_id
 
 from tests import unittest
+from tests.test_utils import make_awaitable
 
 
 class PresenceUpdateTestCase(unittest.TestCase):
@@ -413,6 +418,40 @@ class PresenceTimeoutTestCase(unittest.TestCase):
         self.assertIsNotNone(new_state)
         self.assertEquals(state, new_state)
 
+    def test_next_timeout(self):
+        """get_next_timeout should return the earliest time at which
+        handle_timeout would change the state.
+        """
+        user_id = "@foo:bar"
+        now = 5000000
+
+        state = UserPresenceState.default(user_id)
+        state = state.copy_and_replace(
+            state=PresenceState.ONLINE,
+            last_active_ts=now,
+            last_user_sync_ts=now,
+            last_federation_update_ts=now,
+            currently_active=True,
+        )
+
+        for is_mine, syncing_user_ids, expected in (
+            (True, set(), now + SYNC_ONLINE_TIMEOUT),
+            (True, {user_id}, now + LAST_ACTIVE_GRANULARITY),
+            (False, set(), now + FEDERATION_TIMEOUT),
+        ):
+            then = get_next_timeout(state, is_mine, user_id in syncing_user_ids)
+            self.assertEqual(then, expected)
+
+            self.assertIsNone(
+                handle_timeout(state, is_mine, syncing_user_ids, now=then)
+            )
+            self.assertIsNotNone(
+                handle_timeout(state, is_mine, syncing_user_ids, now=then + 1)
+            )
+
+        offline = state.copy_and_replace(state=PresenceState.OFFLINE)
+        self.assertIsNone(get_next_timeout(offline, is_mine=True, is_syncing=False))
+
 
 class PresenceHandlerTestCase(unittest.HomeserverTestCase):
     def prepare(self, reactor, clock, hs):
@@ -451,6 +490,201 @@ class PresenceHandlerTestCase(unittest.HomeserverTestCase):
         )
         self.assertEqual(state.state, PresenceState.OFFLINE)
 
+    def test_single_timer_per_user(self):
+        """Each user should only have a single timer, which is rescheduled
+        until their presence times out.
+        """
+        user_id = "@test:test"
+
+        self.get_success(
+            self.presence_handler.set_state(
+                UserID.from_string(user_id), {"presence": PresenceState.ONLINE}
+            )
+        )
+        self.assertEqual(len(self.presence_handler.wheel_timer), 1)
+
+        # without any syncs, the user should be timed out and then have no
+        # further timers.
+        self.reactor.advance(30)
+        for _ in range(SYNC_ONLINE_TIMEOUT // 5000 + 2):
+            self.reactor.advance(5)
+
+        state = self.get_success(
+            self.presence_handler.get_state(UserID.from_string(user_id))
+        )
+        self.assertEqual(state.state, PresenceState.OFFLINE)
+        self.assertEqual(len(self.presence_handler.wheel_timer), 0)
+
+
+class ShardedPresenceHandlerTestCase(unittest.HomeserverTestCase):
+    """Tests that presence writers only handle the users they're responsible
+    for, and proxy everything else to the right writer.
+    """
+
+    def default_config(self):
+        conf = super().default_config()
+        conf["stream_writers"] = {"presence": ["master", "presence1"]}
+        conf["instance_map"] = {"presence1": {"host": "testserv", "port": 1001}}
+        return conf
+
+    def prepare(self, reactor, clock, hs):
+        self.presence_handler = hs.get_presence_handler()
+        self.clock = hs.get_clock()
+
+        shard_config = hs.config.worker.presence_shard_config
+        self.local_user = self._find_user("test", shard_config, "master")
+        self.other_user = self._find_user("test", shard_config, "presence1")
+        self.remote_user = self._find_user("remote", shard_config, "master")
+        self.other_remote_user = self._find_user("remote", shard_config, "presence1")
+
+        self.presence_handler._set_state_client = Mock(return_value=make_awaitable({}))
+        self.presence_handler._send_edu_client = Mock(return_value=make_awaitable({}))
+        self.presence_handler.send_user_sync = Mock()
+
+    def _find_user(self, server_name, shard_config, instance_name):
+        """Find a user on the given server that is handled by the given writer.
+        """
+        for i in range(100):
+            user_id = "@user%d:%s" % (i, server_name)
+            if shard_config.get_instance(user_id) == instance_name:
+                return user_id
+        self.fail("No user handled by %s" % (instance_name,))
+
+    def test_handler(self):
+        self.assertIsInstance(self.presence_handler, PresenceHandler)
+
+    def test_set_state(self):
+        """Setting the presence of a user handled by another writer gets
+        proxied to it.
+        """
+        for user_id in (self.local_user, self.other_user):
+            self.get_success(
+                self.presence_handler.set_state(
+                    UserID.from_string(user_id), {"presence": PresenceState.ONLINE}
+                )
+            )
+
+        state = self.presence_handler.user_to_current_state[self.local_user]
+        self.assertEqual(state.state, PresenceState.ONLINE)
+        self.assertNotIn(self.other_user, self.presence_handler.user_to_current_state)
+
+        self.presence_handler._set_state_client.assert_called_once_with(
+            instance_name="presence1",
+            user_id=self.other_user,
+            state={"presence": PresenceState.ONLINE},
+            ignore_status_msg=False,
+        )
+
+        # Only the user we handle gets a timer.
+        self.assertEqual(len(self.presence_handler.wheel_timer), 1)
+
+    def test_incoming_presence(self):
+        """Presence from remote servers is only processed for the users this
+        writer handles, and the rest is forwarded.
+        """
+        self.get_success(
+            self.presence_handler.incoming_presence(
+                "remote",
+                {
+                    "push": [
+                        {"user_id": self.remote_user, "presence": "online"},
+                        {"user_id": self.other_remote_user, "presence": "online"},
+                    ]
+                },
+            )
+        )
+
+        state = self.presence_handler.user_to_current_state[self.remote_user]
+        self.assertEqual(state.state, PresenceState.ONLINE)
+        self.assertNotIn(
+            self.other_remote_user, self.presence_handler.user_to_current_state
+        )
+
+        self.presence_handler._send_edu_client.assert_called_once_with(
+            instance_name="presence1",
+            edu_type="m.presence",
+            origin="remote",
+            content={
+                "push": [{"user_id": self.other_remote_user, "presence": "online"}]
+            },
+        )
+
+    def test_user_syncing(self):
+        """Syncs for users handled by another writer are reported to it over
+        replication, rather than changing their presence here.
+        """
+        sync_context = self.get_success(
+            self.presence_handler.user_syncing(self.other_user, True)
+        )
+        with sync_context:
+            self.presence_handler.send_user_sync.assert_called_once_with(
+                self.other_user, True, self.clock.time_msec()
+            )
+            self.assertEqual(
+                self.presence_handler.get_currently_syncing_users_for_replication(),
+                [self.other_user],
+            )
+
+        self.assertNotIn(self.other_user, self.presence_handler.user_to_current_state)
+        self.assertEqual(
+            self.presence_handler.get_currently_syncing_users_for_replication(), []
+        )
+
+        # We wait a while before telling the writer they've stopped syncing.
+        self.presence_handler.send_user_sync.reset_mock()
+        self.reactor.advance(30)
+        self.presence_handler.send_user_sync.assert_called_once()
+        self.assertFalse(self.presence_handler.send_user_sync.call_args[0][1])
+
+    def test_external_syncs_for_other_writer_ignored(self):
+        """USER_SYNC commands about users handled by another writer are
+        ignored.
+        """
+        self.get_success(
+            self.presence_handler.update_external_syncs_row(
+                1, self.other_user, True, self.clock.time_msec()
+            )
+        )
+        self.assertNotIn(self.other_user, self.presence_handler.user_to_current_state)
+
+        self.get_success(
+            self.presence_handler.update_external_syncs_row(
+                1, self.local_user, True, self.clock.time_msec()
+            )
+        )
+        state = self.presence_handler.user_to_current_state[self.local_user]
+        self.assertEqual(state.state, PresenceState.ONLINE)
+
+
+class WorkerPresenceHandlerTestCase(unittest.HomeserverTestCase):
+    def default_config(self):
+        conf = super().default_config()
+        conf["stream_writers"] = {"presence": ["presence1"]}
+        conf["instance_map"] = {"presence1": {"host": "testserv", "port": 1001}}
+        return conf
+
+    def prepare(self, reactor, clock, hs):
+        self.presence_handler = hs.get_presence_handler()
+
+    def test_set_state_proxied(self):
+        """Processes which aren't presence writers proxy updates to the
+        writer.
+        """
+        self.assertIsInstance(self.presence_handler, WorkerPresenceHandler)
+
+        self.presence_handler._set_state_client = Mock(return_value=make_awaitable({}))
+        self.get_success(
+            self.presence_handler.set_state(
+                UserID.from_string("@test:test"), {"presence": PresenceState.ONLINE}
+            )
+        )
+        self.presence_handler._set_state_client.assert_called_once_with(
+            instance_name="presence1",
+            user_id="@test:test",
+            state={"presence": PresenceState.ONLINE},
+            ignore_status_msg=False,
+        )
+
 
 class PresenceJoinTestCase(unittest.HomeserverTestCase):
     """Tests remote servers get told about presence of users in the room when
@@ -588,6 +822,32 @@ class PresenceJoinTestCase(unittest.HomeserverTestCase):
             destinations={"server2", "server3"}, states=[expected_state]
         )
 
+    def test_get_interested_remotes(self):
+        """Each remote server should get each state once, however many rooms
+        it shares with the user."""
+        room_1 = self.helper.create_room_as(self.user_id)
+        room_2 = self.helper.create_room_as(self.user_id)
+        self._add_new_user(room_1, "@alice:server2")
+        self._add_new_user(room_2, "@alice:server2")
+        self._add_new_user(room_2, "@bob:server3")
+
+        state = UserPresenceState.default(self.user_id).copy_and_replace(
+            state=PresenceState.ONLINE
+        )
+        other_state = UserPresenceState.default("@test2:server")
+
+        states_by_destination = self.get_success(
+            get_interested_remotes(self.store, [state, other_state])
+        )
+        self.assertEqual(
+            states_by_destination,
+            {
+                "server": {self.user_id: state, "@test2:server": other_state},
+                "server2": {self.user_id: state},
+                "server3": {self.user_id: state},
+            },
+        )
+
     def _add_new_user(self, room_id, user_id):
         """Add new user to the room by creating an event and poking the federation API.
         """
@@ -21,6 +21,7 @@ from mock import ANY, Mock, call
 from twisted.internet import defer
 
 from synapse.api.errors import AuthError
+from synapse.handlers.typing import FEDERATION_BATCH_DELAY
 from synapse.types import UserID, create_requester
 
 from tests import unittest
@@ -39,10 +40,10 @@ U_ONION = UserID.from_string("@onion:farm")
 ROOM_ID = "a-room"
 
 
-def _expect_edu_transaction(edu_type, content, origin="test"):
+def _expect_edu_transaction(edu_type, content, origin="test", ts=1000000):
     return {
         "origin": origin,
-        "origin_server_ts": 1000000,
+        "origin_server_ts": ts,
         "pdus": [],
         "edus": [{"edu_type": edu_type, "content": content}],
     }
@@ -192,6 +193,9 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
             )
         )
 
+        # the update is sent once the batching window has passed
+        self.reactor.advance(FEDERATION_BATCH_DELAY / 1000)
+
         put_json = self.hs.get_http_client().put_json
         put_json.assert_called_once_with(
             "farm",
@@ -203,11 +207,13 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                     "user_id": U_APPLE.to_string(),
                     "typing": True,
                 },
+                ts=1000000 + FEDERATION_BATCH_DELAY,
             ),
             json_data_callback=ANY,
             long_retries=True,
             backoff_on_404=True,
             try_trailing_slash_on_400=True,
+            compress_body=False,
         )
 
     def test_started_typing_remote_recv(self):
@@ -270,6 +276,9 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
 
         self.on_new_event.assert_has_calls([call("typing_key", 1, rooms=[ROOM_ID])])
 
+        # the update is sent once the batching window has passed
+        self.reactor.advance(FEDERATION_BATCH_DELAY / 1000)
+
         put_json = self.hs.get_http_client().put_json
         put_json.assert_called_once_with(
             "farm",
@@ -281,11 +290,13 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                     "user_id": U_APPLE.to_string(),
                     "typing": False,
                 },
+                ts=1000000 + FEDERATION_BATCH_DELAY,
             ),
             json_data_callback=ANY,
             long_retries=True,
             backoff_on_404=True,
             try_trailing_slash_on_400=True,
+            compress_body=False,
         )
 
         self.assertEquals(self.event_source.get_current_key(), 1)
@@ -370,3 +381,91 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                 }
             ],
         )
+
+    @override_config({"send_federation": True})
+    def test_remote_updates_coalesced(self):
+        """Typing changes within the batching window should only result in the
+        latest state being sent.
+        """
+        self.room_members = [U_APPLE, U_ONION]
+
+        self.get_success(
+            self.handler.started_typing(
+                target_user=U_APPLE,
+                requester=create_requester(U_APPLE),
+                room_id=ROOM_ID,
+                timeout=20000,
+            )
+        )
+        self.get_success(
+            self.handler.stopped_typing(
+                target_user=U_APPLE,
+                requester=create_requester(U_APPLE),
+                room_id=ROOM_ID,
+            )
+        )
+
+        put_json = self.hs.get_http_client().put_json
+        put_json.assert_not_called()
+
+        self.reactor.advance(FEDERATION_BATCH_DELAY / 1000)
+
+        put_json.assert_called_once_with(
+            "farm",
+            path="/_matrix/federation/v1/send/1000000",
+            data=_expect_edu_transaction(
+                "m.typing",
+                content={
+                    "room_id": ROOM_ID,
+                    "user_id": U_APPLE.to_string(),
+                    "typing": False,
+                },
+                ts=1000000 + FEDERATION_BATCH_DELAY,
+            ),
+            json_data_callback=ANY,
+            long_retries=True,
+            backoff_on_404=True,
+            try_trailing_slash_on_400=True,
+            compress_body=False,
+        )
+
+    def test_typing_event_shared(self):
+        """The typing event for a room should be shared between syncs until
+        the room's typing changes.
+        """
+        self.room_members = [U_APPLE, U_BANANA]
+
+        self.get_success(
+            self.handler.started_typing(
+                target_user=U_APPLE,
+                requester=create_requester(U_APPLE),
+                room_id=ROOM_ID,
+                timeout=10000,
+            )
+        )
+
+        events1 = self.get_success(
+            self.event_source.get_new_events(room_ids=[ROOM_ID], from_key=0)
+        )
+        events2 = self.get_success(
+            self.event_source.get_new_events(room_ids=[ROOM_ID], from_key=0)
+        )
+        self.assertIs(events1[0][0], events2[0][0])
+
+        self.get_success(
+            self.handler.started_typing(
+                target_user=U_BANANA,
+                requester=create_requester(U_BANANA),
+                room_id=ROOM_ID,
+                timeout=10000,
+            )
+        )
+
+        events3 = self.get_success(
+            self.event_source.get_new_events(room_ids=[ROOM_ID], from_key=0)
+        )
+        self.assertIsNot(events1[0][0], events3[0][0])
+        self.assertEqual(
+            set(events3[0][0]["content"]["user_ids"]),
+            {U_APPLE.to_string(), U_BANANA.to_string()},
+        )
@@ -31,8 +31,14 @@ from twisted.web.http_headers import Headers
 from twisted.web.iweb import IPolicyForHTTPS
 
 from synapse.config.homeserver import HomeServerConfig
-from synapse.crypto.context_factory import FederationPolicyForHTTPS
-from synapse.http.federation.matrix_federation_agent import MatrixFederationAgent
+from synapse.crypto.context_factory import (
+    FederationPolicyForHTTPS,
+    tls_handshakes_counter,
+)
+from synapse.http.federation.matrix_federation_agent import (
+    MatrixFederationAgent,
+    connection_requests_counter,
+)
 from synapse.http.federation.srv_resolver import Server
 from synapse.http.federation.well_known_resolver import (
     WellKnownResolver,
@@ -274,6 +280,51 @@ class MatrixFederationAgentTests(unittest.TestCase):
         json = self.successResultOf(treq.json_content(response))
         self.assertEqual(json, {"a": 1})
 
+    def test_get_reuses_connection(self):
+        """
+        A second request to the same server should reuse the idle connection
+        left over from the first.
+        """
+        new_connections = connection_requests_counter.labels("new")._value.get()
+        reused_connections = connection_requests_counter.labels("reused")._value.get()
+        handshakes = tls_handshakes_counter._value.get()
+
+        self.reactor.lookups["testserv"] = "1.2.3.4"
+
+        for i in range(2):
+            test_d = self._make_get_request(b"matrix://testserv:8448/foo/bar")
+
+            if i == 0:
+                clients = self.reactor.tcpClients
+                self.assertEqual(len(clients), 1)
+                (_host, _port, client_factory, _timeout, _bindAddress) = clients[0]
+                http_server = self._make_connection(
+                    client_factory, expected_sni=b"testserv"
+                )
+            else:
+                # no new connection should have been made
+                self.assertEqual(len(self.reactor.tcpClients), 1)
+                self.reactor.pump((0.1,))
+
+            self.assertEqual(len(http_server.requests), 1)
+            request = http_server.requests[0]
+            request.write(b'{ "a": 1 }')
+            request.finish()
+            self.reactor.pump((0.1,))
+
+            response = self.successResultOf(test_d)
+            json = self.successResultOf(treq.json_content(response))
+            self.assertEqual(json, {"a": 1})
+
+        self.assertEqual(
+            connection_requests_counter.labels("new")._value.get(), new_connections + 1,
+        )
+        self.assertEqual(
+            connection_requests_counter.labels("reused")._value.get(),
+            reused_connections + 1,
+        )
+        self.assertEqual(tls_handshakes_counter._value.get(), handshakes + 1)
+
     def test_get_ip_address(self):
         """
         Test the behaviour when the server name contains an explicit IP (with no port)
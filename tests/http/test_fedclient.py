@@ -13,7 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mock import Mock
+import gzip
+
+from mock import Mock, patch
 
 from netaddr import IPSet
 from parameterized import parameterized
@@ -25,7 +27,8 @@ from twisted.test.proto_helpers import StringTransport
 from twisted.web.client import ResponseNeverReceived
 from twisted.web.http import HTTPChannel
 
-from synapse.api.errors import RequestSendFailed
+from synapse.api.errors import Codes, RequestSendFailed, SynapseError
+from synapse.http import matrixfederationclient
 from synapse.http.matrixfederationclient import (
     MatrixFederationHttpClient,
     MatrixFederationRequest,
@@ -561,3 +564,100 @@ class FederationClientTests(HomeserverTestCase):
 
         f = self.failureResultOf(test_d)
         self.assertIsInstance(f.value, ValueError)
+
+    def test_too_large_response(self):
+        """
+        Test what happens if a response is larger than the maximum size.
+        """
+        test_d = defer.ensureDeferred(
+            self.cl.put_json("testserv:8008", "foo/bar", data={}, max_response_size=10)
+        )
+
+        self.pump()
+
+        clients = self.reactor.tcpClients
+        self.assertEqual(len(clients), 1)
+        (_host, _port, factory, _timeout, _bindAddress) = clients[0]
+
+        # complete the connection and wire it up to a fake transport
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+
+        # Send it the HTTP response
+        res_json = b'{"a": "%s"}' % (b"x" * 20,)
+        protocol.dataReceived(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Server: Fake\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: %i\r\n"
+            b"\r\n"
+            b"%s" % (len(res_json), res_json)
+        )
+
+        self.pump()
+
+        f = self.failureResultOf(test_d)
+        self.assertIsInstance(f.value, SynapseError)
+        self.assertEqual(f.value.code, 502)
+        self.assertEqual(f.value.errcode, Codes.TOO_LARGE)
+
+        # the connection should have been dropped
+        self.assertTrue(transport.disconnecting)
+
+    def test_client_sends_compressed_body(self):
+        """
+        If requested, the client should gzip the request body.
+        """
+        defer.ensureDeferred(
+            self.cl.put_json(
+                "testserv:8008", "foo/bar", data={"a": "b"}, compress_body=True
+            )
+        )
+
+        self.pump()
+
+        clients = self.reactor.tcpClients
+        self.assertEqual(len(clients), 1)
+        client = clients[0][2].buildProtocol(None)
+        server = HTTPChannel()
+
+        client.makeConnection(FakeTransport(server, self.reactor))
+        server.makeConnection(FakeTransport(client, self.reactor))
+
+        self.pump(0.1)
+
+        self.assertEqual(len(server.requests), 1)
+        request = server.requests[0]
+        self.assertEqual(request.method, b"PUT")
+        self.assertEqual(
+            request.requestHeaders.getRawHeaders(b"Content-Encoding"), [b"gzip"]
+        )
+
+        content = gzip.decompress(request.content.read())
+        self.assertEqual(content, b'{"a":"b"}')
+
+    def test_client_compresses_body_once(self):
+        """
+        The request body should only be compressed once, however many times
+        the request is retried.
+        """
+        with patch.object(
+            matrixfederationclient.gzip, "compress", wraps=gzip.compress
+        ) as compress:
+            defer.ensureDeferred(
+                self.cl.put_json(
+                    "testserv:8008", "foo/bar", data={"a": "b"}, compress_body=True
+                )
+            )
+            self.pump()
+
+            clients = self.reactor.tcpClients
+            self.assertEqual(len(clients), 1)
+            clients[0][2].clientConnectionFailed(None, Exception("go away"))
+
+            # wait for the retry
+            self.pump(0.05)
+            self.assertEqual(len(clients), 2)
+
+        self.assertEqual(compress.call_count, 1)
@@ -12,11 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import gzip
 import json
+import zlib
 from io import BytesIO
 
 from mock import Mock
 
+from twisted.web.http_headers import Headers
+
 from synapse.api.errors import SynapseError
 from synapse.http.servlet import (
     parse_json_object_from_request,
@@ -26,14 +30,17 @@ from synapse.http.servlet import (
 from tests import unittest
 
 
-def make_request(content):
+def make_request(content, content_encoding=None):
     """Make an object that acts enough like a request."""
-    request = Mock(spec=["content"])
+    request = Mock(spec=["content", "requestHeaders"])
 
     if isinstance(content, dict):
         content = json.dumps(content).encode("utf8")
 
     request.content = BytesIO(content)
+    request.requestHeaders = Headers()
+    if content_encoding:
+        request.requestHeaders.addRawHeader(b"Content-Encoding", content_encoding)
     return request
 
 
@@ -78,3 +85,41 @@ class TestServletUtils(unittest.TestCase):
         # Test not an object
         with self.assertRaises(SynapseError):
             parse_json_object_from_request(make_request(b'["foo"]'))
+
+    def test_parse_compressed_json_object(self):
+        """Tests for parse_json_object_from_request with compressed bodies."""
+        obj = {"foo": 1}
+        body = json.dumps(obj).encode("utf8")
+
+        result = parse_json_object_from_request(
+            make_request(gzip.compress(body), b"gzip"), allow_compressed_body=True
+        )
+        self.assertEqual(result, obj)
+
+        result = parse_json_object_from_request(
+            make_request(zlib.compress(body), b"deflate"), allow_compressed_body=True
+        )
+        self.assertEqual(result, obj)
+
+        result = parse_json_object_from_request(
+            make_request(body, b"identity"), allow_compressed_body=True
+        )
+        self.assertEqual(result, obj)
+
+        # Compressed bodies are rejected unless explicitly allowed.
+        with self.assertRaises(SynapseError):
+            parse_json_object_from_request(make_request(gzip.compress(body), b"gzip"))
+
+        # Invalid compressed data.
+        with self.assertRaises(SynapseError) as cm:
+            parse_json_object_from_request(
+                make_request(body, b"gzip"), allow_compressed_body=True
+            )
+        self.assertEqual(cm.exception.code, 400)
+
+        # Unknown encodings.
+        with self.assertRaises(SynapseError) as cm:
+            parse_json_object_from_request(
+                make_request(body, b"br"), allow_compressed_body=True
+            )
+        self.assertEqual(cm.exception.code, 415)
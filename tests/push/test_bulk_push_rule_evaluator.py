@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.api.room_versions import RoomVersions
+from synapse.events import FrozenEvent
+from synapse.push.baserules import list_with_base_rules
+from synapse.push.bulk_push_rule_evaluator import (
+    _CompiledRulesEvaluator,
+    _get_compiled_push_rules,
+)
+from synapse.push.push_rule_evaluator import PushRuleEvaluatorForEvent
+
+from tests import unittest
+
+
+class CompiledRulesEvaluatorTestCase(unittest.TestCase):
+    def _get_evaluator(self, content):
+        event = FrozenEvent(
+            {
+                "event_id": "$event_id",
+                "type": "m.room.message",
+                "sender": "@sender:test",
+                "room_id": "!room:test",
+                "content": content,
+            },
+            RoomVersions.V1,
+        )
+        return _CompiledRulesEvaluator(PushRuleEvaluatorForEvent(event, 10, 0, {}))
+
+    def test_identical_rules_are_shared(self):
+        """Users with equal push rules should share the compiled rules."""
+        compiled1 = _get_compiled_push_rules(list_with_base_rules([]))
+        compiled2 = _get_compiled_push_rules(list_with_base_rules([]))
+        self.assertIs(compiled1, compiled2)
+
+        disabled = list_with_base_rules([])
+        disabled[-1] = dict(disabled[-1], enabled=False)
+        self.assertIsNot(_get_compiled_push_rules(disabled), compiled1)
+
+    def test_plain_message(self):
+        evaluator = self._get_evaluator({"msgtype": "m.text", "body": "hello"})
+
+        for user_id in ("@alice:test", "@bob:test"):
+            actions = evaluator.actions_for_user(
+                list_with_base_rules([]), user_id, "Alice"
+            )
+            self.assertEqual(
+                actions, ["notify", {"set_tweak": "highlight", "value": False}]
+            )
+
+    def test_user_specific_conditions(self):
+        """Mentions of the user's localpart or display name should highlight
+        only that user."""
+        evaluator = self._get_evaluator({"msgtype": "m.text", "body": "hi alice"})
+
+        actions = evaluator.actions_for_user(
+            list_with_base_rules([]), "@alice:test", None
+        )
+        self.assertIn({"set_tweak": "highlight"}, actions)
+
+        actions = evaluator.actions_for_user(
+            list_with_base_rules([]), "@bob:test", "Alice"
+        )
+        self.assertIn({"set_tweak": "highlight"}, actions)
+
+        actions = evaluator.actions_for_user(
+            list_with_base_rules([]), "@bob:test", "Bob"
+        )
+        self.assertEqual(
+            actions, ["notify", {"set_tweak": "highlight", "value": False}]
+        )
+
+    def test_notice(self):
+        """The suppress_notices rule should stop anyone being notified."""
+        evaluator = self._get_evaluator({"msgtype": "m.notice", "body": "hi alice"})
+
+        actions = evaluator.actions_for_user(
+            list_with_base_rules([]), "@alice:test", "Alice"
+        )
+        self.assertIsNone(actions)
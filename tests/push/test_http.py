@@ -21,7 +21,7 @@ import synapse.rest.admin
 from synapse.logging.context import make_deferred_yieldable
 from synapse.rest.client.v1 import login, room
 
-from tests.unittest import HomeserverTestCase
+from tests.unittest import HomeserverTestCase, override_config
 
 
 class HTTPPusherTests(HomeserverTestCase):
@@ -48,7 +48,7 @@ class HTTPPusherTests(HomeserverTestCase):
         config = self.default_config()
         config["start_pushers"] = True
 
-        hs = self.setup_test_homeserver(config=config, proxied_http_client=m)
+        hs = self.setup_test_homeserver(config=config, push_http_client=m)
 
         return hs
 
@@ -499,3 +499,173 @@ class HTTPPusherTests(HomeserverTestCase):
 
         # check that this is low-priority
         self.assertEqual(self.push_attempts[1][2]["notification"]["prio"], "low")
+
+    @override_config({"push": {"gateway_batch_delay_ms": 10}})
+    def test_batches_devices(self):
+        """
+        With batching enabled, the same notification for several of a user's
+        pushers on one gateway is sent as a single request.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        user_tuple = self.get_success(
+            self.hs.get_datastore().get_user_by_access_token(access_token)
+        )
+        token_id = user_tuple.token_id
+
+        for pushkey in ("a@example.com", "b@example.com"):
+            self.get_success(
+                self.hs.get_pusherpool().add_pusher(
+                    user_id=user_id,
+                    access_token=token_id,
+                    kind="http",
+                    app_id="m.http",
+                    app_display_name="HTTP Push Notifications",
+                    device_display_name="pushy push",
+                    pushkey=pushkey,
+                    lang=None,
+                    data={"url": "example.com"},
+                )
+            )
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+
+        # Advance past the batching window
+        self.pump(0.1)
+
+        # Both devices were sent in one request
+        self.assertEqual(len(self.push_attempts), 1)
+        self.assertEqual(self.push_attempts[0][1], "example.com")
+        devices = self.push_attempts[0][2]["notification"]["devices"]
+        self.assertCountEqual(
+            [d["pushkey"] for d in devices], ["a@example.com", "b@example.com"]
+        )
+
+        # Rejecting one of the pushkeys removes just that pusher
+        self.push_attempts[0][0].callback({"rejected": ["b@example.com"]})
+        self.pump()
+
+        pushers = self.get_success(
+            self.hs.get_datastore().get_pushers_by({"user_name": user_id})
+        )
+        self.assertEqual([p["pushkey"] for p in pushers], ["a@example.com"])
+
+    def test_uses_prefetched_push_actions(self):
+        """
+        Pushers which are caught up are handed their push actions by the pusher
+        pool, rather than querying for them individually, and report a backlog
+        until the push is sent.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        user_tuple = self.get_success(
+            self.hs.get_datastore().get_user_by_access_token(access_token)
+        )
+        token_id = user_tuple.token_id
+
+        self.get_success(
+            self.hs.get_pusherpool().add_pusher(
+                user_id=user_id,
+                access_token=token_id,
+                kind="http",
+                app_id="m.http",
+                app_display_name="HTTP Push Notifications",
+                device_display_name="pushy push",
+                pushkey="a@example.com",
+                lang=None,
+                data={"url": "example.com"},
+            )
+        )
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+
+        # The first push is fetched by the pusher itself, after which it has
+        # caught up.
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+        self.pump()
+        self.assertEqual(len(self.push_attempts), 1)
+        self.push_attempts[0][0].callback({})
+        self.pump()
+
+        store = self.hs.get_datastore()
+        single_user_fetch = Mock(
+            side_effect=store.get_unread_push_actions_for_user_in_range_for_http
+        )
+        store.get_unread_push_actions_for_user_in_range_for_http = single_user_fetch
+
+        self.helper.send(room, body="There!", tok=other_access_token)
+        self.pump()
+
+        self.assertEqual(len(self.push_attempts), 2)
+        self.assertEqual(
+            self.push_attempts[1][2]["notification"]["content"]["body"], "There!"
+        )
+        single_user_fetch.assert_not_called()
+
+        # The push hasn't been sent yet, so there is a backlog
+        self.reactor.advance(10)
+        pusher_pool = self.hs.get_pusherpool()
+        ages = pusher_pool._get_backlog_ages()
+        self.assertGreaterEqual(ages[("http", "m.http")], 10)
+
+        self.push_attempts[1][0].callback({})
+        self.pump()
+
+        ages = pusher_pool._get_backlog_ages()
+        self.assertEqual(ages[("http", "m.http")], 0)
+
+    @override_config({"push": {"processing_lanes": 1}})
+    def test_slow_push_gateway_does_not_block_other_pushers(self):
+        """
+        A pusher waiting on its push gateway doesn't hold a processing lane, so
+        other pushers can still send their notifications.
+        """
+        room_creator_id = self.register_user("creator", "pass")
+        creator_access_token = self.login("creator", "pass")
+        room = self.helper.create_room_as(room_creator_id, tok=creator_access_token)
+
+        store = self.hs.get_datastore()
+        for localpart in ("user", "otheruser"):
+            user_id = self.register_user(localpart, "pass")
+            access_token = self.login(localpart, "pass")
+            self.helper.join(room=room, user=user_id, tok=access_token)
+
+            user_tuple = self.get_success(store.get_user_by_access_token(access_token))
+            self.get_success(
+                self.hs.get_pusherpool().add_pusher(
+                    user_id=user_id,
+                    access_token=user_tuple.token_id,
+                    kind="http",
+                    app_id="m.http",
+                    app_display_name="HTTP Push Notifications",
+                    device_display_name="pushy push",
+                    pushkey="%s@example.com" % (localpart,),
+                    lang=None,
+                    data={"url": "example.com"},
+                )
+            )
+
+        self.helper.send(room, body="Hi!", tok=creator_access_token)
+        self.pump()
+
+        # Neither push has been answered, but both pushers got as far as
+        # talking to the push gateway.
+        self.assertEqual(len(self.push_attempts), 2)
+        self.assertEqual(
+            {
+                attempt[2]["notification"]["devices"][0]["pushkey"]
+                for attempt in self.push_attempts
+            },
+            {"user@example.com", "otheruser@example.com"},
+        )
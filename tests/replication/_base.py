@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import Any, Callable, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 import attr
 
@@ -560,25 +560,33 @@ class FakeRedisPubSubServer:
     """
 
     def __init__(self):
-        self._subscribers = set()
+        # map from channel to the connections subscribed to it
+        self._subscribers_by_channel = {}  # type: Dict[bytes, Set[Protocol]]
 
-    def add_subscriber(self, conn):
+        # a record of all the published (channel, message) pairs
+        self.published = []  # type: List[Tuple[bytes, bytes]]
+
+    def add_subscriber(self, conn, channel):
         """A connection has called SUBSCRIBE
         """
-        self._subscribers.add(conn)
+        self._subscribers_by_channel.setdefault(channel, set()).add(conn)
 
     def remove_subscriber(self, conn):
         """A connection has called UNSUBSCRIBE
         """
-        self._subscribers.discard(conn)
+        for subscribers in self._subscribers_by_channel.values():
+            subscribers.discard(conn)
 
     def publish(self, conn, channel, msg) -> int:
         """A connection want to publish a message to subscribers.
         """
-        for sub in self._subscribers:
+        self.published.append((channel, msg))
+
+        subscribers = self._subscribers_by_channel.get(channel, set())
+        for sub in subscribers:
             sub.send(["message", channel, msg])
 
-        return len(self._subscribers)
+        return len(subscribers)
 
     def buildProtocol(self, addr):
         return FakeRedisPubSubProtocol(self)
@@ -619,9 +627,9 @@ class FakeRedisPubSubProtocol(Protocol):
             num_subscribers = self._server.publish(self, channel, message)
             self.send(num_subscribers)
         elif command == b"SUBSCRIBE":
-            (channel,) = args
-            self._server.add_subscriber(self)
-            self.send(["subscribe", channel, 1])
+            for num, channel in enumerate(args, start=1):
+                self._server.add_subscriber(self, channel)
+                self.send(["subscribe", channel, num])
         else:
             raise Exception("Unknown command")
 
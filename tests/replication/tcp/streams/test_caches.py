@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from mock import Mock
+
+from synapse.replication.tcp.resource import _batch_updates
+from synapse.replication.tcp.streams import CachesStream
+from synapse.storage.databases.main.cache import CURRENT_STATE_CACHE_NAME
+
+from tests.unittest import HomeserverTestCase, TestCase
+
+
+class BatchUpdatesTestCase(TestCase):
+    def test_batch_updates(self):
+        updates = [(1, "a"), (1, "b"), (2, "c"), (3, "d"), (3, "e")]
+
+        self.assertEqual(
+            _batch_updates(updates), [(1, ["a", "b"]), (2, ["c"]), (3, ["d", "e"])]
+        )
+        self.assertEqual(
+            _batch_updates(updates, across_tokens=True),
+            [(3, ["a", "b", "c", "d", "e"])],
+        )
+        self.assertEqual(_batch_updates([]), [])
+
+
+class CachesStreamRowsTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.store._attempt_to_invalidate_cache = Mock()
+        self.store._invalidate_state_caches = Mock()
+
+    def test_duplicate_invalidations_are_coalesced(self):
+        Row = CachesStream.CachesStreamRow
+        rows = [
+            Row("get_user_by_id", ["@a:test"], 0),
+            Row("get_user_by_id", ["@a:test"], 0),
+            Row("get_user_by_id", ["@b:test"], 0),
+            Row("get_user_by_id", ["@a:test"], 0),
+            Row(CURRENT_STATE_CACHE_NAME, ["!room:test", "@a:test"], 0),
+            Row(CURRENT_STATE_CACHE_NAME, ["!room:test", "@b:test"], 0),
+        ]
+
+        self.store.process_replication_rows("caches", "master", 10, rows)
+
+        self.assertCountEqual(
+            [c[0] for c in self.store._attempt_to_invalidate_cache.call_args_list],
+            [("get_user_by_id", ["@a:test"]), ("get_user_by_id", ["@b:test"])],
+        )
+        self.store._invalidate_state_caches.assert_called_once_with(
+            "!room:test", {"@a:test", "@b:test"}
+        )
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from synapse.replication.tcp.commands import (
+    RdataBatchCommand,
     RdataCommand,
     ReplicateCommand,
     parse_command_from_line,
@@ -42,3 +43,24 @@ class ParseCommandTestCase(TestCase):
         self.assertEqual(cmd.stream_name, "presence")
         self.assertEqual(cmd.instance_name, "master")
         self.assertIsNone(cmd.token)
+
+    def test_encode_round_trip(self):
+        line = 'RDATA presence master 59 ["@foo:example.com","online"]'
+        cmd = parse_command_from_line(line)
+        self.assertEqual(cmd.encode(), line.encode("utf-8"))
+
+    def test_encode_is_cached(self):
+        cmd = RdataCommand("presence", "master", 59, ["@foo:example.com", "online"])
+        encoded = cmd.encode()
+        self.assertIs(cmd.encode(), encoded)
+
+    def test_parse_rdata_batch_command(self):
+        line = (
+            'RDATA_BATCH caches master 73 [["get_user_by_id", ["@foo:example.com"], 1]]'
+        )
+        cmd = parse_command_from_line(line)
+        assert isinstance(cmd, RdataBatchCommand)
+        self.assertEqual(cmd.stream_name, "caches")
+        self.assertEqual(cmd.instance_name, "master")
+        self.assertEqual(cmd.token, 73)
+        self.assertEqual(cmd.rows, [["get_user_by_id", ["@foo:example.com"], 1]])
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from twisted.internet import defer
+
+from synapse.replication.tcp.handler import _get_next_catchup_page_size
+from synapse.replication.tcp.streams._base import (
+    _STREAM_UPDATE_MAX_ROW_COUNT,
+    _STREAM_UPDATE_TARGET_ROW_COUNT,
+    AccountDataStream,
+)
+
+from tests import unittest
+from tests.replication._base import BaseMultiWorkerStreamTestCase, BaseStreamTestCase
+
+
+class _CatchupTestBase(BaseStreamTestCase):
+    def _add_account_data(self, count):
+        store = self.hs.get_datastore()
+        for i in range(count):
+            self.get_success(
+                store.add_account_data_for_user("test_user", "m.test.%i" % (i,), {})
+            )
+
+        # tell the notifier to catch up to avoid duplicate rows.
+        self.replicate()
+
+    def _wrap_get_updates_since(self, stream):
+        """Record the page sizes requested from the stream, and allow each
+        request to be blocked.
+        """
+        calls = []
+        orig_get_updates_since = stream.get_updates_since
+
+        async def get_updates_since(instance_name, from_token, upto_token, limit):
+            calls.append(limit)
+            await self.block_fetches
+            return await orig_get_updates_since(
+                instance_name, from_token, upto_token, limit
+            )
+
+        stream.get_updates_since = get_updates_since
+        return calls
+
+
+class CatchupTestCase(_CatchupTestBase):
+    def test_adaptive_page_size(self):
+        """Catching up should fetch increasingly large pages of updates when
+        they are quick to fetch.
+        """
+        self._add_account_data(3 * _STREAM_UPDATE_TARGET_ROW_COUNT + 5)
+
+        self.block_fetches = defer.succeed(None)
+        handler = self.client.command_handler
+        calls = self._wrap_get_updates_since(
+            handler.get_streams()[AccountDataStream.NAME]
+        )
+
+        self.reconnect()
+        self.replicate()
+
+        self.assertEqual(
+            calls,
+            [
+                _STREAM_UPDATE_TARGET_ROW_COUNT,
+                2 * _STREAM_UPDATE_TARGET_ROW_COUNT,
+                4 * _STREAM_UPDATE_TARGET_ROW_COUNT,
+            ],
+        )
+        self.assertEqual(
+            len(self.test_handler.received_rdata_rows),
+            3 * _STREAM_UPDATE_TARGET_ROW_COUNT + 5,
+        )
+
+    def test_not_ready_while_catching_up(self):
+        handler = self.client.command_handler
+        self.assertFalse(handler.is_ready())
+
+        self._add_account_data(5)
+
+        self.block_fetches = defer.Deferred()
+        self._wrap_get_updates_since(handler.get_streams()[AccountDataStream.NAME])
+
+        self.reconnect()
+        self.replicate()
+
+        self.assertFalse(handler.is_ready())
+
+        self.block_fetches.callback(None)
+        self.replicate()
+
+        self.assertTrue(handler.is_ready())
+        self.assertEqual(len(self.test_handler.received_rdata_rows), 5)
+
+    def test_not_ready_when_disconnected(self):
+        handler = self.client.command_handler
+
+        self.reconnect()
+        self.replicate()
+        self.assertTrue(handler.is_ready())
+
+        self.disconnect()
+        self.assertFalse(handler.is_ready())
+
+
+class ReadinessStreamsTestCase(_CatchupTestBase):
+    def _get_worker_hs_config(self) -> dict:
+        config = super()._get_worker_hs_config()
+        config["worker_readiness_streams"] = ["events"]
+        return config
+
+    def test_readiness_streams(self):
+        """Only the configured streams should affect readiness.
+        """
+        handler = self.client.command_handler
+
+        self._add_account_data(5)
+
+        self.block_fetches = defer.Deferred()
+        self._wrap_get_updates_since(handler.get_streams()[AccountDataStream.NAME])
+
+        self.reconnect()
+        self.replicate()
+
+        self.assertTrue(handler.is_ready())
+        self.assertEqual(self.test_handler.received_rdata_rows, [])
+
+        self.block_fetches.callback(None)
+        self.replicate()
+
+        self.assertEqual(len(self.test_handler.received_rdata_rows), 5)
+
+
+class StreamsToSubscribeTestCase(BaseMultiWorkerStreamTestCase):
+    def _get_streams_to_subscribe(self, worker_app, extra_config={}):
+        worker_hs = self.make_worker_hs(worker_app, extra_config)
+        return worker_hs.get_tcp_replication().get_streams_to_subscribe()
+
+    def test_master(self):
+        """The master subscribes to everything but the federation stream."""
+        streams = self.hs.get_tcp_replication().get_streams_to_subscribe()
+        self.assertIn("typing", streams)
+        self.assertIn("presence", streams)
+        self.assertNotIn("federation", streams)
+
+    def test_generic_worker(self):
+        """Generic workers may serve /sync, so need every stream other than the
+        federation stream.
+        """
+        streams = self._get_streams_to_subscribe("synapse.app.generic_worker")
+        self.assertIn("typing", streams)
+        self.assertIn("to_device", streams)
+        self.assertNotIn("federation", streams)
+
+    def test_media_repository(self):
+        streams = self._get_streams_to_subscribe("synapse.app.media_repository")
+        self.assertEqual(streams, {"caches"})
+
+    def test_pusher(self):
+        streams = self._get_streams_to_subscribe(
+            "synapse.app.pusher", {"start_pushers": True}
+        )
+        self.assertEqual(
+            streams, {"caches", "events", "backfill", "receipts", "pushers"}
+        )
+
+    def test_federation_sender(self):
+        streams = self._get_streams_to_subscribe(
+            "synapse.app.federation_sender", {"send_federation": True}
+        )
+        self.assertIn("federation", streams)
+        self.assertIn("device_lists", streams)
+        self.assertNotIn("typing", streams)
+        self.assertNotIn("pushers", streams)
+
+    def test_writer(self):
+        """Workers subscribe to the streams they write to."""
+        streams = self._get_streams_to_subscribe(
+            "synapse.app.user_dir",
+            {
+                "worker_name": "worker1",
+                "instance_map": {"worker1": {"host": "testserv", "port": 1001}},
+                "stream_writers": {"typing": "worker1"},
+            },
+        )
+        self.assertEqual(streams, {"caches", "events", "backfill", "typing"})
+
+
+class PageSizeTestCase(unittest.TestCase):
+    def test_page_size(self):
+        # quick fetches grow the page size, up to the maximum
+        self.assertEqual(_get_next_catchup_page_size(100, 0.01), 200)
+        self.assertEqual(
+            _get_next_catchup_page_size(_STREAM_UPDATE_MAX_ROW_COUNT, 0.01),
+            _STREAM_UPDATE_MAX_ROW_COUNT,
+        )
+
+        # slow fetches shrink it, down to the default
+        self.assertEqual(_get_next_catchup_page_size(1000, 10), 500)
+        self.assertEqual(
+            _get_next_catchup_page_size(_STREAM_UPDATE_TARGET_ROW_COUNT, 10),
+            _STREAM_UPDATE_TARGET_ROW_COUNT,
+        )
+
+        self.assertEqual(_get_next_catchup_page_size(1000, 0.4), 1000)
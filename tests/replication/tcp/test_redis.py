@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.replication.tcp.commands import PositionCommand, UserSyncCommand
+from synapse.replication.tcp.redis import RedisSubscriber, get_channel_for_stream
+
+from tests import unittest
+
+
+class RedisSubscriberTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.outbound = Mock()
+        self.outbound.publish.return_value = defer.succeed(1)
+
+        self.subscriber = RedisSubscriber()
+        self.subscriber.handler = Mock()
+        self.subscriber.stream_name = "test"
+        self.subscriber.subscribed_streams = {"events", "typing"}
+        self.subscriber.outbound_redis_connection = self.outbound
+        self.subscriber.clock = clock
+
+    def test_subscribe_channels(self):
+        """We should subscribe to the main channel and one per stream.
+        """
+        self.subscriber.subscribe = Mock(return_value=defer.succeed(None))
+        self.subscriber.handler.send_positions_to_connection = Mock()
+
+        self.get_success(self.subscriber._send_subscribe())
+
+        self.subscriber.subscribe.assert_called_once_with(
+            ["test", "test/events", "test/typing"]
+        )
+        self.subscriber.handler.new_connection.assert_called_once_with(self.subscriber)
+
+        # the REPLICATE goes out once the subscription has completed
+        self.reactor.advance(0)
+        self.outbound.publish.assert_called_once_with("test", b"REPLICATE ")
+
+    def test_pipelined_commands(self):
+        """Commands sent in the same reactor tick should be published together,
+        with stream commands going to the stream's channel.
+        """
+        self.subscriber.send_command(PositionCommand("events", "master", 1, 2))
+        self.subscriber.send_command(PositionCommand("events", "master", 2, 3))
+        self.subscriber.send_command(
+            UserSyncCommand("master", "@user:test", True, 1000)
+        )
+        self.subscriber.send_command(PositionCommand("events", "master", 3, 4))
+
+        # nothing is published until the reactor gets a chance to run
+        self.outbound.publish.assert_not_called()
+
+        self.reactor.advance(0)
+
+        self.assertEqual(
+            [c[0] for c in self.outbound.publish.call_args_list],
+            [
+                (
+                    "test/events",
+                    b"POSITION events master 1 2\nPOSITION events master 2 3",
+                ),
+                ("test", b"USER_SYNC master @user:test start 1000"),
+                ("test/events", b"POSITION events master 3 4"),
+            ],
+        )
+
+    def test_multiple_commands_received(self):
+        """A message containing several commands should have each dispatched.
+        """
+        self.subscriber.messageReceived(
+            None,
+            "test/events",
+            "POSITION events master 1 2\nPOSITION events master 2 3",
+        )
+
+        calls = self.subscriber.handler.on_POSITION.call_args_list
+        self.assertEqual([c[0][1].new_token for c in calls], [2, 3])
+
+    def test_channel_names(self):
+        self.assertEqual(get_channel_for_stream("test", "events"), "test/events")
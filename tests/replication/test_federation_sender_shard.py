@@ -18,6 +18,7 @@ from mock import Mock
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.events.builder import EventBuilderFactory
+from synapse.handlers.typing import FEDERATION_BATCH_DELAY
 from synapse.rest.admin import register_servlets_for_client_rest_resource
 from synapse.rest.client.v1 import login, room
 from synapse.types import UserID, create_requester
@@ -183,6 +184,9 @@ class FederationSenderTestCase(BaseMultiWorkerStreamTestCase):
 
             self.replicate()
 
+            # wait for the typing batching window to pass
+            self.reactor.advance(FEDERATION_BATCH_DELAY / 1000)
+
             if mock_client1.put_json.called:
                 sent_on_1 = True
                 mock_client2.put_json.assert_not_called()
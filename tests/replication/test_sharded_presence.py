@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+
+from synapse.api.presence import PresenceState
+from synapse.types import UserID
+
+from tests.replication._base import BaseMultiWorkerStreamTestCase
+from tests.utils import USE_POSTGRES_FOR_TESTS
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceWriterShardTestCase(BaseMultiWorkerStreamTestCase):
+    """Checks presence writer sharding works
+    """
+
+    # Presence writer sharding requires postgres (due to needing
+    # `MultiWriterIdGenerator`).
+    if not USE_POSTGRES_FOR_TESTS:
+        skip = "Requires Postgres"
+
+    def default_config(self):
+        conf = super().default_config()
+        conf["redis"] = {"enabled": "true"}
+        conf["stream_writers"] = {"presence": ["worker1", "worker2"]}
+        conf["instance_map"] = {
+            "worker1": {"host": "testserv", "port": 1001},
+            "worker2": {"host": "testserv", "port": 1002},
+        }
+        return conf
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        shard_config = hs.config.worker.presence_shard_config
+        self.user_id1 = self._find_user(shard_config, "worker1")
+        self.user_id2 = self._find_user(shard_config, "worker2")
+
+    def _make_writers(self):
+        self.worker_hs1 = self.make_worker_hs(
+            "synapse.app.generic_worker", {"worker_name": "worker1"},
+        )
+        self.worker_hs2 = self.make_worker_hs(
+            "synapse.app.generic_worker", {"worker_name": "worker2"},
+        )
+
+    def _find_user(self, shard_config, instance_name):
+        """Find a local user that is handled by the given writer.
+        """
+        for i in range(100):
+            user_id = "@user%d:test" % (i,)
+            if shard_config.get_instance(user_id) == instance_name:
+                return user_id
+        self.fail("No user handled by %s" % (instance_name,))
+
+    def test_set_state(self):
+        """Presence changes are persisted by the writer for the user, even when
+        made on the other writer, and are replicated to everyone else.
+        """
+        self._make_writers()
+
+        handler1 = self.worker_hs1.get_presence_handler()
+        for user_id in (self.user_id1, self.user_id2):
+            # The change for the second user is sent to worker2 over HTTP
+            # replication, which needs the reactor to be pumped.
+            self.get_success(
+                handler1.set_state(
+                    UserID.from_string(user_id), {"presence": PresenceState.ONLINE}
+                ),
+                by=0.1,
+            )
+        self.replicate()
+
+        # Each row was written by the writer responsible for the user.
+        rows = self.get_success(
+            self.store.db_pool.simple_select_list(
+                table="presence_stream",
+                keyvalues=None,
+                retcols=("user_id", "instance_name"),
+            )
+        )
+        self.assertEqual(
+            {(row["user_id"], row["instance_name"]) for row in rows},
+            {(self.user_id1, "worker1"), (self.user_id2, "worker2")},
+        )
+
+        # Both writers have advanced their position in the stream, and the
+        # master has seen both positions.
+        id_gen = self.store._presence_id_gen
+        for worker_hs, instance_name in (
+            (self.worker_hs1, "worker1"),
+            (self.worker_hs2, "worker2"),
+        ):
+            worker_id_gen = worker_hs.get_datastore()._presence_id_gen
+            self.assertEqual(
+                id_gen.get_current_token_for_writer(instance_name),
+                worker_id_gen.get_current_token_for_writer(instance_name),
+            )
+
+        # Every process sees both users as online.
+        for hs in (self.hs, self.worker_hs1, self.worker_hs2):
+            states = self.get_success(
+                hs.get_presence_handler().current_state_for_users(
+                    [self.user_id1, self.user_id2]
+                )
+            )
+            for user_id in (self.user_id1, self.user_id2):
+                self.assertEqual(states[user_id].state, PresenceState.ONLINE)
+
+    def test_replication_catch_up(self):
+        """A process which connects after presence was written catches up with
+        both writers.
+        """
+        self._make_writers()
+
+        for worker_hs, user_id in (
+            (self.worker_hs1, self.user_id1),
+            (self.worker_hs2, self.user_id2),
+        ):
+            self.get_success(
+                worker_hs.get_presence_handler().set_state(
+                    UserID.from_string(user_id), {"presence": PresenceState.ONLINE}
+                )
+            )
+        self.replicate()
+
+        reader_hs = self.make_worker_hs(
+            "synapse.app.generic_worker", {"worker_name": "reader"},
+        )
+        self.replicate()
+
+        reader_store = reader_hs.get_datastore()
+        for instance_name in ("worker1", "worker2"):
+            self.assertEqual(
+                reader_store._presence_id_gen.get_current_token_for_writer(
+                    instance_name
+                ),
+                self.store._presence_id_gen.get_current_token_for_writer(instance_name),
+            )
+
+        states = self.get_success(
+            reader_store.get_presence_for_users([self.user_id1, self.user_id2])
+        )
+        for user_id in (self.user_id1, self.user_id2):
+            self.assertEqual(states[user_id].state, PresenceState.ONLINE)
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 
-from synapse.rest.health import HealthResource
+from synapse.rest.health import HealthResource, ReadinessResource
 
 from tests import unittest
 
@@ -29,3 +29,18 @@ class HealthCheckTests(unittest.HomeserverTestCase):
 
         self.assertEqual(request.code, 200)
         self.assertEqual(channel.result["body"], b"OK")
+
+
+class ReadinessCheckTests(unittest.HomeserverTestCase):
+    def create_test_resource(self):
+        self.ready = False
+        return ReadinessResource(lambda: self.ready)
+
+    def test_ready(self):
+        request, channel = self.make_request("GET", "/ready", shorthand=False)
+        self.assertEqual(request.code, 503)
+
+        self.ready = True
+        request, channel = self.make_request("GET", "/ready", shorthand=False)
+        self.assertEqual(request.code, 200)
+        self.assertEqual(channel.result["body"], b"OK")
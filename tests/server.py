@@ -426,6 +426,9 @@ def setup_test_homeserver(cleanup_func, *args, **kwargs):
     # thread, so we need to disable the dedicated thread behaviour.
     server.get_datastores().main.USE_DEDICATED_DB_THREADS_FOR_EVENT_FETCHING = False
 
+    # Likewise, encode large responses on the reactor thread.
+    server.response_encoding_threadpool = ThreadPool(clock._reactor)
+
     return server
 
 
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+
+USER_ID = "@user:test"
+
+
+class DeviceInboxStoreTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        for device_id in ("d1", "d2", "d3"):
+            self.get_success(self.store.store_device(USER_ID, device_id, None))
+
+    def _send(self, messages_by_device):
+        self.get_success(
+            self.store.add_messages_to_device_inbox({USER_ID: messages_by_device}, {})
+        )
+        return self.store.get_to_device_stream_token()
+
+    def _count_messages(self):
+        return self.get_success(
+            self.store.db_pool.simple_select_one_onecol(
+                "device_inbox", {"user_id": USER_ID}, "COUNT(*)"
+            )
+        )
+
+    def test_get_and_delete_for_devices(self):
+        start = self.store.get_to_device_stream_token()
+        self._send({"d1": {"n": 1}, "d2": {"n": 2}})
+        now = self._send({"d1": {"n": 3}})
+
+        results = self.get_success(
+            self.store.get_new_messages_for_devices(
+                USER_ID, {d: (start, now) for d in ("d1", "d2", "d3")}
+            )
+        )
+        self.assertEqual(
+            results,
+            {
+                "d1": ([{"n": 1}, {"n": 3}], now),
+                "d2": ([{"n": 2}], now),
+                "d3": ([], now),
+            },
+        )
+
+        deleted = self.get_success(
+            self.store.delete_messages_for_devices(USER_ID, {"d1": now, "d2": now})
+        )
+        self.assertEqual(deleted, 3)
+        self.assertEqual(self._count_messages(), 0)
+
+    def test_idle_devices_skip_database(self):
+        start = self.store.get_to_device_stream_token()
+        now = self._send({"d1": {"n": 1}})
+
+        # d2 hasn't been sent anything, so fetching its messages shouldn't
+        # need to hit the database, even though d1's have changed.
+        self.assertFalse(self.store._has_device_inbox_changed(USER_ID, "d2", start))
+        self.assertTrue(self.store._has_device_inbox_changed(USER_ID, "d1", start))
+
+        results = self.get_success(
+            self.store.get_new_messages_for_devices(
+                USER_ID, {"d1": (start, now), "d2": (start, now)}
+            )
+        )
+        self.assertEqual(results, {"d1": ([{"n": 1}], now), "d2": ([], now)})
+
+    def test_wildcard_marks_all_devices(self):
+        start = self.store.get_to_device_stream_token()
+        self._send({"*": {"n": 1}})
+
+        for device_id in ("d1", "d2", "d3"):
+            self.assertTrue(
+                self.store._has_device_inbox_changed(USER_ID, device_id, start)
+            )
+
+    def test_prune_deleted_devices(self):
+        self._send({"d1": {"n": 1}, "d2": {"n": 2}})
+        self.get_success(self.store.delete_device(USER_ID, "d1"))
+
+        self.get_success(self.store._prune_device_inbox())
+
+        rows = self.get_success(
+            self.store.db_pool.simple_select_onecol(
+                "device_inbox", {"user_id": USER_ID}, "device_id"
+            )
+        )
+        self.assertEqual(rows, ["d2"])
+
+    @unittest.override_config({"to_device_inactive_device_max_age": "7d"})
+    def test_prune_inactive_devices(self):
+        self._send({"d1": {"n": 1}, "d2": {"n": 2}})
+
+        now = self.clock.time_msec()
+        self.get_success(
+            self.store.db_pool.simple_update(
+                "devices",
+                {"user_id": USER_ID, "device_id": "d1"},
+                {"last_seen": now - 8 * 24 * 60 * 60 * 1000},
+                desc="test",
+            )
+        )
+        self.get_success(
+            self.store.db_pool.simple_update(
+                "devices",
+                {"user_id": USER_ID, "device_id": "d2"},
+                {"last_seen": now},
+                desc="test",
+            )
+        )
+
+        self.get_success(self.store._prune_device_inbox())
+
+        rows = self.get_success(
+            self.store.db_pool.simple_select_onecol(
+                "device_inbox", {"user_id": USER_ID}, "device_id"
+            )
+        )
+        self.assertEqual(rows, ["d2"])
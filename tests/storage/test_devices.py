@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 from twisted.internet import defer
 
 import synapse.api.errors
+from synapse.storage import prepare_database
 
 import tests.unittest
 import tests.utils
@@ -96,6 +99,49 @@ class DeviceStoreTestCase(tests.unittest.TestCase):
         # Check original device_ids are contained within these updates
         self._check_devices_in_updates(device_ids, device_updates)
 
+    @defer.inlineCallbacks
+    def test_device_updates_shared_between_remotes(self):
+        hosts = ["host%d" % (i,) for i in range(20)]
+
+        for _ in range(3):
+            yield defer.ensureDeferred(
+                self.store.add_device_change_to_streams("user_id", ["device_id"], hosts)
+            )
+
+        # there should only be one change, and the set of hosts should only have
+        # been written once.
+        changes = yield defer.ensureDeferred(
+            self.store.db_pool.simple_select_list(
+                "device_lists_outbound_changes", None, ["stream_id"]
+            )
+        )
+        self.assertEqual(len(changes), 1)
+        host_sets = yield defer.ensureDeferred(
+            self.store.db_pool.simple_select_list(
+                "device_lists_outbound_host_sets", None, ["destination"]
+            )
+        )
+        self.assertCountEqual([r["destination"] for r in host_sets], hosts)
+
+        # marking the update as sent to one host shouldn't affect the others.
+        now_stream_id, device_updates = yield defer.ensureDeferred(
+            self.store.get_device_updates_by_remote("host0", -1, limit=100)
+        )
+        self._check_devices_in_updates(["device_id"], device_updates)
+        yield defer.ensureDeferred(
+            self.store.mark_as_sent_devices_by_remote("host0", now_stream_id)
+        )
+
+        _, device_updates = yield defer.ensureDeferred(
+            self.store.get_device_updates_by_remote("host0", -1, limit=100)
+        )
+        self.assertEqual(device_updates, [])
+
+        _, device_updates = yield defer.ensureDeferred(
+            self.store.get_device_updates_by_remote("host1", -1, limit=100)
+        )
+        self._check_devices_in_updates(["device_id"], device_updates)
+
     def _check_devices_in_updates(self, expected_device_ids, device_updates):
         """Check that an specific device ids exist in a list of device update EDUs"""
         self.assertEqual(len(device_updates), len(expected_device_ids))
@@ -139,3 +185,181 @@ class DeviceStoreTestCase(tests.unittest.TestCase):
                 )
             )
         self.assertEqual(404, cm.exception.code)
+
+
+class DeviceListOutboundPruneTestCase(tests.unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+    def _add_change(self, hosts):
+        self.get_success(
+            self.store.add_device_change_to_streams("@user:test", ["device"], hosts)
+        )
+
+    def _get_pending_stream_ids(self, destination):
+        _, updates = self.get_success(
+            self.store.get_device_updates_by_remote(destination, -1, limit=100)
+        )
+        return [update["stream_id"] for _, update in updates]
+
+    def _prune(self):
+        self.reactor.advance(2 * 24 * 60 * 60)
+        self.get_success(self.store._prune_old_outbound_device_pokes())
+
+    def _select(self, table, retcol):
+        rows = self.get_success(
+            self.store.db_pool.simple_select_list(table, None, [retcol])
+        )
+        return [row[retcol] for row in rows]
+
+    def test_superseded_changes(self):
+        """An old change should only be pruned in favour of a later change to
+        the same device if the later change is for every destination which
+        hasn't received the old one.
+        """
+        self._add_change(["hostA"])
+        self._add_change(["hostB"])
+        self._prune()
+
+        # hostA isn't told about the second change, so still needs the first.
+        self.assertEqual(len(self._get_pending_stream_ids("hostA")), 1)
+        self.assertEqual(len(self._get_pending_stream_ids("hostB")), 1)
+
+        self._add_change(["hostA", "hostB"])
+        self._prune()
+
+        stream_ids = self._select("device_lists_outbound_changes", "stream_id")
+        self.assertEqual(len(stream_ids), 1)
+        self.assertEqual(self._get_pending_stream_ids("hostA"), stream_ids)
+        self.assertEqual(self._get_pending_stream_ids("hostB"), stream_ids)
+
+    def test_prune_host_sets(self):
+        """Sets of destinations should be deleted once they are unused, but
+        not while they have been used recently.
+        """
+        self._add_change(["hostA"])
+        stream_id = self.store.get_device_stream_token()
+        self.get_success(self.store.mark_as_sent_devices_by_remote("hostA", stream_id))
+
+        # The change has been sent, so is pruned, but the set was used recently.
+        self.get_success(self.store._prune_old_outbound_device_pokes())
+        self.assertEqual(self._select("device_lists_outbound_changes", "stream_id"), [])
+        self.assertEqual(
+            self._select("device_lists_outbound_host_sets", "destination"), ["hostA"]
+        )
+
+        self._prune()
+        self.assertEqual(
+            self._select("device_lists_outbound_host_sets", "destination"), []
+        )
+        self.assertEqual(
+            self._select("device_lists_outbound_host_set_usage", "host_set"), []
+        )
+
+        # Using the set again recreates it.
+        self._add_change(["hostA"])
+        self.assertEqual(
+            self._select("device_lists_outbound_host_sets", "destination"), ["hostA"]
+        )
+        self.assertEqual(len(self._get_pending_stream_ids("hostA")), 1)
+
+    def test_migrate_outbound_pokes(self):
+        """Unsent pokes in the old device_lists_outbound_pokes table should be
+        carried over to device_lists_outbound_changes.
+        """
+
+        def _create_pokes_txn(txn):
+            txn.execute(
+                """
+                CREATE TABLE device_lists_outbound_pokes (
+                    destination TEXT NOT NULL,
+                    stream_id BIGINT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    device_id TEXT NOT NULL,
+                    sent BOOLEAN NOT NULL,
+                    ts BIGINT NOT NULL,
+                    opentracing_context TEXT
+                )
+                """
+            )
+
+        self.get_success(
+            self.store.db_pool.runInteraction("create_pokes", _create_pokes_txn)
+        )
+        self.get_success(
+            self.store.db_pool.simple_insert_many(
+                "device_lists_outbound_pokes",
+                [
+                    {
+                        "destination": destination,
+                        "stream_id": 1,
+                        "user_id": "@user:test",
+                        "device_id": "device",
+                        "sent": False,
+                        "ts": 1000,
+                        "opentracing_context": "{}",
+                    }
+                    for destination in ("hostA", "hostB")
+                ],
+                desc="insert_pokes",
+            )
+        )
+
+        def _run_deltas_txn(txn):
+            for name in (
+                "25device_list_outbound_changes.sql",
+                "27device_lists_outbound_host_set_usage.sql",
+            ):
+                prepare_database.executescript(
+                    txn,
+                    os.path.join(
+                        prepare_database.dir_path,
+                        "databases",
+                        "main",
+                        "schema",
+                        "delta",
+                        "58",
+                        name,
+                    ),
+                )
+
+        self.get_success(
+            self.store.db_pool.runInteraction("run_deltas", _run_deltas_txn)
+        )
+
+        changes = self.get_success(
+            self.store.db_pool.simple_select_list(
+                "device_lists_outbound_changes",
+                None,
+                ["stream_id", "user_id", "device_id", "host_set", "ts"],
+            )
+        )
+        self.assertCountEqual(
+            changes,
+            [
+                {
+                    "stream_id": 1,
+                    "user_id": "@user:test",
+                    "device_id": "device",
+                    "host_set": "legacy:" + destination,
+                    "ts": 1000,
+                }
+                for destination in ("hostA", "hostB")
+            ],
+        )
+        self.assertCountEqual(
+            self._select("device_lists_outbound_host_sets", "destination"),
+            ["hostA", "hostB"],
+        )
+        self.assertCountEqual(
+            self._select("device_lists_outbound_host_set_usage", "host_set"),
+            ["legacy:hostA", "legacy:hostB"],
+        )
+
+        # the old table is gone.
+        self.get_failure(
+            self.store.db_pool.simple_select_list(
+                "device_lists_outbound_pokes", None, ["stream_id"]
+            ),
+            Exception,
+        )
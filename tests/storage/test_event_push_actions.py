@@ -13,10 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 from mock import Mock
 
 from twisted.internet import defer
 
+from synapse.storage.database import make_conn
+
 import tests.unittest
 import tests.utils
 
@@ -45,6 +49,14 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
             )
         )
 
+    @defer.inlineCallbacks
+    def test_get_unread_push_actions_for_users_in_range_for_http(self):
+        yield defer.ensureDeferred(
+            self.store.get_unread_push_actions_for_users_in_range_for_http(
+                [USER_ID], 0, 1000
+            )
+        )
+
     @defer.inlineCallbacks
     def test_get_unread_push_actions_for_user_in_range_for_email(self):
         yield defer.ensureDeferred(
@@ -153,6 +165,177 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield _rotate(10)
         yield _assert_counts(1, 1)
 
+    @defer.inlineCallbacks
+    def test_incremental_counts(self):
+        """The counts in event_push_counts should be kept up to date as push
+        actions are added and receipts move, and fixed up by reconciliation.
+        """
+        room_id = "!foo:example.com"
+        user_id = "@user1235:test"
+
+        def _get_counts():
+            return defer.ensureDeferred(
+                self.store.db_pool.simple_select_one(
+                    table="event_push_counts",
+                    keyvalues={"room_id": room_id, "user_id": user_id},
+                    retcols=(
+                        "notif_count",
+                        "highlight_count",
+                        "unread_count",
+                        "stream_ordering",
+                    ),
+                    allow_none=True,
+                )
+            )
+
+        @defer.inlineCallbacks
+        def _inject_actions(stream, action):
+            event = Mock()
+            event.room_id = room_id
+            event.event_id = "$test%i:example.com" % (stream,)
+            event.internal_metadata.stream_ordering = stream
+            event.depth = stream
+
+            yield defer.ensureDeferred(
+                self.store.add_push_actions_to_staging(
+                    event.event_id, {user_id: action}, True,
+                )
+            )
+            yield defer.ensureDeferred(
+                self.store.db_pool.runInteraction(
+                    "",
+                    self.persist_events_store._set_push_actions_for_event_and_users_txn,
+                    [(event, None)],
+                    [(event, None)],
+                )
+            )
+
+        def _mark_read(stream):
+            return defer.ensureDeferred(
+                self.store.db_pool.runInteraction(
+                    "",
+                    self.store._remove_old_push_actions_before_txn,
+                    room_id,
+                    user_id,
+                    stream,
+                )
+            )
+
+        # The first push action creates a row which isn't trusted yet.
+        yield _inject_actions(1, PlAIN_NOTIF)
+        counts = yield _get_counts()
+        self.assertIsNone(counts["stream_ordering"])
+
+        # Moving the read receipt calculates the counts in full.
+        yield _mark_read(1)
+        counts = yield _get_counts()
+        self.assertEqual(
+            counts,
+            {
+                "notif_count": 0,
+                "highlight_count": 0,
+                "unread_count": 0,
+                "stream_ordering": 1,
+            },
+        )
+
+        # New push actions increment the counts.
+        yield _inject_actions(2, PlAIN_NOTIF)
+        yield _inject_actions(3, HIGHLIGHT)
+        counts = yield _get_counts()
+        self.assertEqual(
+            counts,
+            {
+                "notif_count": 2,
+                "highlight_count": 1,
+                "unread_count": 2,
+                "stream_ordering": 1,
+            },
+        )
+
+        yield _mark_read(2)
+        counts = yield _get_counts()
+        self.assertEqual(
+            counts,
+            {
+                "notif_count": 1,
+                "highlight_count": 1,
+                "unread_count": 1,
+                "stream_ordering": 2,
+            },
+        )
+
+        # If the counts drift, the reconciliation job fixes them up.
+        yield defer.ensureDeferred(
+            self.store.db_pool.simple_update_one(
+                table="event_push_counts",
+                keyvalues={"room_id": room_id, "user_id": user_id},
+                updatevalues={"notif_count": 10},
+            )
+        )
+        corrected = yield defer.ensureDeferred(
+            self.store.db_pool.runInteraction("", self.store._reconcile_push_counts_txn)
+        )
+        self.assertEqual(corrected, 1)
+        counts = yield _get_counts()
+        self.assertEqual(counts["notif_count"], 1)
+
+    @defer.inlineCallbacks
+    def test_remote_receipts_not_counted(self):
+        """Read receipts from remote users shouldn't create count rows."""
+        room_id = "!foo:example.com"
+        user_id = "@remote:example.com"
+
+        yield defer.ensureDeferred(
+            self.store.db_pool.runInteraction(
+                "", self.store._remove_old_push_actions_before_txn, room_id, user_id, 1,
+            )
+        )
+        counts = yield defer.ensureDeferred(
+            self.store.db_pool.simple_select_list(
+                table="event_push_counts",
+                keyvalues={"user_id": user_id},
+                retcols=("room_id",),
+            )
+        )
+        self.assertEqual(counts, [])
+
+    @defer.inlineCallbacks
+    def test_calculate_uncalculated_counts(self):
+        """Rows whose counts haven't been calculated should be picked up by the
+        calculation job, and deleted if the user isn't in the room.
+        """
+        room_id = "!foo:example.com"
+        user_id = "@user1235:test"
+
+        yield defer.ensureDeferred(
+            self.store.db_pool.simple_insert(
+                table="event_push_counts",
+                values={
+                    "user_id": user_id,
+                    "room_id": room_id,
+                    "notif_count": 1,
+                    "highlight_count": 0,
+                    "unread_count": 1,
+                    "stream_ordering": None,
+                },
+            )
+        )
+
+        looked_at = yield defer.ensureDeferred(
+            self.store.db_pool.runInteraction("", self.store._calculate_push_counts_txn)
+        )
+        self.assertEqual(looked_at, 1)
+
+        counts = yield defer.ensureDeferred(
+            self.store.db_pool.simple_select_list(
+                table="event_push_counts",
+                keyvalues={"user_id": user_id},
+                retcols=("room_id",),
+            )
+        )
+        self.assertEqual(counts, [])
+
     @defer.inlineCallbacks
     def test_find_first_stream_ordering_after_ts(self):
         def add_event(so, ts):
@@ -239,3 +422,122 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
             self.store.find_first_stream_ordering_after_ts(1)
         )
         self.assertEqual(r, 0)
+
+
+class PushCountsRaceTestCase(tests.unittest.HomeserverTestCase):
+    """Checks that recalculating the unread counts for a read receipt doesn't
+    lose the increments of events persisted at the same time.
+    """
+
+    if not tests.utils.USE_POSTGRES_FOR_TESTS:
+        skip = "Requires Postgres"
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.room_id = "!foo:test"
+        self.user_id = "@user:test"
+
+        self.get_success(
+            self.store.db_pool.simple_insert(
+                table="event_push_counts",
+                values={
+                    "user_id": self.user_id,
+                    "room_id": self.room_id,
+                    "notif_count": 0,
+                    "highlight_count": 0,
+                    "unread_count": 0,
+                    "stream_ordering": 1,
+                },
+            )
+        )
+
+    def _make_conn(self):
+        db_pool = self.store.db_pool
+        conn = make_conn(db_pool._database_config, db_pool.engine, "test")
+        self.addCleanup(conn.close)
+        return conn
+
+    def _persist_event(self, conn):
+        """Add a push action for a new event and increment the counts, as
+        persisting the event would, retrying on serialization failures like
+        `runInteraction`.
+        """
+        engine = self.store.db_pool.engine
+        while True:
+            txn = conn.cursor(after_callbacks=[], exception_callbacks=[])
+            try:
+                self.store.db_pool.simple_insert_txn(
+                    txn,
+                    table="event_push_actions",
+                    values={
+                        "room_id": self.room_id,
+                        "event_id": "$event:test",
+                        "user_id": self.user_id,
+                        "actions": "",
+                        "topological_ordering": 2,
+                        "stream_ordering": 2,
+                        "notif": 1,
+                        "highlight": 0,
+                        "unread": 1,
+                    },
+                )
+                self.store._add_to_push_counts_txn(
+                    txn, self.room_id, 2, [(self.user_id, 1, 0, 1)]
+                )
+                conn.commit()
+                return
+            except engine.module.extensions.TransactionRollbackError:
+                conn.rollback()
+
+    def test_event_during_receipt(self):
+        """An event persisted while a receipt's counts are being calculated
+        should still be counted.
+        """
+        receipt_conn = self._make_conn()
+        event_conn = self._make_conn()
+        event_thread = threading.Thread(target=self._persist_event, args=(event_conn,))
+
+        # Persist the event once the receipt has counted the push actions, but
+        # before it has written the new counts.
+        orig_get_unread_counts_by_pos_txn = self.store._get_unread_counts_by_pos_txn
+
+        def _get_unread_counts_by_pos_txn(*args):
+            counts = orig_get_unread_counts_by_pos_txn(*args)
+            event_thread.start()
+            # The event should wait for the receipt's transaction, as it holds
+            # the lock on the row.
+            event_thread.join(1)
+            self.assertTrue(event_thread.is_alive())
+            return counts
+
+        self.store._get_unread_counts_by_pos_txn = _get_unread_counts_by_pos_txn
+
+        receipt_txn = receipt_conn.cursor(after_callbacks=[], exception_callbacks=[])
+        self.store._remove_old_push_actions_before_txn(
+            receipt_txn, self.room_id, self.user_id, 1
+        )
+        receipt_conn.commit()
+
+        event_thread.join()
+
+        counts = self.get_success(
+            self.store.db_pool.simple_select_one(
+                table="event_push_counts",
+                keyvalues={"room_id": self.room_id, "user_id": self.user_id},
+                retcols=(
+                    "notif_count",
+                    "highlight_count",
+                    "unread_count",
+                    "stream_ordering",
+                ),
+            )
+        )
+        self.assertEqual(
+            counts,
+            {
+                "notif_count": 1,
+                "highlight_count": 0,
+                "unread_count": 1,
+                "stream_ordering": 1,
+            },
+        )
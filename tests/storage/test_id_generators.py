@@ -189,6 +189,34 @@ class MultiWriterIdGeneratorTestCase(HomeserverTestCase):
         self.assertEqual(id_gen.get_positions(), {"master": 11})
         self.assertEqual(id_gen.get_current_token_for_writer("master"), 11)
 
+    def test_out_of_order_finish_mult(self):
+        """Test that batches of IDs persisted out of order are correctly handled
+        """
+
+        # Prefill table with 7 rows written by 'master'
+        self._insert_rows("master", 7)
+
+        id_gen = self._create_id_generator()
+
+        ctx1 = id_gen.get_next_mult(3)
+        ctx2 = id_gen.get_next_mult(2)
+
+        s1 = self.get_success(ctx1.__aenter__())
+        s2 = self.get_success(ctx2.__aenter__())
+
+        self.assertEqual(s1, [8, 9, 10])
+        self.assertEqual(s2, [11, 12])
+
+        self.get_success(ctx2.__aexit__(None, None, None))
+
+        self.assertEqual(id_gen.get_current_token_for_writer("master"), 7)
+        self.assertEqual(id_gen.get_persisted_upto_position(), 7)
+
+        self.get_success(ctx1.__aexit__(None, None, None))
+
+        self.assertEqual(id_gen.get_current_token_for_writer("master"), 12)
+        self.assertEqual(id_gen.get_persisted_upto_position(), 12)
+
     def test_multi_instance(self):
         """Test that reads and writes from multiple processes are handled
         correctly.
@@ -170,6 +170,115 @@ class RoomMemberStoreTestCase(unittest.HomeserverTestCase):
         )
         self.assertEqual(users.keys(), {self.u_alice, self.u_bob})
 
+    def test_get_users_who_share_room_with_user(self):
+        room1 = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        room2 = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        self.inject_room_member(room1, self.u_bob, Membership.JOIN)
+        self.inject_room_member(room2, self.u_charlie.to_string(), Membership.JOIN)
+
+        users = self.get_success(
+            self.store.get_users_who_share_room_with_user(self.u_alice)
+        )
+        self.assertEqual(users, {self.u_alice, self.u_bob, self.u_charlie.to_string()})
+
+        users = self.get_success(
+            self.store.get_users_who_share_room_with_user(self.u_bob)
+        )
+        self.assertEqual(users, {self.u_alice, self.u_bob})
+
+        # Bob leaving the room should invalidate the cached result.
+        self.inject_room_member(room1, self.u_bob, Membership.LEAVE)
+
+        users = self.get_success(
+            self.store.get_users_who_share_room_with_user(self.u_alice)
+        )
+        self.assertEqual(users, {self.u_alice, self.u_charlie.to_string()})
+
+        users = self.get_success(
+            self.store.get_users_who_share_room_with_user(self.u_bob)
+        )
+        self.assertEqual(users, set())
+
+    def test_get_current_hosts_in_room(self):
+        room = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        self.inject_room_member(room, self.u_charlie.to_string(), Membership.JOIN)
+
+        hosts = self.get_success(self.store.get_current_hosts_in_room(room))
+        self.assertEqual(hosts, {"test", "elsewhere"})
+
+        # the cached result should be invalidated when charlie leaves.
+        self.inject_room_member(room, self.u_charlie.to_string(), Membership.LEAVE)
+        hosts = self.get_success(self.store.get_current_hosts_in_room(room))
+        self.assertEqual(hosts, {"test"})
+
+    def test_bulk_lookups(self):
+        room_1 = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        room_2 = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        self.inject_room_member(room_2, self.u_charlie.to_string(), Membership.JOIN)
+
+        rooms = self.get_success(
+            self.store.get_rooms_for_users_with_stream_ordering(
+                [self.u_alice, self.u_bob]
+            )
+        )
+        self.assertEqual({r.room_id for r in rooms[self.u_alice]}, {room_1, room_2})
+        self.assertEqual(rooms[self.u_bob], frozenset())
+
+        hosts = self.get_success(
+            self.store.get_current_hosts_in_rooms([room_1, room_2])
+        )
+        self.assertEqual(hosts, {room_1: {"test"}, room_2: {"test", "elsewhere"}})
+
+        # the results should be invalidated alongside the non-bulk versions
+        self.inject_room_member(room_1, self.u_bob, Membership.JOIN)
+        self.inject_room_member(room_2, self.u_charlie.to_string(), Membership.LEAVE)
+
+        rooms = self.get_success(
+            self.store.get_rooms_for_users_with_stream_ordering([self.u_bob])
+        )
+        self.assertEqual({r.room_id for r in rooms[self.u_bob]}, {room_1})
+
+        hosts = self.get_success(self.store.get_current_hosts_in_rooms([room_2]))
+        self.assertEqual(hosts, {room_2: {"test"}})
+
+    def test_get_joined_hosts_from_delta(self):
+        room = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        state_handler = self.hs.get_state_handler()
+
+        def get_hosts_at(event_id):
+            return self.get_success(
+                state_handler.get_hosts_in_room_at_events(room, [event_id])
+            )
+
+        event = self.get_success(
+            event_injection.inject_member_event(
+                self.hs, room, self.u_bob, Membership.JOIN
+            )
+        )
+        self.assertEqual(get_hosts_at(event.event_id), {"test"})
+
+        # the next membership change should be applied to the cached hosts as a
+        # delta, rather than by recomputing from the full state.
+        cache = self.get_success(self.store._get_joined_hosts_cache(room))
+        cache.store = Mock(wraps=self.store)
+
+        event = self.get_success(
+            event_injection.inject_member_event(
+                self.hs, room, self.u_charlie.to_string(), Membership.JOIN
+            )
+        )
+        self.assertEqual(get_hosts_at(event.event_id), {"test", "elsewhere"})
+
+        event = self.get_success(
+            event_injection.inject_member_event(
+                self.hs, room, self.u_charlie.to_string(), Membership.LEAVE
+            )
+        )
+        self.assertEqual(get_hosts_at(event.event_id), {"test"})
+
+        cache.store.get_events.assert_called()
+        cache.store.get_joined_users_from_state.assert_not_called()
+
 
 class CurrentStateMembershipUpdateTestCase(unittest.HomeserverTestCase):
     def prepare(self, reactor, clock, homeserver):
@@ -12,7 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import json
 import re
+import zlib
+
+from mock import patch
 
 from twisted.internet.defer import Deferred
 from twisted.web.resource import Resource
@@ -175,6 +180,130 @@ class JsonResourceTests(unittest.TestCase):
         self.assertEqual(channel.result["code"], b"200")
         self.assertNotIn("body", channel.result)
 
+    def test_large_response(self):
+        """
+        Once a servlet has returned a large response, its responses should be
+        encoded on the response encoding threadpool until it has returned a few
+        small ones.
+        """
+        large_response = {"data": ["x" * 1000 for _ in range(100)]}
+        small_response = {"data": "x"}
+        response = large_response
+
+        def _callback(request, **kwargs):
+            return 200, response
+
+        res = JsonResource(self.homeserver)
+        res.register_paths(
+            "GET", [re.compile("^/_matrix/foo$")], _callback, "test_servlet"
+        )
+
+        threadpool = self.homeserver.get_response_encoding_threadpool()
+
+        def _request():
+            with patch.object(
+                threadpool,
+                "callInThreadWithCallback",
+                wraps=threadpool.callInThreadWithCallback,
+            ) as call_in_thread:
+                _, channel = make_request(
+                    self.reactor, FakeSite(res), b"GET", b"/_matrix/foo"
+                )
+
+            self.assertEqual(channel.result["code"], b"200")
+            self.assertEqual(channel.json_body, response)
+            return call_in_thread.call_count
+
+        # We don't know the first response will be large until it is encoded.
+        self.assertEqual(_request(), 0)
+        self.assertEqual(_request(), 1)
+
+        # The following small responses are still encoded on a thread, until
+        # the servlet's estimated response size has decayed.
+        response = small_response
+        thread_calls = [_request() for _ in range(10)]
+        self.assertEqual(thread_calls[0], 1)
+        self.assertEqual(thread_calls[-1], 0)
+        self.assertEqual(sorted(thread_calls, reverse=True), thread_calls)
+
+        # Another large response moves it back onto a thread.
+        response = large_response
+        self.assertEqual(_request(), 0)
+        self.assertEqual(_request(), 1)
+
+    def _make_compressing_resource(self, response):
+        def _callback(request, **kwargs):
+            return 200, response
+
+        res = JsonResource(self.homeserver)
+        res.register_paths(
+            "GET", [re.compile("^/_matrix/foo$")], _callback, "test_servlet"
+        )
+        res.enable_compression()
+        return res
+
+    def test_compressed_response(self):
+        """
+        Responses should be compressed with an encoding the requester accepts.
+        """
+        response = {"data": ["x" * 100 for _ in range(100)]}
+        res = self._make_compressing_resource(response)
+
+        _, channel = make_request(
+            self.reactor,
+            FakeSite(res),
+            b"GET",
+            b"/_matrix/foo",
+            custom_headers=[(b"Accept-Encoding", b"deflate;q=0.5, gzip")],
+        )
+
+        self.assertEqual(channel.result["code"], b"200")
+        headers = channel.headers
+        self.assertEqual(headers.getRawHeaders(b"Content-Encoding"), [b"gzip"])
+        self.assertEqual(headers.getRawHeaders(b"Vary"), [b"Accept-Encoding"])
+        self.assertEqual(json.loads(gzip.decompress(channel.result["body"])), response)
+
+        _, channel = make_request(
+            self.reactor,
+            FakeSite(res),
+            b"GET",
+            b"/_matrix/foo",
+            custom_headers=[(b"Accept-Encoding", b"deflate, gzip;q=0")],
+        )
+
+        self.assertEqual(channel.result["code"], b"200")
+        self.assertEqual(
+            channel.headers.getRawHeaders(b"Content-Encoding"), [b"deflate"]
+        )
+        self.assertEqual(json.loads(zlib.decompress(channel.result["body"])), response)
+
+    def test_uncompressed_response(self):
+        """
+        Small responses, and responses to requesters which don't accept a
+        compressed encoding, should not be compressed.
+        """
+        response = {"data": ["x" * 100 for _ in range(100)]}
+        res = self._make_compressing_resource(response)
+
+        _, channel = make_request(self.reactor, FakeSite(res), b"GET", b"/_matrix/foo")
+
+        self.assertEqual(channel.result["code"], b"200")
+        self.assertIsNone(channel.headers.getRawHeaders(b"Content-Encoding"))
+        self.assertEqual(channel.json_body, response)
+
+        res = self._make_compressing_resource({"data": "x"})
+        _, channel = make_request(
+            self.reactor,
+            FakeSite(res),
+            b"GET",
+            b"/_matrix/foo",
+            custom_headers=[(b"Accept-Encoding", b"gzip")],
+        )
+
+        self.assertEqual(channel.result["code"], b"200")
+        self.assertIsNone(channel.headers.getRawHeaders(b"Content-Encoding"))
+        self.assertEqual(channel.json_body, {"data": "x"})
+
 
 class OptionsResourceTests(unittest.TestCase):
     def setUp(self):
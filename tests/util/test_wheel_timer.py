@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from synapse.util.wheel_timer import WheelTimer
+from synapse.util.wheel_timer import KeyedWheelTimer, WheelTimer
 
 from .. import unittest
 
@@ -72,3 +72,32 @@ class WheelTimerTestCase(unittest.TestCase):
         self.assertListEqual(wheel.fetch(147), [obj2])
         self.assertListEqual(wheel.fetch(200), [obj1])
         self.assertListEqual(wheel.fetch(240), [])
+
+    def test_keyed_earliest_wins(self):
+        wheel = KeyedWheelTimer(bucket_size=5)
+
+        wheel.insert(100, "obj1", 150)
+        wheel.insert(100, "obj1", 130)
+        wheel.insert(100, "obj1", 160)
+        wheel.insert(100, "obj2", 140)
+        self.assertEqual(len(wheel), 2)
+
+        self.assertListEqual(wheel.fetch(135), ["obj1"])
+        self.assertListEqual(wheel.fetch(147), ["obj2"])
+
+        # the superseded timers should not fire.
+        self.assertListEqual(wheel.fetch(200), [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_keyed_reinsert(self):
+        wheel = KeyedWheelTimer(bucket_size=5)
+
+        wheel.insert(100, "obj", 150)
+        wheel.insert(100, "obj", 120)
+        self.assertListEqual(wheel.fetch(125), ["obj"])
+
+        # once fired, the object can be scheduled again, and the stale entry
+        # from the first insert doesn't fire it early.
+        wheel.insert(125, "obj", 180)
+        self.assertListEqual(wheel.fetch(160), [])
+        self.assertListEqual(wheel.fetch(190), ["obj"])